@@ -0,0 +1,485 @@
+import unittest
+import os
+import tempfile
+import zipfile
+import io
+import json
+import zlib
+from contextlib import contextmanager
+from pathlib import Path
+from unittest.mock import patch, MagicMock
+from volexport.backup import BackupStore, BackupIndex, backup_volume, restore_volume
+from volexport.backup import _chunk_runs
+from volexport.config import config
+from volexport.exceptions import InvalidArgument
+from volexport.jobs import JobCancelled
+from volexport.lvm2 import LV
+
+
+class TestBackupStore(unittest.TestCase):
+    def setUp(self):
+        self.td = tempfile.TemporaryDirectory()
+        self.store = BackupStore(self.td.name)
+
+    def tearDown(self):
+        self.td.cleanup()
+
+    def _blobs(self) -> set[str]:
+        return {x.name for x in (Path(self.td.name) / "blobs").glob("*/*")}
+
+    def test_dedup(self):
+        self.store.create("bk1", dict(export=b"exp1", volume=b"vol1"))
+        self.store.create("bk2", dict(export=b"exp1", volume=b"vol2"))
+        self.assertEqual(3, len(self._blobs()))
+        self.assertEqual(b"exp1", self.store.read("bk2", "export"))
+        self.assertEqual(b"vol1", self.store.read("bk1", "volume"))
+        self.assertEqual(b"vol2", self.store.read("bk2", "volume"))
+        with self.assertRaises(FileExistsError):
+            self.store.create("bk1", dict(export=b"exp3", volume=b"vol3"))
+
+    def test_delete_gc(self):
+        self.store.create("bk1", dict(export=b"exp1", volume=b"vol1"))
+        self.store.create("bk2", dict(export=b"exp1", volume=b"vol2"))
+        self.store.delete("bk1")
+        self.assertEqual(2, len(self._blobs()))
+        self.assertEqual(b"exp1", self.store.read("bk2", "export"))
+        self.store.delete("bk2")
+        self.assertEqual(set(), self._blobs())
+        with self.assertRaises(FileNotFoundError):
+            self.store.delete("bk2")
+
+    def test_gc_unreadable_manifest(self):
+        self.store.create("bk1", dict(export=b"exp1", volume=b"vol1"))
+        self.store.create("bk2", dict(export=b"exp2", volume=b"vol2"))
+        blobs = self._blobs()
+        self.store.path("bk1").write_text('{"version": 1, "members": ')
+        with self.assertRaises(InvalidArgument) as cm:
+            self.store.gc()
+        self.assertIn("bk1.backup", str(cm.exception))
+        # deleting other backup keeps all blobs
+        self.store.delete("bk2")
+        self.assertFalse(self.store.exists("bk2"))
+        self.assertEqual(blobs, self._blobs())
+
+    def test_legacy_zip(self):
+        buf = io.BytesIO()
+        with zipfile.ZipFile(buf, "w") as zf:
+            zf.writestr("export", b"exp1")
+            zf.writestr("volume", b"vol1")
+        self.store.path("legacy").write_bytes(buf.getvalue())
+        self.store.create("bk1", dict(export=b"exp2", volume=b"vol2"))
+        self.assertIsNone(self.store.manifest("legacy"))
+        self.assertEqual(b"exp1", self.store.read("legacy", "export"))
+        out = io.BytesIO()
+        self.store.write_zip("legacy", out)
+        self.assertEqual(buf.getvalue(), out.getvalue())
+        self.assertEqual(0, self.store.gc())
+        self.assertEqual(["bk1.backup", "legacy.backup"], sorted(x.name for x in self.store.list()))
+
+    def test_write_zip(self):
+        self.store.create("bk1", dict(export=b"exp1", volume=b"vol1"))
+        out = io.BytesIO()
+        self.store.write_zip("bk1", out)
+        with zipfile.ZipFile(out) as zf:
+            self.assertEqual({"export": b"exp1", "volume": b"vol1"}, {x: zf.read(x) for x in zf.namelist()})
+
+    def test_corrupted(self):
+        self.store.create("bk1", dict(export=b"exp1", volume=b"vol1"))
+        digest = self.store.manifest("bk1")["members"]["export"]
+        path = Path(self.td.name) / "blobs" / digest[:2] / digest
+        path.write_bytes(zlib.compress(b"broken"))
+        with self.assertRaises(InvalidArgument):
+            self.store.read("bk1", "export")
+        with self.assertRaises(FileNotFoundError):
+            self.store.read("bk1", "notfound")
+        self.store.path("bk2").write_text("not a manifest")
+        with self.assertRaises(InvalidArgument):
+            self.store.read("bk2", "export")
+        with self.assertRaises(InvalidArgument):
+            self.store.get_blob("../../etc/passwd")
+
+
+class FakeLVM:
+    """runcmd of lvm2 module with thin snapshots, an active volume reads the device file"""
+
+    def __init__(self, dev: Path, size: int):
+        self.dev = dev
+        self.calls: list[list[str]] = []
+        self.next_id = 1
+        self.lvs = {"lv1": self._lv("lv1", "volname.vol1", size)}
+
+    def _lv(self, name: str, tag: str, size: int) -> dict:
+        ent = dict(
+            lv_name=name,
+            lv_full_name=f"vg0/{name}",
+            lv_uuid=f"uuid-{name}",
+            lv_tags=tag,
+            lv_path=f"/dev/vg0/{name}",
+            lv_time="2025-08-10 16:48:15 +0900",
+            lv_size=str(size),
+            lv_permissions="writeable",
+            lv_device_open="",
+            origin="" if name == "lv1" else "lv1",
+            pool_lv="pool0",
+            thin_id=str(self.next_id),
+            # thin snapshot has activation skip flag
+            lv_active="active" if name == "lv1" else "",
+        )
+        self.next_id += 1
+        return ent
+
+    def __call__(self, cmd: list[str], root: bool = True):
+        self.calls.append(cmd)
+        if cmd[0] == "lvs":
+            tag = cmd[cmd.index("-S") + 1].removeprefix("tags=")
+            ents = [x for x in self.lvs.values() if tag in x["lv_tags"].split(",")]
+            if "thin_id" in cmd:
+                ents = [dict(thin_id=x["thin_id"]) for x in ents]
+            return MagicMock(stdout=json.dumps({"report": [{"lv": ents}]}))
+        if cmd[0] == "lvcreate":
+            name = cmd[cmd.index("--name") + 1]
+            origin = self.lvs[cmd[-1].split("/")[1]]
+            self.lvs[name] = self._lv(name, cmd[cmd.index("--addtag") + 1], int(origin["lv_size"]))
+        elif cmd[0] == "lvchange" and "--activate" in cmd:
+            ent = self.lvs[cmd[-1].split("/")[1]]
+            if "--ignoreactivationskip" in cmd or ent["lv_active"]:
+                ent["lv_active"] = "active"
+        elif cmd[0] == "lvremove":
+            del self.lvs[cmd[1].split("/")[1]]
+        return MagicMock(stdout="")
+
+    def vol2path(self, lv: LV) -> str:
+        info = lv.get()
+        assert info is not None
+        return str(self.dev) if info["lv_active"] else f"/dev/{info['lv_full_name']}"
+
+
+class TestVolumeBackup(unittest.TestCase):
+    chunk = 4096
+
+    def setUp(self):
+        self.td = tempfile.TemporaryDirectory()
+        self.store = BackupStore(self.td.name, suffix=".data")
+        self.orig = (config.BECOME_METHOD, config.BACKUP_CHUNK_SIZE, config.BACKUP_WORKERS, config.LVM_THINPOOL)
+        config.BECOME_METHOD = "none"
+        config.BACKUP_CHUNK_SIZE = self.chunk
+        config.BACKUP_WORKERS = 0
+        self.dev = Path(self.td.name) / "dev"
+        self.data = os.urandom(self.chunk) + bytes(self.chunk) + os.urandom(self.chunk) + os.urandom(512)
+        self.dev.write_bytes(self.data)
+        self.info = dict(lv_name="lv1", lv_size=str(len(self.data)), pool_lv="pool0")
+
+    def tearDown(self):
+        config.BECOME_METHOD, config.BACKUP_CHUNK_SIZE, config.BACKUP_WORKERS, config.LVM_THINPOOL = self.orig
+        self.td.cleanup()
+
+    def _backup(self, extents=None):
+        if extents is None:
+            extents = [(0, len(self.data))]
+        with (
+            patch.object(LV, "get", return_value=self.info),
+            patch.object(LV, "create_thinsnap") as snap,
+            patch.object(LV, "thin_id", return_value=5),
+            patch.object(LV, "volume_vol2path", return_value=str(self.dev)),
+            patch.object(LV, "delete") as delete,
+            patch("volexport.backup.thin_allocated", return_value=iter(extents)) as allocated,
+        ):
+            res = backup_volume(self.store, "vg0", "vol1", "bk1")
+        snap.assert_called_once_with(parent="lv1")
+        allocated.assert_called_once_with("vg0", "pool0", 5)
+        delete.assert_called_once_with()
+        return res
+
+    def test_backup_restore(self):
+        res = self._backup()
+        self.assertEqual(4, res["chunks"])
+        self.assertEqual(1, res["zero_chunks"])
+        self.assertEqual(len(self.data), res["size"])
+        manifest = self.store.manifest("bk1")
+        self.assertIsNone(manifest["chunks"][1])
+        self.assertEqual(3, len({x.name for x in (Path(self.td.name) / "blobs").glob("*/*")}))
+
+        # restore to thin volume: zero chunk is skipped
+        config.LVM_THINPOOL = "pool0"
+        out = Path(self.td.name) / "out"
+        out.write_bytes(bytes(len(self.data)))
+        with (
+            patch.object(LV, "get", return_value=None),
+            patch.object(LV, "create_thin") as create,
+            patch.object(LV, "volume_vol2path", return_value=str(out)),
+        ):
+            res = restore_volume(self.store, "vg0", "bk1", "vol2")
+        create.assert_called_once_with(size=len(self.data), thinpool="pool0")
+        self.assertEqual(self.data, out.read_bytes())
+
+    def test_backup_allocated(self):
+        # chunk 2 is not allocated: not read even if the device has garbage there
+        res = self._backup([(0, 2 * self.chunk), (3 * self.chunk, 512)])
+        self.assertEqual(4, res["chunks"])
+        self.assertEqual(2, res["zero_chunks"])
+        self.assertEqual(3, res["changed_chunks"])
+        chunks = self.store.manifest("bk1")["chunks"]
+        self.assertIsNone(chunks[2])
+        self.assertEqual(self.store.get_blob(chunks[3]), self.data[3 * self.chunk :])
+
+    def test_backup_empty(self):
+        res = self._backup([])
+        self.assertEqual(4, res["zero_chunks"])
+        self.assertEqual(0, res["changed_chunks"])
+
+    def test_backup_lvm(self):
+        lvm = FakeLVM(self.dev, len(self.data))
+        dmcalls = []
+        thin_cmds = []
+
+        @contextmanager
+        def thin_dump(cmd, stdout, **kwargs):
+            thin_cmds.append(cmd)
+            # 4096 bytes block, chunk 2 is not allocated
+            os.write(
+                stdout,
+                b'<superblock uuid="" time="1" transaction="2" data_block_size="8" nr_data_blocks="0">'
+                b'<device dev_id="2" mapped_blocks="3" transaction="1" creation_time="0" snap_time="1">'
+                b'<range_mapping origin_begin="0" data_begin="10" length="2" time="0"/>'
+                b'<single_mapping origin_block="3" data_block="20" time="0"/>'
+                b"</device></superblock>",
+            )
+            yield MagicMock()
+
+        with (
+            patch("volexport.lvm2.runcmd", lvm),
+            patch("volexport.thin.runcmd", dmcalls.append),
+            patch("volexport.thin.popencmd", thin_dump),
+            patch.object(LV, "volume_vol2path", autospec=True, side_effect=lvm.vol2path),
+        ):
+            res = backup_volume(self.store, "vg0", "vol1", "bk1")
+        self.assertEqual(4, res["chunks"])
+        # chunk 1 is zero, chunk 2 is not allocated
+        self.assertEqual(2, res["zero_chunks"])
+        self.assertEqual(3, res["changed_chunks"])
+        self.assertEqual([["thin_dump", "--metadata-snap", "--dev-id", "2", "/dev/mapper/vg0-pool0_tmeta"]], thin_cmds)
+        self.assertEqual(["reserve_metadata_snap", "release_metadata_snap"], [x[-1] for x in dmcalls])
+        snaps = [x for x in lvm.calls if x[0] == "lvcreate"]
+        self.assertEqual(1, len(snaps))
+        lvname = snaps[0][snaps[0].index("--name") + 1]
+        # activated by the LV name, not the volume name
+        self.assertIn(["lvchange", "--activate", "y", "--ignoreactivationskip", f"vg0/{lvname}"], lvm.calls)
+        self.assertIn(["lvremove", f"vg0/{lvname}", "--yes"], lvm.calls)
+        self.assertEqual(["lv1"], list(lvm.lvs))
+
+    def test_restore_thick(self):
+        self._backup()
+        out = Path(self.td.name) / "out"
+        out.write_bytes(b"\xff" * len(self.data))
+        with (
+            patch.object(LV, "get", return_value=None),
+            patch.object(LV, "create") as create,
+            patch.object(LV, "volume_vol2path", return_value=str(out)),
+        ):
+            restore_volume(self.store, "vg0", "bk1", "vol2")
+        create.assert_called_once_with(size=len(self.data))
+        # garbage in zero chunk is overwritten
+        self.assertEqual(self.data, out.read_bytes())
+
+    def test_restore_exists(self):
+        self._backup()
+        with patch.object(LV, "get", return_value=self.info):
+            with self.assertRaises(FileExistsError):
+                restore_volume(self.store, "vg0", "bk1", "vol1")
+
+    def test_process_pool(self):
+        config.BACKUP_WORKERS = 1
+        res = self._backup()
+        self.assertEqual(4, res["chunks"])
+        self.assertEqual(self.store.get_blob(self.store.manifest("bk1")["chunks"][0]), self.data[: self.chunk])
+
+    @patch("volexport.backup.progress")
+    def test_cancel(self, progress):
+        progress.side_effect = [None, JobCancelled("cancel")]
+        with self.assertRaises(JobCancelled):
+            self._backup()
+        self.assertFalse(self.store.exists("bk1"))
+        self.assertEqual(0, self.store.gc())
+
+    def test_chunk_runs(self):
+        self.assertEqual([(2, 2)], _chunk_runs([(8192, 4096), (12288, 4096)], 4096, 4))
+        # small extents in the same chunk, extent beyond the end
+        self.assertEqual([(0, 1), (3, 1)], _chunk_runs([(512, 512), (2560, 512), (12288, 51200), (512000, 1)], 4096, 4))
+        # large extent covers multiple chunks
+        self.assertEqual([(2, 2), (6, 2)], _chunk_runs([(8192, 8192), (24576, 8192)], 4096, 8))
+
+    def _incremental(self, name: str, thin_ids: list[int]):
+        with (
+            patch.object(LV, "get", return_value=self.info),
+            patch.object(LV, "create_thinsnap"),
+            patch.object(LV, "thin_id", side_effect=thin_ids),
+            patch.object(LV, "volume_vol2path", return_value=str(self.dev)),
+            patch.object(LV, "delete") as delete,
+            patch("volexport.backup.thin_delta", return_value=iter([(8192, 8192)])) as delta,
+            patch("volexport.backup.thin_allocated", return_value=iter([(0, int(self.info["lv_size"]))])),
+        ):
+            res = backup_volume(self.store, "vg0", "vol1", name, incremental=True)
+        return res, delete, delta
+
+    def test_incremental(self):
+        res, delete, delta = self._incremental("bk1", [1])
+        # first one is full, snapshot is kept
+        self.assertIsNone(res["parent"])
+        self.assertEqual(4, res["changed_chunks"])
+        delete.assert_not_called()
+        delta.assert_not_called()
+        first = self.store.manifest("bk1")
+        self.assertEqual(1, first["thin_id"])
+        self.assertTrue(first["snapshot"].startswith("backup-"))
+
+        # chunk 0 is not in the delta: not read again
+        newdata = os.urandom(self.chunk) + self.data[self.chunk : 2 * self.chunk] + os.urandom(self.chunk + 512)
+        self.dev.write_bytes(newdata)
+        res, delete, delta = self._incremental("bk2", [2])
+        self.assertEqual("bk1", res["parent"])
+        self.assertEqual(2, res["changed_chunks"])
+        delta.assert_called_once_with("vg0", "pool0", 1, 2)
+        # previous snapshot is removed
+        delete.assert_called_once_with()
+        second = self.store.manifest("bk2")
+        self.assertEqual(first["chunks"][:2], second["chunks"][:2])
+        self.assertEqual(self.store.get_blob(second["chunks"][2]), newdata[2 * self.chunk : 3 * self.chunk])
+
+        # restore does not depend on the base
+        self.store.delete("bk1")
+        out = Path(self.td.name) / "out"
+        out.write_bytes(bytes(len(self.data)))
+        with (
+            patch.object(LV, "get", return_value=None),
+            patch.object(LV, "create"),
+            patch.object(LV, "volume_vol2path", return_value=str(out)),
+        ):
+            restore_volume(self.store, "vg0", "bk2", "vol2")
+        self.assertEqual(self.data[: 2 * self.chunk] + newdata[2 * self.chunk :], out.read_bytes())
+
+    def test_incremental_lvm(self):
+        lvm = FakeLVM(self.dev, len(self.data))
+        dmcalls = []
+        thin_cmds = []
+
+        @contextmanager
+        def thin_tools(cmd, stdout, **kwargs):
+            thin_cmds.append(cmd)
+            if cmd[0] == "thin_dump":
+                # fully allocated
+                os.write(
+                    stdout,
+                    b'<superblock uuid="" time="1" transaction="2" data_block_size="8" nr_data_blocks="0">'
+                    b'<device dev_id="2" mapped_blocks="4" transaction="1" creation_time="0" snap_time="1">'
+                    b'<range_mapping origin_begin="0" data_begin="10" length="4" time="0"/>'
+                    b"</device></superblock>",
+                )
+            else:
+                # 4096 bytes block, chunk 2 changed
+                os.write(
+                    stdout,
+                    b'<superblock uuid="" time="1" transaction="2" data_block_size="8" nr_data_blocks="0">'
+                    b'<diff left="2" right="3"><same begin="0" length="2"/><different begin="2" length="1"/>'
+                    b"</diff></superblock>",
+                )
+            yield MagicMock()
+
+        with (
+            patch("volexport.lvm2.runcmd", lvm),
+            patch("volexport.thin.runcmd", dmcalls.append),
+            patch("volexport.thin.popencmd", thin_tools),
+            patch.object(LV, "volume_vol2path", autospec=True, side_effect=lvm.vol2path),
+        ):
+            backup_volume(self.store, "vg0", "vol1", "bk1", incremental=True)
+            first = self.store.manifest("bk1")
+            newdata = self.data[: 2 * self.chunk] + os.urandom(self.chunk) + self.data[3 * self.chunk :]
+            self.dev.write_bytes(newdata)
+            res = backup_volume(self.store, "vg0", "vol1", "bk2", incremental=True)
+        # thin ids of the active snapshots
+        self.assertEqual(2, first["thin_id"])
+        self.assertEqual(
+            [
+                ["thin_dump", "--metadata-snap", "--dev-id", "2", "/dev/mapper/vg0-pool0_tmeta"],
+                ["thin_delta", "--metadata-snap", "--snap1", "2", "--snap2", "3", "/dev/mapper/vg0-pool0_tmeta"],
+            ],
+            thin_cmds,
+        )
+        self.assertEqual(["reserve_metadata_snap", "release_metadata_snap"] * 2, [x[-1] for x in dmcalls])
+        self.assertEqual("bk1", res["parent"])
+        self.assertEqual(1, res["changed_chunks"])
+        second = self.store.manifest("bk2")
+        self.assertEqual(self.store.get_blob(second["chunks"][2]), newdata[2 * self.chunk : 3 * self.chunk])
+        # both snapshots are activated, the previous one is removed
+        activated = [x[-1] for x in lvm.calls if x[0] == "lvchange"]
+        self.assertEqual(2, len(activated))
+        self.assertIn(["lvremove", activated[0], "--yes"], lvm.calls)
+        self.assertEqual(["lv1", activated[1].split("/")[1]], list(lvm.lvs))
+
+    def test_incremental_resized(self):
+        self._incremental("bk1", [1])
+        self.info = dict(self.info, lv_size=str(len(self.data) + self.chunk))
+        self.dev.write_bytes(self.data + bytes(self.chunk))
+        res, delete, delta = self._incremental("bk2", [2])
+        self.assertIsNone(res["parent"])
+        self.assertEqual(5, res["changed_chunks"])
+        delta.assert_not_called()
+
+    def test_incremental_thick(self):
+        with patch.object(LV, "get", return_value=dict(self.info, pool_lv="")):
+            with self.assertRaises(InvalidArgument):
+                backup_volume(self.store, "vg0", "vol1", "bk1", incremental=True)
+
+
+class TestBackupIndex(unittest.TestCase):
+    def setUp(self):
+        self.td = tempfile.TemporaryDirectory()
+        self.store = BackupStore(self.td.name)
+        self.summarize = MagicMock(side_effect=lambda name: dict(name=name))
+        self.index = BackupIndex(self.store, self.summarize, key="vg0")
+
+    def tearDown(self):
+        self.td.cleanup()
+
+    def test_load(self):
+        for i in range(1000):
+            self.store.create(f"bk{i:04d}", dict(export=b"exp", volume=b"vol"))
+        self.assertEqual(1000, len(self.index.load()))
+        self.assertEqual(1000, self.summarize.call_count)
+        # valid index: no glob, no summarize
+        with patch.object(BackupStore, "list", side_effect=AssertionError("glob")):
+            self.assertEqual(dict(name="bk0001"), self.index.get("bk0001"))
+        self.assertEqual(1000, self.summarize.call_count)
+
+    def test_incremental(self):
+        self.store.create("bk1", dict(export=b"exp", volume=b"vol"))
+        self.assertEqual(["bk1"], list(self.index.load()))
+        self.store.create("bk2", dict(export=b"exp", volume=b"vol"))
+        self.store.delete("bk1")
+        self.assertEqual(["bk2"], list(self.index.load()))
+        self.assertEqual(2, self.summarize.call_count)
+        with self.assertRaises(FileNotFoundError):
+            self.index.get("bk1")
+
+    def test_update(self):
+        self.store.create("bk1", dict(export=b"exp", volume=b"vol"))
+        self.index.load()
+        self.index.update("bk1")
+        self.assertEqual(2, self.summarize.call_count)
+        self.store.delete("bk1")
+        self.index.update("bk1")
+        self.assertEqual({}, self.index.load())
+
+    def test_invalid(self):
+        self.store.create("bk1", dict(export=b"exp", volume=b"vol"))
+        self.index.load()
+        self.index.path.write_text("broken")
+        self.assertEqual(["bk1"], list(self.index.load()))
+        self.assertEqual(2, self.summarize.call_count)
+        # other VG
+        self.assertEqual(["bk1"], list(BackupIndex(self.store, self.summarize, key="vg1").load()))
+        self.assertEqual(3, self.summarize.call_count)
+
+    def test_error(self):
+        self.summarize.side_effect = ValueError("broken")
+        self.store.create("bk1", dict(export=b"exp", volume=b"vol"))
+        self.assertEqual(dict(error="ValueError: broken"), self.index.get("bk1"))
@@ -1,8 +1,12 @@
 import unittest
 import json
 import tempfile
+import time
+import http.server
+import socketserver
+import threading
 import requests
-from unittest.mock import patch, ANY
+from unittest.mock import patch, ANY, MagicMock
 from click.testing import CliRunner
 from volexport.client import cli
 
@@ -131,7 +135,10 @@ class TestClientCLI(unittest.TestCase):
         self.assertEqual(0, res.exit_code)
         self.assertEqual(output, json.loads(res.stdout))
         req.assert_called_once_with(
-            "POST", "http://dummy.local/volume", data=None, json={"name": "vol123", "size": 1024 * 1024 * 1024}
+            "POST",
+            "http://dummy.local/volume",
+            data=None,
+            json={"name": "vol123", "size": 1024 * 1024 * 1024, "filesystem": None, "from_template": False},
         )
 
     @patch.object(requests.Session, "request")
@@ -146,6 +153,22 @@ class TestClientCLI(unittest.TestCase):
         self.assertEqual(output, json.loads(res.stdout))
         req.assert_called_once_with("DELETE", "http://dummy.local/volume/vol123")
 
+    @patch.object(requests.Session, "request")
+    def test_volume_clone(self, req):
+        output = {"name": "vol234", "size": 1073741824}
+        req.return_value.status_code = 200
+        req.return_value.json.return_value = output
+        res = CliRunner().invoke(
+            cli, ["volume-clone", "--name", "vol234", "--source", "vol123", "--size", "1G"], env=self.envs
+        )
+        if res.exception:
+            raise res.exception
+        self.assertEqual(0, res.exit_code)
+        self.assertEqual(output, json.loads(res.stdout))
+        req.assert_called_once_with(
+            "POST", "http://dummy.local/volume/vol123/clone", json={"name": "vol234", "size": 1073741824}, data=None
+        )
+
     @patch.object(requests.Session, "request")
     def test_volume_stats(self, req):
         output = {"abc": 123}
@@ -196,6 +219,51 @@ class TestClientCLI(unittest.TestCase):
             "POST", "http://dummy.local/volume/vol123/mkfs", json={"filesystem": "xfs", "label": None}, data=None
         )
 
+    @patch.object(requests.Session, "request")
+    def test_request_deadline(self, req):
+        from volexport.client import VERequest, request_deadline
+
+        req.return_value.status_code = 200
+        req.return_value.json.return_value = []
+        token = request_deadline.set(time.monotonic() + 5.0)
+        try:
+            VERequest("http://dummy.local").get("/volume")
+        finally:
+            request_deadline.reset(token)
+        req.assert_called_once_with("GET", "http://dummy.local/volume", allow_redirects=True, headers=ANY, timeout=ANY)
+        self.assertLessEqual(float(req.call_args.kwargs["headers"]["X-Volexp-Timeout"]), 5.0)
+        self.assertLessEqual(req.call_args.kwargs["timeout"], 5.0)
+
+    @patch.object(requests.Session, "request")
+    def test_volume_mkfs_async(self, req):
+        output = {"id": "job123"}
+        req.return_value.status_code = 202
+        req.return_value.json.return_value = output
+        res = CliRunner().invoke(cli, ["volume-mkfs", "--name", "vol123", "--async"], env=self.envs)
+        if res.exception:
+            raise res.exception
+        self.assertEqual(0, res.exit_code)
+        self.assertEqual(output, json.loads(res.stdout))
+        req.assert_called_once_with(
+            "POST",
+            "http://dummy.local/volume/vol123/mkfs",
+            json={"filesystem": "ext4", "label": None},
+            params={"async": "1"},
+            data=None,
+        )
+
+    @patch.object(requests.Session, "request")
+    def test_job_read(self, req):
+        output = {"id": "job123", "status": "running"}
+        req.return_value.status_code = 200
+        req.return_value.json.return_value = output
+        res = CliRunner().invoke(cli, ["job-read", "--id", "job123"], env=self.envs)
+        if res.exception:
+            raise res.exception
+        self.assertEqual(0, res.exit_code)
+        self.assertEqual(output, json.loads(res.stdout))
+        req.assert_called_once_with("GET", "http://dummy.local/jobs/job123", allow_redirects=True)
+
     @patch.object(requests.Session, "request")
     def test_export_list(self, req):
         output = [{"abc": 123}]
@@ -319,6 +387,19 @@ class TestClientCLI(unittest.TestCase):
             allow_redirects=True,
         )
 
+    @patch.object(requests.Session, "request")
+    def test_snapshot_list_all(self, req):
+        page1 = MagicMock(status_code=200)
+        page1.json.return_value = dict(entries=[{"name": "snap1"}], next="snap1")
+        page2 = MagicMock(status_code=200)
+        page2.json.return_value = dict(entries=[{"name": "snap2"}], next=None)
+        req.side_effect = [page1, page2]
+        res = CliRunner().invoke(cli, ["snapshot-list"], env=self.envs)
+        if res.exception:
+            raise res.exception
+        self.assertEqual([{"name": "snap1"}, {"name": "snap2"}], json.loads(res.stdout))
+        req.assert_called_with("GET", "http://dummy.local/snapshot", params={"after": "snap1"}, allow_redirects=True)
+
     @patch.object(requests.Session, "request")
     def test_snapshot_get(self, req):
         output = {"abc": 123}
@@ -402,6 +483,8 @@ class TestClientCLI(unittest.TestCase):
         output = {"abc": 123}
         req.return_value.status_code = 200
         req.return_value.json.return_value = output
+        sent = []
+        req.side_effect = lambda method, url, data: sent.append(data.read()) or req.return_value
         with tempfile.NamedTemporaryFile("r+") as tf:
             tf.write("hello\n")
             tf.flush()
@@ -410,7 +493,40 @@ class TestClientCLI(unittest.TestCase):
             raise res.exception
         self.assertEqual(0, res.exit_code)
         self.assertEqual(output, json.loads(res.stdout))
-        req.assert_called_once_with("PUT", "http://dummy.local/mgmt/backup/backup123", data="hello\n")
+        req.assert_called_once_with("PUT", "http://dummy.local/mgmt/backup/backup123", data=ANY)
+        self.assertEqual([b"hello\n"], sent)
+
+    @patch.object(requests.Session, "request")
+    def test_volume_backup_create(self, req):
+        output = {"id": "job123", "status": "queued"}
+        req.return_value.status_code = 202
+        req.return_value.json.return_value = output
+        res = CliRunner().invoke(
+            cli, ["volume-backup-create", "--volume", "vol1", "--snapshot-size", "1G"], env=self.envs
+        )
+        if res.exception:
+            raise res.exception
+        self.assertEqual(0, res.exit_code)
+        self.assertEqual(output, json.loads(res.stdout))
+        req.assert_called_once_with(
+            "POST",
+            "http://dummy.local/mgmt/volume-backup",
+            data=None,
+            json=dict(volume="vol1", name=None, snapshot_size=1024**3, incremental=False),
+        )
+
+    @patch.object(requests.Session, "request")
+    def test_volume_backup_restore(self, req):
+        output = {"id": "job123", "status": "queued"}
+        req.return_value.status_code = 202
+        req.return_value.json.return_value = output
+        res = CliRunner().invoke(cli, ["volume-backup-restore", "--name", "bk1", "--volume", "vol2"], env=self.envs)
+        if res.exception:
+            raise res.exception
+        self.assertEqual(0, res.exit_code)
+        req.assert_called_once_with(
+            "POST", "http://dummy.local/mgmt/volume-backup/bk1/restore", data=None, json=dict(volume="vol2")
+        )
 
     @patch.object(requests.Session, "request")
     def test_backup_forget(self, req):
@@ -424,6 +540,15 @@ class TestClientCLI(unittest.TestCase):
         self.assertEqual(output, json.loads(res.stdout))
         req.assert_called_once_with("DELETE", "http://dummy.local/mgmt/backup", params=dict(keep=10))
 
+    @patch.object(requests.Session, "request")
+    def test_backup_forget_max_age(self, req):
+        req.return_value.status_code = 200
+        req.return_value.json.return_value = {}
+        res = CliRunner().invoke(cli, ["backup-forget", "--max-age", "86400"], env=self.envs)
+        if res.exception:
+            raise res.exception
+        req.assert_called_once_with("DELETE", "http://dummy.local/mgmt/backup", params=dict(keep=2, max_age=86400.0))
+
     @patch.object(requests.Session, "request")
     def test_backup_delete(self, req):
         output = {"abc": 123}
@@ -512,3 +637,164 @@ class TestClientCLI(unittest.TestCase):
             ["sudo", "iscsiadm", "-m", "node", "-T", "iqn.abc:def", "-l"],
             **basearg,
         )
+
+
+class _Echo(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        body = json.dumps(dict(path=self.path, host=self.headers.get("host"))).encode()
+        self.send_response(200)
+        self.send_header("content-type", "application/json")
+        self.send_header("content-length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        return "unix"
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class TestVERequest(unittest.TestCase):
+    @patch.object(requests.Session, "request")
+    def test_timeout(self, req):
+        from volexport.client import VERequest, request_deadline
+
+        req.return_value.status_code = 200
+        req.return_value.json.return_value = []
+        VERequest("http://dummy.local", timeout=(1.0, 2.0)).get("/volume")
+        req.assert_called_once_with("GET", "http://dummy.local/volume", allow_redirects=True, timeout=(1.0, 2.0))
+        # deadline is shorter
+        req.reset_mock()
+        token = request_deadline.set(time.monotonic() + 0.5)
+        try:
+            VERequest("http://dummy.local", timeout=(1.0, 2.0)).get("/volume")
+        finally:
+            request_deadline.reset(token)
+        self.assertLessEqual(req.call_args.kwargs["timeout"], 0.5)
+
+    def test_pool(self):
+        from volexport.client import VERequest, DEFAULT_POOL_SIZE
+
+        adapter = VERequest("http://dummy.local").get_adapter("http://dummy.local/volume")
+        self.assertEqual(DEFAULT_POOL_SIZE, adapter._pool_maxsize)
+        adapter = VERequest("http://dummy.local", pool_size=100).get_adapter("http://dummy.local/volume")
+        self.assertEqual(100, adapter._pool_maxsize)
+        self.assertTrue(adapter._pool_block)
+
+    def test_unix(self):
+        from volexport.client import VERequest
+
+        with tempfile.TemporaryDirectory() as td:
+            sock = f"{td}/api.sock"
+            server = _UnixServer(sock, _Echo)
+            thread = threading.Thread(target=server.serve_forever, daemon=True)
+            thread.start()
+            try:
+                req = VERequest(f"unix://{sock}", pool_size=2, timeout=(1.0, 5.0))
+                for _ in range(3):
+                    res = req.get("/volume/vol1", params=dict(x="1"))
+                    res.raise_for_status()
+                    self.assertEqual(dict(path="/volume/vol1?x=1", host="localhost"), res.json())
+                # keep-alive
+                pool = req.get_adapter(req.baseurl)._unix_pools[sock]
+                self.assertEqual(1, pool.num_connections)
+                req.close()
+            finally:
+                server.shutdown()
+                server.server_close()
+
+
+class TestAsyncVERequest(unittest.IsolatedAsyncioTestCase):
+    def _mock(self, req, handler):
+        import httpx
+
+        req.client = httpx.AsyncClient(
+            base_url=req.baseurl, timeout=req.client.timeout, transport=httpx.MockTransport(handler)
+        )
+
+    async def test_timeout(self):
+        import httpx
+        from volexport.client import AsyncVERequest, request_deadline, DEADLINE_HEADER
+
+        seen = []
+
+        def handler(request: httpx.Request):
+            seen.append(request)
+            return httpx.Response(200, json=[])
+
+        req = AsyncVERequest("http://dummy.local", timeout=(1.0, 2.0))
+        self._mock(req, handler)
+        res = await req.get("/volume")
+        self.assertEqual([], res.json())
+        self.assertEqual("http://dummy.local/volume", str(seen[0].url))
+        self.assertEqual(dict(connect=1.0, read=2.0, write=2.0, pool=None), seen[0].extensions["timeout"])
+        self.assertNotIn(DEADLINE_HEADER, seen[0].headers)
+        # deadline is shorter
+        token = request_deadline.set(time.monotonic() + 0.5)
+        try:
+            await req.get("/volume")
+        finally:
+            request_deadline.reset(token)
+        self.assertLessEqual(seen[1].extensions["timeout"]["read"], 0.5)
+        self.assertLessEqual(float(seen[1].headers[DEADLINE_HEADER]), 0.5)
+        # deadline exceeded
+        token = request_deadline.set(time.monotonic() - 1)
+        try:
+            with self.assertRaises(TimeoutError):
+                await req.get("/volume")
+        finally:
+            request_deadline.reset(token)
+        self.assertEqual(2, len(seen))
+        await req.aclose()
+
+    async def test_pool(self):
+        import asyncio
+        import httpx
+        from volexport.client import AsyncVERequest
+
+        running = []
+        peak = 0
+
+        async def handler(request: httpx.Request):
+            nonlocal peak
+            running.append(request)
+            peak = max(peak, len(running))
+            await asyncio.sleep(0.01)
+            running.remove(request)
+            return httpx.Response(200, json=dict(path=request.url.path))
+
+        req = AsyncVERequest("http://dummy.local", pool_size=2)
+        self._mock(req, handler)
+        res = await asyncio.gather(*[req.get(f"/volume/vol{i}") for i in range(10)])
+        self.assertEqual([f"/volume/vol{i}" for i in range(10)], [x.json()["path"] for x in res])
+        self.assertEqual(2, peak)
+        async with req.stream("GET", "/volume/vol1") as res:
+            self.assertEqual(dict(path="/volume/vol1"), json.loads(await res.aread()))
+        await req.aclose()
+
+    async def test_unix(self):
+        import asyncio
+        from volexport.client import AsyncVERequest
+
+        with tempfile.TemporaryDirectory() as td:
+            sock = f"{td}/api.sock"
+            server = _UnixServer(sock, _Echo)
+            thread = threading.Thread(target=server.serve_forever, daemon=True)
+            thread.start()
+            try:
+                req = AsyncVERequest(f"unix://{sock}", pool_size=2, timeout=(1.0, 5.0))
+                res = await asyncio.gather(*[req.get("/volume/vol1", params=dict(x="1")) for _ in range(5)])
+                for i in res:
+                    i.raise_for_status()
+                    self.assertEqual(dict(path="/volume/vol1?x=1", host="localhost"), i.json())
+                await req.aclose()
+            finally:
+                server.shutdown()
+                server.server_close()
@@ -0,0 +1,107 @@
+import unittest
+import logging
+import urllib.request
+import urllib.error
+import grpc
+from volexpcsi import api
+from volexpcsi.accesslog import servicer_accesslog, settings, rpc_total, rpc_seconds
+from volexpcsi.server import boot_metrics
+
+
+class dummyctxt:
+    def peer(self):
+        return "client"
+
+    def abort(self, code, details):
+        self.code = code
+        self.details = details
+
+
+@servicer_accesslog
+class Dummy(api.ControllerServicer):
+    def ListVolumes(self, request, context):
+        return api.ListVolumesResponse(
+            entries=[
+                api.ListVolumesResponse.Entry(volume=api.Volume(volume_id=f"vol{i}"))
+                for i in range(request.max_entries)
+            ]
+        )
+
+    def GetCapacity(self, request, context):
+        raise FileNotFoundError("not found")
+
+    def ControllerGetCapabilities(self, request, context):
+        return api.ControllerGetCapabilitiesResponse()
+
+
+class TestAccessLog(unittest.TestCase):
+    def setUp(self):
+        self.saved = dict(vars(settings), levels=dict(settings.levels))
+
+    def tearDown(self):
+        vars(settings).update(self.saved)
+
+    def test_message(self):
+        with self.assertLogs("volexpcsi.accesslog", level=logging.INFO) as cm:
+            Dummy().ListVolumes(api.ListVolumesRequest(max_entries=2), dummyctxt())
+        self.assertEqual(2, len(cm.output))
+        self.assertIn('"max_entries": 2', cm.output[0])
+        self.assertIn('"volume_id": "vol1"', cm.output[1])
+
+    def test_truncate(self):
+        with self.assertLogs("volexpcsi.accesslog", level=logging.INFO) as cm:
+            Dummy().ListVolumes(api.ListVolumesRequest(max_entries=1000), dummyctxt())
+        self.assertRegex(cm.output[1], r"<ListVolumesResponse \d+ bytes>$")
+        settings.configure(dict(log_max_bytes=100000))
+        with self.assertLogs("volexpcsi.accesslog", level=logging.INFO) as cm:
+            Dummy().ListVolumes(api.ListVolumesRequest(max_entries=1000), dummyctxt())
+        self.assertIn("vol999", cm.output[1])
+
+    def test_level(self):
+        # quiet by default
+        with self.assertNoLogs("volexpcsi.accesslog", level=logging.INFO):
+            Dummy().ControllerGetCapabilities(api.ControllerGetCapabilitiesRequest(), dummyctxt())
+        settings.configure(dict(log_levels=dict(ListVolumes="debug", ControllerGetCapabilities="INFO")))
+        with self.assertNoLogs("volexpcsi.accesslog", level=logging.INFO):
+            Dummy().ListVolumes(api.ListVolumesRequest(max_entries=1), dummyctxt())
+        with self.assertLogs("volexpcsi.accesslog", level=logging.INFO):
+            Dummy().ControllerGetCapabilities(api.ControllerGetCapabilitiesRequest(), dummyctxt())
+        # errors are logged at any level
+        settings.configure(dict(log_levels=dict(GetCapacity=logging.CRITICAL)))
+        with self.assertLogs("volexpcsi.accesslog", level=logging.ERROR):
+            Dummy().GetCapacity(api.GetCapacityRequest(), dummyctxt())
+
+    def test_sample(self):
+        settings.configure(dict(log_sample=0.0))
+        with self.assertLogs("volexpcsi.accesslog", level=logging.INFO) as cm:
+            Dummy().ListVolumes(api.ListVolumesRequest(max_entries=1), dummyctxt())
+        self.assertEqual(1, len(cm.output))
+        self.assertRegex(cm.output[0], r"finish\(OK\) client <- Dummy.ListVolumes\([0-9.]+ sec\)$")
+
+    def test_metrics(self):
+        ok = rpc_total.get(method="ListVolumes", code="OK")
+        notfound = rpc_total.get(method="GetCapacity", code="NOT_FOUND")
+        count = rpc_seconds.count(method="ListVolumes")
+        Dummy().ListVolumes(api.ListVolumesRequest(max_entries=1), dummyctxt())
+        ctxt = dummyctxt()
+        Dummy().GetCapacity(api.GetCapacityRequest(), ctxt)
+        self.assertEqual(grpc.StatusCode.NOT_FOUND, ctxt.code)
+        self.assertEqual(ok + 1, rpc_total.get(method="ListVolumes", code="OK"))
+        self.assertEqual(notfound + 1, rpc_total.get(method="GetCapacity", code="NOT_FOUND"))
+        self.assertEqual(count + 1, rpc_seconds.count(method="ListVolumes"))
+
+    def test_metrics_server(self):
+        Dummy().ListVolumes(api.ListVolumesRequest(max_entries=1), dummyctxt())
+        port, srv = boot_metrics("127.0.0.1:0")
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics") as res:
+                self.assertTrue(res.headers["content-type"].startswith("text/plain"))
+                body = res.read().decode()
+            self.assertIn('volexp_csi_rpc_total{method="ListVolumes",code="OK"}', body)
+            self.assertIn('volexp_csi_rpc_seconds_bucket{method="ListVolumes",le="+Inf"}', body)
+            with self.assertRaises(urllib.error.HTTPError) as cm:
+                urllib.request.urlopen(f"http://127.0.0.1:{port}/")
+            self.assertEqual(404, cm.exception.code)
+        finally:
+            srv.shutdown()
+            srv.server_close()
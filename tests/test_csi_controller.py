@@ -1,6 +1,13 @@
 import unittest
+import asyncio
+import http.server
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from unittest.mock import patch, MagicMock
-from volexpcsi.controller import VolExpControl
+from volexpcsi.controller import VolExpControl, AsyncVolExpControl, ResponseCache
+from volexpcsi.inflight import deduped
 from volexpcsi import api
 from requests.exceptions import HTTPError
 import grpc
@@ -15,6 +22,31 @@ class dummyctxt:
         self.details = details
 
 
+class asyncctxt(dummyctxt):
+    async def abort(self, code, details):
+        super().abort(code, details)
+
+
+def response(status_code: int = 200, json=None, headers: dict | None = None):
+    res = MagicMock(status_code=status_code, headers=headers or {})
+    res.json.return_value = json
+    if status_code >= 400:
+        res.raise_for_status.side_effect = HTTPError("error", response=MagicMock(status_code=status_code))
+    return res
+
+
+def routes(table: dict):
+    """side_effect of VERequest.get, response by path"""
+
+    def _get(path, *args, **kwargs):
+        return table[path]
+
+    return _get
+
+
+health = response(headers={"X-Volexp-Generation": "1"})
+
+
 class TestCsiControl(unittest.TestCase):
     def setUp(self):
         self.srv = VolExpControl(dict(endpoint="http://dummy"))
@@ -24,8 +56,7 @@ class TestCsiControl(unittest.TestCase):
 
     @patch("volexport.client.VERequest.get")
     def test_GetCapacity(self, get):
-        get.return_value.status_code = 200
-        get.return_value.json.return_value = dict(free=12345)
+        get.side_effect = routes({"/health": health, "/stats/volume": response(json=dict(free=12345))})
         arg = api.GetCapacityRequest(
             volume_capabilities=[
                 api.VolumeCapability(access_mode=api.VolumeCapability.AccessMode(mode="SINGLE_NODE_WRITER"))
@@ -34,12 +65,16 @@ class TestCsiControl(unittest.TestCase):
         ctxt = dummyctxt()
         res = self.srv.GetCapacity(arg, ctxt)
         self.assertEqual(12345, res.available_capacity)
-        get.assert_called_once_with("/stats/volume")
+        get.assert_any_call("/stats/volume")
+        # cached
+        get.reset_mock()
+        res = self.srv.GetCapacity(arg, ctxt)
+        self.assertEqual(12345, res.available_capacity)
+        get.assert_not_called()
 
     @patch("volexport.client.VERequest.get")
     def test_GetCapacity_error(self, get):
-        get.return_value.status_code = 500
-        get.return_value.raise_for_status.side_effect = HTTPError("error", response=MagicMock(status_code=500))
+        get.side_effect = routes({"/health": health, "/stats/volume": response(500)})
         arg = api.GetCapacityRequest(
             volume_capabilities=[
                 api.VolumeCapability(access_mode=api.VolumeCapability.AccessMode(mode="SINGLE_NODE_WRITER"))
@@ -49,7 +84,7 @@ class TestCsiControl(unittest.TestCase):
         res = self.srv.GetCapacity(arg, ctxt)
         self.assertIsNone(res)
         self.assertEqual(grpc.StatusCode.INTERNAL, ctxt.code)
-        get.assert_called_once_with("/stats/volume")
+        get.assert_called_with("/stats/volume")
 
     @patch("volexport.client.VERequest.get")
     def test_GetCapacity_timeout(self, get):
@@ -63,22 +98,105 @@ class TestCsiControl(unittest.TestCase):
         res = self.srv.GetCapacity(arg, ctxt)
         self.assertIsNone(res)
         self.assertEqual(grpc.StatusCode.DEADLINE_EXCEEDED, ctxt.code)
-        get.assert_called_once_with("/stats/volume")
+        get.assert_called_once_with("/health")
 
     def test_ControllerGetCapbilities(self):
         arg = api.ControllerGetCapabilitiesRequest()
         ctxt = dummyctxt()
         res = self.srv.ControllerGetCapabilities(arg, ctxt)
         self.assertIsNotNone(res)
+        self.assertIn(api.ControllerServiceCapability.RPC.CLONE_VOLUME, [x.rpc.type for x in res.capabilities])
+        self.assertIn(api.ControllerServiceCapability.RPC.LIST_SNAPSHOTS, [x.rpc.type for x in res.capabilities])
+
+    snap1 = dict(
+        name="snap1",
+        created="2025-08-10T16:48:15+09:00",
+        size=1024,
+        used=False,
+        readonly=False,
+        thin=True,
+        parent="vol1",
+    )
+
+    @patch("volexport.client.VERequest.get")
+    def test_ListSnapshots(self, get):
+        get.return_value = response(json=dict(entries=[self.snap1], next="snap1"))
+        arg = api.ListSnapshotsRequest(max_entries=1, source_volume_id="vol1", starting_token="snap-snap0")
+        res = self.srv.ListSnapshots(arg, dummyctxt())
+        self.assertEqual("snap-snap1", res.next_token)
+        self.assertEqual(1, len(res.entries))
+        snap = res.entries[0].snapshot
+        self.assertEqual(
+            ("snap1", "vol1", 1024, True), (snap.snapshot_id, snap.source_volume_id, snap.size_bytes, snap.ready_to_use)
+        )
+        self.assertEqual(1754812095, snap.creation_time.seconds)
+        get.assert_called_once_with("/snapshot", params=dict(source="vol1", after="snap0", limit=1))
+        # last page
+        get.reset_mock()
+        get.return_value = response(json=dict(entries=[], next=None))
+        res = self.srv.ListSnapshots(api.ListSnapshotsRequest(snapshot_id="snap9"), dummyctxt())
+        self.assertEqual("", res.next_token)
+        get.assert_called_once_with("/snapshot", params=dict(name="snap9"))
+        ctxt = dummyctxt()
+        self.assertIsNone(self.srv.ListSnapshots(api.ListSnapshotsRequest(starting_token="vol-x"), ctxt))
+        self.assertEqual(grpc.StatusCode.ABORTED, ctxt.code)
+
+    @patch("volexport.client.VERequest.get")
+    @patch("volexport.client.VERequest.post")
+    def test_CreateSnapshot(self, post, get):
+        get.side_effect = routes(
+            {"/snapshot": response(json=dict(entries=[], next=None)), "/volume/vol1": response(json=dict(size=4096))}
+        )
+        post.return_value = response(json=dict(self.snap1, parent="lvuuid1"))
+        arg = api.CreateSnapshotRequest(name="snap1", source_volume_id="vol1")
+        res = self.srv.CreateSnapshot(arg, dummyctxt())
+        self.assertEqual(("snap1", "vol1"), (res.snapshot.snapshot_id, res.snapshot.source_volume_id))
+        post.assert_called_once_with("/volume/vol1/snapshot", json=dict(name="snap1", size=4096))
+        # retry: already exists
+        post.reset_mock()
+        get.side_effect = routes({"/snapshot": response(json=dict(entries=[self.snap1], next=None))})
+        res = self.srv.CreateSnapshot(arg, dummyctxt())
+        self.assertEqual("snap1", res.snapshot.snapshot_id)
+        post.assert_not_called()
+        # same name, other source
+        ctxt = dummyctxt()
+        arg = api.CreateSnapshotRequest(name="snap1", source_volume_id="vol2")
+        self.assertIsNone(self.srv.CreateSnapshot(arg, ctxt))
+        self.assertEqual(grpc.StatusCode.ALREADY_EXISTS, ctxt.code)
+
+    @patch("volexport.client.VERequest.get")
+    @patch("volexport.client.VERequest.delete")
+    def test_DeleteSnapshot(self, delete, get):
+        get.return_value = response(json=dict(entries=[self.snap1], next=None))
+        delete.return_value = response(json={})
+        self.srv.DeleteSnapshot(api.DeleteSnapshotRequest(snapshot_id="snap1"), dummyctxt())
+        get.assert_called_once_with("/snapshot", params=dict(name="snap1"))
+        delete.assert_called_once_with("/volume/snap1")
+        # not found: success
+        delete.reset_mock()
+        get.return_value = response(json=dict(entries=[], next=None))
+        self.assertIsNotNone(self.srv.DeleteSnapshot(api.DeleteSnapshotRequest(snapshot_id="snap1"), dummyctxt()))
+        delete.assert_not_called()
+
+    @patch("volexport.client.VERequest.get")
+    def test_GetSnapshot(self, get):
+        get.return_value = response(json=dict(entries=[self.snap1], next=None))
+        res = self.srv.GetSnapshot(api.GetSnapshotRequest(snapshot_id="snap1"), dummyctxt())
+        self.assertEqual("vol1", res.snapshot.source_volume_id)
+        get.return_value = response(json=dict(entries=[], next=None))
+        ctxt = dummyctxt()
+        self.assertIsNone(self.srv.GetSnapshot(api.GetSnapshotRequest(snapshot_id="snap9"), ctxt))
+        self.assertEqual(grpc.StatusCode.NOT_FOUND, ctxt.code)
 
     @patch("volexport.client.VERequest.get")
     def test_ListVolumes(self, get):
-        get.return_value.status_code = 200
-        get.return_value.json.return_value = [
+        vols = [
             dict(name="vol123", size=12345),
             dict(name="vol234", size=23456),
             dict(name="volnext", size=999),
         ]
+        exports = [dict(volumes=["vol234"], connected=[dict(address=["1.1.1.1", "1.1.1.2"], initiator="iqn.x")])]
+        get.side_effect = routes({"/health": health, "/volume": response(json=vols), "/export": response(json=exports)})
         arg = api.ListVolumesRequest(max_entries=2)
         ctxt = dummyctxt()
         res = self.srv.ListVolumes(arg, ctxt)
@@ -88,7 +206,11 @@ class TestCsiControl(unittest.TestCase):
         self.assertEqual(12345, res.entries[0].volume.capacity_bytes)
         self.assertEqual("vol234", res.entries[1].volume.volume_id)
         self.assertEqual(23456, res.entries[1].volume.capacity_bytes)
-        get.assert_called_once_with("/volume")
+        self.assertEqual([], res.entries[0].status.published_node_ids)
+        self.assertEqual(["1.1.1.1", "1.1.1.2"], res.entries[1].status.published_node_ids)
+        get.assert_any_call("/volume")
+        get.assert_any_call("/export")
+        self.assertEqual(3, get.call_count)
         get.reset_mock()
         # next token
         arg = api.ListVolumesRequest(max_entries=2, starting_token=res.next_token)
@@ -97,23 +219,30 @@ class TestCsiControl(unittest.TestCase):
         self.assertEqual("", res.next_token)
         self.assertEqual("volnext", res.entries[0].volume.volume_id)
         self.assertEqual(999, res.entries[0].volume.capacity_bytes)
-        get.assert_called_once_with("/volume")
+        # from cache
+        get.assert_not_called()
+        # volume deleted
+        self.srv.cache.invalidate()
+        get.side_effect = routes({"/health": health, "/volume": response(json=vols[:2]), "/export": response(json=[])})
+        res = self.srv.ListVolumes(arg, ctxt)
+        self.assertIsNone(res)
+        self.assertEqual(grpc.StatusCode.ABORTED, ctxt.code)
 
     @patch("volexport.client.VERequest.get")
     def test_ListVolumes_invalid(self, get):
-        get.return_value.status_code = 200
-        get.return_value.json.return_value = [
+        vols = [
             dict(name="vol123", size=12345),
             dict(name="vol234", size=23456),
             dict(name="volnext", size=999),
         ]
+        get.side_effect = routes({"/health": health, "/volume": response(json=vols), "/export": response(json=[])})
         arg = api.ListVolumesRequest(max_entries=2, starting_token="dummy")
         ctxt = dummyctxt()
         res = self.srv.ListVolumes(arg, ctxt)
         self.assertIsNone(res)
         self.assertEqual(grpc.StatusCode.ABORTED, ctxt.code)
         self.assertIn("invalid starting token", ctxt.details)
-        get.assert_called_once_with("/volume")
+        get.assert_any_call("/volume")
 
     @patch("volexport.client.VERequest.get")
     @patch("volexport.client.VERequest.post")
@@ -128,8 +257,226 @@ class TestCsiControl(unittest.TestCase):
         self.assertEqual("vol123", res.volume.volume_id)
         self.assertEqual(1024, res.volume.capacity_bytes)
         get.assert_called_once_with("/volume/vol123")
-        post.assert_any_call("/volume", json=dict(name="vol123", size=123))
-        post.assert_any_call("/volume/vol123/mkfs", json={})
+        # volexport without filesystem on create
+        post.assert_any_call("/volume", json=dict(name="vol123", size=123, filesystem="ext4"), params={"async": "1"})
+        post.assert_any_call("/volume/vol123/mkfs", json=dict(filesystem="ext4"), params={"async": "1"})
+
+    @patch("volexport.client.VERequest.get")
+    @patch("volexport.client.VERequest.post")
+    def test_CreateVolume_inflight(self, post, get):
+        get.return_value.status_code = 404
+        started = threading.Event()
+        release = threading.Event()
+
+        def _post(path, *args, **kwargs):
+            started.set()
+            release.wait(10)
+            return response(json=dict(name="vol123", size=1024, filesystem="ext4"))
+
+        post.side_effect = _post
+        arg = api.CreateVolumeRequest(name="vol123", capacity_range=api.CapacityRange(required_bytes=123))
+        shared = deduped.get(method="CreateVolume", result="shared")
+        aborted = deduped.get(method="ControllerExpandVolume", result="aborted")
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(self.srv.CreateVolume(arg, dummyctxt()))) for _ in range(3)
+        ]
+        threads[0].start()
+        self.assertTrue(started.wait(10))
+        for th in threads[1:]:
+            th.start()
+        for _ in range(500):
+            if deduped.get(method="CreateVolume", result="shared") == shared + 2:
+                break
+            time.sleep(0.01)
+        # other operation on the volume
+        ctxt = dummyctxt()
+        expand = api.ControllerExpandVolumeRequest(
+            volume_id="vol123", capacity_range=api.CapacityRange(required_bytes=1)
+        )
+        self.assertIsNone(self.srv.ControllerExpandVolume(expand, ctxt))
+        self.assertEqual(grpc.StatusCode.ABORTED, ctxt.code)
+        release.set()
+        for th in threads:
+            th.join()
+        self.assertEqual(3, len(results))
+        self.assertTrue(all(x == results[0] for x in results))
+        self.assertEqual("vol123", results[0].volume.volume_id)
+        post.assert_called_once()
+        self.assertEqual(shared + 2, deduped.get(method="CreateVolume", result="shared"))
+        self.assertEqual(aborted + 1, deduped.get(method="ControllerExpandVolume", result="aborted"))
+        self.assertEqual(0, len(self.srv.inflight))
+
+    @patch("volexport.client.VERequest.get")
+    @patch("volexport.client.VERequest.post")
+    def test_CreateVolume_formatted(self, post, get):
+        get.return_value.status_code = 404
+        # spare volume in warm pool
+        post.return_value = response(json=dict(name="vol123", size=1024, filesystem="xfs"))
+        cap = api.VolumeCapability(mount=api.VolumeCapability.MountVolume(fs_type="xfs"))
+        arg = api.CreateVolumeRequest(
+            name="vol123", capacity_range=api.CapacityRange(required_bytes=123), volume_capabilities=[cap]
+        )
+        res = self.srv.CreateVolume(arg, dummyctxt())
+        self.assertEqual("vol123", res.volume.volume_id)
+        post.assert_called_once_with(
+            "/volume", json=dict(name="vol123", size=123, filesystem="xfs"), params={"async": "1"}
+        )
+        # create and mkfs in a job
+        post.reset_mock()
+        post.return_value = response(status_code=202, json=dict(id="job234", name="create vol234", status="queued"))
+        get.side_effect = [
+            response(status_code=404),
+            response(
+                json=dict(
+                    id="job234",
+                    name="create vol234",
+                    status="succeeded",
+                    result=dict(name="vol234", size=1024, filesystem="ext4"),
+                    error=None,
+                )
+            ),
+        ]
+        arg = api.CreateVolumeRequest(name="vol234", capacity_range=api.CapacityRange(required_bytes=123))
+        res = self.srv.CreateVolume(arg, dummyctxt())
+        self.assertEqual("vol234", res.volume.volume_id)
+        post.assert_called_once()
+        get.assert_called_with("/jobs/job234")
+
+    @patch("volexport.client.VERequest.get")
+    @patch("volexport.client.VERequest.post")
+    def test_CreateVolume_clone(self, post, get):
+        get.return_value.status_code = 404
+        post.return_value = response(json=dict(name="vol123", size=2048))
+        for src in (
+            api.VolumeContentSource(volume=api.VolumeContentSource.VolumeSource(volume_id="vol0")),
+            api.VolumeContentSource(snapshot=api.VolumeContentSource.SnapshotSource(snapshot_id="vol0")),
+        ):
+            post.reset_mock()
+            arg = api.CreateVolumeRequest(name="vol123", volume_content_source=src)
+            res = self.srv.CreateVolume(arg, dummyctxt())
+            self.assertEqual("vol123", res.volume.volume_id)
+            self.assertEqual(2048, res.volume.capacity_bytes)
+            self.assertEqual(src, res.volume.content_source)
+            # no mkfs
+            post.assert_called_once_with(
+                "/volume/vol0/clone", json=dict(name="vol123", size=None), params={"async": "1"}
+            )
+        # source not found
+        post.return_value = response(status_code=404)
+        arg = api.CreateVolumeRequest(
+            name="vol123",
+            capacity_range=api.CapacityRange(required_bytes=4096),
+            volume_content_source=src,
+        )
+        ctxt = dummyctxt()
+        self.srv.CreateVolume(arg, ctxt)
+        self.assertEqual(grpc.StatusCode.NOT_FOUND, ctxt.code)
+        post.assert_called_with("/volume/vol0/clone", json=dict(name="vol123", size=4096), params={"async": "1"})
+
+    @patch("volexport.client.VERequest.get")
+    @patch("volexport.client.VERequest.post")
+    def test_CreateVolume_job(self, post, get):
+        volget = MagicMock(status_code=404)
+        jobget = MagicMock(status_code=200)
+        jobget.json.return_value = dict(
+            id="job123", name="mkfs vol123", status="succeeded", result=dict(name="vol123", size=1024), error=None
+        )
+        get.side_effect = [volget, jobget]
+        volpost = MagicMock(status_code=200)
+        volpost.json.return_value = dict(name="vol123", size=1024)
+        mkfspost = MagicMock(status_code=202)
+        mkfspost.json.return_value = dict(id="job123", name="mkfs vol123", status="queued")
+        post.side_effect = [volpost, mkfspost]
+        arg = api.CreateVolumeRequest(name="vol123", capacity_range=api.CapacityRange(required_bytes=123))
+        ctxt = dummyctxt()
+        res = self.srv.CreateVolume(arg, ctxt)
+        self.assertIsNotNone(res)
+        self.assertEqual("vol123", res.volume.volume_id)
+        get.assert_any_call("/jobs/job123")
+        self.assertEqual({}, self.srv.jobs)
+
+    @patch("volexport.client.VERequest.get")
+    @patch("volexport.client.VERequest.post")
+    def test_CreateVolume_job_pending(self, post, get):
+        self.srv.config["job_wait"] = 0
+        volget = MagicMock(status_code=404)
+        jobget = MagicMock(status_code=200)
+        jobget.json.return_value = dict(id="job123", name="mkfs vol123", status="running", result=None, error=None)
+        get.side_effect = [volget, jobget]
+        volpost = MagicMock(status_code=200)
+        volpost.json.return_value = dict(name="vol123", size=1024)
+        mkfspost = MagicMock(status_code=202)
+        mkfspost.json.return_value = dict(id="job123", name="mkfs vol123", status="queued")
+        post.side_effect = [volpost, mkfspost]
+        arg = api.CreateVolumeRequest(name="vol123", capacity_range=api.CapacityRange(required_bytes=123))
+        ctxt = dummyctxt()
+        res = self.srv.CreateVolume(arg, ctxt)
+        self.assertIsNone(res)
+        self.assertEqual(grpc.StatusCode.ABORTED, ctxt.code)
+        self.assertEqual({"create:vol123": "job123"}, self.srv.jobs)
+        # retry: poll the job
+        get.reset_mock()
+        post.reset_mock()
+        jobget.json.return_value = dict(
+            id="job123", name="mkfs vol123", status="succeeded", result=dict(name="vol123", size=1024), error=None
+        )
+        get.side_effect = [jobget]
+        ctxt = dummyctxt()
+        res = self.srv.CreateVolume(arg, ctxt)
+        self.assertEqual("vol123", res.volume.volume_id)
+        get.assert_called_once_with("/jobs/job123")
+        post.assert_not_called()
+        self.assertEqual({}, self.srv.jobs)
+
+    @patch("volexport.client.VERequest.get")
+    def test_jobs_concurrent(self, get):
+        # retries of expand by many threads while the job finishes
+        self.srv.jobs = {f"expand:vol{i}": f"job{i}" for i in range(20)}
+        get.side_effect = lambda path, *args, **kwargs: response(
+            json=dict(id=path, name="expand", status="succeeded", result=dict(size=2048), error=None)
+        )
+
+        def expand(i: int):
+            ctxt = dummyctxt()
+            arg = api.ControllerExpandVolumeRequest(volume_id=f"vol{i % 20}")
+            res = self.srv.ControllerExpandVolume(arg, ctxt)
+            return getattr(ctxt, "code", None), res
+
+        with patch("volexport.client.VERequest.post") as post:
+            post.return_value = response(json=dict(name="vol", size=2048))
+            with ThreadPoolExecutor(max_workers=8) as pool:
+                results = list(pool.map(expand, range(200)))
+        self.assertEqual([None] * 200, [x[0] for x in results])
+        self.assertEqual({2048}, {x[1].capacity_bytes for x in results})
+        self.assertEqual({}, self.srv.jobs)
+
+    def test_forget_job(self):
+        # finished poll of an old job does not drop the newer one
+        self.srv.jobs = {"create:vol1": "job2"}
+        self.srv._forget_job("create:vol1", "job1")
+        self.assertEqual({"create:vol1": "job2"}, self.srv.jobs)
+        self.srv._forget_job("create:vol1", "job2")
+        self.assertEqual({}, self.srv.jobs)
+
+    @patch("volexport.client.VERequest.get")
+    @patch("volexport.client.VERequest.post")
+    def test_CreateVolume_job_failed(self, post, get):
+        volget = MagicMock(status_code=404)
+        jobget = MagicMock(status_code=200)
+        jobget.json.return_value = dict(id="job123", name="mkfs vol123", status="failed", result=None, error="err")
+        get.side_effect = [volget, jobget]
+        volpost = MagicMock(status_code=200)
+        volpost.json.return_value = dict(name="vol123", size=1024)
+        mkfspost = MagicMock(status_code=202)
+        mkfspost.json.return_value = dict(id="job123", name="mkfs vol123", status="queued")
+        post.side_effect = [volpost, mkfspost]
+        arg = api.CreateVolumeRequest(name="vol123", capacity_range=api.CapacityRange(required_bytes=123))
+        ctxt = dummyctxt()
+        res = self.srv.CreateVolume(arg, ctxt)
+        self.assertIsNone(res)
+        self.assertEqual(grpc.StatusCode.INTERNAL, ctxt.code)
+        self.assertEqual({}, self.srv.jobs)
 
     @patch("volexport.client.VERequest.get")
     @patch("volexport.client.VERequest.post")
@@ -225,7 +572,15 @@ class TestCsiControl(unittest.TestCase):
         res = self.srv.ControllerPublishVolume(arg, ctxt)
         self.assertIsNotNone(res)
         self.assertEqual({k: str(v) for k, v in postres.items()}, res.publish_context)
-        post.assert_called_once_with("/export", json=dict(name="vol123", readonly=False, acl=None))
+        post.assert_called_once_with(
+            "/export", json=dict(name="vol123", readonly=False, acl=None, node="node123"), params=dict(reuse="1")
+        )
+        # other node: reused export is looked up by the node
+        arg.node_id = "node456"
+        self.srv.ControllerPublishVolume(arg, ctxt)
+        post.assert_called_with(
+            "/export", json=dict(name="vol123", readonly=False, acl=None, node="node456"), params=dict(reuse="1")
+        )
 
     def test_ControllerPublishVolume_nodeid_empty(self):
         arg = api.ControllerPublishVolumeRequest(
@@ -317,20 +672,252 @@ class TestCsiControl(unittest.TestCase):
         self.assertIsNotNone(res)
         self.assertEqual(15000, res.capacity_bytes)
         self.assertTrue(res.node_expansion_required)
-        post.assert_called_once_with("/volume/vol123", json=dict(size=12345))
+        post.assert_called_once_with("/volume/vol123", json=dict(size=12345), params={"async": "1"})
 
     @patch("volexport.client.VERequest.get")
     def test_ControllerGetVolume(self, get):
-        volget = MagicMock(status_code=200)
-        volget.json.return_value = dict(name="vol123", size=15000)
-        expget = MagicMock(status_code=200)
-        expget.json.return_value = [dict(connected=dict(address="1.1.1.1"))]
-        get.side_effect = [volget, expget]
+        conns = [dict(address=["1.1.1.1", "1.1.1.2"], initiator="iqn.node1"), dict(address=["2.2.2.2"], initiator="x")]
+        exports = [dict(targetname="iqn.abc:1", tid=1, acl=[], users=[], connected=conns)]
+        get.return_value = response(json=dict(name="vol123", size=15000, exports=exports))
         arg = api.ControllerGetVolumeRequest(volume_id="vol123")
         ctxt = dummyctxt()
         res = self.srv.ControllerGetVolume(arg, ctxt)
         self.assertIsNotNone(res)
         self.assertEqual(15000, res.volume.capacity_bytes)
         self.assertEqual("vol123", res.volume.volume_id)
-        get.assert_any_call("/volume/vol123")
-        get.assert_any_call("/export", params=dict(volume="vol123"))
+        self.assertEqual(["1.1.1.1", "1.1.1.2", "2.2.2.2"], list(res.status.published_node_ids))
+        # one call
+        get.assert_called_once_with("/volume/vol123", params=dict(include="exports,sessions"))
+
+
+class TestAsyncCsiControl(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.srv = AsyncVolExpControl(dict(endpoint="http://dummy", job_poll_interval=0.01))
+
+    @patch("volexport.client.AsyncVERequest.get")
+    async def test_GetCapacity(self, get):
+        get.side_effect = routes({"/health": health, "/stats/volume": response(json=dict(free=12345))})
+        arg = api.GetCapacityRequest()
+        res = await self.srv.GetCapacity(arg, asyncctxt())
+        self.assertEqual(12345, res.available_capacity)
+        # cached
+        get.reset_mock()
+        res = await self.srv.GetCapacity(arg, asyncctxt())
+        self.assertEqual(12345, res.available_capacity)
+        get.assert_not_called()
+        # error
+        self.srv.cache.invalidate()
+        get.side_effect = routes({"/health": health, "/stats/volume": response(500)})
+        ctxt = asyncctxt()
+        self.assertIsNone(await self.srv.GetCapacity(arg, ctxt))
+        self.assertEqual(grpc.StatusCode.INTERNAL, ctxt.code)
+
+    async def test_CreateVolume_invalid(self):
+        ctxt = asyncctxt()
+        self.assertIsNone(await self.srv.CreateVolume(api.CreateVolumeRequest(name="vol1"), ctxt))
+        self.assertEqual(grpc.StatusCode.INVALID_ARGUMENT, ctxt.code)
+
+    @patch("volexport.client.AsyncVERequest.get")
+    @patch("volexport.client.AsyncVERequest.post")
+    async def test_CreateVolume_job(self, post, get):
+        post.return_value = response(status_code=202, json=dict(id="job234", name="create vol234", status="queued"))
+        job = dict(id="job234", name="create vol234", result=dict(name="vol234", size=1024, filesystem="ext4"))
+        get.side_effect = [
+            response(status_code=404),
+            response(json=dict(job, status="running", error=None)),
+            response(json=dict(job, status="succeeded", error=None)),
+        ]
+        arg = api.CreateVolumeRequest(name="vol234", capacity_range=api.CapacityRange(required_bytes=123))
+        res = await self.srv.CreateVolume(arg, asyncctxt())
+        self.assertEqual("vol234", res.volume.volume_id)
+        self.assertEqual(1024, res.volume.capacity_bytes)
+        post.assert_called_once_with(
+            "/volume", json=dict(name="vol234", size=123, filesystem="ext4"), params={"async": "1"}
+        )
+        get.assert_called_with("/jobs/job234")
+        self.assertEqual({}, self.srv.jobs)
+
+    @patch("volexport.client.AsyncVERequest.get")
+    @patch("volexport.client.AsyncVERequest.post")
+    async def test_CreateVolume_inflight(self, post, get):
+        get.return_value = response(status_code=404)
+        started = asyncio.Event()
+        release = asyncio.Event()
+
+        async def _post(path, *args, **kwargs):
+            started.set()
+            await release.wait()
+            return response(json=dict(name="vol123", size=1024, filesystem="ext4"))
+
+        post.side_effect = _post
+        arg = api.CreateVolumeRequest(name="vol123", capacity_range=api.CapacityRange(required_bytes=123))
+        shared = deduped.get(method="CreateVolume", result="shared")
+        calls = [asyncio.create_task(self.srv.CreateVolume(arg, asyncctxt())) for _ in range(3)]
+        await started.wait()
+        await asyncio.sleep(0)
+        # other operation on the volume
+        ctxt = asyncctxt()
+        expand = api.ControllerExpandVolumeRequest(
+            volume_id="vol123", capacity_range=api.CapacityRange(required_bytes=1)
+        )
+        self.assertIsNone(await self.srv.ControllerExpandVolume(expand, ctxt))
+        self.assertEqual(grpc.StatusCode.ABORTED, ctxt.code)
+        release.set()
+        results = await asyncio.gather(*calls)
+        self.assertTrue(all(x == results[0] for x in results))
+        self.assertEqual("vol123", results[0].volume.volume_id)
+        post.assert_called_once()
+        self.assertEqual(shared + 2, deduped.get(method="CreateVolume", result="shared"))
+        self.assertEqual(0, len(self.srv.inflight))
+
+
+class TestResponseCache(unittest.TestCase):
+    def setUp(self):
+        self.req = MagicMock()
+        self.gen = "1"
+        self.req.get.side_effect = lambda path: response(headers={"X-Volexp-Generation": self.gen})
+        self.fetch = MagicMock(side_effect=lambda: self.fetch.call_count)
+
+    def test_revalidate(self):
+        cache = ResponseCache(self.req, ttl=0.0, max_age=30.0)
+        self.assertEqual(1, cache.get("key", self.fetch))
+        self.assertEqual(1, cache.get("key", self.fetch))
+        self.assertEqual(2, self.req.get.call_count)
+        self.gen = "2"
+        self.assertEqual(2, cache.get("key", self.fetch))
+        cache.invalidate()
+        self.assertEqual(3, cache.get("key", self.fetch))
+        # without generation
+        self.assertEqual(4, cache.get("other", self.fetch, revalidate=False))
+        self.assertEqual(5, cache.get("other", self.fetch, revalidate=False))
+
+    def test_ttl(self):
+        cache = ResponseCache(self.req, ttl=10.0, max_age=30.0)
+        self.assertEqual(1, cache.get("key", self.fetch))
+        self.gen = "2"
+        self.assertEqual(1, cache.get("key", self.fetch))
+        self.assertEqual(1, self.req.get.call_count)
+
+    def test_old_server(self):
+        self.req.get.side_effect = lambda path: response()
+        cache = ResponseCache(self.req, ttl=0.0, max_age=30.0)
+        self.assertEqual(1, cache.get("key", self.fetch))
+        self.assertEqual(2, cache.get("key", self.fetch))
+
+    def test_concurrent(self):
+        cache = ResponseCache(self.req, ttl=10.0, max_age=30.0)
+        self.assertEqual("cap", cache.get("capacity", lambda: "cap"))
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow():
+            started.set()
+            release.wait(5)
+            return "vols"
+
+        with ThreadPoolExecutor(max_workers=3) as pool:
+            first = pool.submit(cache.get, "volumes", slow)
+            self.assertTrue(started.wait(5))
+            second = pool.submit(cache.get, "volumes", self.fetch)
+            # other key is not blocked by the running fetch
+            self.assertEqual("cap", pool.submit(cache.get, "capacity", self.fetch).result(timeout=5))
+            self.assertFalse(second.done())
+            release.set()
+            self.assertEqual("vols", first.result(timeout=5))
+            self.assertEqual("vols", second.result(timeout=5))
+        self.fetch.assert_not_called()
+
+    def test_invalidate_while_fetching(self):
+        cache = ResponseCache(self.req, ttl=10.0, max_age=30.0)
+
+        def fetch():
+            cache.invalidate()
+            return "old"
+
+        self.assertEqual("old", cache.get("key", fetch))
+        self.assertEqual(1, cache.get("key", self.fetch))
+
+    def test_disabled(self):
+        cache = ResponseCache(self.req, ttl=0.0, max_age=0.0)
+        self.assertEqual(1, cache.get("key", self.fetch))
+        self.assertEqual(2, cache.get("key", self.fetch))
+        self.req.get.assert_not_called()
+
+
+class StandIn(http.server.BaseHTTPRequestHandler):
+    """volexport stand-in with many volumes"""
+
+    volumes = json.dumps([dict(name=f"vol{i:05d}", size=1073741824 * (i % 10 + 1)) for i in range(10000)]).encode()
+    exports = json.dumps(
+        [dict(volumes=[f"vol{i:05d}"], connected=[dict(address=["10.0.0.1"])]) for i in range(0, 10000, 10)]
+    ).encode()
+    paths: list[str] = []
+
+    def do_GET(self):
+        StandIn.paths.append(self.path)
+        body = {"/volume": self.volumes, "/export": self.exports, "/stats/volume": b'{"free": 1}'}.get(
+            self.path, b'{"status": "OK"}'
+        )
+        self.send_response(200)
+        self.send_header("content-type", "application/json")
+        self.send_header("content-length", str(len(body)))
+        self.send_header("x-volexp-generation", "1")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestListVolumesBench(unittest.TestCase):
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), StandIn)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.endpoint = f"http://127.0.0.1:{self.server.server_address[1]}"
+        StandIn.paths = []
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _list_all(self, srv: VolExpControl) -> tuple[int, float]:
+        count = 0
+        token = ""
+        start = time.perf_counter()
+        while True:
+            res = srv.ListVolumes(api.ListVolumesRequest(max_entries=500, starting_token=token), dummyctxt())
+            count += len(res.entries)
+            for _ in range(10):
+                srv.GetCapacity(api.GetCapacityRequest(), dummyctxt())
+            if not res.next_token:
+                break
+            token = res.next_token
+        return count, time.perf_counter() - start
+
+    def test_bench(self):
+        count, nocache = self._list_all(VolExpControl(dict(endpoint=self.endpoint, cache_max_age=0)))
+        self.assertEqual(10000, count)
+        self.assertEqual(20 * 12, len(StandIn.paths))
+        StandIn.paths = []
+        count, cached = self._list_all(VolExpControl(dict(endpoint=self.endpoint, cache_ttl=60)))
+        self.assertEqual(10000, count)
+        self.assertEqual(["/health", "/volume", "/export", "/stats/volume"], StandIn.paths)
+        print(f"list 10k volumes + capacity: nocache={nocache:.3f}s, cached={cached:.3f}s")
+
+    def test_bench_concurrent(self):
+        def run(srv: VolExpControl) -> float:
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=4) as pool:
+                counts = list(pool.map(lambda _: self._list_all(srv)[0], range(4)))
+            self.assertEqual([10000] * 4, counts)
+            return time.perf_counter() - start
+
+        nocache = run(VolExpControl(dict(endpoint=self.endpoint, cache_max_age=0)))
+        self.assertEqual(4 * 20, StandIn.paths.count("/volume"))
+        StandIn.paths = []
+        cached = run(VolExpControl(dict(endpoint=self.endpoint, cache_ttl=60)))
+        # concurrent first calls share one fetch
+        self.assertEqual(1, StandIn.paths.count("/volume"))
+        self.assertEqual(1, StandIn.paths.count("/stats/volume"))
+        print(f"4 concurrent list 10k volumes + capacity: nocache={nocache:.3f}s, cached={cached:.3f}s")
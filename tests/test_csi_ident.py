@@ -34,7 +34,7 @@ class TestCsiIdentity(unittest.TestCase):
         req = api.GetPluginCapabilitiesRequest()
         ctxt = dummyctxt()
         res = hdl.GetPluginCapabilities(req, ctxt)
-        self.assertEqual(2, len(res.capabilities))
+        self.assertEqual(3, len(res.capabilities))
 
     @patch("volexport.client.VERequest.get")
     def test_Probe(self, vreq):
@@ -1,9 +1,13 @@
 import unittest
 import grpc
+import subprocess
 import tempfile
+import threading
+import time
 from pathlib import Path
 from unittest.mock import patch
 from volexpcsi.node import VolExpNode
+from volexpcsi.inflight import deduped
 from volexpcsi import api
 
 
@@ -136,7 +140,7 @@ class TestCsiNode(unittest.TestCase):
     @patch("subprocess.run")
     def test_NodeUnstageVolume(self, run, get):
         get.return_value.status_code = 200
-        get.return_value.json.return_value = [dict(targetname="iqn.abc:def", volumes=["volume123"])]
+        get.return_value.json.return_value = dict(name="volume123", exports=[dict(targetname="iqn.abc:def")])
         run.return_value.stdout = "Logout from [1.1.1.1:3260] successful."
         ctxt = dummyctxt()
         arg = api.NodeUnstageVolumeRequest(
@@ -145,12 +149,20 @@ class TestCsiNode(unittest.TestCase):
         )
         res = self.srv.NodeUnstageVolume(arg, ctxt)
         self.assertIsNotNone(res)
-        get.assert_called_once_with("/export", params=dict(volume="volume123"))
+        get.assert_called_once_with("/volume/volume123", params=dict(include="exports"))
         run.assert_any_call(["iscsiadm", "-m", "node", "-T", "iqn.abc:def", "-u"], **self.basearg)
         run.assert_any_call(
             ["iscsiadm", "-m", "discoverydb", "-t", "st", "-p", "1.1.1.1:3260", "-o", "delete"], **self.basearg
         )
 
+    @patch("volexport.client.VERequest.get")
+    @patch("subprocess.run")
+    def test_NodeUnstageVolume_deleted(self, run, get):
+        get.return_value.status_code = 404
+        arg = api.NodeUnstageVolumeRequest(volume_id="volume123", staging_target_path="/mnt/tmp")
+        self.assertIsNotNone(self.srv.NodeUnstageVolume(arg, dummyctxt()))
+        run.assert_not_called()
+
     def test_NodeUnstageVolume_nopath(self):
         ctxt = dummyctxt()
         arg = api.NodeUnstageVolumeRequest(
@@ -204,12 +216,43 @@ class TestCsiNode(unittest.TestCase):
             self.assertFalse(path.exists())
             run.assert_any_call(["umount", str(path)], **self.basearg)
 
+    @patch("subprocess.run")
+    def test_NodePublishVolume_inflight(self, run):
+        started = threading.Event()
+        release = threading.Event()
+
+        def _run(cmd, **kwargs):
+            started.set()
+            release.wait(10)
+            raise subprocess.CalledProcessError(returncode=1, cmd=cmd, stderr="error")
+
+        run.side_effect = _run
+        with tempfile.TemporaryDirectory() as td:
+            arg = api.NodePublishVolumeRequest(
+                volume_id="volume123",
+                target_path=td,
+                volume_capability=api.VolumeCapability(mount=api.VolumeCapability.MountVolume(fs_type="ext4")),
+            )
+            ctxts = [dummyctxt(), dummyctxt()]
+            threads = [threading.Thread(target=self.srv.NodePublishVolume, args=(arg, x)) for x in ctxts]
+            threads[0].start()
+            self.assertTrue(started.wait(10))
+            threads[1].start()
+            while len(self.srv.inflight) and deduped.get(method="NodePublishVolume", result="shared") == 0:
+                time.sleep(0.01)
+            release.set()
+            for th in threads:
+                th.join()
+        # error of the running call is shared
+        self.assertEqual([grpc.StatusCode.INTERNAL] * 2, [x.code for x in ctxts])
+        run.assert_called_once()
+
     @patch("volexport.client.VERequest.get")
     @patch("subprocess.run")
     def test_NodeExpandVolume(self, run, get):
         run.return_value.stdout = "/dev/sda\n"
         get.return_value.status_code = 200
-        get.return_value.json.return_value = [dict(targetname="iqn.abc:def", volumes=["volume123"])]
+        get.return_value.json.return_value = dict(name="volume123", exports=[dict(targetname="iqn.abc:def")])
         ctxt = dummyctxt()
         arg = api.NodeExpandVolumeRequest(
             volume_id="volume123", volume_path="/mnt/tmp", capacity_range=api.CapacityRange(required_bytes=10240)
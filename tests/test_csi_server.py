@@ -0,0 +1,146 @@
+import unittest
+import asyncio
+import http.server
+import json
+import threading
+import time
+import grpc
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+from volexport.client import DEFAULT_POOL_SIZE
+from volexpcsi import api
+from volexpcsi.server import boot_server, boot_aio_server
+
+
+class StandIn(http.server.BaseHTTPRequestHandler):
+    """volexport stand-in, lvcreate takes latency seconds"""
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    latency = 0.05
+    created: list[str] = []
+
+    def _reply(self, code: int, data):
+        body = json.dumps(data).encode()
+        self.send_response(code)
+        self.send_header("content-type", "application/json")
+        self.send_header("content-length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._reply(200, dict(status="OK"))
+        else:
+            self._reply(404, dict(detail="not found"))
+
+    def do_POST(self):
+        req = json.loads(self.rfile.read(int(self.headers.get("content-length", 0))) or b"{}")
+        if self.path.split("?")[0] == "/volume":
+            time.sleep(self.latency)
+            StandIn.created.append(req["name"])
+            self._reply(200, dict(name=req["name"], size=req["size"]))
+        else:
+            self._reply(200, dict())
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Server(http.server.ThreadingHTTPServer):
+    request_queue_size = 1024
+
+
+class TestCsiServerBench(unittest.TestCase):
+    calls = 500
+
+    def setUp(self):
+        self.server = Server(("127.0.0.1", 0), StandIn)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.endpoint = f"http://127.0.0.1:{self.server.server_address[1]}"
+        StandIn.created = []
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    async def _burst(self, port: int, prefix: str) -> float:
+        async with grpc.aio.insecure_channel(f"127.0.0.1:{port}") as channel:
+            stub = api.ControllerStub(channel)
+            start = time.perf_counter()
+            res = await asyncio.gather(
+                *[
+                    stub.CreateVolume(
+                        api.CreateVolumeRequest(
+                            name=f"{prefix}{i:03d}", capacity_range=api.CapacityRange(required_bytes=1024)
+                        ),
+                        timeout=60,
+                    )
+                    for i in range(self.calls)
+                ]
+            )
+            elapsed = time.perf_counter() - start
+        self.assertEqual(self.calls, len(res))
+        self.assertEqual(f"{prefix}000", res[0].volume.volume_id)
+        return elapsed
+
+    async def _aio_burst(self, conf: dict, prefix: str) -> float:
+        port, srv = await boot_aio_server("127.0.0.1:0", conf)
+        try:
+            return await self._burst(port, prefix)
+        finally:
+            await srv.stop(None)
+
+    def test_bench(self):
+        conf = dict(endpoint=self.endpoint, pool_size=100, max_workers=100, http_timeout=(1.0, 10.0))
+        port, srv = boot_server("127.0.0.1:0", conf)
+        try:
+            threaded = asyncio.run(self._burst(port, "vol"))
+        finally:
+            srv.stop(None)
+        aio = asyncio.run(self._aio_burst(conf, "avol"))
+        self.assertEqual(2 * self.calls, len(StandIn.created))
+        self.assertEqual(2 * self.calls, len(set(StandIn.created)))
+        # CPU bound when client, server and stand-in share a core: aio must stay in the range of threads
+        self.assertLess(aio, threaded * 4)
+
+    def test_aio(self):
+        async def run():
+            port, srv = await boot_aio_server("127.0.0.1:0", dict(endpoint=self.endpoint, nodeid="node1"))
+            try:
+                async with grpc.aio.insecure_channel(f"127.0.0.1:{port}") as channel:
+                    ident = await api.IdentityStub(channel).GetPluginInfo(api.GetPluginInfoRequest())
+                    node = api.NodeStub(channel)
+                    info = await node.NodeGetInfo(api.NodeGetInfoRequest())
+                    with self.assertRaises(grpc.aio.AioRpcError) as cm:
+                        await api.ControllerStub(channel).CreateVolume(api.CreateVolumeRequest(name="vol1"))
+                    with self.assertRaises(grpc.aio.AioRpcError) as ncm:
+                        await node.NodeStageVolume(api.NodeStageVolumeRequest())
+            finally:
+                await srv.stop(None)
+            return ident, info, cm.exception, ncm.exception
+
+        ident, info, err, nerr = asyncio.run(run())
+        self.assertTrue(ident.name)
+        self.assertEqual("node1", info.node_id)
+        self.assertEqual(grpc.StatusCode.INVALID_ARGUMENT, err.code())
+        # sync node servicer in the migration thread pool
+        self.assertEqual(grpc.StatusCode.INVALID_ARGUMENT, nerr.code())
+
+    def test_default_workers(self):
+        with patch("volexpcsi.server.futures.ThreadPoolExecutor", wraps=ThreadPoolExecutor) as pool:
+            port, srv = boot_server("127.0.0.1:0", dict(endpoint=self.endpoint))
+            srv.stop(None)
+        pool.assert_called_once_with(max_workers=DEFAULT_POOL_SIZE)
+
+    def test_error(self):
+        port, srv = boot_server("127.0.0.1:0", dict(endpoint=self.endpoint))
+        try:
+            with grpc.insecure_channel(f"127.0.0.1:{port}") as channel:
+                stub = api.ControllerStub(channel)
+                with self.assertRaises(grpc.RpcError) as cm:
+                    stub.CreateVolume(api.CreateVolumeRequest(name="vol1"))
+        finally:
+            srv.stop(None)
+        self.assertEqual(grpc.StatusCode.INVALID_ARGUMENT, cm.exception.code())
@@ -0,0 +1,136 @@
+import unittest
+import json
+import httpx
+from unittest.mock import patch, MagicMock
+from volexpcsi.snapshot_metadata import VolExpSnapshotMetadata, AsyncVolExpSnapshotMetadata
+from volexpcsi import api
+from requests.exceptions import HTTPError
+import grpc
+
+
+class dummyctxt:
+    def peer(self):
+        return "client"
+
+    def abort(self, code, details):
+        self.code = code
+        self.details = details
+
+
+class asyncctxt(dummyctxt):
+    async def abort(self, code, details):
+        super().abort(code, details)
+
+
+def ndjson_response(*pages):
+    res = MagicMock()
+    res.__enter__.return_value = res
+    res.iter_lines.return_value = [json.dumps(x).encode() for x in pages] + [b""]
+    return res
+
+
+class TestCsiSnapshotMetadata(unittest.TestCase):
+    def setUp(self):
+        self.srv = VolExpSnapshotMetadata(dict(endpoint="http://dummy"))
+
+    @patch("volexport.client.VERequest.get")
+    def test_GetMetadataAllocated(self, get):
+        get.return_value = ndjson_response(
+            dict(size=1024000, extents=[[0, 4096], [8192, 4096]]), dict(size=1024000, extents=[[65536, 1024]])
+        )
+        req = api.GetMetadataAllocatedRequest(snapshot_id="snap1", starting_offset=100, max_results=2)
+        res = list(self.srv.GetMetadataAllocated(req, dummyctxt()))
+        self.assertEqual(2, len(res))
+        self.assertEqual(api.BlockMetadataType.VARIABLE_LENGTH, res[0].block_metadata_type)
+        self.assertEqual(1024000, res[0].volume_capacity_bytes)
+        self.assertEqual([(0, 4096), (8192, 4096)], [(x.byte_offset, x.size_bytes) for x in res[0].block_metadata])
+        self.assertEqual([(65536, 1024)], [(x.byte_offset, x.size_bytes) for x in res[1].block_metadata])
+        get.assert_called_once_with("/volume/snap1/allocated", params=dict(offset=100, page_size=2), stream=True)
+
+    @patch("volexport.client.VERequest.get")
+    def test_GetMetadataDelta(self, get):
+        get.return_value = ndjson_response(dict(size=1024000, extents=[]))
+        req = api.GetMetadataDeltaRequest(base_snapshot_id="snap1", target_snapshot_id="snap2")
+        res = list(self.srv.GetMetadataDelta(req, dummyctxt()))
+        self.assertEqual(1, len(res))
+        self.assertEqual(0, len(res[0].block_metadata))
+        get.assert_called_once_with("/volume/snap2/delta/snap1", params=dict(offset=0, page_size=1000), stream=True)
+
+    @patch("volexport.client.VERequest.get")
+    def test_invalid(self, get):
+        for req in [
+            api.GetMetadataAllocatedRequest(),
+            api.GetMetadataAllocatedRequest(snapshot_id="snap1", starting_offset=-1),
+        ]:
+            with self.subTest(req=req):
+                ctxt = dummyctxt()
+                self.assertEqual([], list(self.srv.GetMetadataAllocated(req, ctxt)))
+                self.assertEqual(grpc.StatusCode.INVALID_ARGUMENT, ctxt.code)
+        ctxt = dummyctxt()
+        req = api.GetMetadataDeltaRequest(target_snapshot_id="snap2")
+        self.assertEqual([], list(self.srv.GetMetadataDelta(req, ctxt)))
+        self.assertEqual(grpc.StatusCode.INVALID_ARGUMENT, ctxt.code)
+        get.assert_not_called()
+
+    @patch("volexport.client.VERequest.get")
+    def test_notfound(self, get):
+        res = ndjson_response()
+        res.raise_for_status.side_effect = HTTPError(response=MagicMock(status_code=404))
+        get.return_value = res
+        ctxt = dummyctxt()
+        req = api.GetMetadataAllocatedRequest(snapshot_id="snap1")
+        self.assertEqual([], list(self.srv.GetMetadataAllocated(req, ctxt)))
+        self.assertEqual(grpc.StatusCode.NOT_FOUND, ctxt.code)
+
+
+class TestAsyncCsiSnapshotMetadata(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.srv = AsyncVolExpSnapshotMetadata(dict(endpoint="http://dummy"))
+        self.requests: list[httpx.Request] = []
+        self.pages: list[dict] = []
+        self.status = 200
+
+        def handler(request: httpx.Request):
+            self.requests.append(request)
+            body = "".join(json.dumps(x) + "\n" for x in self.pages)
+            return httpx.Response(self.status, content=body.encode())
+
+        self.srv.req.client = httpx.AsyncClient(base_url="http://dummy", transport=httpx.MockTransport(handler))
+
+    async def asyncTearDown(self):
+        await self.srv.req.aclose()
+
+    async def test_GetMetadataAllocated(self):
+        self.pages = [
+            dict(size=1024000, extents=[[0, 4096], [8192, 4096]]),
+            dict(size=1024000, extents=[[65536, 1024]]),
+        ]
+        req = api.GetMetadataAllocatedRequest(snapshot_id="snap1", starting_offset=100, max_results=2)
+        res = [x async for x in self.srv.GetMetadataAllocated(req, asyncctxt())]
+        self.assertEqual(2, len(res))
+        self.assertEqual(1024000, res[0].volume_capacity_bytes)
+        self.assertEqual([(0, 4096), (8192, 4096)], [(x.byte_offset, x.size_bytes) for x in res[0].block_metadata])
+        self.assertEqual([(65536, 1024)], [(x.byte_offset, x.size_bytes) for x in res[1].block_metadata])
+        self.assertEqual("/volume/snap1/allocated?offset=100&page_size=2", str(self.requests[0].url.raw_path, "ascii"))
+
+    async def test_GetMetadataDelta(self):
+        self.pages = [dict(size=1024000, extents=[])]
+        req = api.GetMetadataDeltaRequest(base_snapshot_id="snap1", target_snapshot_id="snap2")
+        res = [x async for x in self.srv.GetMetadataDelta(req, asyncctxt())]
+        self.assertEqual(1, len(res))
+        self.assertEqual(0, len(res[0].block_metadata))
+        self.assertEqual(
+            "/volume/snap2/delta/snap1?offset=0&page_size=1000", str(self.requests[0].url.raw_path, "ascii")
+        )
+
+    async def test_error(self):
+        ctxt = asyncctxt()
+        req = api.GetMetadataDeltaRequest(target_snapshot_id="snap2")
+        self.assertEqual([], [x async for x in self.srv.GetMetadataDelta(req, ctxt)])
+        self.assertEqual(grpc.StatusCode.INVALID_ARGUMENT, ctxt.code)
+        self.assertEqual([], self.requests)
+        self.status = 404
+        ctxt = asyncctxt()
+        req = api.GetMetadataAllocatedRequest(snapshot_id="snap1")
+        self.assertEqual([], [x async for x in self.srv.GetMetadataAllocated(req, ctxt)])
+        self.assertEqual(grpc.StatusCode.NOT_FOUND, ctxt.code)
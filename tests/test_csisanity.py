@@ -1,8 +1,10 @@
 import unittest
+import asyncio
 import os
 import shutil
 import subprocess
-from volexpcsi.server import boot_server
+import threading
+from volexpcsi.server import boot_server, boot_aio_server
 
 have_sanity = shutil.which(os.getenv("TEST_CSI_SANITY_BIN", "csi-sanity"))
 have_volexport = os.getenv("TEST_VOLEXPORT")
@@ -23,3 +25,24 @@ class TestCsiSanity(unittest.TestCase):
         assert have_sanity is not None
         res = subprocess.run([have_sanity, f"--csi.endpoint=localhost:{self.port}"])
         res.check_returncode()
+
+
+@unittest.skipUnless(have_sanity and have_volexport, "do not have csi-sanity")
+class TestCsiSanityAio(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        boot = boot_aio_server("localhost:0", {"endpoint": have_volexport, "nodeid": "node123"})
+        self.port, self.srv = asyncio.run_coroutine_threadsafe(boot, self.loop).result()
+
+    def tearDown(self):
+        asyncio.run_coroutine_threadsafe(self.srv.stop(grace=1.0), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    def test_sanity(self):
+        assert have_sanity is not None
+        res = subprocess.run([have_sanity, f"--csi.endpoint=localhost:{self.port}"])
+        res.check_returncode()
@@ -0,0 +1,308 @@
+import unittest
+import os
+import stat
+import subprocess
+import tempfile
+from pathlib import Path
+from unittest.mock import patch
+from fastapi.testclient import TestClient
+from volexport import exportstate
+from volexport.api import api
+from volexport.config import config
+
+export1 = dict(
+    protocol="iscsi",
+    addresses=[],
+    targetname="iqn.abc:1",
+    tid=1,
+    user="user1",
+    passwd="passwd1",
+    lun=1,
+    acl=["192.168.0.0/24", "10.0.0.1"],
+)
+export2 = dict(export1, targetname="iqn.abc:2", tid=2, user="user2", passwd="pass word", acl=[])
+
+
+class FakeTgtd:
+    """tgtadm stand-in keeping targets in memory"""
+
+    def __init__(self):
+        self.targets: dict[int, dict] = {}
+        self.accounts: dict[str, str] = {}
+
+    def __call__(self, lld, mode, op, **kwargs):
+        if mode == "target" and op == "new":
+            self.targets[kwargs["tid"]] = dict(name=kwargs["targetname"], luns={}, users=[], acl=[])
+        elif mode == "logicalunit" and op == "new":
+            self.targets[kwargs["tid"]]["luns"][kwargs["lun"]] = kwargs["backing_store"]
+        elif mode == "account" and op == "new":
+            self.accounts[kwargs["user"]] = kwargs["password"]
+        elif mode == "account" and op == "bind":
+            self.targets[kwargs["tid"]]["users"].append(kwargs["user"])
+        elif mode == "target" and op == "bind":
+            self.targets[kwargs["tid"]]["acl"].append(kwargs["initiator_address"])
+        elif mode == "target" and op == "show":
+            return subprocess.CompletedProcess([], 0, self.show(), "")
+        return subprocess.CompletedProcess([], 0, "", "")
+
+    def show(self) -> str:
+        res = []
+        for tid, tgt in self.targets.items():
+            res.append(f"Target {tid}: {tgt['name']}")
+            res.append("    LUN information:")
+            res.extend(["        LUN: 0", "            Type: controller", "            Backing store path: None"])
+            for lun, path in tgt["luns"].items():
+                res.extend([f"        LUN: {lun}", "            Type: disk", f"            Backing store path: {path}"])
+            res.append("    Account information:")
+            res.extend([f"        {x}" for x in tgt["users"]])
+            res.append("    ACL information:")
+            res.extend([f"        {x}" for x in tgt["acl"]])
+        return "\n".join(res) + "\n"
+
+
+class TestExportState(unittest.TestCase):
+    def setUp(self):
+        self.td = tempfile.TemporaryDirectory()
+        self.statefile = Path(self.td.name) / "state" / "exports.json"
+        self.patcher = patch.object(config, "EXPORT_STATE", str(self.statefile))
+        self.patcher.start()
+        self.dev1 = Path(self.td.name) / "lv1"
+        self.dev2 = Path(self.td.name) / "lv2"
+        self.dev1.touch()
+        self.dev2.touch()
+
+    def tearDown(self):
+        self.patcher.stop()
+        self.td.cleanup()
+
+    def test_add_remove(self):
+        self.assertEqual([], exportstate.entries())
+        exportstate.add(export1, "vol1", "/dev/vg0/lv1")
+        exportstate.add(export2, "vol2", "/dev/vg0/lv2")
+        self.assertEqual(0o600, stat.S_IMODE(os.stat(self.statefile).st_mode))
+        ents = exportstate.entries()
+        self.assertEqual(["iqn.abc:1", "iqn.abc:2"], [x["targetname"] for x in ents])
+        self.assertEqual("passwd1", ents[0]["passwd"])
+        self.assertEqual("rdwr", ents[0]["bstype"])
+        self.assertEqual(2, exportstate.desired_targets.get())
+        self.assertTrue(exportstate.remove("iqn.abc:1"))
+        self.assertFalse(exportstate.remove("iqn.abc:1"))
+        self.assertEqual(["iqn.abc:2"], [x["targetname"] for x in exportstate.entries()])
+        self.assertEqual(["exports.json"], os.listdir(self.statefile.parent))
+
+    def test_disabled(self):
+        with patch.object(config, "EXPORT_STATE", None):
+            exportstate.add(export1, "vol1", "/dev/vg0/lv1")
+            self.assertFalse(exportstate.remove("iqn.abc:1"))
+            self.assertEqual([], exportstate.entries())
+            self.assertIsNone(exportstate.tgtd_watchdog())
+        self.assertFalse(self.statefile.exists())
+        self.assertIsNotNone(exportstate.tgtd_watchdog())
+
+    def test_tgtconf(self):
+        exportstate.add(export1, "vol1", "/dev/vg0/lv1")
+        exportstate.add(export2, "vol2", "/dev/vg0/lv2")
+        with patch.object(config, "TGT_BSOPTS", "path=/tmp/x;opt=1 2"):
+            exportstate.add(export2, "vol2", "/dev/vg0/lv2")
+        self.assertEqual(
+            """<target iqn.abc:1>
+    <backing-store /dev/vg0/lv1>
+        lun 1
+        bs-type rdwr
+        vendor_id VOLEXP
+        product_id lv1
+    </backing-store>
+    incominguser user1 passwd1
+    initiator-address 192.168.0.0/24
+    initiator-address 10.0.0.1
+</target>
+<target iqn.abc:2>
+    <backing-store /dev/vg0/lv2>
+        lun 1
+        bs-type rdwr
+        bsopts "path=/tmp/x;opt=1 2"
+        vendor_id VOLEXP
+        product_id lv2
+    </backing-store>
+    incominguser user2 "pass word"
+</target>
+""",
+            exportstate.tgtconf(exportstate.entries()),
+        )
+
+    @patch("volexport.exportstate.Tgtd")
+    def test_watchdog(self, tgtd):
+        exportstate.add(export1, "vol1", str(self.dev1))
+        exportstate.add(export2, "vol2", str(self.dev2))
+        tgtd.return_value.target_list.return_value = {"Target 1": dict(name="iqn.abc:1"), "Target 2": None}
+        wd = exportstate.TgtdWatchdog()
+        recovered = exportstate.recovered_targets.get()
+        # only missing target
+        self.assertEqual(1, wd.run_once())
+        conf = tgtd.return_value.restore.call_args.args[0]
+        self.assertIn("<target iqn.abc:2>", conf)
+        self.assertNotIn("<target iqn.abc:1>", conf)
+        self.assertEqual(recovered + 1, exportstate.recovered_targets.get())
+        self.assertIsNotNone(wd.last_recovery)
+        self.assertEqual(2, wd.last_targets)
+
+        # tgtd down
+        down = exportstate.tgtd_down.get()
+        tgtd.return_value.target_list.side_effect = subprocess.CalledProcessError(returncode=107, cmd="tgtadm")
+        self.assertEqual(0, wd.run_once())
+        self.assertEqual(0, wd.run_once())
+        self.assertTrue(wd.down)
+        self.assertEqual(down + 1, exportstate.tgtd_down.get())
+
+        # restarted: all exports in one tgt-admin run
+        tgtd.return_value.restore.reset_mock()
+        tgtd.return_value.target_list.side_effect = None
+        tgtd.return_value.target_list.return_value = {}
+        count = exportstate.recovery_seconds.count()
+        self.assertEqual(2, wd.run_once())
+        tgtd.return_value.restore.assert_called_once()
+        self.assertFalse(wd.down)
+        self.assertEqual(count + 1, exportstate.recovery_seconds.count())
+
+        # nothing to do
+        tgtd.return_value.restore.reset_mock()
+        tgtd.return_value.target_list.return_value = {
+            "Target 1": dict(name="iqn.abc:1"),
+            "Target 2": dict(name="iqn.abc:2"),
+        }
+        self.assertEqual(0, wd.run_once())
+        tgtd.return_value.restore.assert_not_called()
+
+    @patch("volexport.exportstate.Tgtd")
+    def test_watchdog_error(self, tgtd):
+        exportstate.add(export1, "vol1", str(self.dev1))
+        exportstate.add(export2, "vol2", str(self.dev2))
+        self.dev1.unlink()
+        tgtd.return_value.target_list.return_value = {}
+        tgtd.return_value.restore.side_effect = subprocess.CalledProcessError(returncode=22, cmd="tgt-admin")
+        errors = exportstate.recovery_total.get(result="error")
+        wd = exportstate.TgtdWatchdog()
+        self.assertEqual(0, wd.run_once())
+        # deleted volume is skipped
+        conf = tgtd.return_value.restore.call_args.args[0]
+        self.assertIn("<target iqn.abc:2>", conf)
+        self.assertNotIn("<target iqn.abc:1>", conf)
+        self.assertEqual(errors + 1, exportstate.recovery_total.get(result="error"))
+        self.assertIn("CalledProcessError", wd.last_error)
+
+    @patch("volexport.api_export.LV")
+    @patch("volexport.api_export.Tgtd")
+    def test_api(self, tgtd, lv):
+        lv.return_value.volume_vol2path.return_value = "/dev/vg0/lv1"
+        tgtd.return_value.export_volume.return_value = export1
+        res = TestClient(api).post("/export", json=dict(name="vol1", acl=export1["acl"]))
+        self.assertEqual(200, res.status_code)
+        ents = exportstate.entries()
+        self.assertEqual(1, len(ents))
+        self.assertEqual(dict(volume="vol1", path="/dev/vg0/lv1"), dict(volume=ents[0]["volume"], path=ents[0]["path"]))
+
+        # connected
+        tgtd.return_value.unexport_volume.side_effect = FileExistsError("client connected")
+        res = TestClient(api).delete("/export/iqn.abc:1")
+        self.assertEqual(400, res.status_code)
+        self.assertEqual(1, len(exportstate.entries()))
+
+        # not running: forget
+        tgtd.return_value.unexport_volume.side_effect = FileNotFoundError("target not found")
+        res = TestClient(api).delete("/export/iqn.abc:1")
+        self.assertEqual(200, res.status_code)
+        self.assertEqual([], exportstate.entries())
+        res = TestClient(api).delete("/export/iqn.abc:1")
+        self.assertEqual(404, res.status_code)
+
+        tgtd.return_value.unexport_volume.side_effect = None
+        exportstate.add(export1, "vol1", "/dev/vg0/lv1")
+        res = TestClient(api).delete("/export/iqn.abc:1")
+        self.assertEqual(200, res.status_code)
+        self.assertEqual([], exportstate.entries())
+
+    @patch("volexport.tgtd.Tgtd.myaddress")
+    @patch("volexport.tgtd.Tgtd.tgtadm")
+    @patch("volexport.api_export.LV")
+    def test_api_reuse(self, lv, tgtadm, myaddress):
+        lv.return_value.volume_vol2path.return_value = str(self.dev1)
+        myaddress.return_value = ["1.1.1.1:3260"]
+        fake = FakeTgtd()
+        tgtadm.side_effect = fake
+        arg = dict(name="vol1", acl=["10.0.0.1"])
+        res1 = TestClient(api).post("/export", json=arg, params=dict(reuse="1"))
+        self.assertEqual(200, res1.status_code)
+        state = (repr(fake.targets), repr(fake.accounts), self.statefile.read_text())
+        # retries of publish
+        for _ in range(3):
+            res = TestClient(api).post("/export", json=arg, params=dict(reuse="1"))
+            self.assertEqual(200, res.status_code)
+            self.assertEqual(res1.json(), res.json())
+        self.assertEqual(state, (repr(fake.targets), repr(fake.accounts), self.statefile.read_text()))
+        self.assertEqual(1, len(fake.targets))
+        # other ACL, or without reuse: new export
+        res = TestClient(api).post("/export", json=dict(arg, acl=["10.0.0.2"]), params=dict(reuse="1"))
+        self.assertEqual(2, res.json()["tid"])
+        res = TestClient(api).post("/export", json=arg)
+        self.assertEqual(3, res.json()["tid"])
+        self.assertEqual(3, len(fake.targets))
+
+    @patch("volexport.tgtd.Tgtd.myaddress")
+    @patch("volexport.tgtd.Tgtd.tgtadm")
+    @patch("volexport.api_export.LV")
+    def test_api_reuse_node(self, lv, tgtadm, myaddress):
+        lv.return_value.volume_vol2path.return_value = str(self.dev1)
+        myaddress.return_value = ["1.1.1.1:3260"]
+        fake = FakeTgtd()
+        tgtadm.side_effect = fake
+        # CSI publish: no ACL, the controller address is the ACL of every node
+        arg = dict(name="vol1", acl=None)
+        res_a = TestClient(api).post("/export", json=dict(arg, node="nodeA"), params=dict(reuse="1"))
+        self.assertEqual(200, res_a.status_code)
+        res_b = TestClient(api).post("/export", json=dict(arg, node="nodeB"), params=dict(reuse="1"))
+        self.assertEqual(200, res_b.status_code)
+        self.assertEqual(res_a.json()["acl"], res_b.json()["acl"])
+        self.assertNotEqual(res_a.json()["targetname"], res_b.json()["targetname"])
+        self.assertEqual(2, len(fake.targets))
+        # retries of each node
+        self.assertEqual(
+            res_a.json(), TestClient(api).post("/export", json=dict(arg, node="nodeA"), params=dict(reuse="1")).json()
+        )
+        self.assertEqual(
+            res_b.json(), TestClient(api).post("/export", json=dict(arg, node="nodeB"), params=dict(reuse="1")).json()
+        )
+        self.assertEqual(2, len(fake.targets))
+        self.assertEqual(["nodeA", "nodeB"], [x["node"] for x in exportstate.entries()])
+
+    @patch("volexport.tgtd.Tgtd.myaddress")
+    @patch("volexport.tgtd.Tgtd.tgtadm")
+    @patch("volexport.api_export.LV")
+    def test_api_reuse_unknown(self, lv, tgtadm, myaddress):
+        lv.return_value.volume_vol2path.return_value = str(self.dev1)
+        myaddress.return_value = []
+        fake = FakeTgtd()
+        tgtadm.side_effect = fake
+        arg = dict(name="vol1", acl=["10.0.0.1"], user="user1", passwd="passwd1")
+        with patch.object(config, "EXPORT_STATE", None):
+            res1 = TestClient(api).post("/export", json=arg, params=dict(reuse="1"))
+            # password is given
+            res2 = TestClient(api).post("/export", json=arg, params=dict(reuse="1"))
+            self.assertEqual(res1.json(), res2.json())
+            # password is unknown
+            res3 = TestClient(api).post("/export", json=dict(arg, user=None, passwd=None), params=dict(reuse="1"))
+        self.assertEqual(1, res2.json()["tid"])
+        self.assertEqual(2, res3.json()["tid"])
+
+    @patch("volexport.exportstate.TgtdWatchdog.run_once")
+    def test_loop(self, run_once):
+        run_once.side_effect = [RuntimeError("error"), 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0]
+        wd = exportstate.TgtdWatchdog(poll=0.01)
+        wd.start()
+        try:
+            for _ in range(500):
+                if run_once.call_count >= 3:
+                    break
+                wd._stop.wait(0.01)
+        finally:
+            wd.stop()
+        self.assertGreaterEqual(run_once.call_count, 3)
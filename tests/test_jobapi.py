@@ -0,0 +1,177 @@
+import unittest
+import threading
+from unittest.mock import patch, MagicMock, ANY
+from fastapi.testclient import TestClient
+from volexport.api import api
+from volexport.jobs import JobManager, JobStatus, progress
+from volexport.exceptions import Busy
+from volexport.util import slot_wait
+
+
+class TestJobManager(unittest.TestCase):
+    def setUp(self):
+        self.mgr = JobManager(workers=1, history=2, queue=10)
+
+    def test_submit(self):
+        job = self.mgr.submit("test", lambda: 123, volume="vol1")
+        job.future.result(timeout=5)
+        self.assertEqual(JobStatus.succeeded, job.status)
+        self.assertEqual(123, job.result)
+        self.assertEqual(1.0, job.progress)
+        self.assertEqual([job], self.mgr.list(volume="vol1"))
+        self.assertEqual([], self.mgr.list(volume="vol2"))
+
+    def test_failed(self):
+        def fn():
+            raise ValueError("error123")
+
+        job = self.mgr.submit("test", fn)
+        job.future.result(timeout=5)
+        self.assertEqual(JobStatus.failed, job.status)
+        self.assertEqual("ValueError: error123", job.error)
+
+    def test_cancel(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def fn():
+            started.set()
+            release.wait(5)
+            progress(0.5, "half")
+            return "unreachable"
+
+        job1 = self.mgr.submit("test1", fn)
+        job2 = self.mgr.submit("test2", lambda: 1)
+        started.wait(5)
+        # queued job is cancelled immediately
+        self.assertEqual(JobStatus.cancelled, self.mgr.cancel(job2.id).status)
+        # running job is cancelled at next progress update
+        self.mgr.cancel(job1.id)
+        release.set()
+        job1.future.result(timeout=5)
+        self.assertEqual(JobStatus.cancelled, job1.status)
+        self.assertIsNone(job1.result)
+
+    def test_slot_wait(self):
+        # submitted from a request, the job may wait for a command slot
+        token = slot_wait.set(False)
+        try:
+            job = self.mgr.submit("test", slot_wait.get)
+        finally:
+            slot_wait.reset(token)
+        job.future.result(timeout=5)
+        self.assertTrue(job.result)
+
+    def test_queue_full(self):
+        started = threading.Event()
+        release = threading.Event()
+        mgr = JobManager(workers=1, history=2, queue=1)
+        job1 = mgr.submit("test1", lambda: (started.set(), release.wait(5)))
+        started.wait(5)
+        job2 = mgr.submit("test2", lambda: None)
+        with self.assertRaises(Busy):
+            mgr.submit("test3", lambda: None)
+        release.set()
+        job1.future.result(timeout=5)
+        job2.future.result(timeout=5)
+        mgr.submit("test4", lambda: None).future.result(timeout=5)
+
+    def test_volume_serialized(self):
+        started = threading.Event()
+        release = threading.Event()
+        mgr = JobManager(workers=2, history=10, queue=10)
+        job1 = mgr.submit("mkfs", lambda: (started.set(), release.wait(5)), volume="vol1")
+        started.wait(5)
+        job2 = mgr.submit("resize", lambda: 2, volume="vol1")
+        job3 = mgr.submit("resize", lambda: 3, volume="vol1")
+        # other volume is not blocked
+        job4 = mgr.submit("resize", lambda: 4, volume="vol2")
+        job4.future.result(timeout=5)
+        self.assertEqual(JobStatus.succeeded, job4.status)
+        self.assertIsNone(job2.future)
+        self.assertEqual(JobStatus.queued, job2.status)
+        # waiting job is cancelled without running
+        self.assertEqual(JobStatus.cancelled, mgr.cancel(job3.id).status)
+        release.set()
+        job1.future.result(timeout=5)
+        job2.future.result(timeout=5)
+        self.assertEqual(JobStatus.succeeded, job2.status)
+        self.assertEqual(2, job2.result)
+        self.assertIsNone(job3.future)
+        self.assertEqual({}, mgr._volumes)
+
+    def test_history(self):
+        done = [self.mgr.submit(f"test{i}", lambda: None) for i in range(4)]
+        for i in done:
+            i.future.result(timeout=5)
+        self.mgr.submit("test", lambda: None).future.result(timeout=5)
+        self.assertLessEqual(len(self.mgr.list()), 3)
+        with self.assertRaises(FileNotFoundError):
+            self.mgr.get(done[0].id)
+
+
+class TestJobAPI(unittest.TestCase):
+    run_basearg = dict(capture_output=True, encoding="utf-8", timeout=10.0, stdin=-3, start_new_session=True)
+    lvs1 = """{"report": [{"lv": [{"lv_name": "lv1", "lv_full_name": "vg0/lv1", "lv_path": "/dev/vg0/lv1",
+"lv_tags": "volname.lv1", "lv_time": "2025-08-10 16:48:15 +0900", "lv_active": "active", "lv_size": "1048576",
+"lv_permissions": "writeable", "origin": "", "pool_lv": "", "lv_device_open": "", "lv_uuid": "xyz",
+"lv_parent": ""}]}]}"""
+
+    def _wait(self, client, jobid):
+        from volexport.jobs import jobs
+
+        jobs.get(jobid).future.result(timeout=5)
+        res = client.get(f"/jobs/{jobid}")
+        self.assertEqual(200, res.status_code)
+        return res.json()
+
+    @patch("volexport.util._run_cancellable")
+    @patch("shutil.which")
+    def test_mkfs_async(self, which, crun):
+        which.return_value = "/bin/mkfs.ext4"
+        crun.side_effect = [MagicMock(stdout=self.lvs1), MagicMock(), MagicMock(stdout=self.lvs1)]
+        client = TestClient(api)
+        res = client.post("/volume/lv1/mkfs", json={"filesystem": "ext4"}, params={"async": "1"})
+        self.assertEqual(202, res.status_code)
+        self.assertEqual("mkfs lv1", res.json()["name"])
+        self.assertEqual("lv1", res.json()["volume"])
+        job = self._wait(client, res.json()["id"])
+        self.assertEqual("succeeded", job["status"])
+        self.assertEqual("lv1", job["result"]["name"])
+        crun.assert_any_call(["sudo", "mkfs.ext4", "-L", "lv1", "/dev/vg0/lv1"], 600.0, ANY)
+        joblist = client.get("/jobs", params={"volume": "lv1"})
+        self.assertEqual(200, joblist.status_code)
+        self.assertIn(res.json()["id"], [x["id"] for x in joblist.json()])
+
+    @patch("volexport.util._run_cancellable")
+    def test_resize_async(self, crun):
+        lvs1 = MagicMock(stdout=self.lvs1)
+        crun.side_effect = [lvs1, MagicMock(), lvs1, MagicMock(stdout=""), lvs1]
+        client = TestClient(api)
+        res = client.post("/volume/lv1", json={"size": 2048}, params={"async": "true"})
+        self.assertEqual(202, res.status_code)
+        job = self._wait(client, res.json()["id"])
+        self.assertEqual("succeeded", job["status"], job["error"])
+        crun.assert_any_call(["sudo", "lvresize", "--size", "2048b", "vg0/lv1", "--yes"], 10.0, ANY)
+
+    def test_mkfs_async_failed(self):
+        client = TestClient(api)
+        with patch("shutil.which") as which:
+            which.return_value = None
+            res = client.post("/volume/lv1/mkfs", json={"filesystem": "ext4"}, params={"async": "1"})
+            self.assertEqual(202, res.status_code)
+            job = self._wait(client, res.json()["id"])
+        self.assertEqual("failed", job["status"])
+        self.assertEqual("NotImplementedError: not supported", job["error"])
+
+    def test_job_notfound(self):
+        res = TestClient(api).get("/jobs/notfound")
+        self.assertEqual(404, res.status_code)
+        res = TestClient(api).delete("/jobs/notfound")
+        self.assertEqual(404, res.status_code)
+
+    @patch("subprocess.run")
+    def test_rollback_notfound(self, run):
+        run.return_value.stdout = self.lvs1
+        res = TestClient(api).post("/volume/lv0/snapshot/lv1/rollback")
+        self.assertEqual(404, res.status_code)
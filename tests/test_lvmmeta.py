@@ -0,0 +1,368 @@
+import unittest
+import random
+from volexport import lvmmeta
+from volexport.exceptions import InvalidArgument
+
+
+def _parse_yaml(s: str) -> dict:
+    # former implementation, kept for comparison
+    import yaml
+
+    s = s.replace(" =", ":")
+    s = s.replace(" {", ":")
+    s = s.replace("\t", " ")
+    s = s.replace("}", "")
+    return yaml.safe_load("\n".join([x.rstrip() for x in s.splitlines()]))
+
+
+def _dump(d: dict, indent: int = 0) -> str:
+    def val(v):
+        if isinstance(v, list):
+            return "[" + ", ".join(val(x) for x in v) + "]"
+        if isinstance(v, str):
+            return '"' + v.replace("\\", "\\\\").replace('"', '\\"') + '"'
+        return str(v)
+
+    res = []
+    for k, v in d.items():
+        if isinstance(v, dict):
+            res.extend(["\t" * indent + k + " {", _dump(v, indent + 1), "\t" * indent + "}"])
+        else:
+            res.append("\t" * indent + f"{k} = {val(v)}")
+    return "\n".join(res)
+
+
+def _generate(num: int) -> str:
+    lines = [
+        'contents = "Text Format Volume Group"',
+        "version = 1",
+        "",
+        "vg0 {",
+        '\tid = "VuhVBu-g8uH-mYag-L7Ma-lHst-N60P-p31JU1"',
+        "\tseqno = 3",
+        "\textent_size = 8192\t\t# 4 Megabytes",
+        "\tlogical_volumes {",
+    ]
+    for i in range(num):
+        lines.extend(
+            [
+                "",
+                f"\t\tlv{i:05d} {{",
+                f'\t\t\tid = "p29l7T-Kn30-VbRn-C7HV-fltO-{i:09d}"',
+                '\t\t\tstatus = ["READ", "WRITE", "VISIBLE"]',
+                "\t\t\tflags = []",
+                f'\t\t\ttags = ["volname.vol{i}"]',
+                "\t\t\tcreation_time = 1760225467\t# 2025-10-12 08:31:07 +0900",
+                '\t\t\tcreation_host = "lima-server"',
+                "\t\t\tsegment_count = 1",
+                "",
+                "\t\t\tsegment1 {",
+                "\t\t\t\tstart_extent = 0",
+                "\t\t\t\textent_count = 2560\t# 10 Gigabytes",
+                "",
+                '\t\t\t\ttype = "striped"',
+                "\t\t\t\tstripe_count = 1\t# linear",
+                "",
+                "\t\t\t\tstripes = [",
+                '\t\t\t\t\t"pv0", 0',
+                "\t\t\t\t]",
+                "\t\t\t}",
+                "\t\t}",
+            ]
+        )
+    lines.extend(["\t}", "}", ""])
+    return "\n".join(lines)
+
+
+class TestLvmMeta(unittest.TestCase):
+    thin_content = """
+# Generated by LVM2 version 2.03.16(2) (2022-05-18): Sun Oct 12 08:40:11 2025
+
+contents = "Text Format Volume Group"
+version = 1
+
+description = "Created *before* executing 'lvcreate -n \\"a {b}\\" vg0'"
+
+creation_host = "lima-server"	# Linux lima-server 6.8.0-63-generic #66-Ubuntu SMP PREEMPT_DYNAMIC aarch64
+creation_time = 1760226011	# Sun Oct 12 08:40:11 2025
+
+vg0 {
+	id = "VuhVBu-g8uH-mYag-L7Ma-lHst-N60P-p31JU1"
+	seqno = 12
+	format = "lvm2"			# informational
+	status = ["RESIZEABLE", "READ", "WRITE"]
+	flags = []
+	extent_size = 8192		# 4 Megabytes
+	max_lv = 0
+	max_pv = 0
+	metadata_copies = 0
+
+	physical_volumes {
+
+		pv0 {
+			id = "38PCVU-G7iU-n5P0-GBvH-fSoL-HQWc-Khv8b0"
+			device = "/dev/vdb"	# Hint only
+
+			status = ["ALLOCATABLE"]
+			flags = []
+			dev_size = 524288000	# 250 Gigabytes
+			pe_start = 2048
+			pe_count = 63999	# 249.996 Gigabytes
+		}
+	}
+
+	logical_volumes {
+
+		pool0 {
+			id = "Bv1Bq2-Hk5l-9pQe-sZ0A-mYn3-Ne5O-Xw1Yzc"
+			status = ["READ", "WRITE", "VISIBLE"]
+			flags = []
+			creation_time = 1760225400	# 2025-10-12 08:30:00 +0900
+			creation_host = "lima-server"
+			segment_count = 1
+
+			segment1 {
+				start_extent = 0
+				extent_count = 25600	# 100 Gigabytes
+
+				type = "thin-pool"
+				metadata = "pool0_tmeta"
+				pool = "pool0_tdata"
+				transaction_id = 2
+				chunk_size = 128	# 64 Kilobytes
+				discards = "passdown"
+				zero_new_blocks = 1
+			}
+		}
+
+		thin1 {
+			id = "aB3dEf-1234-5678-9abc-defg-hijk-lmnopq"
+			status = ["READ", "WRITE", "VISIBLE"]
+			flags = []
+			tags = ["volname.vol{1}", "owner.\\\\x"]
+			creation_time = 1760225500	# 2025-10-12 08:31:40 +0900
+			creation_host = "lima-server"
+			segment_count = 1
+
+			segment1 {
+				start_extent = 0
+				extent_count = 2560	# 10 Gigabytes
+
+				type = "thin"
+				thin_pool = "pool0"
+				transaction_id = 0
+				device_id = 1
+			}
+		}
+
+		snap1 {
+			id = "zY9xWv-8765-4321-0fed-cbaz-yxwv-utsrqp"
+			status = ["READ", "VISIBLE"]
+			flags = ["ACTIVATION_SKIP"]
+			tags = ["volname.snap #1"]
+			creation_time = 1760225600	# 2025-10-12 08:33:20 +0900
+			creation_host = "lima-server"
+			segment_count = 1
+
+			segment1 {
+				start_extent = 0
+				extent_count = 2560	# 10 Gigabytes
+
+				type = "thin"
+				thin_pool = "pool0"
+				transaction_id = 1
+				device_id = 2
+				origin = "thin1"
+			}
+		}
+
+		lvol0_pmspare {
+			id = "Qq1Ww2-Ee3R-r4Tt-5Yy6-Uu7I-i8Oo-9Pp0Aa"
+			status = ["READ", "WRITE"]
+			flags = []
+			creation_time = 1760225400	# 2025-10-12 08:30:00 +0900
+			creation_host = "lima-server"
+			segment_count = 2
+
+			segment1 {
+				start_extent = 0
+				extent_count = 1	# 4 Megabytes
+
+				type = "striped"
+				stripe_count = 1	# linear
+
+				stripes = [
+					"pv0", 0
+				]
+			}
+			segment2 {
+				start_extent = 1
+				extent_count = 2	# 8 Megabytes
+
+				type = "striped"
+				stripe_count = 1	# linear
+
+				stripes = [
+					"pv0", 30000
+				]
+			}
+		}
+	}
+
+}
+"""
+
+    def test_tokenize(self):
+        self.assertEqual(
+            [
+                ("ident", "a", 1),
+                ("op", "=", 1),
+                ("op", "[", 1),
+                ("string", 'x"}', 1),
+                ("op", ",", 1),
+                ("number", -1, 1),
+                ("op", ",", 1),
+                ("number", 1.5, 1),
+                ("op", "]", 1),
+                ("ident", "608dec48-a7f6", 3),
+                ("op", "{", 3),
+                ("op", "}", 3),
+            ],
+            lvmmeta.tokenize('a = ["x\\"}", -1, 1.5] # comment {\n\n608dec48-a7f6 {}'),
+        )
+
+    def test_loads(self):
+        meta = lvmmeta.loads(self.thin_content)
+        self.assertEqual(1, meta.version)
+        self.assertEqual("Created *before* executing 'lvcreate -n \"a {b}\" vg0'", meta.description)
+        self.assertEqual("lima-server", meta.creation_host)
+        self.assertEqual(["vg0"], list(meta.volume_groups.keys()))
+        vg = meta.volume_groups["vg0"]
+        self.assertEqual(8192, vg.extent_size)
+        self.assertEqual(12, vg.seqno)
+        self.assertEqual(63999, vg.physical_volumes["pv0"].pe_count)
+        self.assertEqual("/dev/vdb", vg.physical_volumes["pv0"].device)
+        self.assertEqual(["pool0", "thin1", "snap1", "lvol0_pmspare"], list(vg.logical_volumes.keys()))
+        pool = vg.logical_volumes["pool0"]
+        self.assertTrue(pool.thin_pool)
+        self.assertFalse(pool.thin)
+        self.assertEqual("pool0_tmeta", pool.segments[0].attrs["metadata"])
+        thin = vg.logical_volumes["thin1"]
+        self.assertEqual("vol{1}", thin.tag("volname."))
+        self.assertEqual("\\x", thin.tag("owner."))
+        self.assertTrue(thin.thin)
+        self.assertTrue(thin.writable)
+        self.assertIsNone(thin.origin)
+        self.assertEqual(10 * 1024 * 1024 * 1024, vg.lv_size(thin))
+        snap = vg.logical_volumes["snap1"]
+        self.assertEqual("snap #1", snap.tag("volname."))
+        self.assertEqual("thin1", snap.origin)
+        self.assertFalse(snap.writable)
+        self.assertEqual(["ACTIVATION_SKIP"], snap.flags)
+        spare = vg.logical_volumes["lvol0_pmspare"]
+        self.assertFalse(spare.visible)
+        self.assertIsNone(spare.tag("volname."))
+        self.assertEqual(3, spare.extent_count)
+        self.assertEqual(["pv0", 30000], spare.segments[1].attrs["stripes"])
+
+    def test_compat(self):
+        text = _generate(10)
+        self.assertEqual(_parse_yaml(text), lvmmeta.parse(text))
+
+    def test_invalid(self):
+        for text in [
+            "a",
+            "a =",
+            "a = ",
+            "a = b",
+            "a = [",
+            'a = ["x"',
+            "a = [x]",
+            "a {",
+            "a { b = 1",
+            "}",
+            "a = 1 }",
+            "= 1",
+            "a b",
+            'a = "x',
+            "a = 1 $",
+            "a { b { } c = [1, [2]] }",
+        ]:
+            with self.subTest(text=text):
+                with self.assertRaises(InvalidArgument):
+                    lvmmeta.parse(text)
+        for text in [
+            'version = "1"',
+            "vg0 { extent_size = [1] }",
+            "vg0 { logical_volumes { lv0 = 1 } }",
+            "vg0 { logical_volumes { lv0 { tags = [1] } } }",
+            "vg0 { logical_volumes { lv0 { segment_count = 2 segment1 { } } } }",
+            'vg0 { logical_volumes { lv0 { segment_count = 1 segment1 { extent_count = "1" } } } }',
+        ]:
+            with self.subTest(text=text):
+                with self.assertRaises(InvalidArgument):
+                    lvmmeta.loads(text)
+
+    def test_fuzz_roundtrip(self):
+        rnd = random.Random(1234)
+        chars = 'ab09 \t\n"\\{}[]=,#.-_+:@'
+
+        def rstr():
+            return "".join(rnd.choice(chars) for _ in range(rnd.randrange(10)))
+
+        def rkey():
+            return rnd.choice(["a", "b0", "lv-1", "608dec48-a7f6", "x.y+z", "_tdata", "c:d@e"]) + str(rnd.randrange(5))
+
+        def rvalue():
+            return rnd.choice(
+                [
+                    lambda: rnd.randrange(-(2**40), 2**64),
+                    rstr,
+                    lambda: [rnd.choice([rstr, lambda: rnd.randrange(100)])() for _ in range(rnd.randrange(4))],
+                ]
+            )()
+
+        def rtree(depth):
+            res = {}
+            for _ in range(rnd.randrange(6)):
+                if depth < 4 and rnd.random() < 0.3:
+                    res[rkey()] = rtree(depth + 1)
+                else:
+                    res[rkey()] = rvalue()
+            return res
+
+        for _ in range(300):
+            tree = rtree(0)
+            self.assertEqual(tree, lvmmeta.parse(_dump(tree)))
+
+    def test_fuzz_mutation(self):
+        rnd = random.Random(5678)
+        chars = '{}[]=,"#\\\n \tax0-'
+        for _ in range(1000):
+            text = list(self.thin_content)
+            for _ in range(rnd.randrange(1, 4)):
+                pos = rnd.randrange(len(text))
+                op = rnd.randrange(3)
+                if op == 0:
+                    del text[pos]
+                elif op == 1:
+                    text.insert(pos, rnd.choice(chars))
+                else:
+                    text[pos] = rnd.choice(chars)
+            try:
+                lvmmeta.loads("".join(text))
+            except InvalidArgument:
+                pass
+        for pos in range(0, len(self.thin_content), 7):
+            try:
+                lvmmeta.loads(self.thin_content[:pos])
+            except InvalidArgument:
+                pass
+
+    def test_large(self):
+        num = 10000
+        meta = lvmmeta.loads(_generate(num))
+        self.assertEqual(num, len(meta.volume_groups["vg0"].logical_volumes))
+        # same result as former implementation
+        text = _generate(num // 10)
+        self.assertEqual(_parse_yaml(text), lvmmeta.parse(text))
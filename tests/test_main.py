@@ -1,5 +1,9 @@
 import unittest
 import json
+import os
+import subprocess
+import sys
+import tempfile
 from unittest.mock import patch, ANY, MagicMock
 from volexport.main import cli
 from click.testing import CliRunner
@@ -59,10 +63,18 @@ class TestCLI(unittest.TestCase):
     )
     tgtd = MagicMock(stdout="")
 
+    def _cmd(self, cmd, **kwargs):
+        # pre-boot checks run concurrently
+        if "vgs" in cmd:
+            return self.vgs
+        if "lvs" in cmd:
+            return MagicMock(stdout='{"report": [{"lv": []}]}')
+        return self.tgtd
+
     @patch("uvicorn.run")
     @patch("subprocess.run")
     def test_server_verbose(self, prun, urun):
-        prun.side_effect = [self.vgs, self.tgtd]
+        prun.side_effect = self._cmd
         res = CliRunner().invoke(cli, ["server", "--verbose"])
         self.assertEqual(0, res.exit_code)
         if res.exception:
@@ -72,7 +84,7 @@ class TestCLI(unittest.TestCase):
     @patch("uvicorn.run")
     @patch("subprocess.run")
     def test_server_opts(self, prun, urun):
-        prun.side_effect = [self.vgs, self.tgtd]
+        prun.side_effect = self._cmd
         res = CliRunner().invoke(
             cli,
             ["server", "--quiet", "--vg", "vg123", "--nics", "eth0", "--nics", "eth1", "--hostport", "127.0.0.1:9999"],
@@ -85,7 +97,7 @@ class TestCLI(unittest.TestCase):
     @patch("uvicorn.run")
     @patch("subprocess.run")
     def test_server_opts_unix(self, prun, urun):
-        prun.side_effect = [self.vgs, self.tgtd]
+        prun.side_effect = self._cmd
         res = CliRunner().invoke(
             cli,
             [
@@ -105,3 +117,97 @@ class TestCLI(unittest.TestCase):
             raise res.exception
         self.assertEqual(0, res.exit_code)
         urun.assert_called_once_with(ANY, uds="/tmp/test.sock", log_config=None)
+
+    @patch("uvicorn.run")
+    @patch("subprocess.run")
+    def test_server_warmup(self, prun, urun):
+        from volexport.config import config
+        from volexport.statedb import StateDB
+
+        prun.side_effect = self._cmd
+        with tempfile.TemporaryDirectory() as td:
+            with patch.object(config, "STATE_DB", f"{td}/state.db"), patch.object(config, "BACKUP_DIR", td):
+                res = CliRunner().invoke(cli, ["server", "--quiet", "--warmup"])
+            if res.exception:
+                raise res.exception
+            self.assertEqual(0, res.exit_code)
+            cmds = [x.args[0] for x in prun.call_args_list]
+            self.assertTrue(any("lvs" in x for x in cmds))
+            self.assertTrue(any("show" in x for x in cmds))
+            # state store is reconciled, backup index is written
+            self.assertIsNotNone(StateDB(f"{td}/state.db", "vg0").get_meta("reconciled"))
+            self.assertTrue(os.path.exists(f"{td}/index.json"))
+        urun.assert_called_once_with(ANY, host="127.0.0.1", port=8080, log_config=None)
+
+    @patch("uvicorn.run")
+    @patch("subprocess.run")
+    def test_server_check_failed(self, prun, urun):
+        novg = MagicMock(stdout='{"report": [{"vg": []}]}')
+        prun.side_effect = lambda cmd, **kwargs: novg if "vgs" in cmd else self.tgtd
+        res = CliRunner().invoke(cli, ["server", "--quiet"])
+        self.assertIsInstance(res.exception, AssertionError)
+        urun.assert_not_called()
+
+
+class TestImportTime(unittest.TestCase):
+    lazy = {"yaml", "ifaddr", "uvicorn"}
+
+    def _importtime(self, module) -> dict[str, int]:
+        env = dict(os.environ, VOLEXP_VG="vg0", VOLEXP_NICS="[]")
+        res = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+            capture_output=True,
+            encoding="utf-8",
+            env=env,
+            check=True,
+        )
+        times = {}
+        for line in res.stderr.splitlines():
+            if not line.startswith("import time:") or "|" not in line:
+                continue
+            _, cumulative, name = line.removeprefix("import time:").split("|")
+            if cumulative.strip().isdigit():
+                times[name.strip()] = int(cumulative)
+        return times
+
+    def test_api(self):
+        times = self._importtime("volexport.api")
+        self.assertIn("volexport.api", times)
+        self.assertEqual(set(), self.lazy & times.keys())
+        # imported by the services or endpoints using them
+        self.assertEqual(set(), {"sqlite3", "volexport.backup", "volexport.scheduler"} & times.keys())
+        self.assertLess(times["volexport.api"], 5_000_000)  # usec
+
+    def test_main(self):
+        times = self._importtime("volexport.main")
+        self.assertEqual(set(), self.lazy & times.keys())
+        self.assertNotIn("fastapi", times)
+
+
+class TestServices(unittest.TestCase):
+    def test_disabled(self):
+        from volexport.api import _services
+
+        self.assertEqual([], _services())
+
+    @patch("volexport.warmpool.warm_pool")
+    @patch("volexport.statedb.state_reconciler")
+    @patch("volexport.exportstate.tgtd_watchdog")
+    @patch("volexport.api_mgmt.backup_scheduler")
+    def test_lifespan(self, scheduler, watchdog, reconciler, pool):
+        from fastapi.testclient import TestClient
+        from volexport.api import api
+        from volexport.config import config, WarmPoolSpec
+
+        with (
+            patch.object(config, "BACKUP_DEBOUNCE", 1.0),
+            patch.object(config, "EXPORT_STATE", "/nonexistent/state.json"),
+            patch.object(config, "STATE_DB", "/nonexistent/state.db"),
+            patch.object(config, "WARM_POOL", [WarmPoolSpec(size=1024, count=1)]),
+        ):
+            with TestClient(api):
+                for svc in (scheduler, watchdog, reconciler, pool):
+                    svc.return_value.start.assert_called_once_with()
+                    svc.return_value.stop.assert_not_called()
+        for svc in (scheduler, watchdog, reconciler, pool):
+            svc.return_value.stop.assert_called_once_with()
@@ -0,0 +1,61 @@
+import unittest
+from fastapi.testclient import TestClient
+from volexport.metrics import Registry
+from volexport.api import api
+
+
+class TestMetrics(unittest.TestCase):
+    def test_counter(self):
+        reg = Registry()
+        cnt = reg.counter("test_total", "test counter", ["result"])
+        cnt.inc(result="ok")
+        cnt.inc(2, result="ok")
+        cnt.inc(result="error")
+        self.assertEqual(3, cnt.get(result="ok"))
+        self.assertEqual(
+            '# HELP test_total test counter\n# TYPE test_total counter\ntest_total{result="error"} 1\n'
+            'test_total{result="ok"} 3\n',
+            reg.render(),
+        )
+        with self.assertRaises(ValueError):
+            cnt.inc(-1, result="ok")
+        with self.assertRaises(ValueError):
+            cnt.inc(other="x")
+        with self.assertRaises(ValueError):
+            reg.counter("test_total", "duplicated")
+
+    def test_gauge(self):
+        reg = Registry()
+        g = reg.gauge("test_value", "test gauge")
+        g.set(1.5)
+        self.assertEqual("# HELP test_value test gauge\n# TYPE test_value gauge\ntest_value 1.5\n", reg.render())
+
+    def test_histogram(self):
+        reg = Registry()
+        h = reg.histogram("test_seconds", "test histogram", ["method"], buckets=[0.1, 1.0])
+        for v in [0.05, 0.5, 0.5, 3.0]:
+            h.observe(v, method="get")
+        self.assertEqual(4, h.count(method="get"))
+        self.assertEqual(
+            [
+                "# HELP test_seconds test histogram",
+                "# TYPE test_seconds histogram",
+                'test_seconds_bucket{method="get",le="0.1"} 1',
+                'test_seconds_bucket{method="get",le="1"} 3',
+                'test_seconds_bucket{method="get",le="+Inf"} 4',
+                'test_seconds_sum{method="get"} 4.05',
+                'test_seconds_count{method="get"} 4',
+            ],
+            reg.render().splitlines(),
+        )
+
+    def test_escape(self):
+        reg = Registry()
+        reg.counter("test_total", "test", ["name"]).inc(name='a"b\nc')
+        self.assertIn('test_total{name="a\\"b\\nc"} 1', reg.render())
+
+    def test_endpoint(self):
+        res = TestClient(api).get("/metrics")
+        self.assertEqual(200, res.status_code)
+        self.assertTrue(res.headers["content-type"].startswith("text/plain"))
+        self.assertIn("# TYPE volexp_export_recovery_seconds histogram", res.text)
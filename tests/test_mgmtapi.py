@@ -2,11 +2,14 @@ import unittest
 import tempfile
 import zipfile
 import io
+import os
+import time
 from pathlib import Path
 from unittest.mock import patch, ANY
 from fastapi.testclient import TestClient
 from volexport.api import api
 from volexport.config import config
+from volexport.api_mgmt import parse_volbackup
 
 
 class TestMgmtAPI(unittest.TestCase):
@@ -64,6 +67,20 @@ hello world
         self.assertTrue((bkdir / "2025-09-01.backup").exists())
         self.assertTrue((bkdir / "2025-09-02.backup").exists())
 
+    def test_forget_max_age(self):
+        bkdir = Path(self.td.name)
+        now = time.time()
+        for name, age in [("2025-08-29", 300), ("2025-08-30", 200), ("2025-08-31", 100), ("2025-09-01", 150)]:
+            (bkdir / f"{name}.backup").write_text(name)
+            os.utime(bkdir / f"{name}.backup", (now - age, now - age))
+        res = TestClient(api).delete("/mgmt/backup", params={"keep": 3, "max_age": 120})
+        self.assertEqual(200, res.status_code)
+        self.assertFalse((bkdir / "2025-08-29.backup").exists())
+        self.assertFalse((bkdir / "2025-08-30.backup").exists())
+        self.assertTrue((bkdir / "2025-08-31.backup").exists())
+        # newest one is kept even if expired
+        self.assertTrue((bkdir / "2025-09-01.backup").exists())
+
     def _example_backup(self, export: bytes, volume: bytes):
         buf = io.BytesIO()
         zf = zipfile.ZipFile(buf, "w")
@@ -72,6 +89,12 @@ hello world
         zf.close()
         return buf.getvalue()
 
+    def _download(self, name) -> dict[str, bytes]:
+        res = TestClient(api).get(f"/mgmt/backup/{name}")
+        self.assertEqual(200, res.status_code)
+        zf = zipfile.ZipFile(io.BytesIO(res.content))
+        return {x: zf.read(x) for x in zf.namelist()}
+
     def test_put_delete(self):
         bkdir = Path(self.td.name)
         content = self._example_backup(b"hello export\n", b"hello volume\n")
@@ -79,7 +102,7 @@ hello world
         self.assertEqual(200, res.status_code)
         self.assertEqual({"status": "OK"}, res.json())
         self.assertTrue((bkdir / "2025-08-31.backup").exists())
-        self.assertEqual(content, (bkdir / "2025-08-31.backup").read_bytes())
+        self.assertEqual({"export": b"hello export\n", "volume": b"hello volume\n"}, self._download("2025-08-31"))
 
         resexists = TestClient(api).put("/mgmt/backup/2025-08-31", content=content)
         self.assertEqual(400, resexists.status_code)
@@ -115,6 +138,76 @@ hello world
         self.assertEqual(400, res.status_code)
         self.assertIn("detail", res.json())
 
+    def test_put_stream(self):
+        bkdir = Path(self.td.name)
+        content = self._example_backup(b"hello export\n", b"hello volume\n")
+        chunks = [content[i : i + 10] for i in range(0, len(content), 10)]
+        res = TestClient(api).put("/mgmt/backup/2025-08-31", content=iter(chunks))
+        self.assertEqual(200, res.status_code)
+        self.assertEqual({"export": b"hello export\n", "volume": b"hello volume\n"}, self._download("2025-08-31"))
+        self.assertEqual(["2025-08-31.backup", "blobs", "index.json"], sorted(x.name for x in bkdir.iterdir()))
+
+    def test_put_offload(self):
+        from starlette.concurrency import run_in_threadpool
+
+        content = self._example_backup(b"hello export\n", b"hello volume\n")
+        chunks = [content[i : i + 10] for i in range(0, len(content), 10)]
+        called = []
+
+        async def offload(fn, *args, **kwargs):
+            called.append(getattr(fn, "__name__", ""))
+            return await run_in_threadpool(fn, *args, **kwargs)
+
+        with patch("volexport.api_mgmt.UPLOAD_BUFSIZE", 64), patch("volexport.api_mgmt.run_in_threadpool", offload):
+            res = TestClient(api).put("/mgmt/backup/2025-08-31", content=iter(chunks))
+        self.assertEqual(200, res.status_code)
+        # batched writes, not in the event loop
+        self.assertLess(1, called.count("write"))
+        self.assertLess(called.count("write"), len(chunks))
+        self.assertEqual({"export": b"hello export\n", "volume": b"hello volume\n"}, self._download("2025-08-31"))
+
+    def test_put_too_large(self):
+        bkdir = Path(self.td.name)
+        content = self._example_backup(b"hello export\n", b"hello volume\n")
+        orig = config.BACKUP_MAX_SIZE
+        config.BACKUP_MAX_SIZE = len(content) - 1
+        try:
+            res = TestClient(api).put("/mgmt/backup/2025-08-31", content=content)
+            self.assertEqual(413, res.status_code)
+            # without content-length
+            res = TestClient(api).put("/mgmt/backup/2025-08-31", content=iter([content]))
+            self.assertEqual(413, res.status_code)
+        finally:
+            config.BACKUP_MAX_SIZE = orig
+        self.assertEqual([], list(bkdir.iterdir()))
+
+    def test_put_too_large_uncompressed(self):
+        buf = io.BytesIO()
+        with zipfile.ZipFile(buf, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+            zf.writestr("export", b"x" * 100000)
+            zf.writestr("volume", b"hello volume\n")
+        content = buf.getvalue()
+        orig = config.BACKUP_MAX_SIZE
+        config.BACKUP_MAX_SIZE = 50000
+        try:
+            res = TestClient(api).put("/mgmt/backup/2025-08-31", content=content)
+            self.assertEqual(413, res.status_code)
+        finally:
+            config.BACKUP_MAX_SIZE = orig
+
+    def test_put_invalid_cleanup(self):
+        bkdir = Path(self.td.name)
+        res = TestClient(api).put("/mgmt/backup/2025-08-31", content=b"hello world\n")
+        self.assertEqual(400, res.status_code)
+        self.assertEqual([], list(bkdir.iterdir()))
+
+    def test_read_invalid(self):
+        bkdir = Path(self.td.name)
+        (bkdir / "2025-08-31.backup").write_bytes(self._example_backup(b"exp123", b"vol123"))
+        res = TestClient(api).get("/mgmt/backup/2025-08-31/volume")
+        self.assertEqual(400, res.status_code)
+        self.assertEqual(404, TestClient(api).get("/mgmt/backup/notfound/volume").status_code)
+
     def test_delete_notfound(self):
         res = TestClient(api).delete("/mgmt/backup/notfound")
         self.assertEqual(404, res.status_code)
@@ -299,8 +392,13 @@ vg0 {
         (bkdir / "2025-08-31.backup").write_bytes(
             self._example_backup(self.export_content.encode(), self.volume_content.encode())
         )
-        res = TestClient(api).get("/mgmt/backup/2025-08-31/volume")
-        self.assertEqual(200, res.status_code)
+        with patch("volexport.api_mgmt.parse_volbackup", wraps=parse_volbackup) as parse:
+            res = TestClient(api).get("/mgmt/backup/2025-08-31/volume")
+            self.assertEqual(200, res.status_code)
+            # parsed summary is stored in the index
+            self.assertEqual(res.json(), TestClient(api).get("/mgmt/backup/2025-08-31/volume").json())
+            self.assertEqual(200, TestClient(api).get("/mgmt/backup/2025-08-31/export").status_code)
+            self.assertEqual(2, parse.call_count)
         self.assertEqual(
             [
                 dict(
@@ -324,3 +422,88 @@ vg0 {
             ],
             res.json(),
         )
+
+
+class TestVolumeBackupAPI(unittest.TestCase):
+    def setUp(self):
+        self.td = tempfile.TemporaryDirectory()
+        self.orig_bak = config.BACKUP_DIR
+        config.BACKUP_DIR = self.td.name
+
+    def tearDown(self):
+        self.td.cleanup()
+        config.BACKUP_DIR = self.orig_bak
+
+    def _wait(self, client, res):
+        from volexport.jobs import jobs
+
+        self.assertEqual(202, res.status_code)
+        jobid = res.json()["id"]
+        jobs.get(jobid).future.result(timeout=5)
+        return client.get(f"/jobs/{jobid}").json()
+
+    @patch("volexport.backup.backup_volume")
+    def test_create(self, backup):
+        backup.return_value = {"name": "bk1"}
+        client = TestClient(api)
+        job = self._wait(client, client.post("/mgmt/volume-backup", json=dict(volume="vol1", name="bk1")))
+        self.assertEqual("succeeded", job["status"])
+        self.assertEqual({"name": "bk1"}, job["result"])
+        backup.assert_called_once_with(ANY, "vg0", "vol1", "bk1", snapshot_size=None, incremental=False)
+
+    def test_list_read_delete(self):
+        from volexport.backup import BackupStore
+
+        store = BackupStore(self.td.name, suffix=".data")
+        store.write_manifest(
+            "bk1",
+            dict(
+                version=1,
+                created="2025-08-31T12:00:00+00:00",
+                volume="vol1",
+                size=8192,
+                thin=True,
+                chunk_size=4096,
+                chunks=[store.put_blob(b"x" * 4096), None],
+            ),
+        )
+        client = TestClient(api)
+        res = client.get("/mgmt/volume-backup", params=dict(volume="vol1"))
+        self.assertEqual(200, res.status_code)
+        self.assertEqual(1, len(res.json()))
+        self.assertEqual(dict(chunks=2, zero_chunks=1), {k: res.json()[0][k] for k in ("chunks", "zero_chunks")})
+        self.assertEqual([], client.get("/mgmt/volume-backup", params=dict(volume="vol2")).json())
+        # metadata backups are not listed
+        self.assertEqual([], client.get("/mgmt/backup").json())
+        self.assertEqual("vol1", client.get("/mgmt/volume-backup/bk1").json()["volume"])
+        self.assertEqual(200, client.delete("/mgmt/volume-backup/bk1").status_code)
+        self.assertEqual([], list((Path(self.td.name) / "blobs").glob("*/*")))
+        self.assertEqual(404, client.get("/mgmt/volume-backup/bk1").status_code)
+
+    def test_delete_snapshot(self):
+        from volexport.backup import BackupStore
+        from volexport.lvm2 import LV
+
+        store = BackupStore(self.td.name, suffix=".data")
+        store.write_manifest(
+            "bk1",
+            dict(
+                version=1,
+                created="2025-08-31T12:00:00+00:00",
+                volume="vol1",
+                size=4096,
+                thin=True,
+                chunk_size=4096,
+                chunks=[None],
+                snapshot="backup-0123456789ab",
+                thin_id=3,
+            ),
+        )
+        with patch.object(LV, "get", return_value=dict(lv_name="snap")), patch.object(LV, "delete") as delete:
+            self.assertEqual(200, TestClient(api).delete("/mgmt/volume-backup/bk1").status_code)
+        delete.assert_called_once_with()
+        self.assertFalse(store.exists("bk1"))
+
+    def test_restore_notfound(self):
+        res = TestClient(api).post("/mgmt/volume-backup/notfound/restore", json=dict(volume="vol2"))
+        self.assertEqual(404, res.status_code)
@@ -0,0 +1,151 @@
+import unittest
+import datetime
+import tempfile
+import threading
+import time
+from unittest.mock import patch, MagicMock
+from volexport.exceptions import InvalidArgument
+from volexport.scheduler import CronSchedule, BackupScheduler
+from volexport.util import Generation
+
+
+class TestCronSchedule(unittest.TestCase):
+    def test_next(self):
+        base = datetime.datetime(2025, 10, 12, 8, 40, 11)  # sunday
+        for expr, expected in [
+            ("* * * * *", datetime.datetime(2025, 10, 12, 8, 41)),
+            ("*/15 * * * *", datetime.datetime(2025, 10, 12, 8, 45)),
+            ("0 3 * * *", datetime.datetime(2025, 10, 13, 3, 0)),
+            ("@daily", datetime.datetime(2025, 10, 13, 0, 0)),
+            ("30 8-9 * * *", datetime.datetime(2025, 10, 12, 9, 30)),
+            ("0 0 * * 1-5", datetime.datetime(2025, 10, 13, 0, 0)),
+            ("0 0 * * 7", datetime.datetime(2025, 10, 19, 0, 0)),
+            ("0 0 1 * *", datetime.datetime(2025, 11, 1, 0, 0)),
+            ("0 0 29 2 *", datetime.datetime(2028, 2, 29, 0, 0)),
+            ("0 12 1,15 * 3", datetime.datetime(2025, 10, 15, 12, 0)),
+            ("0 12 13 * 3", datetime.datetime(2025, 10, 13, 12, 0)),
+            ("5,10 */6 * 1 *", datetime.datetime(2026, 1, 1, 0, 5)),
+        ]:
+            with self.subTest(expr=expr):
+                self.assertEqual(expected, CronSchedule(expr).next(base))
+
+    def test_invalid(self):
+        for expr in ["", "* * * *", "60 * * * *", "* 24 * * *", "* * 0 * *", "5-1 * * * *", "*/0 * * * *", "a * * * *"]:
+            with self.subTest(expr=expr):
+                with self.assertRaises(InvalidArgument):
+                    CronSchedule(expr)
+        with self.assertRaises(InvalidArgument):
+            CronSchedule("0 0 31 2 *").next(datetime.datetime(2025, 1, 1))
+
+
+class TestBackupScheduler(unittest.TestCase):
+    def setUp(self):
+        self.generation = Generation()
+        self.patcher = patch("volexport.scheduler.generation", self.generation)
+        self.patcher.start()
+        self.create = MagicMock(side_effect=lambda: f"backup{self.create.call_count}")
+        self.prune = MagicMock(return_value=[])
+
+    def tearDown(self):
+        self.patcher.stop()
+
+    def test_run_once(self):
+        sched = BackupScheduler(self.create, self.prune)
+        self.assertEqual("backup1", sched.run_once())
+        # nothing changed: retention only
+        self.assertIsNone(sched.run_once())
+        self.assertEqual(1, self.create.call_count)
+        self.assertEqual(2, self.prune.call_count)
+        self.generation.bump()
+        self.assertEqual("backup2", sched.run_once())
+        self.assertEqual("backup2", sched.last_backup)
+
+    @patch("subprocess.run")
+    def test_run_once_backup_commands(self, run):
+        from volexport.api_mgmt import make_backup
+        from volexport.config import config
+
+        run.return_value = MagicMock(stdout="", returncode=0)
+        with (
+            tempfile.TemporaryDirectory() as td,
+            patch.object(config, "BACKUP_DIR", td),
+            patch("volexport.util.generation", self.generation),
+        ):
+            sched = BackupScheduler(make_backup, self.prune, debounce=10.0)
+            self.generation.bump()
+            self.assertIsNotNone(sched.run_once())
+            # vgcfgbackup and tgt-admin --dump do not change the inventory
+            self.assertIsNone(sched.pending(time.monotonic()))
+            calls = run.call_count
+            self.assertIsNone(sched.run_once())
+        self.assertEqual(calls, run.call_count)
+        self.assertEqual(2, self.prune.call_count)
+
+    def test_run_once_error(self):
+        self.create.side_effect = RuntimeError("failed")
+        sched = BackupScheduler(self.create, self.prune)
+        self.assertIsNone(sched.run_once())
+        self.assertEqual("RuntimeError: failed", sched.last_error)
+        self.assertIsNone(sched.last_generation)
+        self.prune.assert_not_called()
+        self.assertIsNotNone(sched.last_run)
+
+    def test_pending(self):
+        sched = BackupScheduler(self.create, self.prune, debounce=10.0, min_interval=100.0)
+        self.assertIsNone(sched.pending(time.monotonic()))
+        self.generation.bump()
+        changed = self.generation.changed
+        self.assertEqual(changed + 10.0, sched.pending(time.monotonic()))
+        sched.run_once()
+        self.assertIsNone(sched.pending(time.monotonic()))
+        self.generation.bump()
+        self.assertEqual(sched.last_run + 100.0, sched.pending(time.monotonic()))
+
+    def test_disabled_debounce(self):
+        sched = BackupScheduler(self.create, self.prune)
+        self.generation.bump()
+        self.assertIsNone(sched.pending(time.monotonic()))
+
+    def test_loop(self):
+        done = threading.Event()
+        self.create.side_effect = lambda: done.set() or "backup"
+        sched = BackupScheduler(self.create, self.prune, debounce=0.05, poll=0.01)
+        sched.start()
+        try:
+            time.sleep(0.1)
+            self.create.assert_not_called()
+            self.generation.bump()
+            self.assertTrue(done.wait(5))
+        finally:
+            sched.stop()
+        self.assertEqual(1, self.create.call_count)
+        self.assertEqual(self.generation.value, sched.last_generation)
+
+    @patch("volexport.scheduler.CronSchedule.next")
+    def test_loop_schedule(self, next):
+        done = threading.Event()
+        self.prune.side_effect = lambda: done.set() or []
+        next.side_effect = [datetime.datetime.now(), datetime.datetime.now() + datetime.timedelta(days=1)]
+        sched = BackupScheduler(self.create, self.prune, schedule="@daily", poll=0.01)
+        sched.start()
+        try:
+            self.assertTrue(done.wait(5))
+        finally:
+            sched.stop()
+        self.assertEqual(1, self.create.call_count)
+        self.assertEqual(2, next.call_count)
+
+    def test_from_config(self):
+        from volexport.api_mgmt import backup_scheduler
+        from volexport.config import config
+
+        self.assertIsNone(backup_scheduler())
+        with patch.object(config, "BACKUP_SCHEDULE", "0 3 * * *"), patch.object(config, "BACKUP_KEEP", 5):
+            sched = backup_scheduler()
+        self.assertIsNotNone(sched)
+        self.assertEqual({3}, sched.schedule.hour)
+        self.assertIsNone(sched.debounce)
+        with patch("volexport.api_mgmt.prune_backup") as prune, patch.object(config, "BACKUP_KEEP", 5):
+            prune.return_value = []
+            sched.prune()
+            prune.assert_called_once_with(5, None)
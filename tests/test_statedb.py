@@ -0,0 +1,220 @@
+import unittest
+import tempfile
+import subprocess
+from pathlib import Path
+from unittest.mock import patch
+from fastapi.testclient import TestClient
+from volexport import statedb
+from volexport.api import api
+from volexport.config import config
+from volexport.util import generation
+
+vol1 = dict(
+    name="vol1",
+    created="2025-08-10T16:48:15+09:00",
+    size=1073741824,
+    used=False,
+    readonly=False,
+    thin=False,
+    parent=None,
+    lvm_name="uuid1",
+    lvm_id="lvid1",
+)
+vol2 = dict(vol1, name="vol2", lvm_name="uuid2", lvm_id="lvid2", thin=True)
+export1 = dict(
+    protocol="iscsi",
+    tid=1,
+    targetname="iqn.abc:1",
+    connected=[],
+    volumes=["/dev/vg0/uuid1"],
+    users=["user1"],
+    acl=["10.0.0.0/8"],
+)
+
+
+class TestStateDB(unittest.TestCase):
+    def setUp(self):
+        self.td = tempfile.TemporaryDirectory()
+        self.dbfile = str(Path(self.td.name) / "state.db")
+        self.patcher = patch.object(config, "STATE_DB", self.dbfile)
+        self.patcher.start()
+        self.db = statedb.get()
+        assert self.db is not None
+
+    def tearDown(self):
+        self.patcher.stop()
+        self.td.cleanup()
+
+    def test_schema(self):
+        self.assertEqual("wal", self.db.conn.execute("PRAGMA journal_mode").fetchone()[0])
+        self.assertEqual(str(statedb.SCHEMA_VERSION), self.db.get_meta("schema_version"))
+        # reopen
+        self.assertEqual("1", statedb.StateDB(self.dbfile, "vg0").get_meta("schema_version"))
+        with patch.object(config, "STATE_DB", None):
+            self.assertIsNone(statedb.get())
+            with statedb.mutation() as tx:
+                self.assertIsNone(tx)
+            self.assertIsNone(statedb.reconcile_once())
+            self.assertIsNone(statedb.state_reconciler())
+
+    def test_volume(self):
+        with statedb.mutation() as tx:
+            assert tx is not None
+            tx.put_volume(vol1, params=dict(size=1073741824))
+            tx.put_volume(vol2)
+        ent = self.db.volume("vol1")
+        assert ent is not None
+        self.assertEqual("/dev/vg0/uuid1", ent["path"])
+        self.assertEqual('{"size": 1073741824}', ent["params"])
+        self.assertEqual("vol2", self.db.volume_by_path("/dev/vg0/uuid2"))
+        self.assertIsNone(self.db.volume_by_path("/dev/vg0/uuid3"))
+        # update keeps params
+        with statedb.mutation() as tx:
+            assert tx is not None
+            tx.put_volume(dict(vol1, size=2147483648))
+        ent = self.db.volume("vol1")
+        assert ent is not None
+        self.assertEqual(2147483648, ent["size"])
+        self.assertEqual('{"size": 1073741824}', ent["params"])
+        # renamed (same lv_uuid)
+        with statedb.mutation() as tx:
+            assert tx is not None
+            tx.put_volume(dict(vol1, name="vol1new"))
+        self.assertEqual(["vol1new", "vol2"], self.db.volume_names())
+
+    def test_rollback(self):
+        with self.assertRaises(subprocess.CalledProcessError):
+            with statedb.mutation() as tx:
+                assert tx is not None
+                tx.put_volume(vol1)
+                raise subprocess.CalledProcessError(returncode=5, cmd="lvcreate")
+        self.assertIsNone(self.db.volume("vol1"))
+
+    def test_mutation_unlocked(self):
+        other = statedb.StateDB(self.dbfile, "vg0", timeout=0.1)
+        with statedb.mutation() as tx:
+            assert tx is not None
+            tx.put_volume(vol1)
+            # slow LVM command here does not block other writers
+            with other.transaction() as tx2:
+                tx2.put_volume(vol2)
+            self.assertIsNone(self.db.volume("vol1"))
+        self.assertEqual(["vol1", "vol2"], self.db.volume_names())
+
+    def test_export(self):
+        with statedb.mutation() as tx:
+            assert tx is not None
+            tx.put_volume(vol1)
+            tx.put_export(dict(export1, user="user2", users=None), "vol1", "/dev/vg0/uuid1")
+        res = self.db.exports(volume="vol1")
+        self.assertEqual(1, len(res))
+        self.assertEqual(["user2"], res[0]["users"])
+        self.assertEqual(["10.0.0.0/8"], res[0]["acl"])
+        self.assertEqual([], self.db.exports(volume="vol2"))
+        with statedb.mutation() as tx:
+            assert tx is not None
+            tx.delete_export("iqn.abc:1")
+        self.assertEqual([], self.db.exports())
+        self.assertEqual(0, self.db.conn.execute("SELECT count(*) FROM users").fetchone()[0])
+
+    def test_reconcile(self):
+        with statedb.mutation() as tx:
+            assert tx is not None
+            tx.put_volume(dict(vol1, name="gone", lvm_name="uuid9", lvm_id="lvid9"))
+            tx.put_export(dict(export1, targetname="iqn.gone"), "gone", "/dev/vg0/uuid9")
+        res = self.db.reconcile([vol1, vol2], [export1])
+        self.assertEqual(
+            dict(volumes=2, volumes_added=2, volumes_removed=1, exports=1, exports_added=1, exports_removed=1), res
+        )
+        self.assertEqual(["vol1", "vol2"], self.db.volume_names())
+        self.assertEqual("vol1", self.db.exports()[0]["volume"])
+        self.assertIsNotNone(self.db.get_meta("reconciled"))
+        # changed while listing
+        gen = generation.value
+        generation.bump()
+        self.assertIsNone(self.db.reconcile([], [], gen))
+        self.assertEqual(["vol1", "vol2"], self.db.volume_names())
+
+    @patch("volexport.tgtd.Tgtd.export_list")
+    @patch("volexport.lvm2.LV.volume_list")
+    def test_reconciler(self, volume_list, export_list):
+        volume_list.return_value = [vol1]
+        export_list.return_value = [export1]
+        rec = statedb.state_reconciler()
+        assert rec is not None
+        self.assertEqual(1, rec.run_once()["exports"])
+        self.assertEqual(1, rec.last_result["volumes"])
+        export_list.side_effect = subprocess.CalledProcessError(returncode=107, cmd="tgtadm")
+        self.assertIsNone(rec.run_once())
+        self.assertIn("CalledProcessError", rec.last_error)
+        rec.poll = 0.01
+        rec.start()
+        rec.stop()
+
+    @patch("volexport.lvm2.LV.delete")
+    @patch("volexport.lvm2.LV.create")
+    def test_api_volume(self, create, delete):
+        create.return_value = vol1
+        res = TestClient(api).post("/volume", json=dict(name="vol1", size=1073741824))
+        self.assertEqual(200, res.status_code)
+        ent = self.db.volume("vol1")
+        assert ent is not None
+        self.assertEqual("lvid1", ent["lv_uuid"])
+        res = TestClient(api).delete("/volume/vol1")
+        self.assertEqual(200, res.status_code)
+        self.assertIsNone(self.db.volume("vol1"))
+        create.side_effect = subprocess.CalledProcessError(returncode=5, cmd="lvcreate")
+        res = TestClient(api).post("/volume", json=dict(name="vol1", size=1073741824))
+        self.assertEqual(500, res.status_code)
+        self.assertEqual([], self.db.volume_names())
+
+    @patch("volexport.tgtd.Tgtd.unexport_volume")
+    @patch("volexport.tgtd.Tgtd.export_list")
+    def test_api_delete_export_tid(self, export_list, unexport_volume):
+        self.db.reconcile([vol1], [export1])
+        # tgtadm output has TID as string
+        export_list.return_value = [dict(export1, tid="1")]
+        res = TestClient(api).delete("/export/1")
+        self.assertEqual(200, res.status_code)
+        unexport_volume.assert_called_once_with(targetname="iqn.abc:1", force=False)
+        self.assertEqual([], self.db.exports())
+
+    @patch("volexport.tgtd.Tgtd.tgtadm")
+    @patch("volexport.tgtd.Tgtd.export_list")
+    @patch("volexport.lvm2.LV.volume_read")
+    def test_api_read_volume_include(self, volume_read, export_list, tgtadm):
+        self.db.reconcile([vol1], [export1])
+        volume_read.return_value = vol1
+        tgtadm.return_value.stdout = """Session: 1
+    Connection: 0
+        Initiator: iqn.node1
+        IP Address: 10.0.0.1
+"""
+        res = TestClient(api).get("/volume/vol1", params=dict(include="exports,sessions"))
+        self.assertEqual(200, res.status_code)
+        self.assertEqual(
+            [
+                dict(
+                    targetname="iqn.abc:1",
+                    tid=1,
+                    acl=["10.0.0.0/8"],
+                    users=["user1"],
+                    connected=[dict(address=["10.0.0.1"], initiator="iqn.node1")],
+                )
+            ],
+            res.json()["exports"],
+        )
+        # target by index, sessions of the target only
+        export_list.assert_not_called()
+        tgtadm.assert_called_once_with(lld="iscsi", mode="conn", op="show", tid=1)
+
+    @patch("volexport.lvm2.LV.volume_path2vol")
+    @patch("volexport.tgtd.Tgtd.export_list")
+    def test_api_export_list(self, export_list, path2vol):
+        self.db.reconcile([vol1], [export1])
+        export_list.return_value = [dict(export1, volumes=["/dev/vg0/uuid1"])]
+        res = TestClient(api).get("/export")
+        self.assertEqual(200, res.status_code)
+        self.assertEqual(["vol1"], res.json()[0]["volumes"])
+        # answered from state db
+        path2vol.assert_not_called()
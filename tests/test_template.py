@@ -0,0 +1,151 @@
+import unittest
+import subprocess
+from unittest.mock import patch, call, ANY
+from fastapi.testclient import TestClient
+from volexport import template
+from volexport.api import api
+from volexport.config import config
+from volexport.exceptions import InvalidArgument
+from volexport.lvm2 import LV
+
+vol1 = dict(
+    name="vol1",
+    created="2025-08-10T16:48:15+09:00",
+    size=2147483648,
+    used=False,
+    readonly=False,
+    thin=True,
+    parent=None,
+    lvm_name="lv1",
+    lvm_id="lvid1",
+)
+G = 1073741824
+
+
+@patch.object(config, "LVM_THINPOOL", "pool1")
+@patch.object(config, "TEMPLATE_SIZES", [G, 10 * G])
+class TestTemplate(unittest.TestCase):
+    def test_pick(self):
+        self.assertEqual(G, template.pick(G))
+        self.assertEqual(G, template.pick(2 * G))
+        self.assertEqual(10 * G, template.pick(100 * G))
+        self.assertIsNone(template.pick(1024))
+        self.assertEqual("volexp.template.1073741824.ext4", template.classtag(G, "ext4"))
+
+    @patch("volexport.lvm2.LV.volume_read")
+    @patch("volexport.lvm2.LV.resize")
+    @patch("volexport.lvm2.LV.volume_vol2path")
+    @patch("volexport.lvm2.LV.create_thinclone_of")
+    @patch("volexport.lvm2.LV.get")
+    @patch("shutil.which")
+    @patch("volexport.template.runcmd")
+    @patch("volexport.template.runparse_report")
+    def test_create_ext4(self, report, runcmd, which, get, clone, vol2path, resize, volume_read):
+        which.return_value = "/sbin/mkfs.ext4"
+        report.return_value = []
+        get.return_value = None
+        vol2path.return_value = "/dev/vg0/lv1"
+        volume_read.return_value = vol1
+        self.assertEqual(vol1, template.create_volume("vg0", "vol1", 2 * G, "ext4"))
+        report.assert_called_once_with(mode="lv", filter="vg_name=vg0 && tags=volexp.template.1073741824.ext4")
+        # first use: make template, then snapshot it
+        runcmd.assert_has_calls(
+            [
+                call(
+                    [
+                        "lvcreate",
+                        "--thin",
+                        "--virtualsize",
+                        f"{G}b",
+                        "--name",
+                        ANY,
+                        "--addtag",
+                        "volexp.template",
+                        "vg0/pool1",
+                    ]
+                ),
+                call(["mkfs.ext4", ANY]),
+                call(["lvchange", "--permission", "r", "--addtag", "volexp.template.1073741824.ext4", ANY]),
+                call(["tune2fs", "-U", "random", "-L", "vol1", "/dev/vg0/lv1"]),
+                call(["resize2fs", "/dev/vg0/lv1"]),
+            ]
+        )
+        tmpl = runcmd.call_args_list[0].args[0][5]
+        clone.assert_called_once_with(tmpl)
+        resize.assert_called_once_with(2 * G)
+
+    @patch("volexport.lvm2.LV.volume_read")
+    @patch("volexport.lvm2.LV.resize")
+    @patch("volexport.lvm2.LV.volume_vol2path")
+    @patch("volexport.lvm2.LV.create_thinclone_of")
+    @patch("volexport.lvm2.LV.get")
+    @patch("volexport.template.runcmd")
+    @patch("volexport.template.runparse_report")
+    def test_create_xfs(self, report, runcmd, get, clone, vol2path, resize, volume_read):
+        report.return_value = [dict(lv_name="tmpl1")]
+        get.return_value = None
+        vol2path.return_value = "/dev/vg0/lv1"
+        volume_read.return_value = vol1
+        # same size as template: no resize
+        self.assertEqual(vol1, template.create_volume("vg0", "volume-name-1", 10 * G, "xfs"))
+        clone.assert_called_once_with("tmpl1")
+        runcmd.assert_called_once_with(["xfs_admin", "-U", "generate", "-L", "volume-name-", "/dev/vg0/lv1"])
+        resize.assert_not_called()
+
+    @patch("volexport.template.runcmd")
+    def test_grow_xfs(self, runcmd):
+        template.grow("xfs", "/dev/vg0/lv1")
+        self.assertEqual(["mount", "-t", "xfs", "/dev/vg0/lv1"], runcmd.call_args_list[0].args[0][:4])
+        mnt = runcmd.call_args_list[0].args[0][4]
+        runcmd.assert_has_calls([call(["xfs_growfs", mnt]), call(["umount", mnt])])
+
+    @patch("volexport.lvm2.LV.delete")
+    @patch("volexport.lvm2.LV.volume_vol2path")
+    @patch("volexport.lvm2.LV.create_thinclone_of")
+    @patch("volexport.lvm2.LV.get")
+    @patch("volexport.template.runcmd")
+    @patch("volexport.template.runparse_report")
+    def test_create_error(self, report, runcmd, get, clone, vol2path, delete):
+        report.return_value = [dict(lv_name="tmpl1")]
+        get.return_value = None
+        vol2path.return_value = "/dev/vg0/lv1"
+        runcmd.side_effect = subprocess.CalledProcessError(returncode=1, cmd=["tune2fs"])
+        with self.assertRaises(subprocess.CalledProcessError):
+            template.create_volume("vg0", "vol1", G, "ext4")
+        delete.assert_called_once_with()
+
+    @patch("volexport.lvm2.LV.get")
+    def test_invalid(self, get):
+        get.return_value = None
+        with self.assertRaises(InvalidArgument):
+            template.create_volume("vg0", "vol1", G, "btrfs")
+        with self.assertRaises(InvalidArgument):
+            template.create_volume("vg0", "vol1", G, None)
+        with self.assertRaises(InvalidArgument):
+            template.create_volume("vg0", "vol1", 1024, "ext4")
+        with patch.object(config, "LVM_THINPOOL", None), self.assertRaises(InvalidArgument):
+            template.create_volume("vg0", "vol1", G, "ext4")
+        get.return_value = dict(lv_name="lv1")
+        with self.assertRaises(InvalidArgument):
+            template.create_volume("vg0", "vol1", G, "ext4")
+
+    def test_hidden(self):
+        ent = dict(
+            lv_name="tmpl1",
+            lv_path="/dev/vg0/tmpl1",
+            lv_tags="volexp.template,volexp.template.1073741824.ext4",
+            lv_time="2025-08-10 16:48:15 +0900",
+            lv_active="active",
+        )
+        self.assertIsNone(LV("vg0").vol2dict(ent))
+
+    @patch("volexport.template.create_volume")
+    def test_api(self, create_volume):
+        create_volume.return_value = vol1
+        res = TestClient(api).post("/volume", json=dict(name="vol1", size=2 * G, filesystem="ext4", from_template=True))
+        self.assertEqual(200, res.status_code)
+        self.assertEqual(dict(name="vol1", size=2 * G, filesystem="ext4"), res.json())
+        create_volume.assert_called_once_with("vg0", "vol1", 2 * G, "ext4")
+        create_volume.side_effect = InvalidArgument("from_template requires thin pool")
+        res = TestClient(api).post("/volume", json=dict(name="vol1", size=2 * G, filesystem="ext4", from_template=True))
+        self.assertEqual(400, res.status_code)
@@ -0,0 +1,159 @@
+import unittest
+import io
+import os
+import subprocess
+from unittest.mock import patch, MagicMock, call
+from volexport.exceptions import InvalidArgument
+from volexport.thin import parse_extents, merge_extents, delta, allocated, dm_name, _DELTA_TAGS, _DUMP_TAGS
+
+delta_xml = b"""<superblock uuid="" time="1" transaction="2" data_block_size="128" nr_data_blocks="0">
+  <diff left="1" right="2">
+    <same begin="0" length="2"/>
+    <different begin="2" length="3"/>
+    <right_only begin="5" length="1"/>
+    <same begin="6" length="10"/>
+    <left_only begin="16" length="2"/>
+  </diff>
+</superblock>
+"""
+
+dump_xml = b"""<superblock uuid="" time="1" transaction="2" version="2" data_block_size="128" nr_data_blocks="1600">
+  <device dev_id="2" mapped_blocks="5" transaction="0" creation_time="0" snap_time="1">
+    <range_mapping origin_begin="0" data_begin="10" length="3" time="0"/>
+    <single_mapping origin_block="3" data_block="20" time="1"/>
+    <single_mapping origin_block="10" data_block="21" time="1"/>
+  </device>
+</superblock>
+"""
+
+BLOCK = 128 * 512
+
+
+class TestThin(unittest.TestCase):
+    run_basearg = dict(capture_output=True, encoding="utf-8", timeout=10.0, stdin=-3, start_new_session=True)
+
+    def test_dm_name(self):
+        self.assertEqual("vg0-pool0", dm_name("vg0", "pool0"))
+        self.assertEqual("vg--x-pool--0_tmeta", dm_name("vg-x", "pool-0_tmeta"))
+
+    def test_parse_delta(self):
+        res = list(parse_extents(io.BytesIO(delta_xml), _DELTA_TAGS))
+        self.assertEqual([(2 * BLOCK, 3 * BLOCK), (5 * BLOCK, BLOCK), (16 * BLOCK, 2 * BLOCK)], res)
+
+    def test_parse_dump(self):
+        res = list(parse_extents(io.BytesIO(dump_xml), _DUMP_TAGS))
+        self.assertEqual([(0, 3 * BLOCK), (3 * BLOCK, BLOCK), (10 * BLOCK, BLOCK)], res)
+
+    def test_parse_invalid(self):
+        for xml in [b"<superblock", b"<diff><different begin='0' length='1'/></diff>", b"<superblock/><x"]:
+            with self.subTest(xml=xml):
+                with self.assertRaises(InvalidArgument):
+                    list(parse_extents(io.BytesIO(xml), _DELTA_TAGS))
+        with self.assertRaises(InvalidArgument):
+            list(parse_extents(io.BytesIO(delta_xml.replace(b'length="3"', b'length="x"')), _DELTA_TAGS))
+
+    def test_merge(self):
+        self.assertEqual([], list(merge_extents([])))
+        self.assertEqual([(0, 30), (40, 10)], list(merge_extents([(0, 10), (10, 20), (40, 10)])))
+
+    def _popen(self, popen, xml: bytes, returncode: int = 0):
+        proc = MagicMock(stdin=None, stdout=None, returncode=returncode)
+
+        def _run(cmd, stdout, stderr, **kwargs):
+            os.write(stdout, xml)
+            stderr.write(b"error")
+            return proc
+
+        popen.side_effect = _run
+        return proc
+
+    @patch("subprocess.Popen")
+    @patch("subprocess.run")
+    def test_delta(self, run, popen):
+        self._popen(popen, delta_xml)
+        res = list(delta("vg0", "pool0", 1, 2))
+        self.assertEqual([(2 * BLOCK, 4 * BLOCK), (16 * BLOCK, 2 * BLOCK)], res)
+        run.assert_has_calls(
+            [
+                call(
+                    ["sudo", "dmsetup", "message", "vg0-pool0-tpool", "0", "reserve_metadata_snap"], **self.run_basearg
+                ),
+                call(
+                    ["sudo", "dmsetup", "message", "vg0-pool0-tpool", "0", "release_metadata_snap"], **self.run_basearg
+                ),
+            ],
+            any_order=True,
+        )
+        popen.assert_called_once()
+        self.assertEqual(
+            [
+                "sudo",
+                "thin_delta",
+                "--metadata-snap",
+                "--snap1",
+                "1",
+                "--snap2",
+                "2",
+                "/dev/mapper/vg0-pool0_tmeta",
+            ],
+            popen.call_args.args[0],
+        )
+
+    @patch("subprocess.Popen")
+    @patch("subprocess.run")
+    def test_allocated(self, run, popen):
+        self._popen(popen, dump_xml)
+        res = list(allocated("vg0", "pool0", 2))
+        self.assertEqual([(0, 4 * BLOCK), (10 * BLOCK, BLOCK)], res)
+        self.assertEqual(
+            ["sudo", "thin_dump", "--metadata-snap", "--dev-id", "2", "/dev/mapper/vg0-pool0_tmeta"],
+            popen.call_args.args[0],
+        )
+        self.assertEqual(2, run.call_count)
+
+    @patch("subprocess.Popen")
+    @patch("subprocess.run")
+    def test_stop_early(self, run, popen):
+        proc = self._popen(popen, dump_xml)
+        it = allocated("vg0", "pool0", 2)
+        self.assertEqual((0, 4 * BLOCK), next(it))
+        # metadata snapshot is released before the first extent
+        self.assertEqual(2, run.call_count)
+        self.assertEqual("release_metadata_snap", run.call_args.args[0][-1])
+        it.close()
+        proc.kill.assert_not_called()
+
+    @patch("subprocess.Popen")
+    @patch("subprocess.run")
+    def test_command_error(self, run, popen):
+        self._popen(popen, b"")
+        with self.assertRaises(InvalidArgument):
+            list(allocated("vg0", "pool0", 2))
+        self.assertEqual(2, run.call_count)
+        self._popen(popen, dump_xml, returncode=1)
+        with self.assertRaises(subprocess.CalledProcessError) as cm:
+            list(allocated("vg0", "pool0", 2))
+        self.assertEqual("error", cm.exception.stderr)
+        self.assertEqual(4, run.call_count)
+
+    @patch("subprocess.Popen")
+    @patch("subprocess.run")
+    def test_eager(self, run, popen):
+        # the tool runs and errors raise before iterating
+        self._popen(popen, dump_xml)
+        it = allocated("vg0", "pool0", 2)
+        popen.assert_called_once()
+        self.assertEqual(2, run.call_count)
+        self.assertEqual([(0, 4 * BLOCK), (10 * BLOCK, BLOCK)], list(it))
+        self._popen(popen, dump_xml, returncode=1)
+        with self.assertRaises(subprocess.CalledProcessError):
+            delta("vg0", "pool0", 1, 2)
+        self._popen(popen, b"<superblock")
+        with self.assertRaises(InvalidArgument):
+            allocated("vg0", "pool0", 2)
+        # busy metadata snapshot
+        popen.reset_mock()
+        run.side_effect = subprocess.CalledProcessError(returncode=1, cmd="dmsetup", stderr="busy")
+        with self.assertRaises(subprocess.CalledProcessError):
+            allocated("vg0", "pool0", 2)
+        popen.assert_not_called()
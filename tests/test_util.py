@@ -0,0 +1,234 @@
+import unittest
+import threading
+import time
+import subprocess
+from unittest.mock import patch, MagicMock, ANY
+from fastapi.testclient import TestClient
+from volexport.api import api
+from volexport.exceptions import Cancelled, Busy
+from volexport.util import (
+    cmdclass,
+    cmd_timeout,
+    runcmd,
+    deadline,
+    cancel_event,
+    slot_wait,
+    Limiter,
+    limiter,
+    generation,
+)
+from volexport.util import popencmd
+
+
+class TestUtil(unittest.TestCase):
+    def test_cmdclass(self):
+        self.assertEqual("lvm_read", cmdclass(["lvs", "-o", "lv_all"]))
+        self.assertEqual("lvm_read", cmdclass(["lvm", "vgs"]))
+        self.assertEqual("lvm_write", cmdclass(["lvcreate", "--size", "1b"]))
+        self.assertEqual("lvm_write", cmdclass(["/sbin/lvremove", "vg0/lv1"]))
+        self.assertEqual("lvm_read", cmdclass(["vgcfgbackup", "--file", "/tmp/vg0", "vg0"]))
+        self.assertEqual("lvm_read", cmdclass(["vgcfgrestore", "--list", "vg0"]))
+        self.assertEqual("lvm_write", cmdclass(["vgcfgrestore", "--file", "/tmp/vg0", "vg0"]))
+        self.assertEqual("tgtd_read", cmdclass(["tgtadm", "--mode", "target", "--op", "show"]))
+        self.assertEqual("tgtd_write", cmdclass(["tgtadm", "--mode", "target", "--op", "new"]))
+        self.assertEqual("tgtd_read", cmdclass(["tgt-admin", "--dump"]))
+        self.assertEqual("tgtd_write", cmdclass(["tgt-admin", "-c", "file", "-e"]))
+        self.assertEqual("mkfs", cmdclass(["mkfs.ext4", "-L", "lv1", "/dev/vg0/lv1"]))
+        self.assertEqual("other", cmdclass(["mount", "/dev/vg0/lv1", "/mnt"]))
+        self.assertEqual("other", cmdclass([]))
+
+    def test_cmd_timeout(self):
+        self.assertEqual(10.0, cmd_timeout("lvm_read"))
+        self.assertEqual(600.0, cmd_timeout("mkfs"))
+        token = deadline.set(time.monotonic() + 2.0)
+        try:
+            self.assertLessEqual(cmd_timeout("mkfs"), 2.0)
+        finally:
+            deadline.reset(token)
+
+    def test_deadline_exceeded(self):
+        token = deadline.set(time.monotonic() - 1.0)
+        try:
+            with patch("subprocess.run") as run:
+                with self.assertRaises(TimeoutError):
+                    runcmd(["lvs"])
+                run.assert_not_called()
+        finally:
+            deadline.reset(token)
+
+    def test_cancel(self):
+        ev = threading.Event()
+        token = cancel_event.set(ev)
+        try:
+            threading.Timer(0.2, ev.set).start()
+            start = time.monotonic()
+            with self.assertRaises(Cancelled):
+                runcmd(["sleep", "10"], root=False)
+            self.assertLess(time.monotonic() - start, 5.0)
+        finally:
+            cancel_event.reset(token)
+
+    def test_cancellable_timeout(self):
+        token1 = cancel_event.set(threading.Event())
+        token2 = deadline.set(time.monotonic() + 0.5)
+        try:
+            with self.assertRaises(subprocess.TimeoutExpired):
+                runcmd(["sleep", "10"], root=False)
+        finally:
+            deadline.reset(token2)
+            cancel_event.reset(token1)
+
+    def test_cancellable_ok(self):
+        token = cancel_event.set(threading.Event())
+        try:
+            res = runcmd(["echo", "hello"], root=False)
+            self.assertEqual("hello\n", res.stdout)
+        finally:
+            cancel_event.reset(token)
+
+    def test_popencmd_stderr(self):
+        result = []
+
+        def run():
+            # more stderr than a pipe buffer, before any stdout
+            cmd = ["sh", "-c", "head -c 1000000 /dev/zero | tr '\\0' x >&2; echo hello; exit 3"]
+            with self.assertRaises(subprocess.CalledProcessError) as cm:
+                with popencmd(cmd, root=False, stdout=subprocess.PIPE) as proc:
+                    assert proc.stdout is not None
+                    result.append(proc.stdout.read())
+            result.append(cm.exception.stderr)
+
+        th = threading.Thread(target=run, daemon=True)
+        th.start()
+        th.join(10)
+        self.assertFalse(th.is_alive())
+        self.assertEqual(b"hello\n", result[0])
+        self.assertEqual(1000000, len(result[1]))
+
+    @patch("subprocess.run")
+    def test_generation(self, run):
+        run.return_value.returncode = 0
+        value = generation.value
+        runcmd(["lvs"])
+        runcmd(["tgtadm", "--mode", "target", "--op", "show"])
+        self.assertEqual(value, generation.value)
+        runcmd(["lvcreate", "--name", "lv1", "vg0"])
+        self.assertEqual(value + 1, generation.value)
+        run.return_value.check_returncode.side_effect = subprocess.CalledProcessError(1, ["tgtadm"])
+        with self.assertRaises(subprocess.CalledProcessError):
+            runcmd(["tgtadm", "--mode", "target", "--op", "new"])
+        self.assertEqual(value + 2, generation.value)
+
+
+class TestDeadlineAPI(unittest.TestCase):
+    lvsempty = '{"report": [{"lv": []}]}'
+
+    @patch("volexport.util._run_cancellable")
+    def test_deadline_header(self, crun):
+        crun.return_value = MagicMock(returncode=0, stdout=self.lvsempty)
+        res = TestClient(api).get("/volume", headers={"X-Volexp-Timeout": "2.5"})
+        self.assertEqual(200, res.status_code)
+        crun.assert_called_once_with(ANY, ANY, ANY)
+        self.assertLessEqual(crun.call_args.args[1], 2.5)
+
+    @patch("subprocess.run")
+    def test_deadline_expired(self, run):
+        res = TestClient(api).get("/volume", headers={"X-Volexp-Timeout": "0"})
+        self.assertEqual(504, res.status_code)
+        run.assert_not_called()
+
+    def test_deadline_invalid(self):
+        res = TestClient(api).get("/volume", headers={"X-Volexp-Timeout": "abc"})
+        self.assertEqual(400, res.status_code)
+
+    @patch("subprocess.run")
+    def test_command_timeout(self, run):
+        run.side_effect = subprocess.TimeoutExpired(cmd="lvs", timeout=10.0)
+        res = TestClient(api).get("/volume")
+        self.assertEqual(504, res.status_code)
+
+
+class TestLimiter(unittest.TestCase):
+    def test_queue_full(self):
+        lim = Limiter("test", 1, 1)
+        entered = threading.Event()
+        release = threading.Event()
+        res = []
+
+        def hold():
+            with lim.slot(5.0):
+                entered.set()
+                release.wait(5)
+
+        def wait():
+            with lim.slot(5.0):
+                res.append("waited")
+
+        th1 = threading.Thread(target=hold)
+        th1.start()
+        entered.wait(5)
+        th2 = threading.Thread(target=wait)
+        th2.start()
+        while lim.waiting == 0:
+            time.sleep(0.01)
+        with self.assertRaises(Busy):
+            with lim.slot(5.0):
+                pass
+        release.set()
+        th1.join(5)
+        th2.join(5)
+        self.assertEqual(["waited"], res)
+        self.assertEqual(dict(concurrency=1, queue=1, running=0, waiting=0), lim.stats())
+
+    def test_wait_timeout(self):
+        lim = Limiter("test", 1, 1)
+        with lim.slot(1.0):
+            with self.assertRaises(Busy):
+                with lim.slot(0.1):
+                    pass
+        self.assertEqual(0, lim.running)
+
+    def test_wait_cancel(self):
+        lim = Limiter("test", 1, 1)
+        ev = threading.Event()
+        ev.set()
+        with lim.slot(1.0):
+            with self.assertRaises(Cancelled):
+                with lim.slot(5.0, ev):
+                    pass
+
+    def test_no_wait(self):
+        lim = Limiter("test", 1, 1)
+        with lim.slot(1.0):
+            start = time.monotonic()
+            with self.assertRaises(Busy):
+                with lim.slot(5.0, wait=False):
+                    pass
+            self.assertLess(time.monotonic() - start, 1.0)
+        with lim.slot(1.0, wait=False):
+            self.assertEqual(1, lim.running)
+        self.assertEqual(dict(concurrency=1, queue=1, running=0, waiting=0), lim.stats())
+
+    def test_limiter(self):
+        self.assertIs(limiter("tgtd_read"), limiter("tgtd_write"))
+        self.assertIsNot(limiter("lvm_read"), limiter("lvm_write"))
+        self.assertIsNone(limiter("other"))
+
+    @patch("volexport.util.limiter")
+    def test_busy_api_running(self, lim):
+        # the queue has room, but a request does not wait for the slot
+        lim.return_value = Limiter("lvm_read", 1, 8)
+        with lim.return_value.slot(1.0):
+            start = time.monotonic()
+            res = TestClient(api).get("/volume")
+            self.assertLess(time.monotonic() - start, 1.0)
+        self.assertEqual(429, res.status_code)
+        self.assertEqual(0, lim.return_value.waiting)
+        self.assertTrue(slot_wait.get())
+
+    @patch("volexport.util.limiter")
+    def test_busy_api(self, lim):
+        lim.return_value = Limiter("lvm_read", 0, 0)
+        res = TestClient(api).get("/volume")
+        self.assertEqual(429, res.status_code)
+        self.assertEqual("1", res.headers["retry-after"])
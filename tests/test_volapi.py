@@ -1,9 +1,12 @@
 import unittest
 import json
 import subprocess
+import timeit
 from unittest.mock import patch, ANY, MagicMock
 from fastapi.testclient import TestClient
 from volexport.api import api
+from volexport.config import config
+from volexport.lvm2 import LV
 
 
 class TestVolumeAPI(unittest.TestCase):
@@ -123,6 +126,40 @@ class TestVolumeAPI(unittest.TestCase):
             ["sudo", "lvs", "-o", "lv_all", "--reportformat", "json", "--unit", "b", "--nosuffix"], **self.run_basearg
         )
 
+    @patch("volexport.lvm2.LV.volume_list")
+    def test_listvol_large(self, volume_list):
+        num = 10000
+        volume_list.return_value = [
+            dict(self.volume_info[0], name=f"lv{i}", created="2025-08-10T16:48:15+09:00") for i in range(num)
+        ]
+        res = TestClient(api).get("/volume")
+        self.assertEqual(200, res.status_code)
+        self.assertEqual("application/json", res.headers["content-type"])
+        resj = res.json()
+        self.assertEqual(num, len(resj))
+        self.assertEqual(dict(self.volume_info[0], name="lv9999"), resj[-1])
+        volume_list.assert_called_once_with()
+
+    @patch("volexport.lvm2.LV.volume_list")
+    def test_listvol_bench(self, volume_list):
+        from volexport.api_volume import list_volume, VolumeReadResponse
+
+        num = 10000
+        volume_list.return_value = [
+            dict(self.volume_info[0], name=f"lv{i}", created="2025-08-10T16:48:15+09:00") for i in range(num)
+        ]
+
+        def baseline():
+            # per-item models and json.dumps, the cost before prebuilt TypeAdapters
+            vols = [VolumeReadResponse.model_validate(x) for x in LV("vg0").volume_list()]
+            return json.dumps([x.model_dump(mode="json") for x in vols]).encode()
+
+        self.assertEqual(json.loads(baseline()), json.loads(list_volume().body))
+        # best of repeats, relative to the baseline in the same process
+        cost = min(timeit.repeat(list_volume, number=1, repeat=5)) / num
+        base = min(timeit.repeat(baseline, number=1, repeat=5)) / num
+        self.assertLess(cost, base * 0.85, f"per-item cost {cost * 1e6:.2f}us, baseline {base * 1e6:.2f}us")
+
     @patch("subprocess.run")
     def test_readvol(self, run):
         run.return_value.exit_code = 0
@@ -147,6 +184,51 @@ class TestVolumeAPI(unittest.TestCase):
             **self.run_basearg,
         )
 
+    @patch("subprocess.run")
+    def test_readvol_include(self, run):
+        target = """
+Target 1: iqn.abc:1
+    I_T nexus information:
+        I_T nexus: 3
+            Initiator: iqn.node1 alias: node1
+            Connection: 0
+                IP Address: 192.168.64.41
+    LUN information:
+        LUN: 1
+            Type: disk
+            Backing store path: /dev/vg0/lv2
+    Account information:
+        user1
+    ACL information:
+        192.168.64.0/24
+Target 2: iqn.abc:2
+    LUN information:
+        LUN: 1
+            Type: disk
+            Backing store path: /dev/vg0/lv1
+"""
+
+        def _run(cmd, **kwargs):
+            return MagicMock(stdout=target if "tgtadm" in cmd else self.lvs2)
+
+        run.side_effect = _run
+        res = TestClient(api).get("/volume/lv2", params=dict(include="exports,sessions"))
+        self.assertEqual(200, res.status_code)
+        export = dict(
+            targetname="iqn.abc:1",
+            tid=1,
+            acl=["192.168.64.0/24"],
+            users=["user1"],
+            connected=[dict(address=["192.168.64.41"], initiator="iqn.node1")],
+        )
+        self.assertEqual(dict(self.volume_info[1], exports=[export]), res.json())
+        # lvs and tgtadm once
+        self.assertEqual(2, run.call_count)
+        res = TestClient(api).get("/volume/lv2", params=dict(include="exports"))
+        self.assertEqual([{k: v for k, v in export.items() if k != "connected"}], res.json()["exports"])
+        res = TestClient(api).get("/volume/lv2", params=dict(include="exports,luns"))
+        self.assertEqual(400, res.status_code)
+
     @patch("subprocess.run")
     def test_readvol_notfound(self, run):
         run.return_value.exit_code = 0
@@ -182,7 +264,7 @@ class TestVolumeAPI(unittest.TestCase):
         run.side_effect = [create, read]
         res = TestClient(api).post("/volume", json={"name": "lv1", "size": 512})
         self.assertEqual(200, res.status_code)
-        self.assertEqual({"name": "lv1", "size": 68719476736}, res.json())
+        self.assertEqual({"name": "lv1", "size": 68719476736, "filesystem": None}, res.json())
         run.assert_any_call(
             ["sudo", "lvcreate", "--size", "512b", "vg0", "--name", ANY, "--addtag", "volname.lv1"], **self.run_basearg
         )
@@ -263,10 +345,20 @@ class TestVolumeAPI(unittest.TestCase):
 
     @patch("subprocess.run")
     def test_snapshot_create(self, run):
-        run.return_value.exit_code = 0
-        run.return_value.stdout = self.lvsnap
+        # volname and LV name differ: lvcreate takes the LV name
+        vol = dict(self.lv1, lv_name="uuid1", lv_full_name="vg0/uuid1", lv_tags="volname.vol123")
+        snap = dict(self.lv1, lv_name="uuid2", lv_full_name="vg0/uuid2", lv_tags="volname.snap123", origin="uuid1")
+        vols: dict = dict(vol123=vol, snap123=None, vol9=None)
+
+        def _run(cmd, **kwargs):
+            if "lvcreate" in cmd:
+                vols["snap123"] = snap
+            return self._lvm(vols)(cmd, **kwargs)
+
+        run.side_effect = _run
         res = TestClient(api).post("/volume/vol123/snapshot", json=dict(name="snap123", size=1024 * 1024 * 1024))
         self.assertEqual(200, res.status_code)
+        self.assertEqual("snap123", res.json()["name"])
         run.assert_any_call(
             [
                 "sudo",
@@ -278,10 +370,24 @@ class TestVolumeAPI(unittest.TestCase):
                 ANY,
                 "--addtag",
                 "volname.snap123",
-                "/dev/vg0/vol123",
+                "/dev/vg0/uuid1",
             ],
             **self.run_basearg,
         )
+        # thin pool
+        vols["snap123"] = None
+        with patch.object(config, "LVM_THINPOOL", "pool1"):
+            res = TestClient(api).post("/volume/vol123/snapshot", json=dict(name="snap123"))
+        self.assertEqual(200, res.status_code)
+        run.assert_any_call(
+            ["sudo", "lvcreate", "--snapshot", "--name", ANY, "--addtag", "volname.snap123", "vg0/uuid1"],
+            **self.run_basearg,
+        )
+        # source not found
+        run.reset_mock()
+        res = TestClient(api).post("/volume/vol9/snapshot", json=dict(name="snap9", size=1024 * 1024 * 1024))
+        self.assertEqual(404, res.status_code)
+        self.assertNotIn("lvcreate", [x for call in run.call_args_list for x in call.args[0]])
 
     @patch("subprocess.run")
     def test_resize(self, run):
@@ -429,7 +535,9 @@ Target 1: iqn.def
         which.return_value = "/bin/mkfs.ext4"
         res = TestClient(api).post("/volume/lv1/mkfs", json={"filesystem": "ext4"})
         self.assertEqual(200, res.status_code)
-        run.assert_any_call(["sudo", "mkfs.ext4", "-L", "lv1", "/dev/vg0/lv1"], **self.run_basearg)
+        run.assert_any_call(
+            ["sudo", "mkfs.ext4", "-L", "lv1", "/dev/vg0/lv1"], **(self.run_basearg | dict(timeout=600.0))
+        )
         run.assert_any_call(
             [
                 "sudo",
@@ -458,7 +566,9 @@ Target 1: iqn.def
         which.return_value = "/bin/mkfs.ext4"
         res = TestClient(api).post("/volume/lv1/mkfs", json={"filesystem": "vfat"})
         self.assertEqual(200, res.status_code)
-        run.assert_any_call(["sudo", "mkfs.vfat", "-n", "lv1", "/dev/vg0/lv1"], **self.run_basearg)
+        run.assert_any_call(
+            ["sudo", "mkfs.vfat", "-n", "lv1", "/dev/vg0/lv1"], **(self.run_basearg | dict(timeout=600.0))
+        )
         run.assert_any_call(
             [
                 "sudo",
@@ -491,8 +601,253 @@ Target 1: iqn.def
     @patch("subprocess.run")
     def test_create_snapshot(self, run):
         run.side_effect = [
+            MagicMock(stdout=self.lvs1),
             MagicMock(exit_code=0),
             MagicMock(stdout=self.lvsnap),
         ]
         res = TestClient(api).post("/volume/lv1/snapshot", json=dict(name="snap1", size=10240))
         self.assertEqual(200, res.status_code)
+
+    def _lvm(self, volumes: dict):
+        """side_effect of subprocess.run, lvs by volname tag"""
+
+        def _run(cmd, **kwargs):
+            for tag, ent in volumes.items():
+                if f"tags=volname.{tag}" in cmd:
+                    return MagicMock(stdout=json.dumps({"report": [{"lv": [ent] if ent else []}]}))
+            return MagicMock(stdout="")
+
+        return _run
+
+    @patch("subprocess.run")
+    def test_snapshot_list_all(self, run):
+        origin = dict(self.lv1, lv_name="uuid1", lv_tags="volname.vol1")
+        snaps = [dict(self.lvsnap_thin, lv_name=f"u{x}", lv_tags=f"volname.{x}", origin="uuid1") for x in "cab"]
+        clone = dict(self.lvsnap_thin, lv_name="u9", lv_tags="volname.clone1,volexp.clone", origin="uuid1")
+        selects = {
+            'vg_name=vg0 && origin!=""': [*snaps, clone],
+            "vg_name=vg0 && origin=uuid1": [*snaps, clone],
+            "vg_name=vg0 && (lv_name=uuid1)": [origin],
+            "tags=volname.vol1": [origin],
+            "tags=volname.b": [snaps[2]],
+            "tags=volname.vol9": [],
+        }
+
+        def _run(cmd, **kwargs):
+            self.assertIn("-S", cmd)
+            return MagicMock(stdout=json.dumps({"report": [{"lv": selects[cmd[cmd.index("-S") + 1]]}]}))
+
+        run.side_effect = _run
+        res = TestClient(api).get("/snapshot", params=dict(limit=2))
+        self.assertEqual(200, res.status_code)
+        self.assertEqual(["a", "b"], [x["name"] for x in res.json()["entries"]])
+        self.assertEqual(["vol1", "vol1"], [x["parent"] for x in res.json()["entries"]])
+        self.assertEqual("b", res.json()["next"])
+        res = TestClient(api).get("/snapshot", params=dict(limit=2, after="b"))
+        self.assertEqual(["c"], [x["name"] for x in res.json()["entries"]])
+        self.assertIsNone(res.json()["next"])
+        # filters
+        res = TestClient(api).get("/snapshot", params=dict(source="vol1"))
+        self.assertEqual(["a", "b", "c"], [x["name"] for x in res.json()["entries"]])
+        res = TestClient(api).get("/snapshot", params=dict(name="b"))
+        self.assertEqual([("b", "vol1")], [(x["name"], x["parent"]) for x in res.json()["entries"]])
+        res = TestClient(api).get("/snapshot", params=dict(source="vol9"))
+        self.assertEqual(dict(entries=[], next=None), res.json())
+
+    @patch("subprocess.run")
+    def test_clone_thin(self, run):
+        clone = dict(self.lvsnap_thin, lv_name="uuid9", lv_tags="volname.clone1,volexp.clone", origin="lvsnap")
+        vols: dict = dict(lvsnap=self.lvsnap_thin, clone1=None)
+        run.side_effect = self._lvm(vols)
+
+        def _lvcreate(cmd, **kwargs):
+            if "lvcreate" in cmd:
+                vols["clone1"] = clone
+            return self._lvm(vols)(cmd, **kwargs)
+
+        run.side_effect = _lvcreate
+        res = TestClient(api).post("/volume/lvsnap/clone", json=dict(name="clone1"))
+        self.assertEqual(200, res.status_code)
+        self.assertEqual("clone1", res.json()["name"])
+        # independent volume
+        self.assertIsNone(res.json()["parent"])
+        run.assert_any_call(
+            [
+                "sudo",
+                "lvcreate",
+                "--snapshot",
+                "--setactivationskip",
+                "n",
+                "--permission",
+                "rw",
+                "--name",
+                ANY,
+                "--addtag",
+                "volname.clone1",
+                "--addtag",
+                "volexp.clone",
+                "vg0/lvsnap",
+            ],
+            **self.run_basearg,
+        )
+        # exists
+        res = TestClient(api).post("/volume/lvsnap/clone", json=dict(name="clone1"))
+        self.assertEqual(400, res.status_code)
+
+    @patch("subprocess.run")
+    def test_clone_thin_resize(self, run):
+        clone = dict(self.lvsnap_thin, lv_name="uuid9", lv_tags="volname.clone1,volexp.clone", lv_size="40000000000")
+        run.side_effect = self._lvm(dict(lvsnap=self.lvsnap_thin, clone1=clone))
+        with patch("volexport.lvm2.LV.get", side_effect=[self.lvsnap_thin, None, self.lvsnap_thin, clone, clone]):
+            res = TestClient(api).post("/volume/lvsnap/clone", json=dict(name="clone1", size=40000000000))
+        self.assertEqual(200, res.status_code)
+        self.assertEqual(40000000000, res.json()["size"])
+        run.assert_any_call(["sudo", "lvresize", "--size", "40000000000b", "vg0/lvsnap", "--yes"], **self.run_basearg)
+        # smaller
+        res = TestClient(api).post("/volume/lvsnap/clone", json=dict(name="clone1", size=1024))
+        self.assertEqual(400, res.status_code)
+
+    @patch("volexport.api_volume._copy_volume")
+    @patch("subprocess.run")
+    def test_clone_thick(self, run, copy):
+        lv3 = dict(self.lv1, lv_name="uuid9", lv_full_name="vg0/uuid9", lv_tags="volname.lv3")
+        vols: dict = dict(lv1=self.lv1, lv3=None, lv9=None)
+
+        def _lvcreate(cmd, **kwargs):
+            if "lvcreate" in cmd and "--snapshot" in cmd:
+                tag = cmd[cmd.index("--addtag") + 1]
+                vols[tag.removeprefix("volname.")] = dict(
+                    self.lv1, lv_name="uuid8", lv_full_name="vg0/uuid8", lv_tags=tag, origin="lv1"
+                )
+            elif "lvcreate" in cmd:
+                vols["lv3"] = lv3
+            if "lvremove" in cmd:
+                for k, v in list(vols.items()):
+                    if v is not None and v["lv_full_name"] == cmd[cmd.index("lvremove") + 1]:
+                        vols[k] = None
+            return self._lvm(vols)(cmd, **kwargs)
+
+        def _snapshots():
+            return [k for k, v in vols.items() if k.startswith("clone-") and v is not None]
+
+        run.side_effect = _lvcreate
+        res = TestClient(api).post("/volume/lv1/clone", json=dict(name="lv3"))
+        self.assertEqual(200, res.status_code)
+        self.assertEqual("lv3", res.json()["name"])
+        run.assert_any_call(
+            ["sudo", "lvcreate", "--size", "68719476736b", "vg0", "--name", ANY, "--addtag", "volname.lv3"],
+            **self.run_basearg,
+        )
+        # copied from a temporary snapshot of the source, removed after copy
+        run.assert_any_call(
+            ["sudo", "lvcreate", "--snapshot", "--size", "6871947264b", "--name", ANY, "--addtag", ANY, "/dev/vg0/lv1"],
+            **self.run_basearg,
+        )
+        copy.assert_called_once_with("/dev/vg0/uuid8", "/dev/vg0/uuid9")
+        run.assert_any_call(["sudo", "lvremove", "vg0/uuid8", "--yes"], **self.run_basearg)
+        self.assertEqual([], _snapshots())
+        # copy failed: clone and snapshot removed
+        vols["lv3"] = None
+        copy.side_effect = subprocess.CalledProcessError(returncode=1, cmd="dd")
+        res = TestClient(api).post("/volume/lv1/clone", json=dict(name="lv3", snapshot_size=1048576))
+        self.assertEqual(500, res.status_code)
+        run.assert_any_call(
+            ["sudo", "lvcreate", "--snapshot", "--size", "1048576b", "--name", ANY, "--addtag", ANY, "/dev/vg0/lv1"],
+            **self.run_basearg,
+        )
+        run.assert_any_call(["sudo", "lvremove", "vg0/uuid9", "--yes"], **self.run_basearg)
+        self.assertIsNone(vols["lv3"])
+        self.assertEqual([], _snapshots())
+        # source not found
+        res = TestClient(api).post("/volume/lv9/clone", json=dict(name="lv3"))
+        self.assertEqual(404, res.status_code)
+
+    @patch("volexport.thin.allocated")
+    @patch("volexport.lvm2.LV.thin_id")
+    @patch("volexport.lvm2.LV.get")
+    def test_allocated(self, get, thin_id, allocated):
+        get.return_value = dict(self.lvsnap_thin, lv_size="100000")
+        thin_id.return_value = 3
+        allocated.return_value = iter([(0, 4096), (8192, 4096), (16384, 8192), (98304, 65536)])
+        res = TestClient(api).get("/volume/lvsnap/allocated", params=dict(offset=10000, page_size=2))
+        self.assertEqual(200, res.status_code)
+        self.assertEqual("application/x-ndjson", res.headers["content-type"])
+        lines = [json.loads(x) for x in res.text.splitlines()]
+        self.assertEqual(
+            [dict(size=100000, extents=[[10000, 2288], [16384, 8192]]), dict(size=100000, extents=[[98304, 1696]])],
+            lines,
+        )
+        allocated.assert_called_once_with("vg0", "pool1", 3)
+
+    @patch("volexport.thin.allocated")
+    @patch("volexport.lvm2.LV.thin_id")
+    @patch("volexport.lvm2.LV.get")
+    def test_allocated_empty(self, get, thin_id, allocated):
+        get.return_value = self.lvsnap_thin
+        thin_id.return_value = 3
+        allocated.return_value = iter([])
+        res = TestClient(api).get("/volume/lvsnap/allocated")
+        self.assertEqual(200, res.status_code)
+        self.assertEqual([dict(size=int(self.lvsnap_thin["lv_size"]), extents=[])], [json.loads(res.text)])
+
+    @patch("volexport.lvm2.LV.get")
+    def test_allocated_error(self, get):
+        get.return_value = None
+        self.assertEqual(404, TestClient(api).get("/volume/lvsnap/allocated").status_code)
+        get.return_value = self.lv1
+        self.assertEqual(400, TestClient(api).get("/volume/lv1/allocated").status_code)
+        self.assertEqual(422, TestClient(api).get("/volume/lv1/allocated", params=dict(offset=-1)).status_code)
+
+    @patch("subprocess.Popen")
+    @patch("subprocess.run")
+    @patch("volexport.lvm2.LV.thin_id")
+    @patch("volexport.lvm2.LV.get")
+    def test_allocated_command_error(self, get, thin_id, run, popen):
+        get.return_value = self.lvsnap_thin
+        thin_id.return_value = 3
+
+        def _popen(cmd, stdout, stderr, **kwargs):
+            stderr.write(b"thin_dump failed")
+            return MagicMock(stdin=None, stdout=None, returncode=1)
+
+        popen.side_effect = _popen
+        # error status instead of a truncated 200 stream
+        res = TestClient(api).get("/volume/lvsnap/allocated")
+        self.assertEqual(500, res.status_code)
+        get.side_effect = [self.lvsnap_thin, dict(self.lvsnap_thin, lv_name="lvbase")]
+        res = TestClient(api).get("/volume/lvsnap/delta/lvbase")
+        self.assertEqual(500, res.status_code)
+        # no output
+        get.side_effect = None
+        popen.side_effect = lambda cmd, stdout, stderr, **kwargs: MagicMock(stdin=None, stdout=None, returncode=0)
+        res = TestClient(api).get("/volume/lvsnap/allocated")
+        self.assertEqual(400, res.status_code)
+
+    @patch("volexport.thin.delta")
+    @patch("volexport.lvm2.LV.thin_id")
+    @patch("volexport.lvm2.LV.get")
+    def test_delta(self, get, thin_id, delta):
+        get.side_effect = [self.lvsnap_thin, dict(self.lvsnap_thin, lv_name="lvbase")]
+        thin_id.side_effect = [5, 3]
+        delta.return_value = iter([(0, 4096)])
+        res = TestClient(api).get("/volume/lvsnap/delta/lvbase")
+        self.assertEqual(200, res.status_code)
+        self.assertEqual([[0, 4096]], json.loads(res.text)["extents"])
+        delta.assert_called_once_with("vg0", "pool1", 3, 5)
+
+    @patch("volexport.lvm2.LV.thin_id")
+    @patch("volexport.lvm2.LV.get")
+    def test_delta_other_pool(self, get, thin_id):
+        get.side_effect = [self.lvsnap_thin, dict(self.lvsnap_thin, pool_lv="pool2")]
+        thin_id.side_effect = [5, 3]
+        res = TestClient(api).get("/volume/lvsnap/delta/lvbase")
+        self.assertEqual(400, res.status_code)
+
+    def test_generation_header(self):
+        from volexport.util import generation
+
+        res = TestClient(api).get("/health")
+        self.assertEqual(str(generation.value), res.headers["x-volexp-generation"])
+        generation.bump()
+        res = TestClient(api).get("/not-found")
+        self.assertEqual(str(generation.value), res.headers["x-volexp-generation"])
@@ -0,0 +1,224 @@
+import unittest
+import subprocess
+from unittest.mock import patch, ANY
+from fastapi.testclient import TestClient
+from volexport import warmpool
+from volexport.api import api
+from volexport.config import config, WarmPoolSpec
+from volexport.exceptions import InvalidArgument
+from volexport.lvm2 import LV
+
+specs = [
+    WarmPoolSpec(size=10737418240, filesystem="ext4", count=2),
+    WarmPoolSpec(size=1073741824, filesystem="ext4", count=1),
+    WarmPoolSpec(size=1073741824, count=1),
+]
+vol1 = dict(
+    name="vol1",
+    created="2025-08-10T16:48:15+09:00",
+    size=1073741824,
+    used=False,
+    readonly=False,
+    thin=False,
+    parent=None,
+    lvm_name="spare1",
+    lvm_id="lvid1",
+)
+
+
+def spare(name: str, *tags: str) -> dict:
+    return dict(lv_name=name, lv_tags=",".join(["volexp.warm", *tags]))
+
+
+class TestWarmPool(unittest.TestCase):
+    def setUp(self):
+        self.patcher = patch.object(config, "WARM_POOL", specs)
+        self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+
+    def test_match(self):
+        self.assertEqual(specs[1], warmpool.match(1073741824, "ext4"))
+        self.assertEqual(specs[0], warmpool.match(10737418240, "ext4"))
+        self.assertEqual(specs[2], warmpool.match(1024, None))
+        self.assertEqual(specs[2], warmpool.match(1073741824, None))
+        self.assertIsNone(warmpool.match(1073741824, "xfs"))
+        self.assertIsNone(warmpool.match(10737418241, "ext4"))
+        self.assertIsNone(warmpool.match(1073741825, None))
+        # formatted spare is never larger than requested
+        self.assertIsNone(warmpool.match(1024, "ext4"))
+        self.assertIsNone(warmpool.match(1073741825, "ext4"))
+        self.assertEqual("volexp.warm.1073741824.raw", warmpool.classtag(specs[2]))
+
+    @patch("volexport.lvm2.LV.get", return_value=None)
+    @patch("volexport.lvm2.LV.volume_read")
+    @patch("volexport.warmpool.runcmd")
+    @patch("volexport.warmpool.runparse_report")
+    def test_claim(self, report, runcmd, volume_read, get):
+        tag = "volexp.warm.1073741824.ext4"
+        report.return_value = [spare("spare1", tag), spare("spare2", tag)]
+        volume_read.return_value = vol1
+        hit = warmpool.claims.get(result="hit")
+        self.assertEqual(vol1, warmpool.claim("vg0", "vol1", 1073741824, "ext4"))
+        report.assert_called_once_with(mode="lv", filter=f"vg_name=vg0 && tags={tag}")
+        runcmd.assert_called_once_with(
+            ["lvchange", "--deltag", tag, "--deltag", "volexp.warm", "--addtag", "volname.vol1", "vg0/spare1"]
+        )
+        self.assertEqual(hit + 1, warmpool.claims.get(result="hit"))
+        self.assertEqual(1, warmpool.depth.get(size="1073741824", filesystem="ext4"))
+        self.assertTrue(warmpool.wakeup.is_set())
+
+        # empty, no size class
+        miss = warmpool.claims.get(result="miss")
+        runcmd.reset_mock()
+        report.return_value = []
+        self.assertIsNone(warmpool.claim("vg0", "vol1", 1073741824, "ext4"))
+        self.assertIsNone(warmpool.claim("vg0", "vol1", 1073741824, "xfs"))
+        runcmd.assert_not_called()
+        self.assertEqual(miss + 2, warmpool.claims.get(result="miss"))
+        with patch.object(config, "WARM_POOL", []):
+            self.assertIsNone(warmpool.claim("vg0", "vol1", 1073741824, "ext4"))
+            self.assertIsNone(warmpool.warm_pool())
+        self.assertEqual(miss + 2, warmpool.claims.get(result="miss"))
+
+    @patch("volexport.lvm2.LV.get")
+    @patch("volexport.warmpool.runcmd")
+    @patch("volexport.warmpool.runparse_report")
+    def test_claim_exists(self, report, runcmd, get):
+        get.return_value = dict(lv_name="lv1", lv_tags="volname.vol1")
+        report.return_value = [spare("spare1", "volexp.warm.1073741824.ext4")]
+        with self.assertRaises(InvalidArgument):
+            warmpool.claim("vg0", "vol1", 1073741824, "ext4")
+        runcmd.assert_not_called()
+        with patch("volexport.lvm2.runcmd") as lvcmd:
+            res = TestClient(api).post("/volume", json=dict(name="vol1", size=1073741824, filesystem="ext4"))
+        self.assertEqual(400, res.status_code)
+        lvcmd.assert_not_called()
+
+    @patch("volexport.lvm2.LV.volume_read")
+    @patch("volexport.lvm2.LV.get")
+    @patch("volexport.lvm2.runcmd")
+    @patch("volexport.warmpool.runcmd")
+    @patch("volexport.warmpool.runparse_report")
+    def test_claim_resize(self, report, runcmd, lvcmd, get, volume_read):
+        tag = "volexp.warm.1073741824.raw"
+        claimed = dict(lv_name="spare1", lv_full_name="vg0/spare1", lv_tags="volname.vol1")
+        get.side_effect = [None, claimed]
+        report.return_value = [spare("spare1", tag)]
+        volume_read.return_value = dict(vol1, size=536870912)
+        self.assertEqual(536870912, warmpool.claim("vg0", "vol1", 536870912, None)["size"])
+        runcmd.assert_called_once_with(
+            ["lvchange", "--deltag", tag, "--deltag", "volexp.warm", "--addtag", "volname.vol1", "vg0/spare1"]
+        )
+        lvcmd.assert_called_once_with(["lvresize", "--size", "536870912b", "vg0/spare1", "--yes"])
+        # resize failed: the claimed spare is removed
+        get.side_effect = [None, claimed, claimed]
+        lvcmd.reset_mock()
+        lvcmd.side_effect = [subprocess.CalledProcessError(returncode=5, cmd="lvresize"), None]
+        with self.assertRaises(subprocess.CalledProcessError):
+            warmpool.claim("vg0", "vol1", 536870912, None)
+        lvcmd.assert_called_with(["lvremove", "vg0/spare1", "--yes"])
+
+    @patch("shutil.which")
+    @patch("volexport.warmpool.runcmd")
+    @patch("volexport.warmpool.runparse_report")
+    def test_run_once(self, report, runcmd, which):
+        which.return_value = "/sbin/mkfs.ext4"
+        report.return_value = [
+            spare("s1", "volexp.warm.10737418240.ext4"),
+            spare("s2", "volexp.warm.1073741824.ext4"),
+            spare("s3", "volexp.warm.1073741824.ext4"),
+            spare("half"),
+            spare("old", "volexp.warm.2048.xfs"),
+        ]
+        pool = warmpool.WarmPool("vg0", 1.0)
+        count = warmpool.refill_seconds.count()
+        # 1 for 10G ext4, 1 for 1G raw
+        self.assertEqual(2, pool.run_once())
+        self.assertEqual(count + 2, warmpool.refill_seconds.count())
+        for name in ("s3", "half", "old"):
+            runcmd.assert_any_call(["lvremove", f"vg0/{name}", "--yes"])
+        runcmd.assert_any_call(["lvcreate", "--size", "10737418240b", "vg0", "--name", ANY, "--addtag", "volexp.warm"])
+        runcmd.assert_any_call(["mkfs.ext4", ANY])
+        runcmd.assert_any_call(["lvchange", "--addtag", "volexp.warm.10737418240.ext4", ANY])
+        runcmd.assert_any_call(["lvchange", "--addtag", "volexp.warm.1073741824.raw", ANY])
+        self.assertEqual(2, warmpool.depth.get(size="10737418240", filesystem="ext4"))
+        self.assertEqual(1, warmpool.depth.get(size="1073741824", filesystem="raw"))
+
+    @patch("shutil.which")
+    @patch("volexport.warmpool.runcmd")
+    @patch("volexport.warmpool.runparse_report")
+    def test_run_once_error(self, report, runcmd, which):
+        which.return_value = "/sbin/mkfs.ext4"
+        report.return_value = []
+
+        def _run(cmd):
+            if cmd[0] == "mkfs.ext4":
+                raise subprocess.CalledProcessError(returncode=1, cmd=cmd)
+
+        runcmd.side_effect = _run
+        errors = warmpool.refills.get(result="error")
+        with patch.object(config, "LVM_THINPOOL", "pool1"), patch.object(config, "WARM_POOL", specs[:1]):
+            self.assertEqual(0, warmpool.WarmPool("vg0", 1.0).run_once())
+        runcmd.assert_any_call(
+            [
+                "lvcreate",
+                "--thin",
+                "--virtualsize",
+                "10737418240b",
+                "--name",
+                ANY,
+                "--addtag",
+                "volexp.warm",
+                "vg0/pool1",
+            ]
+        )
+        # half-made spare is removed
+        runcmd.assert_called_with(["lvremove", ANY, "--yes"])
+        self.assertEqual(errors + 1, warmpool.refills.get(result="error"))
+
+    @patch("volexport.warmpool.WarmPool.run_once")
+    def test_loop(self, run_once):
+        run_once.side_effect = [RuntimeError("error"), 0, 0, 0, 0, 0, 0, 0, 0, 0]
+        pool = warmpool.warm_pool()
+        assert pool is not None
+        pool.poll = 0.01
+        pool.start()
+        try:
+            for _ in range(500):
+                if run_once.call_count >= 3:
+                    break
+                pool._stop.wait(0.01)
+        finally:
+            pool.stop()
+        self.assertIn("RuntimeError", pool.last_error)
+
+    def test_hidden(self):
+        ent = dict(
+            lv_name="spare1",
+            lv_path="/dev/vg0/spare1",
+            lv_tags="volexp.warm,volexp.warm.1073741824.ext4",
+            lv_time="2025-08-10 16:48:15 +0900",
+            lv_active="active",
+        )
+        self.assertIsNone(LV("vg0").vol2dict(ent))
+
+    @patch("volexport.lvm2.LV.format_volume")
+    @patch("volexport.lvm2.LV.create")
+    @patch("volexport.warmpool.claim")
+    def test_api(self, claim, create, format_volume):
+        claim.return_value = vol1
+        res = TestClient(api).post("/volume", json=dict(name="vol1", size=1073741824, filesystem="ext4"))
+        self.assertEqual(200, res.status_code)
+        self.assertEqual(dict(name="vol1", size=1073741824, filesystem="ext4"), res.json())
+        claim.assert_called_once_with("vg0", "vol1", 1073741824, "ext4")
+        create.assert_not_called()
+        # no spare: create and mkfs
+        claim.return_value = None
+        create.return_value = dict(vol1, size=1024)
+        res = TestClient(api).post("/volume", json=dict(name="vol1", size=1024, filesystem="ext4"))
+        self.assertEqual(200, res.status_code)
+        self.assertEqual(dict(name="vol1", size=1024, filesystem="ext4"), res.json())
+        create.assert_called_once_with(size=1024)
+        format_volume.assert_called_once_with("ext4", None)
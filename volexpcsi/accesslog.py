@@ -1,95 +1,225 @@
 import grpc
+import httpx
 import functools
+import logging
+import random
 import time
 import urllib.parse
 import inspect
+from contextlib import contextmanager
 from typing import Callable, Type
 from google.protobuf.message import Message
 from google.protobuf.json_format import MessageToJson
 from logging import getLogger
 from requests.exceptions import HTTPError, Timeout
+from volexport.exceptions import OperationPending
+from volexport.client import request_deadline
+from volexport.metrics import registry
 
 _log = getLogger(__name__)
 
 
+class LogSettings:
+    """Access log settings, shared by all servicers"""
+
+    # frequent calls with no interest
+    quiet = ("Probe", "GetPluginInfo", "GetPluginCapabilities", "ControllerGetCapabilities", "NodeGetCapabilities")
+
+    def __init__(self):
+        self.levels: dict[str, int] = {x: logging.DEBUG for x in self.quiet}
+        self.max_bytes = 1024
+        self.sample = 1.0
+
+    def configure(self, config: dict):
+        """Update by servicer config: log_levels, log_max_bytes, log_sample"""
+        for name, level in (config.get("log_levels") or {}).items():
+            self.levels[name] = level if isinstance(level, int) else logging.getLevelName(level.upper())
+        if config.get("log_max_bytes") is not None:
+            self.max_bytes = config["log_max_bytes"]
+        if config.get("log_sample") is not None:
+            self.sample = config["log_sample"]
+
+
+settings = LogSettings()
+rpc_total = registry.counter("volexp_csi_rpc_total", "Number of CSI calls by status code", ["method", "code"])
+rpc_seconds = registry.histogram("volexp_csi_rpc_seconds", "Time to process CSI calls", ["method"])
+
+
+def _m2j(msg: Message) -> str:
+    """JSON of the message, or its size if larger than max_bytes"""
+    size = msg.ByteSize()
+    if size > settings.max_bytes:
+        # skip serialization of large messages
+        return f"<{type(msg).__name__} {size} bytes>"
+    return MessageToJson(msg, preserving_proto_field_name=True, indent=None, ensure_ascii=False)
+
+
+_HTTP_CODES: dict[int, grpc.StatusCode] = {
+    400: grpc.StatusCode.INVALID_ARGUMENT,
+    401: grpc.StatusCode.UNAUTHENTICATED,
+    403: grpc.StatusCode.PERMISSION_DENIED,
+    404: grpc.StatusCode.NOT_FOUND,
+    408: grpc.StatusCode.DEADLINE_EXCEEDED,
+    409: grpc.StatusCode.ALREADY_EXISTS,
+    429: grpc.StatusCode.RESOURCE_EXHAUSTED,
+    499: grpc.StatusCode.CANCELLED,
+    500: grpc.StatusCode.INTERNAL,
+    501: grpc.StatusCode.UNIMPLEMENTED,
+    503: grpc.StatusCode.UNAVAILABLE,
+    504: grpc.StatusCode.DEADLINE_EXCEEDED,
+}
+
+
+def _status(e: Exception) -> tuple[grpc.StatusCode, str]:
+    """gRPC status of the exception, and the label in the log"""
+    if isinstance(e, PermissionError):
+        return grpc.StatusCode.PERMISSION_DENIED, "permission"
+    if isinstance(e, ValueError):
+        return grpc.StatusCode.INVALID_ARGUMENT, "value"
+    if isinstance(e, NotImplementedError):
+        return grpc.StatusCode.UNIMPLEMENTED, "not implemented"
+    if isinstance(e, FileExistsError):
+        return grpc.StatusCode.ALREADY_EXISTS, "exists"
+    if isinstance(e, FileNotFoundError):
+        return grpc.StatusCode.NOT_FOUND, "not found"
+    if isinstance(e, (Timeout, TimeoutError, httpx.TimeoutException)):
+        return grpc.StatusCode.DEADLINE_EXCEEDED, "timeout"
+    if isinstance(e, OperationPending):
+        return grpc.StatusCode.ABORTED, "pending"
+    if isinstance(e, AssertionError):
+        return grpc.StatusCode.ABORTED, "abort"
+    if isinstance(e, (HTTPError, httpx.HTTPStatusError)):
+        status = e.response.status_code
+        return _HTTP_CODES.get(status, grpc.StatusCode.UNKNOWN), f"http {status}"
+    return grpc.StatusCode.INTERNAL, "other error"
+
+
 def accesslog(f: Callable):
-    def _m2j(msg: Message) -> str:
-        return MessageToJson(msg, preserving_proto_field_name=True, indent=None, ensure_ascii=False)
+    method = f.__name__
+
+    def _finish(start: float, code: grpc.StatusCode) -> float:
+        elapsed = time.perf_counter() - start
+        rpc_seconds.observe(elapsed, method=method)
+        rpc_total.inc(method=method, code=code.name)
+        return elapsed
+
+    def _failed(e: Exception, client: str, funcname: str, start: float) -> dict:
+        """Log the error, returns arguments of context.abort()"""
+        code, label = _status(e)
+        elapsed = _finish(start, code)
+        if isinstance(e, OperationPending):
+            _log.info("finish(%s) %s <- %s(%.3f sec): %s", label, client, funcname, elapsed, e)
+        else:
+            _log.error("finish(%s) %s <- %s(%.3f sec): %s", label, client, funcname, elapsed, e, exc_info=e)
+        return dict(code=code, details=f"{type(e).__qualname__}: {e}")
+
+    @contextmanager
+    def _errors(context: grpc.ServicerContext, client: str, funcname: str, start: float):
+        """Map exceptions to gRPC status"""
+        try:
+            yield
+        except Exception as e:
+            context.abort(**_failed(e, client, funcname, start))
+
+    def _ok(res: Message, client: str, funcname: str, level: int | None, full: bool, start: float):
+        elapsed = _finish(start, grpc.StatusCode.OK)
+        if full:
+            _log.log(level, "finish(OK) %s <- %s(%.3f sec): %s", client, funcname, elapsed, _m2j(res))
+        elif level is not None:
+            _log.log(level, "finish(OK) %s <- %s(%.3f sec)", client, funcname, elapsed)
+
+    def _begin(request: Message, context: grpc.ServicerContext):
+        level = settings.levels.get(method, logging.INFO)
+        if not _log.isEnabledFor(level):
+            level = None
+        # sampled out calls are logged by one line without messages
+        full = level is not None and (settings.sample >= 1.0 or random.random() < settings.sample)
+        client = urllib.parse.unquote(context.peer())
+        if full:
+            _log.log(level, "start %s -> %s: %s", client, f.__qualname__, _m2j(request))
+        remaining = context.time_remaining() if hasattr(context, "time_remaining") else None
+        token = request_deadline.set(time.monotonic() + remaining if remaining is not None else None)
+        return client, level, full, time.perf_counter(), token
+
+    if inspect.isasyncgenfunction(f):
+        # server streaming of the asyncio server
+
+        @functools.wraps(f)
+        async def _astream(self, request: Message, context: grpc.aio.ServicerContext):
+            funcname = f.__qualname__
+            client, level, _full, start, token = _begin(request, context)
+            try:
+                count = 0
+                try:
+                    async for res in f(self, request, context):
+                        count += 1
+                        yield res
+                except grpc.aio.AbortError:
+                    raise
+                except Exception as e:
+                    await context.abort(**_failed(e, client, funcname, start))
+                    return
+                elapsed = _finish(start, grpc.StatusCode.OK)
+                if level is not None:
+                    _log.log(level, "finish(OK) %s <- %s(%.3f sec): %d messages", client, funcname, elapsed, count)
+            finally:
+                request_deadline.reset(token)
+
+        return _astream
+
+    if inspect.iscoroutinefunction(f):
+
+        @functools.wraps(f)
+        async def _async(self, request: Message, context: grpc.aio.ServicerContext):
+            funcname = f.__qualname__
+            client, level, full, start, token = _begin(request, context)
+            try:
+                try:
+                    res = await f(self, request, context)
+                except grpc.aio.AbortError:
+                    raise
+                except Exception as e:
+                    await context.abort(**_failed(e, client, funcname, start))
+                    return None
+                _ok(res, client, funcname, level, full, start)
+                return res
+            finally:
+                request_deadline.reset(token)
+
+        return _async
+
+    if inspect.isgeneratorfunction(f):
+        # server streaming: errors are raised while iterating
+
+        @functools.wraps(f)
+        def _stream(self, request: Message, context: grpc.ServicerContext):
+            funcname = f.__qualname__
+            client, level, _full, start, token = _begin(request, context)
+            try:
+                with _errors(context, client, funcname, start):
+                    count = 0
+                    for res in f(self, request, context):
+                        count += 1
+                        yield res
+                    elapsed = _finish(start, grpc.StatusCode.OK)
+                    if level is not None:
+                        _log.log(level, "finish(OK) %s <- %s(%.3f sec): %d messages", client, funcname, elapsed, count)
+            finally:
+                request_deadline.reset(token)
+
+        return _stream
 
     @functools.wraps(f)
     def _(self, request: Message, context: grpc.ServicerContext):
-        client = urllib.parse.unquote(context.peer())
         funcname = f.__qualname__
-        _log.info("start %s -> %s: %s", client, funcname, _m2j(request))
-        start = time.time()
+        client, level, full, start, token = _begin(request, context)
         try:
-            res = f(self, request, context)
-            finish = time.time()
-            _log.info("finish(OK) %s <- %s(%.3f sec): %s", client, funcname, finish - start, _m2j(res))
-            return res
-        except PermissionError as e:
-            finish = time.time()
-            _log.error("finish(permission) %s <- %s(%.3f sec): %s", client, funcname, finish - start, e, exc_info=e)
-            context.abort(code=grpc.StatusCode.PERMISSION_DENIED, details=f"{type(e).__qualname__}: {e}")
-        except ValueError as e:
-            finish = time.time()
-            _log.error("finish(value) %s <- %s(%.3f sec): %s", client, funcname, finish - start, e, exc_info=e)
-            context.abort(code=grpc.StatusCode.INVALID_ARGUMENT, details=f"{type(e).__qualname__}: {e}")
-        except NotImplementedError as e:
-            finish = time.time()
-            _log.error(
-                "finish(not implemented) %s <- %s(%.3f sec): %s", client, funcname, finish - start, e, exc_info=e
-            )
-            context.abort(code=grpc.StatusCode.UNIMPLEMENTED, details=f"{type(e).__qualname__}: {e}")
-        except FileExistsError as e:
-            finish = time.time()
-            _log.error("finish(exists) %s <- %s(%.3f sec): %s", client, funcname, finish - start, e, exc_info=e)
-            context.abort(code=grpc.StatusCode.ALREADY_EXISTS, details=f"{type(e).__qualname__}: {e}")
-        except FileNotFoundError as e:
-            finish = time.time()
-            _log.error("finish(not found) %s <- %s(%.3f sec): %s", client, funcname, finish - start, e, exc_info=e)
-            context.abort(code=grpc.StatusCode.NOT_FOUND, details=f"{type(e).__qualname__}: {e}")
-        except (Timeout, TimeoutError) as e:
-            finish = time.time()
-            _log.error("finish(timeout) %s <- %s(%.3f sec): %s", client, funcname, finish - start, e, exc_info=e)
-            context.abort(code=grpc.StatusCode.DEADLINE_EXCEEDED, details=f"{type(e).__qualname__}: {e}")
-        except AssertionError as e:
-            finish = time.time()
-            _log.error("finish(abort) %s <- %s(%.3f sec): %s", client, funcname, finish - start, e, exc_info=e)
-            context.abort(code=grpc.StatusCode.ABORTED, details=f"{type(e).__qualname__}: {e}")
-        except HTTPError as e:
-            finish = time.time()
-            _log.error(
-                "finish(http %s) %s <- %s(%.3f sec): %s",
-                e.response.status_code,
-                client,
-                funcname,
-                finish - start,
-                e,
-                exc_info=e,
-            )
-            codemap: dict[int, grpc.StatusCode] = {
-                400: grpc.StatusCode.INVALID_ARGUMENT,
-                401: grpc.StatusCode.UNAUTHENTICATED,
-                403: grpc.StatusCode.PERMISSION_DENIED,
-                404: grpc.StatusCode.NOT_FOUND,
-                408: grpc.StatusCode.DEADLINE_EXCEEDED,
-                409: grpc.StatusCode.ALREADY_EXISTS,
-                429: grpc.StatusCode.RESOURCE_EXHAUSTED,
-                499: grpc.StatusCode.CANCELLED,
-                500: grpc.StatusCode.INTERNAL,
-                501: grpc.StatusCode.UNIMPLEMENTED,
-                503: grpc.StatusCode.UNAVAILABLE,
-                504: grpc.StatusCode.DEADLINE_EXCEEDED,
-            }
-            context.abort(
-                code=codemap.get(e.response.status_code, grpc.StatusCode.UNKNOWN),
-                details=f"{type(e).__qualname__}: {e}",
-            )
-        except Exception as e:
-            finish = time.time()
-            _log.error("finish(other error) %s <- %s(%.3f sec): %s", client, funcname, finish - start, e, exc_info=e)
-            context.abort(code=grpc.StatusCode.INTERNAL, details=f"{type(e).__qualname__}: {e}")
+            with _errors(context, client, funcname, start):
+                res = f(self, request, context)
+                _ok(res, client, funcname, level, full, start)
+                return res
+        finally:
+            request_deadline.reset(token)
 
     return _
 
@@ -1,106 +1,438 @@
+import asyncio
 import grpc
+import datetime
+import time
+import threading
+from typing import Any, Awaitable, Callable
 from logging import getLogger
-from volexport.client import VERequest
+from volexport.client import VERequest, AsyncVERequest, GENERATION_HEADER
+from volexport.exceptions import OperationPending
 from google.protobuf.message import Message
+from google.protobuf.timestamp_pb2 import Timestamp
 from google.protobuf.json_format import MessageToDict
 from . import api
 from .accesslog import servicer_accesslog
+from .inflight import InFlight, AsyncInFlight, dedupe
 
 _log = getLogger(__name__)
 
 
+def _validate(request: Message):
+    if hasattr(request, "volume_id"):
+        if not getattr(request, "volume_id"):
+            raise ValueError("volume id is empty")
+
+
+def _volume_index(vols: list[dict]) -> tuple[list[dict], dict[str, int]]:
+    """Volume list and name to offset index"""
+    return vols, {x["name"]: i for i, x in enumerate(vols)}
+
+
+def _published(exports: list[dict]) -> dict[str, list[str]]:
+    """Connected addresses of each exported volume"""
+    nodes: dict[str, list[str]] = {}
+    for exp in exports:
+        addrs = [addr for conn in exp.get("connected", []) for addr in conn.get("address", [])]
+        for vol in exp.get("volumes", []):
+            nodes.setdefault(vol, []).extend(addrs)
+    return nodes
+
+
+def _capabilities() -> api.ControllerGetCapabilitiesResponse:
+    caps: list[api.ControllerServiceCapability.RPC.Type] = [
+        api.ControllerServiceCapability.RPC.CREATE_DELETE_VOLUME,
+        api.ControllerServiceCapability.RPC.PUBLISH_UNPUBLISH_VOLUME,
+        api.ControllerServiceCapability.RPC.LIST_VOLUMES,
+        api.ControllerServiceCapability.RPC.EXPAND_VOLUME,
+        api.ControllerServiceCapability.RPC.GET_CAPACITY,
+        api.ControllerServiceCapability.RPC.GET_VOLUME,
+        api.ControllerServiceCapability.RPC.PUBLISH_READONLY,
+        api.ControllerServiceCapability.RPC.CLONE_VOLUME,
+        api.ControllerServiceCapability.RPC.CREATE_DELETE_SNAPSHOT,
+        api.ControllerServiceCapability.RPC.LIST_SNAPSHOTS,
+        api.ControllerServiceCapability.RPC.GET_SNAPSHOT,
+        # api.ControllerServiceCapability.RPC.MODIFY_VOLUME,
+    ]
+    res: list[api.ControllerServiceCapability] = [
+        api.ControllerServiceCapability(rpc=api.ControllerServiceCapability.RPC(type=typ)) for typ in caps
+    ]
+    return api.ControllerGetCapabilitiesResponse(capabilities=res)
+
+
+def _list_volumes(
+    request: api.ListVolumesRequest, vols: list[dict], index: dict[str, int], nodes: dict[str, list[str]]
+) -> api.ListVolumesResponse:
+    start = 0
+    if request.starting_token:
+        if not request.starting_token.startswith("vol-"):
+            raise AssertionError(f"invalid starting token: {request.starting_token}")
+        offset = index.get(request.starting_token.removeprefix("vol-"))
+        if offset is None:
+            raise AssertionError(f"invalid starting token: {request.starting_token}")
+        start = offset
+    end = len(vols)
+    if request.max_entries:
+        end = min(end, start + request.max_entries)
+    res: list[api.ListVolumesResponse.Entry] = []
+    for vol in vols[start:end]:
+        vent = api.Volume(
+            volume_id=vol.get("name"),
+            capacity_bytes=vol.get("size"),
+        )
+        stat = api.ListVolumesResponse.VolumeStatus(
+            volume_condition=api.VolumeCondition(abnormal=False),
+            published_node_ids=nodes.get(vol["name"], []),
+        )
+        ent = api.ListVolumesResponse.Entry(volume=vent, status=stat)
+        res.append(ent)
+    if end < len(vols):
+        return api.ListVolumesResponse(entries=res, next_token="vol-" + vols[end]["name"])
+    return api.ListVolumesResponse(entries=res)
+
+
+def _source_volume(source: api.VolumeContentSource) -> str | None:
+    """volexport volume name of the content source, snapshot id is a volume name too"""
+    kind = source.WhichOneof("type")
+    if kind == "volume":
+        return source.volume.volume_id
+    if kind == "snapshot":
+        return source.snapshot.snapshot_id
+    return None
+
+
+def _create_source(request: api.CreateVolumeRequest) -> tuple[str | None, api.VolumeContentSource | None]:
+    """Validate CreateVolume request, returns the source volume and the content source of the response"""
+    _validate(request)
+    if not request.name:
+        raise ValueError("no volume name")
+    source = _source_volume(request.volume_content_source)
+    if not source and not request.capacity_range.required_bytes:
+        raise ValueError("no capacity specified")
+    return source, request.volume_content_source if source else None
+
+
+def _existing_volume(
+    request: api.CreateVolumeRequest, volsize: int, content_source: api.VolumeContentSource | None
+) -> api.CreateVolumeResponse:
+    if request.capacity_range.required_bytes and volsize < request.capacity_range.required_bytes:
+        raise FileExistsError("volume already exists(short)")
+    if request.capacity_range.limit_bytes and request.capacity_range.limit_bytes < volsize:
+        raise FileExistsError("volume already exists(too large)")
+    return api.CreateVolumeResponse(
+        volume=api.Volume(capacity_bytes=volsize, volume_id=request.name, content_source=content_source)
+    )
+
+
+def _publish_args(request: api.ControllerPublishVolumeRequest) -> dict:
+    """Validate ControllerPublishVolume request, returns the export request"""
+    _validate(request)
+    if not request.node_id:
+        raise ValueError("no node_id")
+    if not MessageToDict(request.volume_capability):
+        raise ValueError("no capability")
+    # if request.volume_capability.access_mode not in (api.VolumeCapability.AccessMode.SINGLE_NODE_WRITER,):
+    #     raise ValueError("invalid mode")
+    if not request.volume_capability.mount.fs_type:
+        raise ValueError("invalid type")
+    return dict(name=request.volume_id, readonly=request.readonly, acl=None, node=request.node_id)
+
+
+def _get_volume(resj: dict) -> api.ControllerGetVolumeResponse:
+    nodes = [addr for exp in resj["exports"] for conn in exp["connected"] for addr in conn["address"]]
+    return api.ControllerGetVolumeResponse(
+        volume=api.Volume(
+            capacity_bytes=resj["size"],
+            volume_id=resj["name"],
+        ),
+        status=api.ControllerGetVolumeResponse.VolumeStatus(
+            published_node_ids=nodes, volume_condition=api.VolumeCondition(abnormal=False)
+        ),
+    )
+
+
+def _confirmed(request: api.ValidateVolumeCapabilitiesRequest) -> api.ValidateVolumeCapabilitiesResponse:
+    supported_mode = [
+        api.VolumeCapability.AccessMode.Mode.SINGLE_NODE_WRITER,
+    ]
+    caps: list[api.VolumeCapability] = []
+    for cap in request.volume_capabilities:
+        if cap.access_mode.mode in supported_mode:
+            caps.append(cap)
+    return api.ValidateVolumeCapabilitiesResponse(
+        confirmed=api.ValidateVolumeCapabilitiesResponse.Confirmed(
+            volume_capabilities=caps,
+            parameters=request.parameters,
+            mutable_parameters=request.mutable_parameters,
+        ),
+    )
+
+
+def _snapshot(snap: dict) -> api.Snapshot:
+    created = Timestamp()
+    created.FromDatetime(datetime.datetime.fromisoformat(snap["created"]))
+    return api.Snapshot(
+        size_bytes=snap["size"],
+        snapshot_id=snap["name"],
+        source_volume_id=snap["parent"],
+        creation_time=created,
+        ready_to_use=True,
+    )
+
+
+def _snapshot_params(request: api.ListSnapshotsRequest) -> dict[str, str | int]:
+    # filtered and paged by volexport
+    params: dict[str, str | int] = {}
+    if request.snapshot_id:
+        params["name"] = request.snapshot_id
+    if request.source_volume_id:
+        params["source"] = request.source_volume_id
+    if request.starting_token:
+        if not request.starting_token.startswith("snap-"):
+            raise AssertionError(f"invalid starting token: {request.starting_token}")
+        params["after"] = request.starting_token.removeprefix("snap-")
+    if request.max_entries:
+        params["limit"] = request.max_entries
+    return params
+
+
+def _list_snapshots(resj: dict) -> api.ListSnapshotsResponse:
+    entries = [api.ListSnapshotsResponse.Entry(snapshot=_snapshot(x)) for x in resj["entries"]]
+    if resj.get("next"):
+        return api.ListSnapshotsResponse(entries=entries, next_token="snap-" + resj["next"])
+    return api.ListSnapshotsResponse(entries=entries)
+
+
+def _validate_snapshot(request: api.CreateSnapshotRequest):
+    if not request.name:
+        raise ValueError("no snapshot name")
+    if not request.source_volume_id:
+        raise ValueError("no source volume id")
+
+
+def _existing_snapshot(request: api.CreateSnapshotRequest, snap: dict) -> api.CreateSnapshotResponse:
+    if snap["parent"] != request.source_volume_id:
+        raise FileExistsError(f"snapshot exists: {request.name}, source={snap['parent']}")
+    return api.CreateSnapshotResponse(snapshot=_snapshot(snap))
+
+
+class _Fetch:
+    """Running fetch of a cache key, shared by concurrent callers"""
+
+    def __init__(self, done: threading.Event | asyncio.Event):
+        self.done = done
+        self.value: Any = None
+        self.error: BaseException | None = None
+
+
+class ResponseCache:
+    """Short-lived snapshots of volexport responses, revalidated by inventory generation"""
+
+    def __init__(self, req: VERequest, ttl: float, max_age: float):
+        self.req = req
+        self.ttl = ttl
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._entries: dict[str, tuple[int | None, float, Any]] = {}
+        self._fetching: dict[str, _Fetch] = {}
+        self._checked: tuple[int | None, float] | None = None
+        # bumped by invalidate(), fetches started before it are not stored
+        self._epoch = 0
+
+    def generation(self) -> int | None:
+        """Inventory generation of volexport, asked at most once per ttl"""
+        now = time.monotonic()
+        checked = self._checked
+        if checked is not None and now - checked[1] < self.ttl:
+            return checked[0]
+        res = self.req.get("/health")
+        res.raise_for_status()
+        value = res.headers.get(GENERATION_HEADER)
+        gen = int(value) if value is not None else None
+        self._checked = (gen, now)
+        return gen
+
+    def get(self, key: str, fetch: Callable[[], Any], revalidate: bool = True) -> Any:
+        """Cached value, fetch again if expired or generation changed
+
+        HTTP requests run outside of the lock, concurrent callers of the same key share one fetch.
+        """
+        if self.max_age <= 0:
+            return fetch()
+        with self._lock:
+            now = time.monotonic()
+            ent = self._entries.get(key)
+            if ent is not None and now - ent[1] < self.ttl:
+                return ent[2]
+            running = self._fetching.get(key)
+            if running is None:
+                running = self._fetching[key] = _Fetch(threading.Event())
+                owner = True
+                epoch = self._epoch
+            else:
+                owner = False
+        if not owner:
+            running.done.wait()
+            if running.error is not None:
+                raise running.error
+            return running.value
+        try:
+            if revalidate and ent is not None and ent[0] is not None and now - ent[1] < self.max_age:
+                if self.generation() == ent[0]:
+                    running.value = ent[2]
+                    return ent[2]
+            # generation before fetch: changes while fetching are detected next time
+            gen = self.generation() if revalidate else None
+            running.value = fetch()
+            with self._lock:
+                if self._epoch == epoch:
+                    self._entries[key] = (gen, time.monotonic(), running.value)
+            return running.value
+        except BaseException as e:
+            running.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._fetching[key]
+            running.done.set()
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+            self._checked = None
+            self._epoch += 1
+
+
 @servicer_accesslog
 class VolExpControl(api.ControllerServicer):
     def __init__(self, config: dict):
         self.config = config
-        self.req = VERequest(config["endpoint"])
+        self.req = VERequest(config["endpoint"], pool_size=config.get("pool_size"), timeout=config.get("http_timeout"))
+        # running job id by operation key, shared by worker threads
+        self.jobs: dict[str, str] = {}
+        self._jobs_lock = threading.Lock()
+        self.inflight = InFlight()
+        ttl = config.get("cache_ttl")
+        max_age = config.get("cache_max_age")
+        self.cache = ResponseCache(
+            self.req, ttl=2.0 if ttl is None else ttl, max_age=30.0 if max_age is None else max_age
+        )
 
-    def _validate(self, request: Message):
-        if hasattr(request, "volume_id"):
-            if not getattr(request, "volume_id"):
-                raise ValueError("volume id is empty")
+    def _wait_job(self, key: str, res, context: grpc.ServicerContext) -> dict:
+        """wait for the job started by async request, return the result"""
+        res.raise_for_status()
+        if res.status_code != 202:
+            # completed synchronously
+            return res.json()
+        jobid = res.json()["id"]
+        with self._jobs_lock:
+            self.jobs[key] = jobid
+        return self._poll_job(key, jobid, context)
 
-    def GetCapacity(self, request: api.GetCapacityRequest, context: grpc.ServicerContext):
+    def _running_job(self, key: str) -> str | None:
+        with self._jobs_lock:
+            return self.jobs.get(key)
+
+    def _forget_job(self, key: str, jobid: str):
+        with self._jobs_lock:
+            if self.jobs.get(key) == jobid:
+                del self.jobs[key]
+
+    def _poll_job(self, key: str, jobid: str, context: grpc.ServicerContext) -> dict:
+        interval = self.config.get("job_poll_interval", 1.0)
+        wait = self.config.get("job_wait", 30.0)
+        remaining = context.time_remaining() if hasattr(context, "time_remaining") else None
+        if remaining is not None:
+            wait = min(wait, remaining - interval)
+        limit = time.monotonic() + wait
+        while True:
+            res = self.req.get(f"/jobs/{jobid}")
+            if res.status_code == 404:
+                self._forget_job(key, jobid)
+                raise FileNotFoundError(f"job not found: {jobid}")
+            res.raise_for_status()
+            job = res.json()
+            if job["status"] == "succeeded":
+                self._forget_job(key, jobid)
+                return job["result"]
+            if job["status"] in ("failed", "cancelled"):
+                self._forget_job(key, jobid)
+                raise Exception(f"job {job['status']}: {job['name']}: {job['error']}")
+            if time.monotonic() + interval > limit:
+                raise OperationPending(f"operation pending: {key}, job={jobid}")
+            time.sleep(interval)
+
+    def _capacity(self) -> int:
         res = self.req.get("/stats/volume")
         res.raise_for_status()
-        resj = res.json()
-        return api.GetCapacityResponse(available_capacity=resj["free"])
+        return res.json()["free"]
+
+    def _volumes(self) -> tuple[list[dict], dict[str, int]]:
+        res = self.req.get("/volume")
+        res.raise_for_status()
+        return _volume_index(res.json())
+
+    def _published(self) -> dict[str, list[str]]:
+        res = self.req.get("/export")
+        res.raise_for_status()
+        return _published(res.json())
+
+    def GetCapacity(self, request: api.GetCapacityRequest, context: grpc.ServicerContext):
+        return api.GetCapacityResponse(available_capacity=self.cache.get("capacity", self._capacity))
 
     def ControllerGetCapabilities(self, request: api.ControllerGetCapabilitiesRequest, context: grpc.ServicerContext):
-        caps: list[api.ControllerServiceCapability.RPC.Type] = [
-            api.ControllerServiceCapability.RPC.CREATE_DELETE_VOLUME,
-            api.ControllerServiceCapability.RPC.PUBLISH_UNPUBLISH_VOLUME,
-            api.ControllerServiceCapability.RPC.LIST_VOLUMES,
-            api.ControllerServiceCapability.RPC.EXPAND_VOLUME,
-            api.ControllerServiceCapability.RPC.GET_CAPACITY,
-            api.ControllerServiceCapability.RPC.GET_VOLUME,
-            api.ControllerServiceCapability.RPC.PUBLISH_READONLY,
-            # api.ControllerServiceCapability.RPC.MODIFY_VOLUME,
-            # api.ControllerServiceCapability.RPC.GET_SNAPSHOT,
-        ]
-        res: list[api.ControllerServiceCapability] = [
-            api.ControllerServiceCapability(rpc=api.ControllerServiceCapability.RPC(type=typ)) for typ in caps
-        ]
-        return api.ControllerGetCapabilitiesResponse(capabilities=res)
+        return _capabilities()
 
     def ListVolumes(self, request: api.ListVolumesRequest, context: grpc.ServicerContext):
-        vols = self.req.get("/volume")
-        vols.raise_for_status()
-        res: list[api.ListVolumesResponse.Entry] = []
-        flag = True
-        if request.starting_token:
-            if not request.starting_token.startswith("vol-"):
-                raise AssertionError(f"invalid starting token: {request.starting_token}")
-            flag = False
-        next_entry: str | None = None
-        for vol in vols.json():
-            if request.max_entries and request.max_entries <= len(res):
-                next_entry = vol["name"]
-                break
-            if not flag and vol["name"] == request.starting_token.removeprefix("vol-"):
-                flag = True
-            if not flag:
-                continue
-            vent = api.Volume(
-                volume_id=vol.get("name"),
-                capacity_bytes=vol.get("size"),
-            )
-            stat = api.ListVolumesResponse.VolumeStatus(
-                volume_condition=api.VolumeCondition(abnormal=False),
-                published_node_ids=vol.get("addresses", []),
-            )
-            ent = api.ListVolumesResponse.Entry(volume=vent, status=stat)
-            res.append(ent)
-        if next_entry:
-            return api.ListVolumesResponse(entries=res, next_token="vol-" + next_entry)
-        return api.ListVolumesResponse(entries=res)
+        vols, index = self.cache.get("volumes", self._volumes)
+        nodes = self.cache.get("published", self._published, revalidate=False)
+        return _list_volumes(request, vols, index, nodes)
 
+    @dedupe(lambda x: x.name)
     def CreateVolume(self, request: api.CreateVolumeRequest, context: grpc.ServicerContext):
-        self._validate(request)
-        if not request.name:
-            raise ValueError("no volume name")
-        if not request.capacity_range.required_bytes:
-            raise ValueError("no capacity specified")
+        source, content_source = _create_source(request)
+        jobid = self._running_job(f"create:{request.name}")
+        if jobid is not None:
+            resj = self._poll_job(f"create:{request.name}", jobid, context)
+            return api.CreateVolumeResponse(
+                volume=api.Volume(capacity_bytes=resj["size"], volume_id=resj["name"], content_source=content_source)
+            )
         chk = self.req.get(f"/volume/{request.name}")
         if chk.status_code == 200:
-            volsize = chk.json()["size"]
-            if request.capacity_range.required_bytes and volsize < request.capacity_range.required_bytes:
-                raise FileExistsError("volume already exists(short)")
-            if request.capacity_range.limit_bytes and request.capacity_range.limit_bytes < volsize:
-                raise FileExistsError("volume already exists(too large)")
-            return api.CreateVolumeResponse(volume=api.Volume(capacity_bytes=volsize, volume_id=request.name))
+            return _existing_volume(request, chk.json()["size"], content_source)
+        if source:
+            # thin snapshot of the source, or full copy of thick volume. filesystem is cloned too
+            res = self.req.post(
+                f"/volume/{source}/clone",
+                json=dict(name=request.name, size=request.capacity_range.required_bytes or None),
+                params={"async": "1"},
+            )
+            if res.status_code == 404:
+                raise FileNotFoundError(f"source volume not found: {source}")
+            self.cache.invalidate()
+            resj = self._wait_job(f"create:{request.name}", res, context)
+            return api.CreateVolumeResponse(
+                volume=api.Volume(capacity_bytes=resj["size"], volume_id=resj["name"], content_source=content_source)
+            )
+        filesystem = next((x.mount.fs_type for x in request.volume_capabilities if x.mount.fs_type), "ext4")
+        # formatted spare volume if available, otherwise a job to create and mkfs
         res = self.req.post(
             "/volume",
             json=dict(
                 name=request.name,
                 size=request.capacity_range.required_bytes,
+                filesystem=filesystem,
             ),
+            params={"async": "1"},
         )
         res.raise_for_status()
-        resj = res.json()
-        volname = resj["name"]
-        mkfsres = self.req.post(f"/volume/{volname}/mkfs", json=dict())
-        mkfsres.raise_for_status()
+        self.cache.invalidate()
+        resj = self._wait_job(f"create:{request.name}", res, context)
+        if not resj.get("filesystem"):
+            # volexport does not make filesystem on create
+            mkfsres = self.req.post(
+                f"/volume/{resj['name']}/mkfs", json=dict(filesystem=filesystem), params={"async": "1"}
+            )
+            self._wait_job(f"create:{resj['name']}", mkfsres, context)
         return api.CreateVolumeResponse(
             volume=api.Volume(
                 capacity_bytes=resj["size"],
@@ -108,33 +440,31 @@ class VolExpControl(api.ControllerServicer):
             )
         )
 
+    @dedupe(lambda x: x.volume_id)
     def DeleteVolume(self, request: api.DeleteVolumeRequest, context: grpc.ServicerContext):
-        self._validate(request)
+        _validate(request)
         res = self.req.delete(f"/volume/{request.volume_id}")
         if res.status_code == 404:
             _log.info("delete not found: %s", request.volume_id)
             return api.DeleteVolumeResponse()
         res.raise_for_status()
+        self.cache.invalidate()
         return api.DeleteVolumeResponse()
 
+    @dedupe(lambda x: x.volume_id)
     def ControllerPublishVolume(self, request: api.ControllerPublishVolumeRequest, context: grpc.ServicerContext):
-        self._validate(request)
-        if not request.node_id:
-            raise ValueError("no node_id")
-        if not MessageToDict(request.volume_capability):
-            raise ValueError("no capability")
-        # if request.volume_capability.access_mode not in (api.VolumeCapability.AccessMode.SINGLE_NODE_WRITER,):
-        #     raise ValueError("invalid mode")
-        if not request.volume_capability.mount.fs_type:
-            raise ValueError("invalid type")
-        res = self.req.post("/export", json=dict(name=request.volume_id, readonly=request.readonly, acl=None))
+        arg = _publish_args(request)
+        # retried publish to the node returns the same export
+        res = self.req.post("/export", json=arg, params=dict(reuse="1"))
         res.raise_for_status()
+        self.cache.invalidate()
         resj = res.json()
         ctxt = {k: str(v) for k, v in resj.items()}
         return api.ControllerPublishVolumeResponse(publish_context=ctxt)
 
+    @dedupe(lambda x: x.volume_id)
     def ControllerUnpublishVolume(self, request: api.ControllerUnpublishVolumeRequest, context: grpc.ServicerContext):
-        self._validate(request)
+        _validate(request)
         qres = self.req.get("/export", params=dict(volume=request.volume_id))
         qres.raise_for_status()
         for tgt in qres.json():
@@ -144,69 +474,418 @@ class VolExpControl(api.ControllerServicer):
             tgtname = tgt["targetname"]
             res = self.req.delete(f"/export/{tgtname}")
             res.raise_for_status()
+            self.cache.invalidate()
         return api.ControllerUnpublishVolumeResponse()
 
+    @dedupe(lambda x: x.volume_id)
     def ControllerExpandVolume(self, request: api.ControllerExpandVolumeRequest, context: grpc.ServicerContext):
-        self._validate(request)
-        res = self.req.post(f"/volume/{request.volume_id}", json=dict(size=request.capacity_range.required_bytes))
-        res.raise_for_status()
-        return api.ControllerExpandVolumeResponse(capacity_bytes=res.json()["size"], node_expansion_required=True)
+        _validate(request)
+        jobid = self._running_job(f"expand:{request.volume_id}")
+        if jobid is not None:
+            resj = self._poll_job(f"expand:{request.volume_id}", jobid, context)
+        else:
+            res = self.req.post(
+                f"/volume/{request.volume_id}",
+                json=dict(size=request.capacity_range.required_bytes),
+                params={"async": "1"},
+            )
+            resj = self._wait_job(f"expand:{request.volume_id}", res, context)
+        self.cache.invalidate()
+        return api.ControllerExpandVolumeResponse(capacity_bytes=resj["size"], node_expansion_required=True)
 
     def ControllerGetVolume(self, request: api.ControllerGetVolumeRequest, context: grpc.ServicerContext):
-        self._validate(request)
-        res = self.req.get(f"/volume/{request.volume_id}")
+        _validate(request)
+        res = self.req.get(f"/volume/{request.volume_id}", params=dict(include="exports,sessions"))
         res.raise_for_status()
-        resj = res.json()
-        qres = self.req.get("/export", params=dict(volume=request.volume_id))
-        qres.raise_for_status()
-        qresj = qres.json()
-        nodes = []
-        for i in qresj:
-            nodes.extend(i["connected"]["address"])
-        return api.ControllerGetVolumeResponse(
-            volume=api.Volume(
-                capacity_bytes=resj["size"],
-                volume_id=resj["name"],
-            ),
-            status=api.ControllerGetVolumeResponse.VolumeStatus(
-                published_node_ids=nodes, volume_condition=api.VolumeCondition(abnormal=False)
-            ),
-        )
+        return _get_volume(res.json())
 
     def ControllerModifyVolume(self, request: api.ControllerModifyVolumeRequest, context: grpc.ServicerContext):
-        self._validate(request)
+        _validate(request)
         return super().ControllerModifyVolume(request, context)
 
     def ValidateVolumeCapabilities(self, request: api.ValidateVolumeCapabilitiesRequest, context: grpc.ServicerContext):
-        self._validate(request)
+        _validate(request)
         if not request.volume_capabilities:
             raise ValueError("no capabilities")
         res = self.req.get(f"/volume/{request.volume_id}")
         if res.status_code != 200:
             raise FileNotFoundError(f"volume not found: {request.volume_id}")
-        supported_mode = [
-            api.VolumeCapability.AccessMode.Mode.SINGLE_NODE_WRITER,
-        ]
-        caps: list[api.VolumeCapability] = []
-        for cap in request.volume_capabilities:
-            if cap.access_mode.mode in supported_mode:
-                caps.append(cap)
-        return api.ValidateVolumeCapabilitiesResponse(
-            confirmed=api.ValidateVolumeCapabilitiesResponse.Confirmed(
-                volume_capabilities=caps,
-                parameters=request.parameters,
-                mutable_parameters=request.mutable_parameters,
-            ),
-        )
+        return _confirmed(request)
+
+    def _find_snapshot(self, snapshot_id: str) -> dict | None:
+        res = self.req.get("/snapshot", params=dict(name=snapshot_id))
+        res.raise_for_status()
+        ents = res.json()["entries"]
+        return ents[0] if ents else None
 
     def ListSnapshots(self, request: api.ListSnapshotsRequest, context: grpc.ServicerContext):
-        return super().ListSnapshots(request, context)
+        res = self.req.get("/snapshot", params=_snapshot_params(request))
+        res.raise_for_status()
+        return _list_snapshots(res.json())
 
+    @dedupe(lambda x: x.name)
     def CreateSnapshot(self, request: api.CreateSnapshotRequest, context: grpc.ServicerContext):
-        return super().CreateSnapshot(request, context)
+        _validate_snapshot(request)
+        snap = self._find_snapshot(request.name)
+        if snap is not None:
+            return _existing_snapshot(request, snap)
+        # CoW size of thick snapshot: same as the source
+        src = self.req.get(f"/volume/{request.source_volume_id}")
+        src.raise_for_status()
+        res = self.req.post(
+            f"/volume/{request.source_volume_id}/snapshot", json=dict(name=request.name, size=src.json()["size"])
+        )
+        res.raise_for_status()
+        self.cache.invalidate()
+        return api.CreateSnapshotResponse(snapshot=_snapshot(dict(res.json(), parent=request.source_volume_id)))
 
+    @dedupe(lambda x: x.snapshot_id)
     def DeleteSnapshot(self, request: api.DeleteSnapshotRequest, context: grpc.ServicerContext):
-        return super().DeleteSnapshot(request, context)
+        if not request.snapshot_id:
+            raise ValueError("no snapshot id")
+        # not a volume
+        if self._find_snapshot(request.snapshot_id) is not None:
+            res = self.req.delete(f"/volume/{request.snapshot_id}")
+            res.raise_for_status()
+            self.cache.invalidate()
+        return api.DeleteSnapshotResponse()
 
     def GetSnapshot(self, request: api.GetSnapshotRequest, context: grpc.ServicerContext):
-        return super().GetSnapshot(request, context)
+        if not request.snapshot_id:
+            raise ValueError("no snapshot id")
+        snap = self._find_snapshot(request.snapshot_id)
+        if snap is None:
+            raise FileNotFoundError(f"snapshot not found: {request.snapshot_id}")
+        return api.GetSnapshotResponse(snapshot=_snapshot(snap))
+
+
+class AsyncResponseCache:
+    """ResponseCache of the asyncio server, concurrent callers of the same key share one fetch"""
+
+    def __init__(self, req: AsyncVERequest, ttl: float, max_age: float):
+        self.req = req
+        self.ttl = ttl
+        self.max_age = max_age
+        self._entries: dict[str, tuple[int | None, float, Any]] = {}
+        self._fetching: dict[str, _Fetch] = {}
+        self._checked: tuple[int | None, float] | None = None
+        # bumped by invalidate(), fetches started before it are not stored
+        self._epoch = 0
+
+    async def generation(self) -> int | None:
+        """Inventory generation of volexport, asked at most once per ttl"""
+        now = time.monotonic()
+        checked = self._checked
+        if checked is not None and now - checked[1] < self.ttl:
+            return checked[0]
+        res = await self.req.get("/health")
+        res.raise_for_status()
+        value = res.headers.get(GENERATION_HEADER)
+        gen = int(value) if value is not None else None
+        self._checked = (gen, now)
+        return gen
+
+    async def get(self, key: str, fetch: Callable[[], Awaitable[Any]], revalidate: bool = True) -> Any:
+        """Cached value, fetch again if expired or generation changed"""
+        if self.max_age <= 0:
+            return await fetch()
+        now = time.monotonic()
+        ent = self._entries.get(key)
+        if ent is not None and now - ent[1] < self.ttl:
+            return ent[2]
+        running = self._fetching.get(key)
+        if running is not None:
+            await running.done.wait()
+            if running.error is not None:
+                raise running.error
+            return running.value
+        running = self._fetching[key] = _Fetch(asyncio.Event())
+        epoch = self._epoch
+        try:
+            if revalidate and ent is not None and ent[0] is not None and now - ent[1] < self.max_age:
+                if await self.generation() == ent[0]:
+                    running.value = ent[2]
+                    return ent[2]
+            # generation before fetch: changes while fetching are detected next time
+            gen = await self.generation() if revalidate else None
+            running.value = await fetch()
+            if self._epoch == epoch:
+                self._entries[key] = (gen, time.monotonic(), running.value)
+            return running.value
+        except BaseException as e:
+            running.error = e
+            raise
+        finally:
+            del self._fetching[key]
+            running.done.set()
+
+    def invalidate(self):
+        self._entries.clear()
+        self._checked = None
+        self._epoch += 1
+
+
+@servicer_accesslog
+class AsyncVolExpControl(api.ControllerServicer):
+    """VolExpControl of the asyncio server, calls volexport by AsyncVERequest"""
+
+    def __init__(self, config: dict):
+        self.config = config
+        self.req = AsyncVERequest(
+            config["endpoint"], pool_size=config.get("pool_size"), timeout=config.get("http_timeout")
+        )
+        # running job id by operation key, all calls run in one event loop
+        self.jobs: dict[str, str] = {}
+        self.inflight = AsyncInFlight()
+        ttl = config.get("cache_ttl")
+        max_age = config.get("cache_max_age")
+        self.cache = AsyncResponseCache(
+            self.req, ttl=2.0 if ttl is None else ttl, max_age=30.0 if max_age is None else max_age
+        )
+
+    async def _wait_job(self, key: str, res, context: grpc.aio.ServicerContext) -> dict:
+        """wait for the job started by async request, return the result"""
+        res.raise_for_status()
+        if res.status_code != 202:
+            # completed synchronously
+            return res.json()
+        jobid = res.json()["id"]
+        self.jobs[key] = jobid
+        return await self._poll_job(key, jobid, context)
+
+    def _forget_job(self, key: str, jobid: str):
+        if self.jobs.get(key) == jobid:
+            del self.jobs[key]
+
+    async def _poll_job(self, key: str, jobid: str, context: grpc.aio.ServicerContext) -> dict:
+        interval = self.config.get("job_poll_interval", 1.0)
+        wait = self.config.get("job_wait", 30.0)
+        remaining = context.time_remaining() if hasattr(context, "time_remaining") else None
+        if remaining is not None:
+            wait = min(wait, remaining - interval)
+        limit = time.monotonic() + wait
+        while True:
+            res = await self.req.get(f"/jobs/{jobid}")
+            if res.status_code == 404:
+                self._forget_job(key, jobid)
+                raise FileNotFoundError(f"job not found: {jobid}")
+            res.raise_for_status()
+            job = res.json()
+            if job["status"] == "succeeded":
+                self._forget_job(key, jobid)
+                return job["result"]
+            if job["status"] in ("failed", "cancelled"):
+                self._forget_job(key, jobid)
+                raise Exception(f"job {job['status']}: {job['name']}: {job['error']}")
+            if time.monotonic() + interval > limit:
+                raise OperationPending(f"operation pending: {key}, job={jobid}")
+            await asyncio.sleep(interval)
+
+    async def _capacity(self) -> int:
+        res = await self.req.get("/stats/volume")
+        res.raise_for_status()
+        return res.json()["free"]
+
+    async def _volumes(self) -> tuple[list[dict], dict[str, int]]:
+        res = await self.req.get("/volume")
+        res.raise_for_status()
+        return _volume_index(res.json())
+
+    async def _published(self) -> dict[str, list[str]]:
+        res = await self.req.get("/export")
+        res.raise_for_status()
+        return _published(res.json())
+
+    async def GetCapacity(self, request: api.GetCapacityRequest, context: grpc.aio.ServicerContext):
+        return api.GetCapacityResponse(available_capacity=await self.cache.get("capacity", self._capacity))
+
+    async def ControllerGetCapabilities(
+        self, request: api.ControllerGetCapabilitiesRequest, context: grpc.aio.ServicerContext
+    ):
+        return _capabilities()
+
+    async def ListVolumes(self, request: api.ListVolumesRequest, context: grpc.aio.ServicerContext):
+        vols, index = await self.cache.get("volumes", self._volumes)
+        nodes = await self.cache.get("published", self._published, revalidate=False)
+        return _list_volumes(request, vols, index, nodes)
+
+    @dedupe(lambda x: x.name)
+    async def CreateVolume(self, request: api.CreateVolumeRequest, context: grpc.aio.ServicerContext):
+        source, content_source = _create_source(request)
+        jobid = self.jobs.get(f"create:{request.name}")
+        if jobid is not None:
+            resj = await self._poll_job(f"create:{request.name}", jobid, context)
+            return api.CreateVolumeResponse(
+                volume=api.Volume(capacity_bytes=resj["size"], volume_id=resj["name"], content_source=content_source)
+            )
+        chk = await self.req.get(f"/volume/{request.name}")
+        if chk.status_code == 200:
+            return _existing_volume(request, chk.json()["size"], content_source)
+        if source:
+            # thin snapshot of the source, or full copy of thick volume. filesystem is cloned too
+            res = await self.req.post(
+                f"/volume/{source}/clone",
+                json=dict(name=request.name, size=request.capacity_range.required_bytes or None),
+                params={"async": "1"},
+            )
+            if res.status_code == 404:
+                raise FileNotFoundError(f"source volume not found: {source}")
+            self.cache.invalidate()
+            resj = await self._wait_job(f"create:{request.name}", res, context)
+            return api.CreateVolumeResponse(
+                volume=api.Volume(capacity_bytes=resj["size"], volume_id=resj["name"], content_source=content_source)
+            )
+        filesystem = next((x.mount.fs_type for x in request.volume_capabilities if x.mount.fs_type), "ext4")
+        # formatted spare volume if available, otherwise a job to create and mkfs
+        res = await self.req.post(
+            "/volume",
+            json=dict(
+                name=request.name,
+                size=request.capacity_range.required_bytes,
+                filesystem=filesystem,
+            ),
+            params={"async": "1"},
+        )
+        res.raise_for_status()
+        self.cache.invalidate()
+        resj = await self._wait_job(f"create:{request.name}", res, context)
+        if not resj.get("filesystem"):
+            # volexport does not make filesystem on create
+            mkfsres = await self.req.post(
+                f"/volume/{resj['name']}/mkfs", json=dict(filesystem=filesystem), params={"async": "1"}
+            )
+            await self._wait_job(f"create:{resj['name']}", mkfsres, context)
+        return api.CreateVolumeResponse(
+            volume=api.Volume(
+                capacity_bytes=resj["size"],
+                volume_id=resj["name"],
+            )
+        )
+
+    @dedupe(lambda x: x.volume_id)
+    async def DeleteVolume(self, request: api.DeleteVolumeRequest, context: grpc.aio.ServicerContext):
+        _validate(request)
+        res = await self.req.delete(f"/volume/{request.volume_id}")
+        if res.status_code == 404:
+            _log.info("delete not found: %s", request.volume_id)
+            return api.DeleteVolumeResponse()
+        res.raise_for_status()
+        self.cache.invalidate()
+        return api.DeleteVolumeResponse()
+
+    @dedupe(lambda x: x.volume_id)
+    async def ControllerPublishVolume(
+        self, request: api.ControllerPublishVolumeRequest, context: grpc.aio.ServicerContext
+    ):
+        arg = _publish_args(request)
+        # retried publish to the node returns the same export
+        res = await self.req.post("/export", json=arg, params=dict(reuse="1"))
+        res.raise_for_status()
+        self.cache.invalidate()
+        resj = res.json()
+        ctxt = {k: str(v) for k, v in resj.items()}
+        return api.ControllerPublishVolumeResponse(publish_context=ctxt)
+
+    @dedupe(lambda x: x.volume_id)
+    async def ControllerUnpublishVolume(
+        self, request: api.ControllerUnpublishVolumeRequest, context: grpc.aio.ServicerContext
+    ):
+        _validate(request)
+        qres = await self.req.get("/export", params=dict(volume=request.volume_id))
+        qres.raise_for_status()
+        for tgt in qres.json():
+            if request.volume_id not in tgt["volumes"]:
+                _log.warning("export response: volume_id=%s, tgt=%s", request.volume_id, tgt)
+                continue
+            tgtname = tgt["targetname"]
+            res = await self.req.delete(f"/export/{tgtname}")
+            res.raise_for_status()
+            self.cache.invalidate()
+        return api.ControllerUnpublishVolumeResponse()
+
+    @dedupe(lambda x: x.volume_id)
+    async def ControllerExpandVolume(
+        self, request: api.ControllerExpandVolumeRequest, context: grpc.aio.ServicerContext
+    ):
+        _validate(request)
+        jobid = self.jobs.get(f"expand:{request.volume_id}")
+        if jobid is not None:
+            resj = await self._poll_job(f"expand:{request.volume_id}", jobid, context)
+        else:
+            res = await self.req.post(
+                f"/volume/{request.volume_id}",
+                json=dict(size=request.capacity_range.required_bytes),
+                params={"async": "1"},
+            )
+            resj = await self._wait_job(f"expand:{request.volume_id}", res, context)
+        self.cache.invalidate()
+        return api.ControllerExpandVolumeResponse(capacity_bytes=resj["size"], node_expansion_required=True)
+
+    async def ControllerGetVolume(self, request: api.ControllerGetVolumeRequest, context: grpc.aio.ServicerContext):
+        _validate(request)
+        res = await self.req.get(f"/volume/{request.volume_id}", params=dict(include="exports,sessions"))
+        res.raise_for_status()
+        return _get_volume(res.json())
+
+    async def ControllerModifyVolume(
+        self, request: api.ControllerModifyVolumeRequest, context: grpc.aio.ServicerContext
+    ):
+        _validate(request)
+        return super().ControllerModifyVolume(request, context)
+
+    async def ValidateVolumeCapabilities(
+        self, request: api.ValidateVolumeCapabilitiesRequest, context: grpc.aio.ServicerContext
+    ):
+        _validate(request)
+        if not request.volume_capabilities:
+            raise ValueError("no capabilities")
+        res = await self.req.get(f"/volume/{request.volume_id}")
+        if res.status_code != 200:
+            raise FileNotFoundError(f"volume not found: {request.volume_id}")
+        return _confirmed(request)
+
+    async def _find_snapshot(self, snapshot_id: str) -> dict | None:
+        res = await self.req.get("/snapshot", params=dict(name=snapshot_id))
+        res.raise_for_status()
+        ents = res.json()["entries"]
+        return ents[0] if ents else None
+
+    async def ListSnapshots(self, request: api.ListSnapshotsRequest, context: grpc.aio.ServicerContext):
+        res = await self.req.get("/snapshot", params=_snapshot_params(request))
+        res.raise_for_status()
+        return _list_snapshots(res.json())
+
+    @dedupe(lambda x: x.name)
+    async def CreateSnapshot(self, request: api.CreateSnapshotRequest, context: grpc.aio.ServicerContext):
+        _validate_snapshot(request)
+        snap = await self._find_snapshot(request.name)
+        if snap is not None:
+            return _existing_snapshot(request, snap)
+        # CoW size of thick snapshot: same as the source
+        src = await self.req.get(f"/volume/{request.source_volume_id}")
+        src.raise_for_status()
+        res = await self.req.post(
+            f"/volume/{request.source_volume_id}/snapshot", json=dict(name=request.name, size=src.json()["size"])
+        )
+        res.raise_for_status()
+        self.cache.invalidate()
+        return api.CreateSnapshotResponse(snapshot=_snapshot(dict(res.json(), parent=request.source_volume_id)))
+
+    @dedupe(lambda x: x.snapshot_id)
+    async def DeleteSnapshot(self, request: api.DeleteSnapshotRequest, context: grpc.aio.ServicerContext):
+        if not request.snapshot_id:
+            raise ValueError("no snapshot id")
+        # not a volume
+        if await self._find_snapshot(request.snapshot_id) is not None:
+            res = await self.req.delete(f"/volume/{request.snapshot_id}")
+            res.raise_for_status()
+            self.cache.invalidate()
+        return api.DeleteSnapshotResponse()
+
+    async def GetSnapshot(self, request: api.GetSnapshotRequest, context: grpc.aio.ServicerContext):
+        if not request.snapshot_id:
+            raise ValueError("no snapshot id")
+        snap = await self._find_snapshot(request.snapshot_id)
+        if snap is None:
+            raise FileNotFoundError(f"snapshot not found: {request.snapshot_id}")
+        return api.GetSnapshotResponse(snapshot=_snapshot(snap))
@@ -1,7 +1,7 @@
 import grpc
 import requests
 from volexport.version import VERSION
-from volexport.client import VERequest
+from volexport.client import VERequest, AsyncVERequest
 from google.protobuf import wrappers_pb2
 from logging import getLogger
 from . import api
@@ -10,30 +10,39 @@ from .accesslog import servicer_accesslog
 _log = getLogger(__name__)
 
 
+def _capabilities() -> api.GetPluginCapabilitiesResponse:
+    return api.GetPluginCapabilitiesResponse(
+        capabilities=[
+            api.PluginCapability(
+                service=api.PluginCapability.Service(
+                    type=api.PluginCapability.Service.Type.CONTROLLER_SERVICE,
+                )
+            ),
+            api.PluginCapability(
+                service=api.PluginCapability.Service(
+                    type=api.PluginCapability.Service.Type.SNAPSHOT_METADATA_SERVICE,
+                )
+            ),
+            api.PluginCapability(
+                volume_expansion=api.PluginCapability.VolumeExpansion(
+                    type=api.PluginCapability.VolumeExpansion.Type.ONLINE,
+                )
+            ),
+        ]
+    )
+
+
 @servicer_accesslog
 class VolExpIdentity(api.IdentityServicer):
     def __init__(self, config: dict):
         self.config = config
-        self.req = VERequest(config["endpoint"])
+        self.req = VERequest(config["endpoint"], pool_size=config.get("pool_size"), timeout=config.get("http_timeout"))
 
     def GetPluginInfo(self, request: api.GetPluginInfoRequest, context: grpc.ServicerContext):
         return api.GetPluginInfoResponse(name="volexport", vendor_version=VERSION)
 
     def GetPluginCapabilities(self, request: api.GetPluginCapabilitiesRequest, context: grpc.ServicerContext):
-        return api.GetPluginCapabilitiesResponse(
-            capabilities=[
-                api.PluginCapability(
-                    service=api.PluginCapability.Service(
-                        type=api.PluginCapability.Service.Type.CONTROLLER_SERVICE,
-                    )
-                ),
-                api.PluginCapability(
-                    volume_expansion=api.PluginCapability.VolumeExpansion(
-                        type=api.PluginCapability.VolumeExpansion.Type.ONLINE,
-                    )
-                ),
-            ]
-        )
+        return _capabilities()
 
     def Probe(self, request: api.ProbeRequest, context: grpc.ServicerContext):
         try:
@@ -43,3 +52,29 @@ class VolExpIdentity(api.IdentityServicer):
         except Exception as e:
             _log.warning("health check error", exc_info=e)
         return api.ProbeResponse(ready=wrappers_pb2.BoolValue(value=False))
+
+
+@servicer_accesslog
+class AsyncVolExpIdentity(api.IdentityServicer):
+    """VolExpIdentity of the asyncio server"""
+
+    def __init__(self, config: dict):
+        self.config = config
+        self.req = AsyncVERequest(
+            config["endpoint"], pool_size=config.get("pool_size"), timeout=config.get("http_timeout")
+        )
+
+    async def GetPluginInfo(self, request: api.GetPluginInfoRequest, context: grpc.aio.ServicerContext):
+        return api.GetPluginInfoResponse(name="volexport", vendor_version=VERSION)
+
+    async def GetPluginCapabilities(self, request: api.GetPluginCapabilitiesRequest, context: grpc.aio.ServicerContext):
+        return _capabilities()
+
+    async def Probe(self, request: api.ProbeRequest, context: grpc.aio.ServicerContext):
+        try:
+            res = await self.req.get("/health")
+            if res.status_code == requests.codes.ok:
+                return api.ProbeResponse(ready=wrappers_pb2.BoolValue(value=True))
+        except Exception as e:
+            _log.warning("health check error", exc_info=e)
+        return api.ProbeResponse(ready=wrappers_pb2.BoolValue(value=False))
@@ -0,0 +1,139 @@
+import asyncio
+import time
+import functools
+import inspect
+import threading
+from typing import Any, Awaitable, Callable
+from logging import getLogger
+from google.protobuf.message import Message
+from volexport.client import request_deadline
+from volexport.exceptions import OperationPending
+from volexport.metrics import registry
+
+_log = getLogger(__name__)
+
+deduped = registry.counter(
+    "volexp_csi_deduped_total", "Calls overlapping a running operation of the same volume", ["method", "result"]
+)
+
+
+class _Operation:
+    def __init__(self, method: str, request: Message, done: threading.Event | asyncio.Event):
+        self.method = method
+        self.request = request
+        self.done = done
+        self.result: Any = None
+        self.error: BaseException | None = None
+
+    def join(self, key: str, method: str, request: Message):
+        """Share the result if the call is identical, raise OperationPending if not"""
+        if self.method != method or self.request != request:
+            # CSI: ABORTED if an operation is pending for the volume
+            _log.info("operation pending: %s, running=%s, called=%s", key, self.method, method)
+            deduped.inc(method=method, result="aborted")
+            raise OperationPending(f"operation pending: {key}, {self.method}")
+        _log.info("wait for running operation: %s %s", method, key)
+        deduped.inc(method=method, result="shared")
+
+
+def _remaining() -> float | None:
+    deadline = request_deadline.get()
+    return None if deadline is None else max(0.0, deadline - time.monotonic())
+
+
+class InFlight:
+    """Running operations per volume, identical calls share the result and others are aborted"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ops: dict[str, _Operation] = {}
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._ops)
+
+    def run(self, key: str, method: str, request: Message, fn: Callable[[], Any]) -> Any:
+        with self._lock:
+            op = self._ops.get(key)
+            if op is None:
+                op = self._ops[key] = _Operation(method, request, threading.Event())
+                owner = True
+            else:
+                owner = False
+        if owner:
+            try:
+                op.result = fn()
+                return op.result
+            except BaseException as e:
+                op.error = e
+                raise
+            finally:
+                with self._lock:
+                    del self._ops[key]
+                op.done.set()
+        op.join(key, method, request)
+        if not op.done.wait(_remaining()):
+            raise OperationPending(f"operation pending: {key}, {op.method}")
+        if op.error is not None:
+            raise op.error
+        return op.result
+
+
+class AsyncInFlight:
+    """InFlight of the asyncio server, all calls run in one event loop"""
+
+    def __init__(self):
+        self._ops: dict[str, _Operation] = {}
+
+    def __len__(self) -> int:
+        return len(self._ops)
+
+    async def run(self, key: str, method: str, request: Message, fn: Callable[[], Awaitable[Any]]) -> Any:
+        op = self._ops.get(key)
+        if op is None:
+            op = self._ops[key] = _Operation(method, request, asyncio.Event())
+            try:
+                op.result = await fn()
+                return op.result
+            except BaseException as e:
+                op.error = e
+                raise
+            finally:
+                del self._ops[key]
+                op.done.set()
+        op.join(key, method, request)
+        try:
+            await asyncio.wait_for(op.done.wait(), _remaining())
+        except TimeoutError:
+            raise OperationPending(f"operation pending: {key}, {op.method}")
+        if op.error is not None:
+            raise op.error
+        return op.result
+
+
+def dedupe(key: Callable[[Any], str]):
+    """Run the servicer method in self.inflight (AsyncInFlight for coroutines), keyed by the volume of the request"""
+
+    def deco(f: Callable):
+        if inspect.iscoroutinefunction(f):
+
+            @functools.wraps(f)
+            async def _async(self, request: Message, context):
+                name = key(request)
+                if not name:
+                    return await f(self, request, context)
+                return await self.inflight.run(name, f.__name__, request, lambda: f(self, request, context))
+
+            return _async
+
+        @functools.wraps(f)
+        def _(self, request: Message, context):
+            name = key(request)
+            if not name:
+                # validation error in the method
+                return f(self, request, context)
+            return self.inflight.run(name, f.__name__, request, lambda: f(self, request, context))
+
+        return _
+
+    return deco
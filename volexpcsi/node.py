@@ -8,6 +8,7 @@ from google.protobuf.json_format import MessageToDict
 from volexport.client import VERequest
 from . import api
 from .accesslog import servicer_accesslog
+from .inflight import InFlight, dedupe
 
 _log = getLogger(__name__)
 
@@ -16,8 +17,9 @@ _log = getLogger(__name__)
 class VolExpNode(api.NodeServicer):
     def __init__(self, config: dict):
         self.config = config
-        self.req = VERequest(config["endpoint"])
+        self.req = VERequest(config["endpoint"], pool_size=config.get("pool_size"), timeout=config.get("http_timeout"))
         self.become_method: str | None = config.get("become_method")
+        self.inflight = InFlight()
 
     def _validate(self, request: Message):
         notempty = {"volume_id", "target_path"}
@@ -26,6 +28,14 @@ class VolExpNode(api.NodeServicer):
                 if not getattr(request, i):
                     raise ValueError(f"empty {i}")
 
+    def _exports(self, volume_id: str) -> list[dict]:
+        """Exports of the volume, empty if the volume does not exist"""
+        res = self.req.get(f"/volume/{volume_id}", params=dict(include="exports"))
+        if res.status_code == 404:
+            return []
+        res.raise_for_status()
+        return res.json()["exports"]
+
     def runcmd(self, cmd: list[str], root: bool = True):
         """Run a command"""
         _log.info("run %s, root=%s", cmd, root)
@@ -60,6 +70,7 @@ class VolExpNode(api.NodeServicer):
     def NodeGetInfo(self, request: api.NodeGetInfoRequest, context: grpc.ServicerContext):
         return api.NodeGetInfoResponse(node_id=self.config["nodeid"])
 
+    @dedupe(lambda x: x.volume_id)
     def NodeStageVolume(self, request: api.NodeStageVolumeRequest, context: grpc.ServicerContext):
         self._validate(request)
         if not request.staging_target_path:
@@ -84,17 +95,13 @@ class VolExpNode(api.NodeServicer):
                 raise
         return api.NodeStageVolumeResponse()
 
+    @dedupe(lambda x: x.volume_id)
     def NodeUnstageVolume(self, request: api.NodeUnstageVolumeRequest, context: grpc.ServicerContext):
         self._validate(request)
         if not request.staging_target_path:
             raise ValueError("no staging target path")
         # detach iscsi
-        res = self.req.get("/export", params=dict(volume=request.volume_id))
-        res.raise_for_status()
-        for tgt in res.json():
-            if request.volume_id not in tgt["volumes"]:
-                _log.warning("export response: volume_id=%s, tgt=%s", request.volume_id, tgt)
-                continue
+        for tgt in self._exports(request.volume_id):
             targetname = tgt.get("targetname")
             portal = None
             try:
@@ -113,6 +120,7 @@ class VolExpNode(api.NodeServicer):
                 self.iscsiadm(m="discoverydb", t="st", p=portal, o="delete")
         return api.NodeUnstageVolumeResponse()
 
+    @dedupe(lambda x: x.volume_id)
     def NodePublishVolume(self, request: api.NodePublishVolumeRequest, context: grpc.ServicerContext):
         self._validate(request)
         if not MessageToDict(request.volume_capability):
@@ -130,6 +138,7 @@ class VolExpNode(api.NodeServicer):
                 raise
         return api.NodePublishVolumeResponse()
 
+    @dedupe(lambda x: x.volume_id)
     def NodeUnpublishVolume(self, request: api.NodeUnpublishVolumeRequest, context: grpc.ServicerContext):
         self._validate(request)
         p = Path(request.target_path)
@@ -141,16 +150,12 @@ class VolExpNode(api.NodeServicer):
             raise FileNotFoundError(f"target path is not mounted: {request.target_path}")
         return api.NodeUnpublishVolumeResponse()
 
+    @dedupe(lambda x: x.volume_id)
     def NodeExpandVolume(self, request: api.NodeExpandVolumeRequest, context: grpc.ServicerContext):
         self._validate(request)
         if not request.volume_path:
             raise ValueError("no volume path")
-        res = self.req.get("/export", params=dict(volume=request.volume_id))
-        res.raise_for_status()
-        for tgt in res.json():
-            if request.volume_id not in tgt["volumes"]:
-                _log.warning("export response: volume_id=%s, tgt=%s", request.volume_id, tgt)
-                continue
+        for tgt in self._exports(request.volume_id):
             targetname = tgt.get("targetname")
             break
         else:
@@ -1,22 +1,33 @@
 import grpc
+import threading
 from concurrent import futures
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from grpc_health.v1 import health, health_pb2, health_pb2_grpc
 from grpc_reflection.v1alpha import reflection
 from logging import getLogger
+from volexport.client import DEFAULT_POOL_SIZE
+from volexport.metrics import registry, CONTENT_TYPE
 from . import api
-from .identity import VolExpIdentity
-from .controller import VolExpControl
+from .accesslog import settings
+from .identity import VolExpIdentity, AsyncVolExpIdentity
+from .controller import VolExpControl, AsyncVolExpControl
 from .node import VolExpNode
+from .snapshot_metadata import VolExpSnapshotMetadata, AsyncVolExpSnapshotMetadata
 
 _log = getLogger(__name__)
 
 
-def boot_server(hostport: str, config: dict, cred: grpc.ServerCredentials | None = None):
-    _log.info("booting server at %s", hostport)
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=config.get("max_workers")))
-    health_pb2_grpc.add_HealthServicer_to_server(health.HealthServicer(), server)
-    api.add_IdentityServicer_to_server(VolExpIdentity(config), server)
-    api.add_ControllerServicer_to_server(VolExpControl(config), server)
+def _add_services(server, config: dict, aio: bool = False):
+    settings.configure(config)
+    if aio:
+        api.add_IdentityServicer_to_server(AsyncVolExpIdentity(config), server)
+        api.add_ControllerServicer_to_server(AsyncVolExpControl(config), server)
+        api.add_SnapshotMetadataServicer_to_server(AsyncVolExpSnapshotMetadata(config), server)
+    else:
+        api.add_IdentityServicer_to_server(VolExpIdentity(config), server)
+        api.add_ControllerServicer_to_server(VolExpControl(config), server)
+        api.add_SnapshotMetadataServicer_to_server(VolExpSnapshotMetadata(config), server)
+    # node operations run local commands, in the thread pool of both servers
     api.add_NodeServicer_to_server(VolExpNode(config), server)
     SERVICE_NAMES = (
         health_pb2.DESCRIPTOR.services_by_name["Health"].full_name,
@@ -24,13 +35,71 @@ def boot_server(hostport: str, config: dict, cred: grpc.ServerCredentials | None
         api.DESCRIPTOR.services_by_name["Identity"].full_name,
         api.DESCRIPTOR.services_by_name["Controller"].full_name,
         # api.DESCRIPTOR.services_by_name["GroupController"].full_name,
-        # api.DESCRIPTOR.services_by_name["SnapshotMetadata"].full_name,
+        api.DESCRIPTOR.services_by_name["SnapshotMetadata"].full_name,
         api.DESCRIPTOR.services_by_name["Node"].full_name,
     )
     reflection.enable_server_reflection(SERVICE_NAMES, server)
+
+
+def _add_port(server, hostport: str, cred: grpc.ServerCredentials | None) -> int:
     if cred:
-        port = server.add_secure_port(hostport, cred)
-    else:
-        port = server.add_insecure_port(hostport)
+        return server.add_secure_port(hostport, cred)
+    return server.add_insecure_port(hostport)
+
+
+def boot_server(hostport: str, config: dict, cred: grpc.ServerCredentials | None = None):
+    # servicers wait on volexport most of the time: as many workers as HTTP connections
+    workers = config.get("max_workers") or DEFAULT_POOL_SIZE
+    _log.info("booting server at %s: workers=%s", hostport, workers)
+    server = grpc.server(
+        futures.ThreadPoolExecutor(max_workers=workers),
+        maximum_concurrent_rpcs=config.get("max_concurrent_rpcs"),
+    )
+    health_pb2_grpc.add_HealthServicer_to_server(health.HealthServicer(), server)
+    _add_services(server, config)
+    port = _add_port(server, hostport, cred)
     server.start()
     return port, server
+
+
+async def boot_aio_server(hostport: str, config: dict, cred: grpc.ServerCredentials | None = None):
+    """asyncio server: controller, identity and snapshot metadata are coroutines on AsyncVERequest,
+    node methods run in max_workers threads
+    """
+    workers = config.get("max_workers") or DEFAULT_POOL_SIZE
+    _log.info("booting aio server at %s: workers=%s", hostport, workers)
+    server = grpc.aio.server(
+        migration_thread_pool=futures.ThreadPoolExecutor(max_workers=workers),
+        maximum_concurrent_rpcs=config.get("max_concurrent_rpcs"),
+    )
+    health_pb2_grpc.add_HealthServicer_to_server(health.aio.HealthServicer(), server)
+    _add_services(server, config, aio=True)
+    port = _add_port(server, hostport, cred)
+    await server.start()
+    return port, server
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = registry.render().encode()
+        self.send_response(200)
+        self.send_header("content-type", CONTENT_TYPE)
+        self.send_header("content-length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        _log.debug("metrics: " + format, *args)
+
+
+def boot_metrics(hostport: str):
+    """Serve GET /metrics in Prometheus text format from a thread"""
+    host, port = hostport.rsplit(":", 1)
+    server = ThreadingHTTPServer((host, int(port)), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="volexp-csi-metrics", daemon=True).start()
+    _log.info("metrics server at %s", server.server_address)
+    return server.server_address[1], server
@@ -0,0 +1,114 @@
+import grpc
+import json
+from typing import AsyncIterator, Iterator
+from logging import getLogger
+from volexport.client import VERequest, AsyncVERequest
+from . import api
+from .accesslog import servicer_accesslog
+
+_log = getLogger(__name__)
+DEFAULT_PAGE_SIZE = 1000
+
+
+def _params(starting_offset: int, max_results: int) -> dict:
+    if starting_offset < 0:
+        raise ValueError(f"invalid starting offset: {starting_offset}")
+    if max_results < 0:
+        raise ValueError(f"invalid max results: {max_results}")
+    return dict(offset=starting_offset, page_size=max_results or DEFAULT_PAGE_SIZE)
+
+
+def _page(line: str | bytes) -> tuple[int, list]:
+    """Volume size and blocks of a NDJSON line"""
+    page = json.loads(line)
+    return page["size"], [api.BlockMetadata(byte_offset=x[0], size_bytes=x[1]) for x in page["extents"]]
+
+
+@servicer_accesslog
+class VolExpSnapshotMetadata(api.SnapshotMetadataServicer):
+    """Block metadata of snapshots (snapshot id is the name of the snapshot volume)"""
+
+    def __init__(self, config: dict):
+        self.config = config
+        self.req = VERequest(config["endpoint"], pool_size=config.get("pool_size"), timeout=config.get("http_timeout"))
+
+    def _pages(self, path: str, starting_offset: int, max_results: int) -> Iterator[tuple[int, list]]:
+        """Forward pages of extents from volexport without reading whole map"""
+        params = _params(starting_offset, max_results)
+        with self.req.get(path, params=params, stream=True) as res:
+            res.raise_for_status()
+            for line in res.iter_lines():
+                if line:
+                    yield _page(line)
+
+    def GetMetadataAllocated(self, request: api.GetMetadataAllocatedRequest, context: grpc.ServicerContext):
+        if not request.snapshot_id:
+            raise ValueError("snapshot id is empty")
+        for size, blocks in self._pages(
+            f"/volume/{request.snapshot_id}/allocated", request.starting_offset, request.max_results
+        ):
+            yield api.GetMetadataAllocatedResponse(
+                block_metadata_type=api.BlockMetadataType.VARIABLE_LENGTH,
+                volume_capacity_bytes=size,
+                block_metadata=blocks,
+            )
+
+    def GetMetadataDelta(self, request: api.GetMetadataDeltaRequest, context: grpc.ServicerContext):
+        if not request.base_snapshot_id or not request.target_snapshot_id:
+            raise ValueError("snapshot id is empty")
+        for size, blocks in self._pages(
+            f"/volume/{request.target_snapshot_id}/delta/{request.base_snapshot_id}",
+            request.starting_offset,
+            request.max_results,
+        ):
+            yield api.GetMetadataDeltaResponse(
+                block_metadata_type=api.BlockMetadataType.VARIABLE_LENGTH,
+                volume_capacity_bytes=size,
+                block_metadata=blocks,
+            )
+
+
+@servicer_accesslog
+class AsyncVolExpSnapshotMetadata(api.SnapshotMetadataServicer):
+    """VolExpSnapshotMetadata of the asyncio server"""
+
+    def __init__(self, config: dict):
+        self.config = config
+        self.req = AsyncVERequest(
+            config["endpoint"], pool_size=config.get("pool_size"), timeout=config.get("http_timeout")
+        )
+
+    async def _pages(self, path: str, starting_offset: int, max_results: int) -> AsyncIterator[tuple[int, list]]:
+        """Forward pages of extents from volexport without reading whole map"""
+        params = _params(starting_offset, max_results)
+        async with self.req.stream("GET", path, params=params) as res:
+            res.raise_for_status()
+            async for line in res.aiter_lines():
+                if line:
+                    yield _page(line)
+
+    async def GetMetadataAllocated(self, request: api.GetMetadataAllocatedRequest, context: grpc.aio.ServicerContext):
+        if not request.snapshot_id:
+            raise ValueError("snapshot id is empty")
+        async for size, blocks in self._pages(
+            f"/volume/{request.snapshot_id}/allocated", request.starting_offset, request.max_results
+        ):
+            yield api.GetMetadataAllocatedResponse(
+                block_metadata_type=api.BlockMetadataType.VARIABLE_LENGTH,
+                volume_capacity_bytes=size,
+                block_metadata=blocks,
+            )
+
+    async def GetMetadataDelta(self, request: api.GetMetadataDeltaRequest, context: grpc.aio.ServicerContext):
+        if not request.base_snapshot_id or not request.target_snapshot_id:
+            raise ValueError("snapshot id is empty")
+        async for size, blocks in self._pages(
+            f"/volume/{request.target_snapshot_id}/delta/{request.base_snapshot_id}",
+            request.starting_offset,
+            request.max_results,
+        ):
+            yield api.GetMetadataDeltaResponse(
+                block_metadata_type=api.BlockMetadataType.VARIABLE_LENGTH,
+                volume_capacity_bytes=size,
+                block_metadata=blocks,
+            )
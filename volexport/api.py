@@ -1,17 +1,144 @@
+import asyncio
+import threading
+import time
+from contextlib import asynccontextmanager
 from logging import getLogger
-from subprocess import SubprocessError
+from subprocess import SubprocessError, TimeoutExpired
 from fastapi import FastAPI, Request
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse
 from .api_export import router as export_router
 from .api_volume import router as volume_router
 from .api_mgmt import router as mgmt_router
-from .exceptions import InvalidArgument
+from .api_jobs import router as jobs_router
+from .exceptions import InvalidArgument, Cancelled, Busy
+from .config import config
+from .metrics import registry, CONTENT_TYPE
+from .util import deadline, cancel_event, slot_wait, generation
 
 _log = getLogger(__name__)
-api = FastAPI()
+DEADLINE_HEADER = "x-volexp-timeout"
+GENERATION_HEADER = "x-volexp-generation"
+
+
+class DeadlineMiddleware:
+    """Propagate request deadline (X-Volexp-Timeout: remaining seconds) and client disconnect to commands"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        value = dict(scope["headers"]).get(DEADLINE_HEADER.encode())
+        if value is None:
+            return await self.app(scope, receive, send)
+        try:
+            remaining = float(value)
+        except ValueError:
+            resp = JSONResponse(status_code=400, content=dict(detail=f"invalid {DEADLINE_HEADER}"))
+            return await resp(scope, receive, send)
+        if remaining <= 0:
+            resp = JSONResponse(status_code=504, content=dict(detail="deadline exceeded"))
+            return await resp(scope, receive, send)
+        cancel = threading.Event()
+        queue: asyncio.Queue = asyncio.Queue()
+
+        async def watch():
+            while True:
+                msg = await receive()
+                await queue.put(msg)
+                if msg["type"] == "http.disconnect":
+                    cancel.set()
+                    return
+
+        deadline_token = deadline.set(time.monotonic() + remaining)
+        cancel_token = cancel_event.set(cancel)
+        watcher = asyncio.create_task(watch())
+        try:
+            await self.app(scope, queue.get, send)
+        finally:
+            watcher.cancel()
+            deadline.reset(deadline_token)
+            cancel_event.reset(cancel_token)
+
+
+class NoWaitMiddleware:
+    """Commands of requests do not wait for a slot of the subsystem, a waiting one would hold a threadpool worker"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        token = slot_wait.set(False)
+        try:
+            return await self.app(scope, receive, send)
+        finally:
+            slot_wait.reset(token)
+
+
+class GenerationMiddleware:
+    """Add inventory generation (X-Volexp-Generation) to responses, clients use it to validate caches"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        async def _send(msg):
+            if msg["type"] == "http.response.start":
+                header = (GENERATION_HEADER.encode(), str(generation.value).encode())
+                msg = {**msg, "headers": [*msg.get("headers", []), header]}
+            await send(msg)
+
+        return await self.app(scope, receive, _send)
+
+
+def _services() -> list:
+    """Background services enabled by configuration, modules of disabled ones are not imported"""
+    res = []
+    if config.BACKUP_SCHEDULE or config.BACKUP_DEBOUNCE is not None:
+        from .api_mgmt import backup_scheduler
+
+        res.append(backup_scheduler())
+    if config.EXPORT_STATE:
+        from .exportstate import tgtd_watchdog
+
+        res.append(tgtd_watchdog())
+    if config.STATE_DB:
+        from .statedb import state_reconciler
+
+        res.append(state_reconciler())
+    if config.WARM_POOL:
+        from .warmpool import warm_pool
+
+        res.append(warm_pool())
+    return [x for x in res if x is not None]
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    services = _services()
+    for svc in services:
+        svc.start()
+    try:
+        yield
+    finally:
+        for svc in reversed(services):
+            svc.stop()
+
+
+api = FastAPI(lifespan=lifespan)
+api.add_middleware(DeadlineMiddleware)
+api.add_middleware(NoWaitMiddleware)
+api.add_middleware(GenerationMiddleware)
 api.include_router(export_router)
 api.include_router(volume_router)
 api.include_router(mgmt_router)
+api.include_router(jobs_router)
 
 
 @api.exception_handler(FileNotFoundError)
@@ -35,6 +162,36 @@ def notimplemented(request: Request, exc: NotImplementedError):
     return JSONResponse(status_code=501, content=dict(detail=str(exc)))
 
 
+@api.exception_handler(TimeoutExpired)
+def cmdtimeout(request: Request, exc: TimeoutExpired):
+    """TimeoutExpired to 504 Gateway Timeout"""
+    _log.info("command timeout: request=%s %s", request.method, request.url.path, exc_info=exc)
+    return JSONResponse(status_code=504, content=dict(detail="command timeout"))
+
+
+@api.exception_handler(TimeoutError)
+def timeout(request: Request, exc: TimeoutError):
+    """TimeoutError to 504 Gateway Timeout"""
+    _log.info("timeout: request=%s %s", request.method, request.url.path, exc_info=exc)
+    return JSONResponse(status_code=504, content=dict(detail=str(exc)))
+
+
+@api.exception_handler(Cancelled)
+def cancelled(request: Request, exc: Cancelled):
+    """Cancelled to 499 Client Closed Request"""
+    _log.info("cancelled: request=%s %s", request.method, request.url.path, exc_info=exc)
+    return JSONResponse(status_code=499, content=dict(detail=str(exc)))
+
+
+@api.exception_handler(Busy)
+def busy(request: Request, exc: Busy):
+    """Busy to 429 Too Many Requests"""
+    _log.info("busy: request=%s %s: %s", request.method, request.url.path, exc)
+    return JSONResponse(
+        status_code=429, content=dict(detail=str(exc)), headers={"Retry-After": str(config.RETRY_AFTER)}
+    )
+
+
 @api.exception_handler(SubprocessError)
 def commanderror(request: Request, exc: SubprocessError):
     """SubprocessError to 500 Internal Server Error"""
@@ -73,3 +230,8 @@ def asserterror(request: Request, exc: AssertionError):
 @api.get("/health", description="Health check endpoint")
 def health():
     return {"status": "OK"}
+
+
+@api.get("/metrics", description="Metrics in Prometheus text format", response_class=PlainTextResponse)
+def metrics():
+    return PlainTextResponse(registry.render(), media_type=CONTENT_TYPE)
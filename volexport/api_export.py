@@ -1,9 +1,12 @@
-from fastapi import APIRouter, HTTPException, Request
-from pydantic import BaseModel, Field, SecretStr, field_serializer
+from fastapi import APIRouter, HTTPException, Query, Request, Response
+from pydantic import BaseModel, Field, SecretStr, TypeAdapter, field_serializer
+from logging import getLogger
 from .config2 import config2
 from .tgtd import Tgtd
 from .lvm2 import LV
+from . import exportstate, statedb
 
+_log = getLogger(__name__)
 router = APIRouter()
 
 
@@ -13,6 +16,7 @@ class ExportRequest(BaseModel):
     readonly: bool = Field(default=False, description="read-only if true", examples=[True, False])
     user: str | None = Field(default=None, description="user name for access. auto-generate if null")
     passwd: SecretStr | None = Field(default=None, description="password for access. auto-generate if null")
+    node: str | None = Field(default=None, description="node ID of the client, reused exports are keyed by this")
 
 
 class ExportResponse(BaseModel):
@@ -51,35 +55,91 @@ class ExportStats(BaseModel):
     volumes: int = Field(description="Number of volumes exported", examples=[15])
 
 
+def _path2vol(path: str) -> str | None:
+    db = statedb.get()
+    if db is not None:
+        name = db.volume_by_path(path)
+        if name is not None:
+            return name
+    return LV(config2.VG).volume_path2vol(path)
+
+
 def _fixpath(data: dict) -> dict:
     if "volumes" in data:
-        data["volumes"] = [LV(config2.VG).volume_path2vol(x) for x in data["volumes"]]
+        data["volumes"] = [_path2vol(x) for x in data["volumes"]]
     return data
 
 
-@router.get("/export", description="List all exports")
-def list_export(volume: str | None = None) -> list[ExportReadResponse]:
-    res = [ExportReadResponse.model_validate(_fixpath(x)) for x in Tgtd().export_list()]
+_export_list = TypeAdapter(list[ExportReadResponse])
+
+
+@router.get("/export", description="List all exports", response_model=list[ExportReadResponse])
+def list_export(volume: str | None = None) -> Response:
+    res = _export_list.validate_python([_fixpath(x) for x in Tgtd().export_list()])
     if volume:
         res = [x for x in res if volume in x.volumes]
-    return res
+    return Response(content=_export_list.dump_json(res), media_type="application/json")
+
+
+def _reuse(filename: str, arg: ExportRequest) -> dict | None:
+    """Existing export of the volume to the same node (ACL if no node), None if not found or its password is unknown"""
+    assert arg.acl is not None
+    if arg.node:
+        # exports to different nodes may share the ACL, the node is known by desired state
+        names = {x["targetname"] for x in exportstate.entries() if x.get("node") == arg.node}
+        tgt = next((x for x in Tgtd().export_list() if x["volumes"] == [filename] and x["targetname"] in names), None)
+    else:
+        tgt = Tgtd().export_find(filename, arg.acl)
+    if tgt is None:
+        return None
+    if arg.user and arg.passwd and arg.user in tgt["users"]:
+        user, passwd, lun = arg.user, arg.passwd.get_secret_value(), 1
+    else:
+        # tgtd does not show passwords, take them from desired state
+        ent = next((x for x in exportstate.entries() if x["targetname"] == tgt["targetname"]), None)
+        if ent is None or ent["user"] not in tgt["users"] or (arg.user and arg.user != ent["user"]):
+            _log.info("password unknown, create new export: %s", tgt["targetname"])
+            return None
+        user, passwd, lun = ent["user"], ent["passwd"], ent["lun"]
+    _log.info("reuse export: %s", tgt["targetname"])
+    return dict(
+        protocol=tgt["protocol"],
+        addresses=Tgtd().myaddress(),
+        targetname=tgt["targetname"],
+        tid=tgt["tid"],
+        user=user,
+        passwd=passwd,
+        lun=lun,
+        acl=tgt["acl"],
+    )
 
 
 @router.post("/export", description="Create a new export")
-def create_export(req: Request, arg: ExportRequest) -> ExportResponse:
+def create_export(
+    req: Request,
+    arg: ExportRequest,
+    reuse: bool = Query(default=False, description="return existing export of the volume to the same node or ACL"),
+) -> ExportResponse:
     filename = LV(config2.VG, arg.name).volume_vol2path()
     if not arg.acl:
         assert req.client is not None
         arg.acl = [req.client.host]
-    return ExportResponse.model_validate(
-        Tgtd().export_volume(
+    with exportstate.lock, statedb.mutation() as tx:
+        if reuse:
+            res = _reuse(filename, arg)
+            if res is not None:
+                return ExportResponse.model_validate(res)
+        res = Tgtd().export_volume(
             filename=filename,
             acl=arg.acl,
             readonly=arg.readonly,
             user=arg.user,
             passwd=arg.passwd.get_secret_value() if arg.passwd else None,
         )
-    )
+        exportstate.add(res, arg.name, filename, node=arg.node)
+        if tx is not None:
+            tx.put_export(res, arg.name, filename)
+    return ExportResponse.model_validate(res)
 
 
 @router.get("/export/{name}", description="Read export details by name or TID")
@@ -92,7 +152,22 @@ def read_export(name) -> ExportReadResponse:
 
 @router.delete("/export/{name}", description="Delete an export by name or TID")
 def delete_export(name, force: bool = False):
-    return Tgtd().unexport_volume(targetname=name, force=force)
+    tgtd = Tgtd()
+    with exportstate.lock, statedb.mutation() as tx:
+        if name.isdigit():
+            # the state is keyed by target name
+            name = next((x["targetname"] for x in tgtd.export_list() if x["tid"] == name), name)
+        if tx is not None:
+            tx.delete_export(name)
+        try:
+            res = tgtd.unexport_volume(targetname=name, force=force)
+        except FileNotFoundError:
+            # lost by tgtd restart and not re-created yet
+            if exportstate.remove(name):
+                return None
+            raise
+        exportstate.remove(name)
+        return res
 
 
 @router.get("/address", description="Get addresses of the target")
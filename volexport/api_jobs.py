@@ -0,0 +1,49 @@
+import datetime
+from typing import Any, Callable
+from fastapi import APIRouter
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel, Field
+from .jobs import jobs, Job, JobStatus
+
+router = APIRouter()
+
+
+class JobResponse(BaseModel):
+    """Response type for GET /jobs/{id}, and async operations"""
+
+    id: str = Field(description="Job ID", examples=["0f3c6b0e8d7a4f4e9d3c2b1a09876543"])
+    name: str = Field(description="Name of the job", examples=["mkfs volume1"])
+    volume: str | None = Field(default=None, description="Target volume name", examples=["volume1"])
+    status: JobStatus = Field(description="Status of the job")
+    progress: float = Field(description="Progress of the job (0.0 - 1.0)", examples=[0.5])
+    message: str | None = Field(default=None, description="Progress message")
+    result: Any = Field(default=None, description="Result of the job if succeeded")
+    error: str | None = Field(default=None, description="Error message if failed")
+    created: datetime.datetime = Field(description="Creation timestamp of the job")
+    started: datetime.datetime | None = Field(default=None, description="Start timestamp of the job")
+    finished: datetime.datetime | None = Field(default=None, description="Finish timestamp of the job")
+
+
+def submit_job(name: str, fn: Callable[[], Any], volume: str | None = None) -> JSONResponse:
+    """Run fn as background job, return 202 Accepted with job info"""
+    job = jobs.submit(name, fn, volume=volume)
+    return JSONResponse(status_code=202, content=_job2response(job).model_dump(mode="json"))
+
+
+def _job2response(job: Job) -> JobResponse:
+    return JobResponse.model_validate(job.to_dict())
+
+
+@router.get("/jobs", description="List jobs")
+def list_jobs(volume: str | None = None) -> list[JobResponse]:
+    return [_job2response(x) for x in jobs.list(volume=volume)]
+
+
+@router.get("/jobs/{jobid}", description="Read job status")
+def read_job(jobid: str) -> JobResponse:
+    return _job2response(jobs.get(jobid))
+
+
+@router.delete("/jobs/{jobid}", description="Cancel a job")
+def cancel_job(jobid: str) -> JobResponse:
+    return _job2response(jobs.cancel(jobid))
@@ -1,43 +1,99 @@
-from fastapi import APIRouter, Request
+import os
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import FileResponse
+from starlette.background import BackgroundTask
 from pathlib import Path
-from typing import Iterator
-import io
-import yaml
 import datetime
+import time
 import zipfile
 import tempfile
 from .config import config
 from .config2 import config2
 from .tgtd import Tgtd
-from .lvm2 import VG
+from .lvm2 import VG, LV
+from . import lvmmeta
 from .api_export import ExportReadResponse
 from .api_volume import VolumeReadResponse
 from .exceptions import InvalidArgument
+from .api_jobs import JobResponse, submit_job
+from pydantic import BaseModel, Field
+from typing import TYPE_CHECKING
 from logging import getLogger
 
+if TYPE_CHECKING:
+    from .backup import BackupStore, BackupIndex
+    from .scheduler import BackupScheduler
+
 _log = getLogger(__name__)
 router = APIRouter()
+UPLOAD_BUFSIZE = 1024 * 1024
+
+
+# backup pulls in compression and process pools, imported on first use
+
+
+def _store() -> "BackupStore":
+    from .backup import BackupStore
+
+    return BackupStore(config.BACKUP_DIR)
+
+
+def _index() -> "BackupIndex":
+    from .backup import BackupIndex
+
+    # summaries depend on the VG name
+    return BackupIndex(_store(), _summarize, key=config2.VG)
+
+
+def _datastore() -> "BackupStore":
+    from .backup import BackupStore
 
+    return BackupStore(config.BACKUP_DIR, suffix=".data")
 
-def _backup_file(name) -> Path:
-    assert "/" not in name
-    assert not name.startswith(".")
-    dir = Path(config.BACKUP_DIR)
-    return (dir / name).with_suffix(".backup")
 
+class VolumeBackupRequest(BaseModel):
+    """Request type for POST /mgmt/volume-backup"""
 
-def _list_backup() -> Iterator[Path]:
-    dir = Path(config.BACKUP_DIR)
-    return dir.glob("*.backup")
+    volume: str = Field(description="Name of the volume to backup", examples=["volume1"])
+    name: str | None = Field(default=None, description="Name of backup. (volume)-(timestamp) if null")
+    snapshot_size: int | None = Field(default=None, description="Size of snapshot CoW (ignore if thin volume)")
+    incremental: bool = Field(
+        default=False, description="Copy only blocks changed since previous incremental backup (thin volume)"
+    )
 
 
-def parse_volbackup(s: str) -> dict:
-    s = s.replace(" =", ":")
-    s = s.replace(" {", ":")
-    s = s.replace("\t", " ")
-    s = s.replace("}", "")
-    return yaml.safe_load("\n".join([x.rstrip() for x in s.splitlines()]))
+class VolumeBackupResponse(BaseModel):
+    """Response type for GET /mgmt/volume-backup/{name}"""
+
+    name: str = Field(description="Name of backup", examples=["volume1-20250831-120000"])
+    volume: str = Field(description="Name of the source volume", examples=["volume1"])
+    created: datetime.datetime = Field(description="Creation timestamp of the backup")
+    size: int = Field(description="Size of the volume in bytes", examples=[1073741824])
+    thin: bool = Field(description="true if source is thin volume")
+    chunk_size: int = Field(description="Chunk size in bytes", examples=[4194304])
+    chunks: int = Field(description="Number of chunks")
+    zero_chunks: int = Field(description="Number of all-zero chunks (not stored)")
+    parent: str | None = Field(default=None, description="Base backup if incremental")
+    changed_chunks: int | None = Field(default=None, description="Number of chunks copied if incremental")
+
+
+class VolumeRestoreRequest(BaseModel):
+    """Request type for POST /mgmt/volume-backup/{name}/restore"""
+
+    volume: str = Field(description="Name of the new volume", examples=["volume2"])
+
+
+def parse_volbackup(s: str) -> lvmmeta.VolumeGroup:
+    meta = lvmmeta.loads(s)
+    if meta.version != 1:
+        raise InvalidArgument(f"invalid backup format: version={meta.version}")
+    vg = meta.volume_groups.get(config2.VG)
+    if vg is None:
+        raise InvalidArgument("invalid backup format: no vg")
+    if not vg.extent_size:
+        raise InvalidArgument(f"invalid backup format: extent size={vg.extent_size}")
+    return vg
 
 
 def parse_export(s: str) -> list[dict]:
@@ -61,145 +117,326 @@ def parse_export(s: str) -> list[dict]:
     return res
 
 
-@router.post("/mgmt/backup", description="create backup")
-def create_backup() -> dict[str, str]:
+def make_backup() -> str:
+    """Save current export and volume metadata"""
     basename = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
-    outfile = _backup_file(basename)
-    with zipfile.ZipFile(outfile, "w", compression=zipfile.ZIP_DEFLATED) as zf, tempfile.NamedTemporaryFile("r+") as tf:
-        zf.writestr("export", Tgtd().dump())
+    with tempfile.NamedTemporaryFile("r+") as tf:
+        export = Tgtd().dump().encode("utf-8")
         VG(config2.VG).backup(Path(tf.name))
-        zf.writestr("volume", Path(tf.name).read_bytes())
-    _log.info("backup created: %s", outfile)
-    return {"name": basename}
+        _store().create(basename, dict(export=export, volume=Path(tf.name).read_bytes()))
+    _index().update(basename)
+    return basename
+
+
+def prune_backup(keep: int | None, max_age: float | None) -> list[str]:
+    """Delete backups except newest keep, and older than max_age seconds except the newest one"""
+    store = _store()
+    now = time.time()
+    names = []
+    for i, path in enumerate(sorted(store.list(), reverse=True)):
+        if keep is not None and i >= keep:
+            names.append(path.with_suffix("").name)
+        elif max_age is not None and i != 0 and now - path.stat().st_mtime > max_age:
+            names.append(path.with_suffix("").name)
+    for name in names:
+        _log.info("delete old backup: %s", name)
+        store.delete(name, gc=False)
+    if names:
+        _index().update(*names)
+        store.gc()
+    return names
+
+
+def load_backup_index() -> int:
+    """Refresh the backup index, returns number of backups"""
+    return len(_index().load())
+
+
+def backup_scheduler() -> "BackupScheduler | None":
+    """Scheduler of metadata backup, None if not configured"""
+    if not config.BACKUP_SCHEDULE and config.BACKUP_DEBOUNCE is None:
+        return None
+    from .scheduler import BackupScheduler
+
+    return BackupScheduler(
+        create=make_backup,
+        prune=lambda: prune_backup(config.BACKUP_KEEP, config.BACKUP_MAX_AGE),
+        schedule=config.BACKUP_SCHEDULE,
+        debounce=config.BACKUP_DEBOUNCE,
+        min_interval=config.BACKUP_MIN_INTERVAL,
+    )
+
+
+@router.post("/mgmt/backup", description="create backup")
+def create_backup() -> dict[str, str]:
+    return {"name": make_backup()}
 
 
 @router.get("/mgmt/backup", description="list backup files")
 def list_backup() -> list[dict]:
-    return [dict(name=path.with_suffix("").name) for path in sorted(_list_backup())]
+    return [dict(name=name) for name in sorted(_index().load())]
 
 
 @router.delete("/mgmt/backup", description="delete old backup file")
-def forget_backup(keep: int = 2) -> dict[str, str]:
-    files = sorted(_list_backup(), reverse=True)
-    for f in files[keep:]:
-        _log.info("delete old backup(export): %s", f)
-        f.unlink()
+def forget_backup(keep: int = 2, max_age: float | None = None) -> dict[str, str]:
+    prune_backup(keep, max_age)
     return {"status": "OK"}
 
 
 @router.get("/mgmt/backup/{name}", description="download backup file")
 def get_backup(name: str) -> FileResponse:
-    path = _backup_file(name)
-    if path.exists():
-        return FileResponse(path, filename=path.name)
-    raise FileNotFoundError("backup file not found")
+    store = _store()
+    path = store.path(name)
+    if not path.exists():
+        raise FileNotFoundError("backup file not found")
+    # assemble zip file from blobs
+    fd, tmpname = tempfile.mkstemp(dir=config.BACKUP_DIR, prefix=".download-", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as ofp:
+            store.write_zip(name, ofp)
+    except Exception:
+        Path(tmpname).unlink(missing_ok=True)
+        raise
+    return FileResponse(
+        tmpname,
+        filename=path.name,
+        media_type="application/zip",
+        background=BackgroundTask(Path(tmpname).unlink, missing_ok=True),
+    )
 
 
-@router.get("/mgmt/backup/{name}/export", description="get export list of backup")
-def get_backup_export(name: str) -> list[ExportReadResponse]:
-    path = _backup_file(name)
-    if not path.exists():
+@router.post(
+    "/mgmt/volume-backup",
+    description="backup volume data (background job)",
+    status_code=202,
+    response_model=JobResponse,
+)
+def create_volume_backup(arg: VolumeBackupRequest):
+    from .backup import backup_volume
+
+    name = arg.name or f"{arg.volume}-{datetime.datetime.now().strftime('%Y%m%d-%H%M%S')}"
+    store = _datastore()
+    if store.exists(name):
+        raise FileExistsError("backup already exists")
+    return submit_job(
+        f"backup {arg.volume}",
+        lambda: backup_volume(
+            store, config2.VG, arg.volume, name, snapshot_size=arg.snapshot_size, incremental=arg.incremental
+        ),
+        volume=arg.volume,
+    )
+
+
+def _volume_backup_info(name: str, manifest: dict) -> VolumeBackupResponse:
+    return VolumeBackupResponse(
+        name=name,
+        volume=manifest["volume"],
+        created=manifest["created"],
+        size=manifest["size"],
+        thin=manifest["thin"],
+        chunk_size=manifest["chunk_size"],
+        chunks=len(manifest["chunks"]),
+        zero_chunks=manifest["chunks"].count(None),
+        parent=manifest.get("parent"),
+        changed_chunks=manifest.get("changed_chunks"),
+    )
+
+
+@router.get("/mgmt/volume-backup", description="list volume data backups")
+def list_volume_backup(volume: str | None = None) -> list[VolumeBackupResponse]:
+    store = _datastore()
+    res = []
+    for path in sorted(store.list()):
+        name = path.with_suffix("").name
+        manifest = store.manifest(name)
+        if manifest is None or (volume and manifest.get("volume") != volume):
+            continue
+        res.append(_volume_backup_info(name, manifest))
+    return res
+
+
+@router.get("/mgmt/volume-backup/{name}", description="read volume data backup")
+def read_volume_backup(name: str) -> VolumeBackupResponse:
+    manifest = _datastore().manifest(name)
+    if manifest is None:
+        raise InvalidArgument("invalid backup format")
+    return _volume_backup_info(name, manifest)
+
+
+@router.delete("/mgmt/volume-backup/{name}", description="delete volume data backup")
+def delete_volume_backup(name: str) -> dict[str, str]:
+    store = _datastore()
+    manifest = store.manifest(name) if store.exists(name) else None
+    store.delete(name)
+    if manifest and manifest.get("snapshot"):
+        # base of next incremental backup
+        snap = LV(config2.VG, manifest["snapshot"])
+        if snap.get() is not None:
+            snap.delete()
+    return {"status": "OK"}
+
+
+@router.post(
+    "/mgmt/volume-backup/{name}/restore",
+    description="restore volume data backup into a new volume (background job)",
+    status_code=202,
+    response_model=JobResponse,
+)
+def restore_volume_backup(name: str, arg: VolumeRestoreRequest):
+    from .backup import restore_volume
+
+    store = _datastore()
+    if not store.exists(name):
         raise FileNotFoundError("backup file not found")
+    return submit_job(f"restore {name}", lambda: restore_volume(store, config2.VG, name, arg.volume), volume=arg.volume)
+
+
+def _backup_exports(name: str) -> list[ExportReadResponse]:
+    store = _store()
     res = []
-    with zipfile.ZipFile(path, "r") as zf:
-        voldata = zf.read("volume").decode("utf-8")
-        volparsed = parse_volbackup(voldata)
-        data = zf.read("export").decode("utf-8")
-        parsed = parse_export(data)
-        for exp in parsed:
-            vol = volparsed.get(config2.VG, {}).get("logical_volumes", {}).get(exp["volume"])
-            if not vol:
-                raise Exception(f"invalid backup format: vol {exp['volume']}")
-            volname = [x.removeprefix("volname.") for x in vol.get("tags", []) if x.startswith("volname.")][0]
-            res.append(
-                ExportReadResponse(
-                    protocol="iscsi",
-                    connected=[],
-                    targetname=exp["name"],
-                    tid=0,
-                    volumes=[volname],
-                    users=[exp["user"]],
-                    acl=exp["acl"],
-                )
+    vg = parse_volbackup(store.read(name, "volume").decode("utf-8"))
+    parsed = parse_export(store.read(name, "export").decode("utf-8"))
+    for exp in parsed:
+        lv = vg.logical_volumes.get(exp["volume"])
+        if lv is None:
+            raise InvalidArgument(f"invalid backup format: vol {exp['volume']}")
+        volname = lv.tag(LV.nametag_prefix) or lv.name
+        res.append(
+            ExportReadResponse(
+                protocol="iscsi",
+                connected=[],
+                targetname=exp["name"],
+                tid=0,
+                volumes=[volname],
+                users=[exp["user"]],
+                acl=exp["acl"],
             )
+        )
     return res
 
 
-@router.get("/mgmt/backup/{name}/volume", description="get volume list of backup")
-def get_backup_volume(name: str) -> list[VolumeReadResponse]:
-    path = _backup_file(name)
-    if not path.exists():
-        raise FileNotFoundError("backup file not found")
+def _backup_volumes(name: str) -> list[VolumeReadResponse]:
     res = []
-    with zipfile.ZipFile(path, "r") as zf:
-        data = zf.read("volume").decode("utf-8")
-        parsed = parse_volbackup(data)
-        if parsed.get("version") != 1:
-            raise Exception(f"invalid backup format: version={parsed.get('version')}")
-        vginfo = parsed.get(config2.VG)
-        if not vginfo:
-            raise Exception("invalid backup format: no vg")
-        extent_size = vginfo.get("extent_size")
-        if not extent_size:
-            raise Exception(f"invalid backup format: extent size={extent_size}")
-        for lvinfo in vginfo.get("logical_volumes", {}).values():
-            tags = lvinfo.get("tags", [])
-            volname = [x.removeprefix("volname.") for x in tags if x.startswith("volname.")][0]
-            if "VISIBLE" not in lvinfo.get("status", []):
-                continue
-            extents = 0
-            for i in range(lvinfo.get("segment_count")):
-                extents += lvinfo.get(f"segment{i + 1}", {}).get("extent_count")
-            res.append(
-                VolumeReadResponse(
-                    name=volname,
-                    created=datetime.datetime.fromtimestamp(lvinfo.get("creation_time"), tz=datetime.timezone.utc),
-                    size=extents * extent_size * 512,
-                    used=False,
-                    readonly="WRITE" not in lvinfo.get("status", []),
-                    thin=False,
-                    parent=None,
-                )
+    vg = parse_volbackup(_store().read(name, "volume").decode("utf-8"))
+    for lv in vg.logical_volumes.values():
+        if not lv.visible or lv.thin_pool:
+            # thin pool has no device
+            continue
+        res.append(
+            VolumeReadResponse(
+                name=lv.tag(LV.nametag_prefix) or lv.name,
+                created=datetime.datetime.fromtimestamp(lv.creation_time or 0, tz=datetime.timezone.utc),
+                size=vg.lv_size(lv),
+                used=False,
+                readonly=not lv.writable,
+                thin=lv.thin,
+                parent=lv.origin,
             )
+        )
     return res
 
 
+def _summarize(name: str) -> dict:
+    store = _store()
+    manifest = store.manifest(name)
+    if manifest is None:
+        stat = store.path(name).stat()
+        created = datetime.datetime.fromtimestamp(stat.st_mtime, tz=datetime.timezone.utc).isoformat()
+        size = stat.st_size
+    else:
+        created = manifest["created"]
+        size = sum(store.blob_size(x) for x in manifest.get("members", {}).values())
+    res: dict = dict(created=created, size=size)
+    for key, fn in (("volumes", _backup_volumes), ("exports", _backup_exports)):
+        try:
+            res[key] = [x.model_dump(mode="json") for x in fn(name)]
+        except Exception as e:
+            res[f"{key}_error"] = f"{type(e).__qualname__}: {e}"
+    return res
+
+
+def _summary(name: str, key: str) -> list[dict]:
+    entry = _index().get(name)
+    if "error" in entry or f"{key}_error" in entry:
+        raise InvalidArgument(f"invalid backup format: {entry.get('error') or entry.get(f'{key}_error')}")
+    return entry[key]
+
+
+@router.get("/mgmt/backup/{name}/export", description="get export list of backup")
+def get_backup_export(name: str) -> list[ExportReadResponse]:
+    return [ExportReadResponse.model_validate(x) for x in _summary(name, "exports")]
+
+
+@router.get("/mgmt/backup/{name}/volume", description="get volume list of backup")
+def get_backup_volume(name: str) -> list[VolumeReadResponse]:
+    return [VolumeReadResponse.model_validate(x) for x in _summary(name, "volumes")]
+
+
+def _validate_backup(path: Path):
+    try:
+        zf = zipfile.ZipFile(path, "r")
+    except zipfile.BadZipFile as e:
+        raise InvalidArgument(f"invalid backup file: {e}")
+    with zf:
+        if set(zf.namelist()) != {"volume", "export"}:
+            raise InvalidArgument("invalid backup file")
+        if sum(x.file_size for x in zf.infolist()) > config.BACKUP_MAX_SIZE:
+            raise HTTPException(status_code=413, detail="backup file too large")
+        # read members in chunks and check CRC
+        chk = zf.testzip()
+        if chk is not None:
+            raise InvalidArgument(f"invalid backup file: {chk}")
+
+
 @router.put("/mgmt/backup/{name}", description="upload backup file")
 async def put_backup(name: str, req: Request) -> dict[str, str]:
-    path = _backup_file(name)
+    store = _store()
+    path = store.path(name)
     if path.exists():
         raise FileExistsError("backup already exists")
-    # validate
+    if int(req.headers.get("content-length", 0)) > config.BACKUP_MAX_SIZE:
+        raise HTTPException(status_code=413, detail="backup file too large")
+    # stream to temporary file in the same directory, then link atomically
+    fd, tmpname = await run_in_threadpool(tempfile.mkstemp, dir=path.parent, prefix=".upload-", suffix=".tmp")
+    tmppath = Path(tmpname)
     try:
-        buf = io.BytesIO(await req.body())
-        zf = zipfile.ZipFile(buf, "r")
-    except zipfile.BadZipFile as e:
-        raise InvalidArgument(f"invalid backup file: {e}")
-    chk = zf.testzip()
-    if chk is not None:
-        raise InvalidArgument(f"invalid backup file: {chk}")
-    if set(zf.namelist()) != {"volume", "export"}:
-        raise InvalidArgument("invalid backup file")
-
-    path.write_bytes(buf.getbuffer())
+        size = 0
+        # file writes run in the threadpool, batched to keep the event loop free
+        buf = bytearray()
+        with os.fdopen(fd, "wb") as ofp:
+            async for chunk in req.stream():
+                size += len(chunk)
+                if size > config.BACKUP_MAX_SIZE:
+                    raise HTTPException(status_code=413, detail="backup file too large")
+                buf += chunk
+                if len(buf) >= UPLOAD_BUFSIZE:
+                    await run_in_threadpool(ofp.write, bytes(buf))
+                    buf.clear()
+            await run_in_threadpool(ofp.write, bytes(buf))
+        await run_in_threadpool(_validate_backup, tmppath)
+        await run_in_threadpool(store.import_zip, name, tmppath)
+    finally:
+        tmppath.unlink(missing_ok=True)
+    await run_in_threadpool(_index().update, name)
+    _log.info("backup uploaded: %s (%d bytes)", path, size)
     return {"status": "OK"}
 
 
 @router.post("/mgmt/backup/{name}", description="restore backup")
 def restore_backup(name: str, export: bool = True, volume: bool = True) -> dict[str, str]:
-    path = _backup_file(name)
+    store = _store()
     if not (export or volume):
         raise InvalidArgument("nothing to restore")
-    if path.exists():
+    if store.exists(name):
         result = dict(status="OK")
-        with zipfile.ZipFile(path, "r") as zf, tempfile.NamedTemporaryFile("r+") as tf:
+        with tempfile.NamedTemporaryFile("r+") as tf:
             if export:
-                Tgtd().restore(zf.read("export").decode("utf-8"))
+                Tgtd().restore(store.read(name, "export").decode("utf-8"))
                 result["export"] = "restored"
             else:
                 result["export"] = "skipped"
             if volume:
-                Path(tf.name).write_bytes(zf.read("volume"))
+                Path(tf.name).write_bytes(store.read(name, "volume"))
                 VG(config2.VG).restore(Path(tf.name))
                 result["volume"] = "restored"
             else:
@@ -210,9 +447,6 @@ def restore_backup(name: str, export: bool = True, volume: bool = True) -> dict[
 
 @router.delete("/mgmt/backup/{name}", description="delete specified backup file")
 def delete_backup(name: str) -> dict[str, str]:
-    path = _backup_file(name)
-    if path.exists():
-        _log.info("delete backup: %s", path)
-        path.unlink()
-        return {"status": "OK"}
-    raise FileNotFoundError("backup file not found")
+    _store().delete(name)
+    _index().update(name)
+    return {"status": "OK"}
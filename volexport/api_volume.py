@@ -1,14 +1,29 @@
 import datetime
-from typing import Annotated
+import json
+import time
+import uuid
+from typing import Annotated, Iterable, Iterator
 from enum import Enum
-from fastapi import APIRouter, HTTPException
-from pydantic import BaseModel, Field, AfterValidator
+from fastapi import APIRouter, HTTPException, Query, Response
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field, AfterValidator, TypeAdapter
+from logging import getLogger
 from .config2 import config2
 from .config import config
 from .lvm2 import LV, VG
 from .tgtd import Tgtd
-
+from .jobs import progress
+from .api_jobs import JobResponse, submit_job
+from .api_export import ClientInfo
+from .exceptions import InvalidArgument
+from .util import popencmd
+from . import thin, statedb, warmpool, template
+
+_log = getLogger(__name__)
 router = APIRouter()
+AsyncFlag = Query(default=False, alias="async", description="run as background job, returns job info")
+OffsetParam = Query(default=0, ge=0, description="skip extents before this byte offset")
+PageSizeParam = Query(default=1000, ge=1, le=100000, description="max extents per line")
 
 
 def _is_volsize(value: int):
@@ -20,11 +35,29 @@ def _is_volsize(value: int):
 VolumeSize = Annotated[int, AfterValidator(_is_volsize)]
 
 
+class Filesystem(str, Enum):
+    """supported filesystems"""
+
+    ext4 = "ext4"
+    xfs = "xfs"
+    btrfs = "btrfs"
+    vfat = "vfat"
+    ntfs = "ntfs"
+    exfat = "exfat"
+    nilfs2 = "nilfs2"
+
+
 class VolumeCreateRequest(BaseModel):
     """Request type for POST /volume"""
 
     name: str = Field(description="Name of the volume to create", examples=["volume1"])
     size: VolumeSize = Field(description="Size of the volume in bytes", examples=[1073741824], gt=0)
+    filesystem: Filesystem | None = Field(
+        default=None, description="Make filesystem in the volume (taken from warm pool if available)"
+    )
+    from_template: bool = Field(
+        default=False, description="Create as a thin snapshot of the formatted golden template, requires filesystem"
+    )
 
 
 class VolumeCreateResponse(BaseModel):
@@ -32,6 +65,7 @@ class VolumeCreateResponse(BaseModel):
 
     name: str = Field(description="Name of the created volume", examples=["volume1"])
     size: VolumeSize = Field(description="Size of the created volume in bytes", examples=[1073741824], gt=0)
+    filesystem: Filesystem | None = Field(default=None, description="Filesystem made in the volume")
 
 
 class VolumeReadResponse(BaseModel):
@@ -46,6 +80,22 @@ class VolumeReadResponse(BaseModel):
     parent: str | None = Field(description="parent volname if snapshot")
 
 
+class VolumeExportInfo(BaseModel):
+    """Export of the volume in GET /volume/{name}?include=exports"""
+
+    targetname: str = Field(description="target name", examples=["iqn.2025-08.volexport:abcde"])
+    tid: int = Field(description="target ID")
+    acl: list[str] = Field(description="Access Control List (ACL) for the export")
+    users: list[str] = Field(description="List of users with access", examples=["admin", "user1"])
+    connected: list[ClientInfo] | None = Field(default=None, description="Connected clients, with include=sessions")
+
+
+class VolumeDetailResponse(VolumeReadResponse):
+    """Response type for GET /volume/{name}"""
+
+    exports: list[VolumeExportInfo] | None = Field(default=None, description="Exports, with include=exports")
+
+
 class VolumeUpdateRequest(BaseModel):
     """Request type for POST /volume/{name}"""
 
@@ -55,18 +105,6 @@ class VolumeUpdateRequest(BaseModel):
     readonly: bool | None = Field(default=None, description="Set volume to read-only if true", examples=[True, False])
 
 
-class Filesystem(str, Enum):
-    """supported filesystems"""
-
-    ext4 = "ext4"
-    xfs = "xfs"
-    btrfs = "btrfs"
-    vfat = "vfat"
-    ntfs = "ntfs"
-    exfat = "exfat"
-    nilfs2 = "nilfs2"
-
-
 class VolumeFormatRequest(BaseModel):
     """Request type for POST /volume/{name}/mkfs"""
 
@@ -81,6 +119,28 @@ class SnapshotCreateRequest(BaseModel):
     size: int | None = Field(default=None, description="Size of snapshot CoW (ignore if using thinpool)")
 
 
+class CloneCreateRequest(BaseModel):
+    """Request type for POST /volume/{name}/clone"""
+
+    name: str = Field(description="Name of the new volume", examples=["volume2"])
+    size: VolumeSize | None = Field(
+        default=None,
+        description="Size of the new volume in bytes (default: same as source)",
+        examples=[2147483648],
+        gt=0,
+    )
+    snapshot_size: int | None = Field(
+        default=None, description="Size of snapshot CoW while copying (ignore if thin volume)", gt=0
+    )
+
+
+class SnapshotListResponse(BaseModel):
+    """Response type for GET /snapshot"""
+
+    entries: list[VolumeReadResponse] = Field(description="Snapshots sorted by name")
+    next: str | None = Field(default=None, description="after parameter of the next page, null if last page")
+
+
 class PoolStats(BaseModel):
     """Response type for GET /stats/volume"""
 
@@ -91,41 +151,112 @@ class PoolStats(BaseModel):
     volumes: int = Field(description="Number of volumes in the pool", examples=[10])
 
 
-@router.get("/volume", description="List all volumes")
-def list_volume() -> list[VolumeReadResponse]:
-    return [VolumeReadResponse.model_validate(x) for x in LV(config2.VG).volume_list()]
-
-
-@router.post("/volume", description="Create a new volume")
-def create_volume(arg: VolumeCreateRequest) -> VolumeCreateResponse:
-    if config.LVM_THINPOOL:
-        return VolumeCreateResponse.model_validate(
-            LV(config2.VG, arg.name).create_thin(size=arg.size, thinpool=config.LVM_THINPOOL)
-        )
-    return VolumeCreateResponse.model_validate(LV(config2.VG, arg.name).create(size=arg.size))
-
-
-@router.get("/volume/{name}", description="Read volume details by name")
-def read_volume(name) -> VolumeReadResponse:
+_volume_list = TypeAdapter(list[VolumeReadResponse])
+
+
+@router.get("/volume", description="List all volumes", response_model=list[VolumeReadResponse])
+def list_volume() -> Response:
+    # validate once and serialize in pydantic-core, bypass jsonable_encoder
+    res = _volume_list.validate_python(LV(config2.VG).volume_list())
+    return Response(content=_volume_list.dump_json(res), media_type="application/json")
+
+
+@router.post("/volume", description="Create a new volume", responses={202: {"model": JobResponse}})
+def create_volume(arg: VolumeCreateRequest, async_: bool = AsyncFlag) -> VolumeCreateResponse:
+    filesystem = arg.filesystem.value if arg.filesystem else None
+    params = dict(size=arg.size, thinpool=config.LVM_THINPOOL, filesystem=filesystem)
+    with statedb.mutation() as tx:
+        res = warmpool.claim(config2.VG, arg.name, arg.size, filesystem)
+        if tx is not None and res is not None:
+            tx.put_volume(res, params=dict(params, warm=True))
+    if res is not None:
+        # already formatted, no job
+        return VolumeCreateResponse.model_validate(dict(res, filesystem=filesystem))
+    if arg.from_template:
+        # no mkfs, takes same time for any size
+        with statedb.mutation() as tx:
+            res = template.create_volume(config2.VG, arg.name, arg.size, filesystem)
+            if tx is not None and res is not None:
+                tx.put_volume(res, params=dict(params, template=True))
+        return VolumeCreateResponse.model_validate(dict(res, filesystem=filesystem))
+
+    def _create():
+        lv = LV(config2.VG, arg.name)
+        with statedb.mutation() as tx:
+            if config.LVM_THINPOOL:
+                res = lv.create_thin(size=arg.size, thinpool=config.LVM_THINPOOL)
+            else:
+                res = lv.create(size=arg.size)
+            if tx is not None and res is not None:
+                tx.put_volume(res, params=params)
+        if filesystem:
+            progress(0.1, f"mkfs.{filesystem}")
+            lv.format_volume(filesystem, None)
+        return VolumeCreateResponse.model_validate(dict(res, filesystem=filesystem))
+
+    if async_:
+        return submit_job(f"create {arg.name}", lambda: _create().model_dump(mode="json"), volume=arg.name)
+    return _create()
+
+
+def _volume_exports(name: str, path: str, sessions: bool) -> list[dict]:
+    db = statedb.get()
+    if db is None:
+        # one tgtadm run, sessions included
+        return [x for x in Tgtd().export_list() if path in x["volumes"]]
+    res = db.exports(volume=name)
+    if sessions:
+        for ent in res:
+            ent["connected"] = Tgtd().connected(ent["tid"])
+    return res
+
+
+@router.get(
+    "/volume/{name}",
+    description="Read volume details by name",
+    response_model=VolumeDetailResponse,
+    response_model_exclude_unset=True,
+)
+def read_volume(
+    name, include: str | None = Query(default=None, description="comma separated: exports, sessions")
+) -> VolumeDetailResponse:
+    parts = set(include.split(",")) if include else set()
+    if parts - {"exports", "sessions"}:
+        raise InvalidArgument(f"invalid include: {include}")
     res = LV(config2.VG, name).volume_read()
     if res is None:
         raise HTTPException(status_code=404, detail="volume not found")
-    return VolumeReadResponse.model_validate(res)
+    if parts:
+        exports = _volume_exports(name, f"/dev/{config2.VG}/{res['lvm_name']}", "sessions" in parts)
+        if "sessions" not in parts:
+            exports = [{k: v for k, v in x.items() if k != "connected"} for x in exports]
+        res = dict(res, exports=exports)
+    return VolumeDetailResponse.model_validate(res)
 
 
 @router.delete("/volume/{name}", description="Delete a volume by name")
 def delete_volume(name) -> dict:
-    LV(config2.VG, name).delete()
+    with statedb.mutation() as tx:
+        LV(config2.VG, name).delete()
+        if tx is not None:
+            tx.delete_volume(name)
     return {}
 
 
 @router.post("/volume/{name}/snapshot", description="Create snapshot")
 def create_snapshot(name, arg: SnapshotCreateRequest) -> VolumeReadResponse:
-    if config.LVM_THINPOOL:
-        res = LV(config2.VG, arg.name).create_thinsnap(parent=name)
-        return VolumeReadResponse.model_validate(res)
-    assert arg.size
-    res = LV(config2.VG, arg.name).create_snapshot(size=arg.size, parent=name)
+    # LVs are uuid-named, lvcreate takes the LV name of the volume
+    src = LV(config2.VG, name).get()
+    if src is None:
+        raise FileNotFoundError(f"volume not found: {name}")
+    with statedb.mutation() as tx:
+        if config.LVM_THINPOOL:
+            res = LV(config2.VG, arg.name).create_thinsnap(parent=src["lv_name"])
+        else:
+            assert arg.size
+            res = LV(config2.VG, arg.name).create_snapshot(size=arg.size, parent=src["lv_name"])
+        if tx is not None and res is not None:
+            tx.put_volume(res, params=dict(snapshot_of=name, size=arg.size))
     return VolumeReadResponse.model_validate(res)
 
 
@@ -134,6 +265,20 @@ def list_snapshot(name) -> list[VolumeReadResponse]:
     return [VolumeReadResponse.model_validate(x) for x in LV(config2.VG).volume_list() if x.get("parent") == name]
 
 
+@router.get("/snapshot", description="List snapshots of all volumes by pages")
+def list_all_snapshot(
+    source: str | None = Query(default=None, description="snapshots of this volume"),
+    name: str | None = Query(default=None, description="snapshot of this name"),
+    after: str | None = Query(default=None, description="snapshots whose name is after this"),
+    limit: int = Query(default=1000, ge=1, le=100000, description="max snapshots per page"),
+) -> SnapshotListResponse:
+    ents = LV(config2.VG).snapshot_list(source=source, name=name)
+    if after is not None:
+        ents = [x for x in ents if x["name"] > after]
+    page = [VolumeReadResponse.model_validate(x) for x in ents[:limit]]
+    return SnapshotListResponse(entries=page, next=page[-1].name if len(ents) > limit else None)
+
+
 @router.get("/volume/{name}/snapshot/{snapname}", description="Read snapshot")
 def read_snapshot(name, snapname) -> VolumeReadResponse:
     # check if name is parent
@@ -152,30 +297,198 @@ def delete_snapshot(name, snapname) -> dict:
     lv = LV(config2.VG, snapname)
     if lv.get_parent() != name:
         raise HTTPException(status_code=404, detail="volume not found")
-    lv.delete()
+    with statedb.mutation() as tx:
+        lv.delete()
+        if tx is not None:
+            tx.delete_volume(snapname)
     return {}
 
 
-@router.post("/volume/{name}", description="Update a volume by name")
-def update_volume(name, arg: VolumeUpdateRequest) -> VolumeReadResponse:
-    lv = LV(config2.VG, name)
-    if arg.readonly is not None:
-        lv.read_only(arg.readonly)
-    if arg.size is not None:
-        lv.resize(arg.size)
+@router.post(
+    "/volume/{name}/snapshot/{snapname}/rollback",
+    description="Rollback volume to snapshot (merge snapshot)",
+    responses={202: {"model": JobResponse}},
+)
+def rollback_snapshot(name, snapname, async_: bool = AsyncFlag) -> VolumeReadResponse:
+    # check if name is parent
+    lv = LV(config2.VG, snapname)
+    if lv.get_parent() != name:
+        raise HTTPException(status_code=404, detail="volume not found")
+
+    def _rollback():
+        with statedb.mutation() as tx:
+            res = lv.rollback_snapshot()
+            if res is None:
+                raise FileNotFoundError(f"volume not found: {name}")
+            if tx is not None:
+                tx.delete_volume(snapname)
+                tx.put_volume(res)
+        return VolumeReadResponse.model_validate(res)
+
+    if async_:
+        return submit_job(f"rollback {name} {snapname}", lambda: _rollback().model_dump(mode="json"), volume=name)
+    return _rollback()
+
+
+def _copy_volume(src: str, dst: str):
+    """Copy whole data of the volume, cancellable in job"""
+    with popencmd(["dd", f"if={src}", f"of={dst}", "bs=4M", "iflag=direct", "oflag=direct", "status=none"]) as proc:
+        while proc.poll() is None:
+            progress(0.2, "copy data")
+            time.sleep(0.5)
+
+
+@router.post(
+    "/volume/{name}/clone",
+    description="Create a writable copy of a volume (thin snapshot if thin volume, full copy otherwise)",
+    responses={202: {"model": JobResponse}},
+)
+def clone_volume(name, arg: CloneCreateRequest, async_: bool = AsyncFlag) -> VolumeReadResponse:
+    src = LV(config2.VG, name).volume_read()
+    if src is None:
+        raise HTTPException(status_code=404, detail="volume not found")
+    if arg.size is not None and arg.size < src["size"]:
+        raise InvalidArgument(f"smaller than source volume: {arg.size} < {src['size']}")
+    lv = LV(config2.VG, arg.name)
+    if lv.get() is not None:
+        raise FileExistsError(f"volume already exists: {arg.name}")
+
+    def _clone():
+        params = dict(clone_of=name, size=arg.size)
+        if src["thin"]:
+            with statedb.mutation() as tx:
+                res = lv.create_thinclone(parent=name, size=arg.size)
+                if tx is not None and res is not None:
+                    tx.put_volume(res, params=params)
+            return VolumeReadResponse.model_validate(res)
+        # copy from a point-in-time snapshot, the source may be written meanwhile
+        progress(0.0, "create snapshot")
+        snap = LV(config2.VG, f"clone-{uuid.uuid4().hex[:12]}")
+        cow_size = arg.snapshot_size or max(src["size"] // 10 // 512 * 512, 4 * 1024 * 1024)
+        snap.create_snapshot(size=cow_size, parent=src["lvm_name"])
         try:
-            Tgtd().refresh_volume_bypath(lv.volume_vol2path())
-        except FileNotFoundError:
-            # not exported
-            pass
-    return VolumeReadResponse.model_validate(lv.volume_read())
+            progress(0.0, "create volume")
+            lv.create(size=arg.size or src["size"])
+            try:
+                _copy_volume(snap.volume_vol2path(), lv.volume_vol2path())
+            except BaseException:
+                _log.warning("clone failed, remove volume: %s", arg.name)
+                lv.delete()
+                raise
+        finally:
+            snap.delete()
+        res = lv.volume_read()
+        with statedb.mutation() as tx:
+            if tx is not None and res is not None:
+                tx.put_volume(res, params=params)
+        return VolumeReadResponse.model_validate(res)
+
+    if async_:
+        return submit_job(f"clone {name} {arg.name}", lambda: _clone().model_dump(mode="json"), volume=name)
+    return _clone()
+
+
+def _thin_volume(name: str) -> tuple[dict, int]:
+    lv = LV(config2.VG, name)
+    info = lv.get()
+    if info is None:
+        raise FileNotFoundError(f"volume not found: {name}")
+    if not info["pool_lv"]:
+        raise InvalidArgument(f"not a thin volume: {name}")
+    dev_id = lv.thin_id()
+    if dev_id is None:
+        raise InvalidArgument(f"no thin device id: {name}")
+    return info, dev_id
+
+
+def _extent_pages(extents: Iterable[tuple[int, int]], size: int, offset: int, page_size: int) -> Iterator[str]:
+    """Clip extents to [offset, size), yield JSON lines of up to page_size extents"""
+    page: list[list[int]] = []
+    sent = False
+    for start, length in extents:
+        if start >= size:
+            break
+        end = min(start + length, size)
+        start = max(start, offset)
+        if start >= end:
+            continue
+        page.append([start, end - start])
+        if len(page) >= page_size:
+            yield json.dumps(dict(size=size, extents=page)) + "\n"
+            page = []
+            sent = True
+    if page or not sent:
+        yield json.dumps(dict(size=size, extents=page)) + "\n"
+
+
+@router.get(
+    "/volume/{name}/allocated",
+    description="Allocated extents of thin volume, JSON lines of {size, extents: [[offset, length], ...]}",
+)
+def allocated_volume(name, offset: int = OffsetParam, page_size: int = PageSizeParam) -> StreamingResponse:
+    info, dev_id = _thin_volume(name)
+    extents = thin.allocated(config2.VG, info["pool_lv"], dev_id)
+    return StreamingResponse(
+        _extent_pages(extents, int(info["lv_size"]), offset, page_size), media_type="application/x-ndjson"
+    )
+
+
+@router.get(
+    "/volume/{name}/delta/{base}",
+    description="Changed extents from base volume, JSON lines of {size, extents: [[offset, length], ...]}",
+)
+def delta_volume(name, base, offset: int = OffsetParam, page_size: int = PageSizeParam) -> StreamingResponse:
+    info, dev_id = _thin_volume(name)
+    baseinfo, base_id = _thin_volume(base)
+    if info["pool_lv"] != baseinfo["pool_lv"]:
+        raise InvalidArgument(f"not in the same pool: {name}, {base}")
+    extents = thin.delta(config2.VG, info["pool_lv"], base_id, dev_id)
+    return StreamingResponse(
+        _extent_pages(extents, int(info["lv_size"]), offset, page_size), media_type="application/x-ndjson"
+    )
+
+
+@router.post("/volume/{name}", description="Update a volume by name", responses={202: {"model": JobResponse}})
+def update_volume(name, arg: VolumeUpdateRequest, async_: bool = AsyncFlag) -> VolumeReadResponse:
+    lv = LV(config2.VG, name)
+
+    def _update():
+        if arg.readonly is not None:
+            lv.read_only(arg.readonly)
+        if arg.size is not None:
+            progress(0.1, "resize volume")
+            lv.resize(arg.size)
+            progress(0.8, "refresh export")
+            try:
+                Tgtd().refresh_volume_bypath(lv.volume_vol2path())
+            except FileNotFoundError:
+                # not exported
+                pass
+        res = lv.volume_read()
+        with statedb.mutation() as tx:
+            if tx is not None and res is not None:
+                tx.put_volume(res)
+        return VolumeReadResponse.model_validate(res)
+
+    if async_:
+        return submit_job(f"update {name}", lambda: _update().model_dump(mode="json"), volume=name)
+    return _update()
 
 
-@router.post("/volume/{name}/mkfs", description="Format a volume, make filesystem")
-def format_volume(name, arg: VolumeFormatRequest) -> VolumeReadResponse:
+@router.post(
+    "/volume/{name}/mkfs", description="Format a volume, make filesystem", responses={202: {"model": JobResponse}}
+)
+def format_volume(name, arg: VolumeFormatRequest, async_: bool = AsyncFlag) -> VolumeReadResponse:
     lv = LV(config2.VG, name)
-    lv.format_volume(arg.filesystem.value, arg.label)
-    return VolumeReadResponse.model_validate(lv.volume_read())
+
+    def _format():
+        progress(0.1, f"mkfs.{arg.filesystem.value}")
+        lv.format_volume(arg.filesystem.value, arg.label)
+        return VolumeReadResponse.model_validate(lv.volume_read())
+
+    if async_:
+        return submit_job(f"mkfs {name}", lambda: _format().model_dump(mode="json"), volume=name)
+    return _format()
 
 
 @router.get("/stats/volume", description="Get statistics of the volume pool")
@@ -0,0 +1,582 @@
+import os
+import json
+import hashlib
+import datetime
+import multiprocessing
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+import zlib
+import zipfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, BinaryIO
+from logging import getLogger
+from .config import config
+from .exceptions import InvalidArgument
+from .jobs import progress
+from .lvm2 import LV
+from .util import popencmd
+from .thin import allocated as thin_allocated, delta as thin_delta
+
+_log = getLogger(__name__)
+_lock = threading.Lock()
+_index_lock = threading.Lock()
+# blobs written by running backups, not referenced by manifest yet
+_pins: list[set[str]] = []
+
+
+class BackupStore:
+    """Content-addressed backup store
+
+    - (dir)/(name).backup: manifest (JSON) or zip file (legacy format)
+    - (dir)/(name).data: manifest of volume data backup (JSON)
+    - (dir)/blobs/(hash[:2])/(hash): zlib compressed member data, named by sha256 of uncompressed data
+    """
+
+    suffix = ".backup"
+    suffixes = (".backup", ".data")
+    manifest_version = 1
+
+    def __init__(self, basedir: Path | str, suffix: str | None = None):
+        self.basedir = Path(basedir)
+        self.blobdir = self.basedir / "blobs"
+        if suffix is not None:
+            assert suffix in self.suffixes
+            self.suffix = suffix
+
+    def path(self, name: str) -> Path:
+        """Path of the backup manifest"""
+        assert "/" not in name
+        assert not name.startswith(".")
+        return (self.basedir / name).with_suffix(self.suffix)
+
+    def exists(self, name: str) -> bool:
+        return self.path(name).exists()
+
+    def list(self) -> Iterator[Path]:
+        """List backup manifests"""
+        return self.basedir.glob(f"*{self.suffix}")
+
+    def _blob_path(self, digest: str) -> Path:
+        if len(digest) != 64 or not all(x in "0123456789abcdef" for x in digest):
+            raise InvalidArgument(f"invalid blob id: {digest}")
+        return self.blobdir / digest[:2] / digest
+
+    def put_blob(self, data: bytes) -> str:
+        """Store data if not exists, returns the hash"""
+        digest = hashlib.sha256(data).hexdigest()
+        if not self.has_blob(digest):
+            self.put_compressed(digest, zlib.compress(data))
+        return digest
+
+    def blob_size(self, digest: str) -> int:
+        """Stored (compressed) size of the blob"""
+        return self._blob_path(digest).stat().st_size
+
+    def has_blob(self, digest: str) -> bool:
+        return self._blob_path(digest).exists()
+
+    def put_compressed(self, digest: str, compressed: bytes) -> int:
+        """Store compressed data, returns written bytes (0 if already exists)"""
+        path = self._blob_path(digest)
+        if path.exists():
+            _log.debug("blob exists: %s", digest)
+            return 0
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmpname = tempfile.mkstemp(dir=path.parent, prefix=".", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as ofp:
+                ofp.write(compressed)
+            os.replace(tmpname, path)
+        except Exception:
+            Path(tmpname).unlink(missing_ok=True)
+            raise
+        _log.debug("blob created: %s (%d bytes)", digest, len(compressed))
+        return len(compressed)
+
+    def get_blob(self, digest: str) -> bytes:
+        path = self._blob_path(digest)
+        if not path.exists():
+            raise FileNotFoundError(f"blob not found: {digest}")
+        data = zlib.decompress(path.read_bytes())
+        if hashlib.sha256(data).hexdigest() != digest:
+            raise InvalidArgument(f"blob corrupted: {digest}")
+        return data
+
+    def write_manifest(self, name: str, manifest: dict):
+        """Write a manifest, fails if exists"""
+        path = self.path(name)
+        fd, tmpname = tempfile.mkstemp(dir=self.basedir, prefix=".", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as ofp:
+                json.dump(manifest, ofp)
+            # link fails if exists
+            os.link(tmpname, path)
+        except FileExistsError:
+            raise FileExistsError("backup already exists")
+        finally:
+            Path(tmpname).unlink(missing_ok=True)
+
+    def create(self, name: str, members: dict[str, bytes]):
+        """Create a backup from member data"""
+        with _lock:
+            manifest = dict(
+                version=self.manifest_version,
+                created=datetime.datetime.now(tz=datetime.timezone.utc).isoformat(),
+                members={k: self.put_blob(v) for k, v in members.items()},
+            )
+            self.write_manifest(name, manifest)
+        _log.info("backup created: %s %s", name, manifest["members"])
+
+    def import_zip(self, name: str, path: Path):
+        """Create a backup from zip file"""
+        with zipfile.ZipFile(path, "r") as zf:
+            self.create(name, {x: zf.read(x) for x in zf.namelist()})
+
+    def _is_zip(self, path: Path) -> bool:
+        with path.open("rb") as ifp:
+            return ifp.read(4) == b"PK\x03\x04"
+
+    def manifest(self, name: str) -> dict | None:
+        """Read manifest, None if legacy zip backup"""
+        return self._read_manifest(self.path(name))
+
+    def _read_manifest(self, path: Path) -> dict | None:
+        if not path.exists():
+            raise FileNotFoundError("backup file not found")
+        if self._is_zip(path):
+            return None
+        try:
+            res = json.loads(path.read_text())
+        except ValueError as e:
+            raise InvalidArgument(f"invalid backup format: {e}")
+        if not isinstance(res, dict) or res.get("version") != self.manifest_version:
+            raise InvalidArgument("invalid backup format")
+        return res
+
+    def read(self, name: str, member: str) -> bytes:
+        """Read a member of the backup"""
+        manifest = self.manifest(name)
+        if manifest is None:
+            with zipfile.ZipFile(self.path(name), "r") as zf:
+                return zf.read(member)
+        digest = manifest.get("members", {}).get(member)
+        if digest is None:
+            raise FileNotFoundError(f"member not found: {member}")
+        return self.get_blob(digest)
+
+    def write_zip(self, name: str, ofp: BinaryIO):
+        """Assemble zip file of the backup"""
+        manifest = self.manifest(name)
+        if manifest is None:
+            with self.path(name).open("rb") as ifp:
+                while chunk := ifp.read(1024 * 1024):
+                    ofp.write(chunk)
+            return
+        with zipfile.ZipFile(ofp, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+            for member, digest in manifest.get("members", {}).items():
+                zf.writestr(member, self.get_blob(digest))
+
+    def delete(self, name: str, gc: bool = True):
+        """Delete a backup and unreferenced blobs"""
+        path = self.path(name)
+        if not path.exists():
+            raise FileNotFoundError("backup file not found")
+        with _lock:
+            _log.info("delete backup: %s", path)
+            path.unlink()
+            if gc:
+                try:
+                    self._gc()
+                except InvalidArgument as e:
+                    # the backup is deleted, its blobs are left for later gc
+                    _log.error("gc skipped: %s", e)
+
+    def _refs(self) -> set[str]:
+        """Blobs referenced by manifests, raise InvalidArgument if any manifest is unreadable"""
+        res = set()
+        errors = []
+        for suffix in self.suffixes:
+            for path in self.basedir.glob(f"*{suffix}"):
+                try:
+                    manifest = self._read_manifest(path)
+                    if manifest is not None:
+                        res.update(manifest.get("members", {}).values())
+                        res.update(x for x in manifest.get("chunks", []) if x)
+                except Exception as e:
+                    _log.warning("cannot read manifest: %s: %s", path, e)
+                    errors.append(path.name)
+        if errors:
+            # blobs of the unreadable manifest would be removed
+            raise InvalidArgument(f"gc aborted, cannot read manifest: {', '.join(sorted(errors))}")
+        return res
+
+    @contextmanager
+    def pinning(self) -> Iterator[set[str]]:
+        """Protect blobs added to the set from gc until manifest is written"""
+        pins: set[str] = set()
+        with _lock:
+            _pins.append(pins)
+        try:
+            yield pins
+        finally:
+            with _lock:
+                _pins.remove(pins)
+
+    def _gc(self) -> int:
+        if not self.blobdir.exists():
+            return 0
+        refs = self._refs()
+        for pins in _pins:
+            refs.update(pins)
+        removed = 0
+        for path in self.blobdir.glob("*/*"):
+            if path.name.startswith("."):
+                continue
+            if path.name not in refs:
+                _log.debug("remove blob: %s", path)
+                path.unlink()
+                removed += 1
+        _log.info("gc: %d blobs removed, %d blobs in use", removed, len(refs))
+        return removed
+
+    def gc(self) -> int:
+        """Remove unreferenced blobs"""
+        with _lock:
+            return self._gc()
+
+
+class BackupIndex:
+    """Summary of backups in (dir)/index.json, refreshed when the directory is modified"""
+
+    filename = "index.json"
+    version = 1
+
+    def __init__(self, store: BackupStore, summarize: Callable[[str], dict], key: str = ""):
+        self.store = store
+        self.summarize = summarize
+        self.key = key
+        self.path = store.basedir / self.filename
+
+    def _summarize(self, name: str) -> dict:
+        try:
+            return self.summarize(name)
+        except Exception as e:
+            _log.warning("cannot summarize backup: %s: %s", name, e)
+            return dict(error=f"{type(e).__qualname__}: {e}")
+
+    def _read(self) -> dict | None:
+        try:
+            data = json.loads(self.path.read_text())
+        except (OSError, ValueError) as e:
+            _log.debug("cannot read index: %s", e)
+            return None
+        if not isinstance(data, dict) or data.get("version") != self.version or data.get("key") != self.key:
+            return None
+        return data
+
+    def _write(self, backups: dict[str, dict]):
+        if not self.path.exists():
+            self.path.touch()
+        # rewrite in place, mtime of the directory is unchanged
+        mtime = self.store.basedir.stat().st_mtime_ns
+        with self.path.open("r+") as ofp:
+            json.dump(dict(version=self.version, key=self.key, dir_mtime_ns=mtime, backups=backups), ofp)
+            ofp.truncate()
+
+    def _refresh(self, data: dict | None) -> dict[str, dict]:
+        if data is not None and data.get("dir_mtime_ns") == self.store.basedir.stat().st_mtime_ns:
+            return data["backups"]
+        old = data["backups"] if data is not None else {}
+        names = sorted(x.with_suffix("").name for x in self.store.list())
+        backups = {x: old[x] if x in old else self._summarize(x) for x in names}
+        _log.info("refresh backup index: %d entries, %d new", len(backups), len(backups.keys() - old.keys()))
+        self._write(backups)
+        return backups
+
+    def load(self) -> dict[str, dict]:
+        """Read summaries of all backups"""
+        with _index_lock:
+            return self._refresh(self._read())
+
+    def get(self, name: str) -> dict:
+        """Read summary of a backup"""
+        res = self.load().get(name)
+        if res is None:
+            raise FileNotFoundError("backup file not found")
+        return res
+
+    def update(self, *names: str):
+        """Update summaries of created/deleted backups"""
+        with _index_lock:
+            data = self._read()
+            if data is not None:
+                for name in names:
+                    data["backups"].pop(name, None)
+                data["dir_mtime_ns"] = None
+            self._refresh(data)
+
+
+def _compress_chunk(data: bytes) -> tuple[str, bytes]:
+    """Hash and compress a chunk (runs in worker process)"""
+    return hashlib.sha256(data).hexdigest(), zlib.compress(data)
+
+
+def _is_zero(data: bytes) -> bool:
+    return data.count(0) == len(data)
+
+
+class _Throughput:
+    def __init__(self, total: int):
+        self.total = total
+        self.done = 0
+        self.start = time.monotonic()
+
+    def add(self, size: int):
+        self.done += size
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self.start
+
+    @property
+    def rate(self) -> float:
+        """bytes/sec"""
+        return self.done / max(self.elapsed, 1e-6)
+
+    def report(self, message: str):
+        progress(
+            self.done / max(self.total, 1),
+            f"{message}: {self.done >> 20}/{self.total >> 20} MiB, {self.rate / 2**20:.1f} MiB/s",
+        )
+
+
+def _executor(workers: int):
+    if workers <= 0:
+        return None
+    # avoid fork() in threaded server
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+
+
+def _chunk_runs(extents: Iterable[tuple[int, int]], chunk_size: int, nchunks: int) -> list[tuple[int, int]]:
+    """Convert (offset, length) extents in bytes into sorted runs of (first chunk, count)"""
+    idx: set[int] = set()
+    for offset, length in extents:
+        if length <= 0:
+            continue
+        first = offset // chunk_size
+        last = min((offset + length - 1) // chunk_size, nchunks - 1)
+        idx.update(range(first, last + 1))
+    runs: list[tuple[int, int]] = []
+    for i in sorted(idx):
+        if runs and runs[-1][0] + runs[-1][1] == i:
+            runs[-1] = (runs[-1][0], runs[-1][1] + 1)
+        else:
+            runs.append((i, 1))
+    return runs
+
+
+def _backup_chunks(
+    store: BackupStore,
+    device: str,
+    chunk_size: int,
+    pins: set[str],
+    tput: "_Throughput",
+    chunks: list[str | None],
+    runs: list[tuple[int, int]],
+) -> int:
+    """Read runs of (first chunk, count) from device and store non-zero chunks into chunks, returns stored bytes"""
+    stored = 0
+    pending: deque = deque()
+    pool = _executor(config.BACKUP_WORKERS)
+
+    def _store_one() -> int:
+        idx, fut = pending.popleft()
+        digest, compressed = fut.result() if pool else fut
+        with _lock:
+            pins.add(digest)
+        chunks[idx] = digest
+        return store.put_compressed(digest, compressed)
+
+    try:
+        for first, count in runs:
+            cmd = ["dd", f"if={device}", f"bs={chunk_size}", "status=none"]
+            if (first, count) != (0, len(chunks)):
+                cmd[3:3] = [f"skip={first}", f"count={count}"]
+            with popencmd(cmd, stdout=subprocess.PIPE) as proc:
+                assert proc.stdout is not None
+                idx = first
+                while data := proc.stdout.read(chunk_size):
+                    if idx >= first + count:
+                        raise IOError(f"long read: chunk {idx}")
+                    tput.add(len(data))
+                    chunks[idx] = None
+                    if not _is_zero(data):
+                        pending.append((idx, pool.submit(_compress_chunk, data) if pool else _compress_chunk(data)))
+                    idx += 1
+                    # bound memory: wait for compressed chunks
+                    while len(pending) > max(config.BACKUP_WORKERS, 1) * 2:
+                        stored += _store_one()
+                    tput.report("backup")
+        while pending:
+            stored += _store_one()
+    finally:
+        if pool:
+            pool.shutdown(cancel_futures=True)
+    return stored
+
+
+def _incremental_base(
+    store: BackupStore, vgname: str, volume: str, size: int, chunk_size: int
+) -> tuple[str, dict] | None:
+    """Latest backup of the volume which kept its snapshot"""
+    for path in sorted(store.list(), key=lambda x: x.stat().st_mtime, reverse=True):
+        name = path.with_suffix("").name
+        try:
+            manifest = store.manifest(name)
+        except Exception as e:
+            _log.warning("cannot read manifest: %s: %s", name, e)
+            continue
+        if manifest is None or manifest.get("volume") != volume or not manifest.get("snapshot"):
+            continue
+        if manifest["size"] != size or manifest["chunk_size"] != chunk_size:
+            _log.info("volume or chunk size changed, full backup: base=%s", name)
+            return None
+        if LV(vgname, manifest["snapshot"]).get() is None:
+            _log.info("snapshot removed, full backup: base=%s", name)
+            return None
+        return name, manifest
+    return None
+
+
+def backup_volume(
+    store: BackupStore,
+    vgname: str,
+    volume: str,
+    name: str,
+    snapshot_size: int | None = None,
+    incremental: bool = False,
+) -> dict:
+    """Backup volume data from its snapshot, returns the summary"""
+    info = LV(vgname, volume).get()
+    if info is None:
+        raise FileNotFoundError(f"volume does not exists: {volume}")
+    if store.exists(name):
+        raise FileExistsError("backup already exists")
+    size = int(info["lv_size"])
+    thin = bool(info["pool_lv"])
+    if incremental and not thin:
+        raise InvalidArgument("incremental backup requires thin volume")
+    chunk_size = config.BACKUP_CHUNK_SIZE
+    nchunks = -(-size // chunk_size)
+    base = _incremental_base(store, vgname, volume, size, chunk_size) if incremental else None
+    snap = LV(vgname, f"backup-{uuid.uuid4().hex[:12]}")
+    progress(0.0, "create snapshot")
+    if thin:
+        snap.create_thinsnap(parent=info["lv_name"])
+    else:
+        snap.create_snapshot(size=snapshot_size or max(size // 10 // 512 * 512, chunk_size), parent=info["lv_name"])
+    try:
+        chunks: list[str | None] = [None] * nchunks
+        runs = [(0, nchunks)]
+        thin_id = snap.thin_id() if thin else None
+        if base is not None:
+            progress(0.0, "compute changed blocks")
+            extents = thin_delta(vgname, info["pool_lv"], base[1]["thin_id"], thin_id)  # type: ignore[arg-type]
+            chunks = list(base[1]["chunks"])
+            runs = _chunk_runs(extents, chunk_size, nchunks)
+        elif thin:
+            # unallocated blocks read as zero: read only the allocated ones
+            progress(0.0, "compute allocated blocks")
+            extents = thin_allocated(vgname, info["pool_lv"], thin_id)  # type: ignore[arg-type]
+            runs = _chunk_runs(extents, chunk_size, nchunks)
+        expected = sum(
+            min(chunk_size, size - i * chunk_size) for first, count in runs for i in range(first, first + count)
+        )
+        tput = _Throughput(expected)
+        with store.pinning() as pins:
+            stored = _backup_chunks(store, snap.volume_vol2path(), chunk_size, pins, tput, chunks, runs)
+            if tput.done != expected:
+                raise IOError(f"short read: {tput.done} != {expected}")
+            manifest = dict(
+                version=store.manifest_version,
+                created=datetime.datetime.now(tz=datetime.timezone.utc).isoformat(),
+                volume=volume,
+                size=size,
+                thin=thin,
+                chunk_size=chunk_size,
+                chunks=chunks,
+            )
+            if incremental:
+                # keep the snapshot as the base of next incremental backup
+                manifest.update(snapshot=snap.name, thin_id=thin_id)
+            if base is not None:
+                manifest.update(parent=base[0], changed_chunks=sum(x[1] for x in runs))
+            store.write_manifest(name, manifest)
+    except BaseException:
+        snap.delete()
+        raise
+    if not incremental:
+        snap.delete()
+    elif base is not None:
+        _log.info("remove previous snapshot: %s", base[1]["snapshot"])
+        LV(vgname, base[1]["snapshot"]).delete()
+    res = dict(
+        name=name,
+        volume=volume,
+        size=size,
+        chunks=len(chunks),
+        zero_chunks=chunks.count(None),
+        changed_chunks=sum(x[1] for x in runs),
+        parent=base[0] if base else None,
+        stored_bytes=stored,
+        elapsed=tput.elapsed,
+        throughput=tput.rate,
+    )
+    _log.info("volume backup created: %s", res)
+    return res
+
+
+def restore_volume(store: BackupStore, vgname: str, name: str, volume: str) -> dict:
+    """Restore volume data backup into a new volume"""
+    manifest = store.manifest(name)
+    if manifest is None or "chunks" not in manifest:
+        raise InvalidArgument(f"not a volume backup: {name}")
+    lv = LV(vgname, volume)
+    if lv.get() is not None:
+        raise FileExistsError(f"volume already exists: {volume}")
+    size = manifest["size"]
+    chunk_size = manifest["chunk_size"]
+    progress(0.0, "create volume")
+    if config.LVM_THINPOOL:
+        lv.create_thin(size=size, thinpool=config.LVM_THINPOOL)
+    else:
+        lv.create(size=size)
+    # new thin volume reads as zero, skip writing zero chunks
+    conv = "conv=sparse,notrunc" if config.LVM_THINPOOL else "conv=notrunc"
+    tput = _Throughput(size)
+    try:
+        with popencmd(
+            ["dd", f"of={lv.volume_vol2path()}", f"bs={chunk_size}", conv, "status=none"], stdin=subprocess.PIPE
+        ) as proc:
+            assert proc.stdin is not None
+            for idx, digest in enumerate(manifest["chunks"]):
+                length = min(chunk_size, size - idx * chunk_size)
+                data = store.get_blob(digest) if digest else bytes(length)
+                if len(data) != length:
+                    raise InvalidArgument(f"invalid chunk size: {idx}")
+                proc.stdin.write(data)
+                tput.add(length)
+                tput.report("restore")
+    except BaseException:
+        _log.warning("restore failed, remove volume: %s", volume)
+        lv.delete()
+        raise
+    res = dict(name=name, volume=volume, size=size, elapsed=tput.elapsed, throughput=tput.rate)
+    _log.info("volume restored: %s", res)
+    return res
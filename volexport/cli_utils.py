@@ -1,6 +1,5 @@
 import click
 import json
-import yaml
 import pprint
 import functools
 from decimal import Decimal
@@ -56,6 +55,8 @@ def output_format(func):
         elif format == "pjson":
             click.echo(json.dumps(res, indent=2, ensure_ascii=False))
         elif format == "yaml":
+            import yaml
+
             click.echo(yaml.dump(res, allow_unicode=True, encoding="utf-8"))
         elif format == "pprint":
             click.echo(pprint.pformat(res))
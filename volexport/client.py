@@ -1,25 +1,132 @@
+import asyncio
 import click
 import requests
 import functools
+import socket
+import threading
+import time
+import urllib3
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
 from pathlib import Path
-from urllib.parse import urljoin, urlparse
+from urllib.parse import urljoin, urlparse, quote, unquote
+from requests.adapters import HTTPAdapter
 from logging import getLogger
 from .cli_utils import verbose_option, SizeType, output_format
 from .util import runcmd
 from .version import VERSION
 
 _log = getLogger(__name__)
+DEADLINE_HEADER = "X-Volexp-Timeout"
+GENERATION_HEADER = "X-Volexp-Generation"
+UNIX_SCHEME = "http+unix://"
+DEFAULT_POOL_SIZE = 32
+# absolute deadline of current call (time.monotonic() based), propagated to server
+request_deadline: ContextVar[float | None] = ContextVar("request_deadline", default=None)
+
+
+class _UnixConnection(urllib3.connection.HTTPConnection):
+    def __init__(self, sockpath: str, **kwargs):
+        super().__init__("localhost", **kwargs)
+        self.sockpath = sockpath
+
+    def _new_conn(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if isinstance(self.timeout, (int, float)):
+            sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.sockpath)
+        except BaseException:
+            sock.close()
+            raise
+        return sock
+
+
+class _UnixConnectionPool(urllib3.HTTPConnectionPool):
+    def __init__(self, sockpath: str, **kwargs):
+        super().__init__("localhost", **kwargs)
+        self.sockpath = sockpath
+
+    def _new_conn(self):
+        self.num_connections += 1
+        return _UnixConnection(self.sockpath, timeout=self.timeout.connect_timeout)
+
+
+class UnixAdapter(HTTPAdapter):
+    """HTTP over unix domain socket, http+unix://(quoted socket path)/(path)"""
+
+    def __init__(self, **kwargs):
+        self._unix_pools: dict[str, _UnixConnectionPool] = {}
+        self._unix_lock = threading.Lock()
+        super().__init__(**kwargs)
+
+    def get_connection_with_tls_context(self, request, verify, proxies=None, cert=None):
+        sockpath = unquote(urlparse(request.url).netloc)
+        with self._unix_lock:
+            pool = self._unix_pools.get(sockpath)
+            if pool is None:
+                pool = _UnixConnectionPool(sockpath, maxsize=self._pool_maxsize, block=self._pool_block)
+                self._unix_pools[sockpath] = pool
+            return pool
+
+    def request_url(self, request, proxies):
+        return request.path_url
+
+    def close(self):
+        super().close()
+        with self._unix_lock:
+            for pool in self._unix_pools.values():
+                pool.close()
+            self._unix_pools.clear()
 
 
 class VERequest(requests.Session):
-    def __init__(self, baseurl: str):
+    """volexport API session: keep-alive pool of pool_size connections, default timeout (connect, read)
+
+    baseurl may be unix://(socket path) to connect volexport listening on unix socket
+    """
+
+    def __init__(
+        self,
+        baseurl: str,
+        pool_size: int | None = None,
+        timeout: float | tuple[float, float] | None = None,
+    ):
         super().__init__()
+        if baseurl.startswith("unix://"):
+            baseurl = UNIX_SCHEME + quote(baseurl.removeprefix("unix://"), safe="") + "/"
         self.baseurl = baseurl
+        self.timeout = timeout
+        size = pool_size or DEFAULT_POOL_SIZE
+        # block: wait for a free connection instead of opening one to be discarded
+        for prefix, adapter in (
+            ("http://", HTTPAdapter),
+            ("https://", HTTPAdapter),
+            (UNIX_SCHEME, UnixAdapter),
+        ):
+            self.mount(prefix, adapter(pool_maxsize=size, pool_block=True))
 
     def request(self, method, path, *args, **kwargs):
-        url = urljoin(self.baseurl.removesuffix("/") + "/", path.removeprefix("/"))
+        if self.baseurl.startswith(UNIX_SCHEME):
+            # urljoin does not know the scheme
+            url = self.baseurl.removesuffix("/") + "/" + path.removeprefix("/")
+        else:
+            url = urljoin(self.baseurl.removesuffix("/") + "/", path.removeprefix("/"))
+        limit = request_deadline.get()
+        if limit is not None:
+            remaining = limit - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(f"deadline exceeded: {method} {url}")
+            kwargs["headers"] = {**(kwargs.get("headers") or {}), DEADLINE_HEADER: f"{remaining:.3f}"}
+            kwargs.setdefault("timeout", remaining)
+        if self.timeout is not None:
+            kwargs.setdefault("timeout", self.timeout)
         _log.debug("request: method=%s url=%s args=%s", method, url, kwargs.get("json") or kwargs.get("data"))
         res = super().request(method, url, *args, **kwargs)
+        if kwargs.get("stream"):
+            # body is consumed by caller
+            _log.debug("response(stream): method=%s url=%s code=%s", method, url, res.status_code)
+            return res
         try:
             _log.debug(
                 "response(json): elapsed=%s method=%s url=%s code=%s, body=%s",
@@ -45,6 +152,75 @@ class VERequest(requests.Session):
         return res
 
 
+class AsyncVERequest:
+    """volexport API client of the asyncio CSI server (httpx), same pool, timeout and baseurl as VERequest"""
+
+    def __init__(
+        self,
+        baseurl: str,
+        pool_size: int | None = None,
+        timeout: float | tuple[float, float] | None = None,
+    ):
+        import httpx
+
+        size = pool_size or DEFAULT_POOL_SIZE
+        uds = None
+        if baseurl.startswith("unix://"):
+            uds = baseurl.removeprefix("unix://")
+            baseurl = "http://localhost"
+        self.baseurl = baseurl
+        if isinstance(timeout, tuple):
+            tmo = httpx.Timeout(timeout[1], connect=timeout[0], pool=None)
+        else:
+            tmo = httpx.Timeout(timeout, pool=None)
+        limits = httpx.Limits(max_connections=size, max_keepalive_connections=size)
+        self.client = httpx.AsyncClient(
+            base_url=baseurl, timeout=tmo, transport=httpx.AsyncHTTPTransport(uds=uds, limits=limits)
+        )
+        # callers wait here for a free connection (the gRPC deadline cancels the wait):
+        # each waiter in the httpx pool costs O(waiters) per request, slow in a burst
+        self._slots = asyncio.Semaphore(size)
+
+    def _args(self, method: str, path: str, kwargs: dict) -> str:
+        limit = request_deadline.get()
+        if limit is not None:
+            remaining = limit - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(f"deadline exceeded: {method} {path}")
+            kwargs["headers"] = {**(kwargs.get("headers") or {}), DEADLINE_HEADER: f"{remaining:.3f}"}
+            kwargs.setdefault("timeout", remaining)
+        url = "/" + path.removeprefix("/")
+        _log.debug("request: method=%s url=%s args=%s", method, url, kwargs.get("json"))
+        return url
+
+    async def request(self, method: str, path: str, **kwargs):
+        url = self._args(method, path, kwargs)
+        async with self._slots:
+            res = await self.client.request(method, url, **kwargs)
+        _log.debug("response: method=%s url=%s code=%s, body=%s", method, url, res.status_code, res.text)
+        return res
+
+    async def get(self, path: str, **kwargs):
+        return await self.request("GET", path, **kwargs)
+
+    async def post(self, path: str, **kwargs):
+        return await self.request("POST", path, **kwargs)
+
+    async def delete(self, path: str, **kwargs):
+        return await self.request("DELETE", path, **kwargs)
+
+    @asynccontextmanager
+    async def stream(self, method: str, path: str, **kwargs):
+        """Response whose body is read by caller"""
+        url = self._args(method, path, kwargs)
+        async with self._slots, self.client.stream(method, url, **kwargs) as res:
+            _log.debug("response(stream): method=%s url=%s code=%s", method, url, res.status_code)
+            yield res
+
+    async def aclose(self):
+        await self.client.aclose()
+
+
 def client_option(func):
     @functools.wraps(func)
     def wrap(endpoint, *args, **kwargs):
@@ -92,9 +268,11 @@ def volume_stats(req):
 @output_format
 @click.option("--name", required=True, help="volume name")
 @click.option("--size", type=SizeType(), help="volume size", required=True)
-def volume_create(req, name, size):
+@click.option("--filesystem", help="make filesystem (formatted spare volume is used if available)")
+@click.option("--from-template", is_flag=True, help="snapshot of formatted template instead of mkfs (thin pool)")
+def volume_create(req, name, size, filesystem, from_template):
     """create new volume"""
-    res = req.post("/volume", json=dict(name=name, size=size))
+    res = req.post("/volume", json=dict(name=name, size=size, filesystem=filesystem, from_template=from_template))
     res.raise_for_status()
     return res.json()
 
@@ -130,9 +308,11 @@ def volume_readonly(req, name, readonly):
 @output_format
 @click.option("--name", required=True, help="volume name")
 @click.option("--size", type=SizeType(), help="volume size", required=True)
-def volume_resize(req, name, size):
+@click.option("--async", "async_", is_flag=True, help="run as background job")
+def volume_resize(req, name, size, async_):
     """resize volume"""
-    res = req.post(f"/volume/{name}", json=dict(size=size))
+    opts = dict(params={"async": "1"}) if async_ else dict()
+    res = req.post(f"/volume/{name}", json=dict(size=size), **opts)
     res.raise_for_status()
     return res.json()
 
@@ -144,9 +324,11 @@ def volume_resize(req, name, size):
 @click.option("--name", required=True, help="volume name")
 @click.option("--filesystem", default="ext4", help="filesystem")
 @click.option("--label")
-def volume_mkfs(req, name, filesystem, label):
+@click.option("--async", "async_", is_flag=True, help="run as background job")
+def volume_mkfs(req, name, filesystem, label, async_):
     """mkfs volume"""
-    res = req.post(f"/volume/{name}/mkfs", json=dict(filesystem=filesystem, label=label))
+    opts = dict(params={"async": "1"}) if async_ else dict()
+    res = req.post(f"/volume/{name}/mkfs", json=dict(filesystem=filesystem, label=label), **opts)
     res.raise_for_status()
     return res.json()
 
@@ -163,6 +345,22 @@ def volume_delete(req, name):
     return res.json()
 
 
+@cli.command()
+@verbose_option
+@client_option
+@output_format
+@click.option("--name", required=True, help="new volume name")
+@click.option("--source", required=True, help="source volume name")
+@click.option("--size", type=SizeType(), help="volume size (default: same as source)")
+@click.option("--async", "async_", is_flag=True, help="run as background job")
+def volume_clone(req, name, source, size, async_):
+    """clone volume"""
+    opts = dict(params={"async": "1"}) if async_ else dict()
+    res = req.post(f"/volume/{source}/clone", json=dict(name=name, size=size), **opts)
+    res.raise_for_status()
+    return res.json()
+
+
 @cli.command()
 @verbose_option
 @client_option
@@ -181,12 +379,23 @@ def snapshot_create(req, name, parent, size):
 @verbose_option
 @client_option
 @output_format
-@click.option("--parent", required=True, help="parent volume name")
+@click.option("--parent", help="parent volume name (default: all volumes)")
 def snapshot_list(req, parent):
     """list snapshot"""
-    res = req.get(f"/volume/{parent}/snapshot")
-    res.raise_for_status()
-    return res.json()
+    if parent:
+        res = req.get(f"/volume/{parent}/snapshot")
+        res.raise_for_status()
+        return res.json()
+    entries = []
+    params = {}
+    while True:
+        res = req.get("/snapshot", params=params)
+        res.raise_for_status()
+        data = res.json()
+        entries.extend(data["entries"])
+        if not data.get("next"):
+            return entries
+        params["after"] = data["next"]
 
 
 @cli.command()
@@ -215,6 +424,58 @@ def snapshot_delete(req, name, parent):
     return res.json()
 
 
+@cli.command()
+@verbose_option
+@client_option
+@output_format
+@click.option("--name", required=True, help="snapshot name")
+@click.option("--parent", required=True, help="parent volume name")
+@click.option("--async", "async_", is_flag=True, help="run as background job")
+def snapshot_rollback(req, name, parent, async_):
+    """rollback volume to snapshot"""
+    param = {"async": "1"} if async_ else dict()
+    res = req.post(f"/volume/{parent}/snapshot/{name}/rollback", params=param)
+    res.raise_for_status()
+    return res.json()
+
+
+@cli.command()
+@verbose_option
+@client_option
+@output_format
+@click.option("--volume", help="volume name")
+def job_list(req, volume):
+    """list jobs"""
+    param = dict(volume=volume) if volume else dict()
+    res = req.get("/jobs", params=param)
+    res.raise_for_status()
+    return res.json()
+
+
+@cli.command()
+@verbose_option
+@client_option
+@output_format
+@click.option("--id", "jobid", required=True, help="job id")
+def job_read(req, jobid):
+    """show job status"""
+    res = req.get(f"/jobs/{jobid}")
+    res.raise_for_status()
+    return res.json()
+
+
+@cli.command()
+@verbose_option
+@client_option
+@output_format
+@click.option("--id", "jobid", required=True, help="job id")
+def job_cancel(req, jobid):
+    """cancel job"""
+    res = req.delete(f"/jobs/{jobid}")
+    res.raise_for_status()
+    return res.json()
+
+
 @cli.command()
 @verbose_option
 @client_option
@@ -387,10 +648,10 @@ def backup_restore(req, name):
 @client_option
 @output_format
 @click.option("--name", required=True, help="name of backup")
-@click.option("--input", type=click.File("r"))
+@click.option("--input", type=click.File("rb"))
 def backup_put(req, name, input):
     """write backup data"""
-    res = req.put(f"/mgmt/backup/{name}", data=input.read())
+    res = req.put(f"/mgmt/backup/{name}", data=input)
     res.raise_for_status()
     return res.json()
 
@@ -400,9 +661,13 @@ def backup_put(req, name, input):
 @client_option
 @output_format
 @click.option("--keep", type=int, default=2, show_default=True)
-def backup_forget(req, keep):
+@click.option("--max-age", type=float, help="also delete backups older than seconds")
+def backup_forget(req, keep, max_age):
     """forget old backups"""
-    res = req.delete("/mgmt/backup", params=dict(keep=keep))
+    param: dict = dict(keep=keep)
+    if max_age is not None:
+        param["max_age"] = max_age
+    res = req.delete("/mgmt/backup", params=param)
     res.raise_for_status()
     return res.json()
 
@@ -419,6 +684,62 @@ def backup_delete(req, name):
     return res.json()
 
 
+@cli.command()
+@verbose_option
+@client_option
+@output_format
+@click.option("--volume", required=True, help="volume name")
+@click.option("--name", help="name of backup")
+@click.option("--snapshot-size", type=SizeType(), help="size of snapshot CoW (thick volume)")
+@click.option("--incremental/--full", default=False, help="copy only changed blocks (thin volume)")
+def volume_backup_create(req, volume, name, snapshot_size, incremental):
+    """backup volume data (returns job)"""
+    res = req.post(
+        "/mgmt/volume-backup",
+        json=dict(volume=volume, name=name, snapshot_size=snapshot_size, incremental=incremental),
+    )
+    res.raise_for_status()
+    return res.json()
+
+
+@cli.command()
+@verbose_option
+@client_option
+@output_format
+@click.option("--volume", help="volume name")
+def volume_backup_list(req, volume):
+    """list volume data backups"""
+    param = dict(volume=volume) if volume else dict()
+    res = req.get("/mgmt/volume-backup", params=param)
+    res.raise_for_status()
+    return res.json()
+
+
+@cli.command()
+@verbose_option
+@client_option
+@output_format
+@click.option("--name", required=True, help="name of backup")
+@click.option("--volume", required=True, help="name of new volume")
+def volume_backup_restore(req, name, volume):
+    """restore volume data backup into a new volume (returns job)"""
+    res = req.post(f"/mgmt/volume-backup/{name}/restore", json=dict(volume=volume))
+    res.raise_for_status()
+    return res.json()
+
+
+@cli.command()
+@verbose_option
+@client_option
+@output_format
+@click.option("--name", required=True, help="name of backup")
+def volume_backup_delete(req, name):
+    """delete volume data backup"""
+    res = req.delete(f"/mgmt/volume-backup/{name}")
+    res.raise_for_status()
+    return res.json()
+
+
 def iscsiadm(**kwargs):
     arg = ["iscsiadm"]
     for k, v in kwargs.items():
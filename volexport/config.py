@@ -1,12 +1,20 @@
 import os
 from pathlib import Path
 from typing_extensions import Annotated
-from pydantic import AfterValidator, Field
+from pydantic import AfterValidator, BaseModel, Field
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 HomePath = Annotated[Path, AfterValidator(lambda v: v.expanduser())]
 
 
+class WarmPoolSpec(BaseModel):
+    """Size class of spare volumes"""
+
+    size: int = Field(description="Size of spare volumes in bytes, serves requests up to this size", gt=0)
+    filesystem: str | None = Field(default=None, description="Filesystem made in spare volumes")
+    count: int = Field(default=1, description="Number of spare volumes to keep", ge=0)
+
+
 class Config(BaseSettings):
     """Configuration settings for the volexport application."""
 
@@ -20,7 +28,48 @@ class Config(BaseSettings):
     LVM_THINPOOL: str | None = Field(default=None, description="LVM2 thinpool")
     IQN_BASE: str = Field(default="iqn.2025-08.com.github.wtnb75", description="Base IQN for iSCSI targets")
     CMD_TIMEOUT: float = Field(default=10.0, description="Timeout for commands in seconds")
+    CMD_TIMEOUT_CLASS: dict[str, float] = Field(
+        default={"mkfs": 600.0},
+        description="Timeout per command class in seconds (lvm_read, lvm_write, tgtd_read, tgtd_write, mkfs, other)",
+    )
+    CMD_MIN_TIME: float = Field(default=0.1, description="Reject commands if remaining request time is below this")
+    CMD_CONCURRENCY: dict[str, int] = Field(
+        default={"lvm_read": 8, "lvm_write": 2, "tgtd": 4, "mkfs": 2},
+        description="Max concurrent commands per subsystem (lvm_read, lvm_write, tgtd, mkfs)",
+    )
+    CMD_QUEUE: dict[str, int] = Field(
+        default={"lvm_read": 32, "lvm_write": 8, "tgtd": 16, "mkfs": 4},
+        description="Max commands of jobs and services waiting per subsystem, API requests do not wait (429)",
+    )
+    RETRY_AFTER: int = Field(default=1, description="Retry-After seconds for 429 responses")
     BACKUP_DIR: str = Field(default="/tmp", description="backup directory")
+    BACKUP_MAX_SIZE: int = Field(default=64 * 1024 * 1024, description="Max size of uploaded backup file in bytes")
+    BACKUP_CHUNK_SIZE: int = Field(default=4 * 1024 * 1024, description="Chunk size of volume data backup in bytes")
+    BACKUP_WORKERS: int = Field(default=2, description="Number of processes to compress volume data backup")
+    BACKUP_SCHEDULE: str | None = Field(default=None, description='Cron-like schedule of backup, e.g., "0 3 * * *"')
+    BACKUP_DEBOUNCE: float | None = Field(default=None, description="Backup after changes settled for seconds")
+    BACKUP_MIN_INTERVAL: float = Field(default=300.0, description="Min seconds between backups after changes")
+    BACKUP_KEEP: int | None = Field(default=None, description="Number of backups to keep by scheduler")
+    BACKUP_MAX_AGE: float | None = Field(default=None, description="Delete backups older than seconds by scheduler")
+    EXPORT_STATE: str | None = Field(
+        default=None, description="File to keep desired exports, re-created after tgtd restart"
+    )
+    TGTD_WATCH_INTERVAL: float | None = Field(default=5.0, description="Seconds between tgtd checks for lost exports")
+    STATE_DB: str | None = Field(default=None, description="SQLite file to keep volume and export metadata")
+    STATE_RECONCILE_INTERVAL: float | None = Field(
+        default=300.0, description="Seconds between reconciling state db with LVM and tgtd"
+    )
+    WARM_POOL: list[WarmPoolSpec] = Field(
+        default=[],
+        description='Spare volumes to keep created and formatted, e.g. [{"size": 10737418240, "filesystem": "ext4"}]',
+    )
+    WARM_POOL_INTERVAL: float = Field(default=30.0, description="Seconds between warm pool checks")
+    TEMPLATE_SIZES: list[int] = Field(
+        default=[1073741824], description="Sizes of golden template volumes for from_template, made on first use"
+    )
+    JOB_WORKERS: int = Field(default=2, description="Number of workers for background jobs")
+    JOB_QUEUE: int = Field(default=16, description="Max queued background jobs, reject with 429 if exceeded")
+    JOB_HISTORY: int = Field(default=100, description="Number of finished jobs to keep")
 
 
 config = Config()  # type: ignore
@@ -1,2 +1,14 @@
 class InvalidArgument(Exception):
     pass
+
+
+class OperationPending(Exception):
+    pass
+
+
+class Cancelled(Exception):
+    pass
+
+
+class Busy(Exception):
+    pass
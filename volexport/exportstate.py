@@ -0,0 +1,205 @@
+import os
+import json
+import time
+import datetime
+import threading
+import tempfile
+from pathlib import Path
+from subprocess import SubprocessError
+from logging import getLogger
+from .config import config
+from .tgtd import Tgtd
+from .metrics import registry
+
+_log = getLogger(__name__)
+# serialize export/unexport and recovery, so that watchdog never sees half-done changes
+lock = threading.RLock()
+
+tgtd_down = registry.counter("volexp_tgtd_down_total", "Number of times tgtd became unreachable")
+recovery_total = registry.counter("volexp_export_recovery_total", "Number of export recoveries", ["result"])
+recovered_targets = registry.counter("volexp_export_recovered_targets_total", "Number of re-created targets")
+recovery_seconds = registry.histogram("volexp_export_recovery_seconds", "Time to re-create missing exports")
+desired_targets = registry.gauge("volexp_export_desired_targets", "Number of exports in desired state")
+
+
+def _path() -> Path | None:
+    if not config.EXPORT_STATE:
+        return None
+    return Path(config.EXPORT_STATE)
+
+
+def entries() -> list[dict]:
+    """Desired exports"""
+    path = _path()
+    if path is None or not path.exists():
+        return []
+    return json.loads(path.read_text()).get("exports", [])
+
+
+def _save(exports: list[dict]):
+    path = _path()
+    assert path is not None
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # contains CHAP passwords
+    fd, tmpname = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.")
+    try:
+        with os.fdopen(fd, "w") as ofp:
+            json.dump(dict(version=1, exports=exports), ofp, indent=2)
+        os.replace(tmpname, path)
+    except BaseException:
+        os.unlink(tmpname)
+        raise
+    desired_targets.set(len(exports))
+
+
+def add(export: dict, volume: str, path: str, node: str | None = None):
+    """Record a created export"""
+    if _path() is None:
+        return
+    ent = dict(
+        targetname=export["targetname"],
+        volume=volume,
+        path=path,
+        lun=export["lun"],
+        user=export["user"],
+        passwd=export["passwd"],
+        acl=export["acl"],
+        node=node,
+        bstype=config.TGT_BSTYPE,
+        bsopts=config.TGT_BSOPTS,
+        bsoflags=config.TGT_BSOFLAGS,
+        created=datetime.datetime.now(tz=datetime.timezone.utc).isoformat(),
+    )
+    with lock:
+        exports = [x for x in entries() if x["targetname"] != ent["targetname"]]
+        exports.append(ent)
+        _save(exports)
+
+
+def remove(targetname: str) -> bool:
+    """Forget a deleted export, returns True if it was recorded"""
+    if _path() is None:
+        return False
+    with lock:
+        exports = entries()
+        rest = [x for x in exports if x["targetname"] != targetname]
+        if len(rest) == len(exports):
+            return False
+        _save(rest)
+        return True
+
+
+def _quote(value) -> str:
+    value = str(value)
+    if any(x in value for x in " \t#<>\"'"):
+        return '"' + value.replace('"', '\\"') + '"'
+    return value
+
+
+def tgtconf(exports: list[dict]) -> str:
+    """tgt-admin configuration of exports"""
+    res = []
+    for ent in exports:
+        res.append(f"<target {ent['targetname']}>")
+        res.append(f"    <backing-store {ent['path']}>")
+        res.append(f"        lun {ent['lun']}")
+        res.append(f"        bs-type {ent['bstype']}")
+        if ent.get("bsopts"):
+            res.append(f"        bsopts {_quote(ent['bsopts'])}")
+        if ent.get("bsoflags"):
+            res.append(f"        bsoflags {_quote(ent['bsoflags'])}")
+        res.append("        vendor_id VOLEXP")
+        res.append(f"        product_id {_quote(Path(ent['path']).name)}")
+        res.append("    </backing-store>")
+        res.append(f"    incominguser {_quote(ent['user'])} {_quote(ent['passwd'])}")
+        for addr in ent["acl"]:
+            res.append(f"    initiator-address {addr}")
+        res.append("</target>")
+    return "\n".join(res) + "\n"
+
+
+class TgtdWatchdog:
+    """Re-create exports in desired state after tgtd restart"""
+
+    def __init__(self, poll: float = 5.0):
+        self.poll = poll
+        self.down = False
+        self.last_targets: int | None = None
+        self.last_recovery: float | None = None
+        self.last_error: str | None = None
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name="volexp-tgtd-watchdog", daemon=True)
+        self._thread.start()
+        _log.info("tgtd watchdog started: poll=%s", self.poll)
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def run_once(self) -> int:
+        """Check tgtd and re-create missing exports in one tgt-admin run, returns number of re-created"""
+        with lock:
+            try:
+                live = {tgt.get("name") for tgt in Tgtd().target_list().values() if tgt}
+            except (SubprocessError, OSError) as e:
+                if not self.down:
+                    _log.warning("tgtd is not available: %s", e)
+                    tgtd_down.inc()
+                self.down = True
+                return 0
+            if self.down:
+                _log.info("tgtd is available: targets=%s", len(live))
+            elif self.last_targets is not None and len(live) < self.last_targets:
+                _log.warning("number of targets dropped: %s -> %s", self.last_targets, len(live))
+            self.down = False
+            self.last_targets = len(live)
+            desired = entries()
+            desired_targets.set(len(desired))
+            missing = []
+            for ent in desired:
+                if ent["targetname"] in live:
+                    continue
+                if not Path(ent["path"]).exists():
+                    _log.warning("volume does not exists, skip: %s (%s)", ent["volume"], ent["path"])
+                    continue
+                missing.append(ent)
+            if not missing:
+                return 0
+            start = time.perf_counter()
+            try:
+                Tgtd().restore(tgtconf(missing))
+            except (SubprocessError, OSError) as e:
+                _log.warning("failed to re-create exports: %s", [x["targetname"] for x in missing], exc_info=e)
+                self.last_error = f"{type(e).__qualname__}: {e}"
+                recovery_total.inc(result="error")
+                return 0
+            elapsed = time.perf_counter() - start
+            recovery_seconds.observe(elapsed)
+            recovery_total.inc(result="ok")
+            recovered_targets.inc(len(missing))
+            self.last_recovery = elapsed
+            self.last_error = None
+            self.last_targets = len(live) + len(missing)
+            _log.warning("re-created %s exports in %.3f sec", len(missing), elapsed)
+            return len(missing)
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                _log.warning("tgtd watchdog error", exc_info=e)
+            self._stop.wait(self.poll)
+
+
+def tgtd_watchdog() -> TgtdWatchdog | None:
+    """Watchdog from configuration, None if export state is disabled"""
+    if not config.EXPORT_STATE or not config.TGTD_WATCH_INTERVAL:
+        return None
+    return TgtdWatchdog(poll=config.TGTD_WATCH_INTERVAL)
@@ -0,0 +1,218 @@
+import datetime
+import threading
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, Future
+from contextvars import Context, ContextVar, copy_context
+from enum import Enum
+from typing import Callable, Any
+from logging import getLogger
+from .config import config
+from .exceptions import Cancelled, Busy
+from .util import deadline, cancel_event, slot_wait
+
+_log = getLogger(__name__)
+
+
+class JobStatus(str, Enum):
+    """status of background job"""
+
+    queued = "queued"
+    running = "running"
+    succeeded = "succeeded"
+    failed = "failed"
+    cancelled = "cancelled"
+
+
+class JobCancelled(Cancelled):
+    pass
+
+
+class Job:
+    """Long-running operation executed in the job worker pool"""
+
+    def __init__(self, name: str, volume: str | None = None):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.volume = volume
+        self.status = JobStatus.queued
+        self.progress = 0.0
+        self.message: str | None = None
+        self.result: Any = None
+        self.error: str | None = None
+        self.created = datetime.datetime.now(tz=datetime.timezone.utc)
+        self.started: datetime.datetime | None = None
+        self.finished: datetime.datetime | None = None
+        self.cancel_event = threading.Event()
+        self.future: Future | None = None
+
+    @property
+    def done(self) -> bool:
+        return self.status in (JobStatus.succeeded, JobStatus.failed, JobStatus.cancelled)
+
+    def set_progress(self, progress: float, message: str | None = None):
+        """Update progress (0.0 - 1.0), raise JobCancelled if cancel requested"""
+        self.progress = max(0.0, min(1.0, progress))
+        if message is not None:
+            self.message = message
+        if self.cancel_event.is_set():
+            raise JobCancelled(f"job cancelled: {self.id}")
+
+    def to_dict(self) -> dict:
+        return dict(
+            id=self.id,
+            name=self.name,
+            volume=self.volume,
+            status=self.status.value,
+            progress=self.progress,
+            message=self.message,
+            result=self.result,
+            error=self.error,
+            created=self.created.isoformat(),
+            started=self.started.isoformat() if self.started else None,
+            finished=self.finished.isoformat() if self.finished else None,
+        )
+
+
+current_job: ContextVar[Job | None] = ContextVar("current_job", default=None)
+
+
+def progress(value: float, message: str | None = None):
+    """Update progress of the running job (no-op outside of job)"""
+    job = current_job.get()
+    if job is not None:
+        job.set_progress(value, message)
+
+
+class JobManager:
+    """Bounded worker pool and result store for background jobs"""
+
+    def __init__(self, workers: int, history: int, queue: int):
+        self.workers = workers
+        self.history = history
+        self.queue = queue
+        self._executor: ThreadPoolExecutor | None = None
+        self._jobs: OrderedDict[str, Job] = OrderedDict()
+        # jobs waiting for the running job of the same volume
+        self._volumes: dict[str, deque[tuple[Job, Context, Callable[[], Any]]]] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="volexp-job")
+        return self._executor
+
+    def submit(self, name: str, fn: Callable[[], Any], volume: str | None = None) -> Job:
+        """Submit a function as a new job, jobs of the same volume run one at a time in order"""
+        job = Job(name, volume)
+        ctx = copy_context()
+        with self._lock:
+            queued = sum(1 for x in self._jobs.values() if x.status == JobStatus.queued)
+            if queued >= self.queue:
+                raise Busy(f"too many queued jobs: {queued}")
+            self._jobs[job.id] = job
+            self._expire()
+            if volume is not None:
+                if volume in self._volumes:
+                    # started by _next() when the previous job finishes
+                    self._volumes[volume].append((job, ctx, fn))
+                    _log.info("job waits for volume: id=%s, name=%s, volume=%s", job.id, name, volume)
+                    return job
+                self._volumes[volume] = deque()
+            job.future = self.executor.submit(ctx.run, self._start, job, fn)
+        _log.info("job submitted: id=%s, name=%s", job.id, name)
+        return job
+
+    def _next(self, volume: str | None):
+        """Start the next job of the volume"""
+        if volume is None:
+            return
+        with self._lock:
+            waiting = self._volumes.get(volume)
+            if not waiting:
+                self._volumes.pop(volume, None)
+                return
+            job, ctx, fn = waiting.popleft()
+            job.future = self.executor.submit(ctx.run, self._start, job, fn)
+        _log.info("job submitted: id=%s, name=%s", job.id, job.name)
+
+    def _start(self, job: Job, fn: Callable[[], Any]):
+        try:
+            self._run(job, fn)
+        finally:
+            self._next(job.volume)
+
+    def _run(self, job: Job, fn: Callable[[], Any]):
+        if job.cancel_event.is_set():
+            job.status = JobStatus.cancelled
+            job.finished = datetime.datetime.now(tz=datetime.timezone.utc)
+            return
+        token = current_job.set(job)
+        # jobs outlive the request which started them
+        deadline.set(None)
+        cancel_event.set(job.cancel_event)
+        # on its own worker, may wait for a command slot
+        slot_wait.set(True)
+        job.status = JobStatus.running
+        job.started = datetime.datetime.now(tz=datetime.timezone.utc)
+        try:
+            job.result = fn()
+            job.progress = 1.0
+            job.status = JobStatus.succeeded
+        except Cancelled as e:
+            _log.info("job cancelled: id=%s, name=%s", job.id, job.name)
+            job.error = str(e)
+            job.status = JobStatus.cancelled
+        except Exception as e:
+            _log.warning("job failed: id=%s, name=%s", job.id, job.name, exc_info=e)
+            job.error = f"{type(e).__qualname__}: {e}"
+            job.status = JobStatus.failed
+        finally:
+            job.finished = datetime.datetime.now(tz=datetime.timezone.utc)
+            current_job.reset(token)
+        _log.info("job finished: id=%s, name=%s, status=%s", job.id, job.name, job.status.value)
+
+    def _expire(self):
+        finished = [k for k, v in self._jobs.items() if v.done]
+        for k in finished[: max(0, len(finished) - self.history)]:
+            del self._jobs[k]
+
+    def get(self, jobid: str) -> Job:
+        """Get a job by id"""
+        job = self._jobs.get(jobid)
+        if job is None:
+            raise FileNotFoundError(f"job not found: {jobid}")
+        return job
+
+    def list(self, volume: str | None = None) -> list[Job]:
+        """List jobs"""
+        with self._lock:
+            res = list(self._jobs.values())
+        if volume is not None:
+            res = [x for x in res if x.volume == volume]
+        return res
+
+    def cancel(self, jobid: str) -> Job:
+        """Request cancellation of a job, running command of the job is terminated"""
+        job = self.get(jobid)
+        if job.done:
+            return job
+        job.cancel_event.set()
+        if job.future is None:
+            # waiting for the volume, never started
+            with self._lock:
+                waiting = self._volumes.get(job.volume or "", deque())
+                if any(x[0] is job for x in waiting):
+                    self._volumes[job.volume or ""] = deque(x for x in waiting if x[0] is not job)
+                    job.status = JobStatus.cancelled
+                    job.finished = datetime.datetime.now(tz=datetime.timezone.utc)
+        elif job.future.cancel():
+            job.status = JobStatus.cancelled
+            job.finished = datetime.datetime.now(tz=datetime.timezone.utc)
+            self._next(job.volume)
+        _log.info("job cancel requested: id=%s, status=%s", job.id, job.status.value)
+        return job
+
+
+jobs = JobManager(workers=config.JOB_WORKERS, history=config.JOB_HISTORY, queue=config.JOB_QUEUE)
@@ -160,6 +160,9 @@ class LV(Base):
 
     mode = "lv"
     nametag_prefix = "volname."
+    clone_tag = "volexp.clone"
+    warm_tag = "volexp.warm"
+    template_tag = "volexp.template"
 
     def __init__(self, vgname: str, name: str | None = None):
         super().__init__(name)
@@ -287,9 +290,55 @@ class LV(Base):
                 f"{self.vgname}/{parent}",
             ]
         )
-        runcmd(["lvchange", "--activate", "y", f"/dev/{self.vgname}/{self.name}", "--ignoreactivationskip"])
+        # thin snapshots are skipped in activation by default
+        runcmd(["lvchange", "--activate", "y", "--ignoreactivationskip", f"{self.vgname}/{name}"])
         return self.volume_read()
 
+    def create_thinclone(self, parent: str, size: int | None = None) -> dict | None:
+        """Create a writable thin snapshot of the volume, listed as an independent volume"""
+        assert self.name is not None
+        src = LV(self.vgname, parent).get()
+        if src is None:
+            raise FileNotFoundError(f"volume does not exists: {parent}")
+        self.create_thinclone_of(src["lv_name"])
+        if size is not None and size > int(src["lv_size"]):
+            self.resize(size)
+        return self.volume_read()
+
+    def create_thinclone_of(self, lv_name: str):
+        """Create a writable thin snapshot of the logical volume as the volume"""
+        assert self.name is not None
+        name = str(uuid.uuid4())
+        runcmd(
+            [
+                "lvcreate",
+                "--snapshot",
+                "--setactivationskip",
+                "n",
+                "--permission",
+                "rw",
+                "--name",
+                name,
+                "--addtag",
+                self.tagname,
+                "--addtag",
+                self.clone_tag,
+                f"{self.vgname}/{lv_name}",
+            ]
+        )
+
+    def thin_id(self) -> int | None:
+        """Device id of the thin volume in its pool"""
+        cmd = ["lvs", "-o", "thin_id", "--reportformat", "json", "-S", f"tags={self.tagname}"]
+        if config.LVM_BIN:
+            cmd[0:0] = shlex.split(config.LVM_BIN)
+        res = json.loads(runcmd(cmd, root=True).stdout)
+        for i in res.get("report", []):
+            for ent in i.get("lv", []) + i.get("seg", []):
+                if ent.get("thin_id"):
+                    return int(ent["thin_id"])
+        return None
+
     def rollback_snapshot(self) -> dict | None:
         assert self.name is not None
         parent = self.get_parent()
@@ -330,20 +379,23 @@ class LV(Base):
             # not available
             _log.debug("not active: %s", vol["lv_name"])
             return None
+        if self.warm_tag in vol["lv_tags"].split(","):
+            # spare volume in warm pool
+            _log.debug("spare: %s", vol["lv_name"])
+            return None
+        if self.template_tag in vol["lv_tags"].split(","):
+            # golden template
+            _log.debug("template: %s", vol["lv_name"])
+            return None
         size = int(vol["lv_size"])
         readonly = vol["lv_permissions"] != "writeable"
-        parent = vol["origin"]
         thin = bool(vol["pool_lv"])
         used = bool(vol["lv_device_open"])
         tags = vol["lv_tags"]
-        for tag in tags.split(","):
-            if tag.startswith(self.nametag_prefix):
-                name = tag.removeprefix(self.nametag_prefix)
-                break
-        else:
-            name = vol["lv_name"]
+        # clone is a thin snapshot, but not a snapshot of the volume for users
+        parent = None if self.clone_tag in tags.split(",") else vol["origin"]
         return dict(
-            name=name,
+            name=self.name_of(vol),
             created=created.isoformat(),
             size=size,
             used=used,
@@ -354,6 +406,38 @@ class LV(Base):
             lvm_id=vol["lv_uuid"],
         )
 
+    def name_of(self, vol: dict) -> str:
+        """Volume name of the LVM report entry"""
+        for tag in vol["lv_tags"].split(","):
+            if tag.startswith(self.nametag_prefix):
+                return tag.removeprefix(self.nametag_prefix)
+        return vol["lv_name"]
+
+    def snapshot_list(self, source: str | None = None, name: str | None = None) -> list[dict]:
+        """List snapshots sorted by name, selected by LVM; parent is the volume name of the origin"""
+        if name is not None:
+            vol = LV(self.vgname, name).get()
+            vols = [vol] if vol is not None else []
+        elif source is not None:
+            src = LV(self.vgname, source).get()
+            if src is None:
+                return []
+            vols = runparse_report(mode="lv", filter=f"vg_name={self.vgname} && origin={src['lv_name']}")
+        else:
+            vols = runparse_report(mode="lv", filter=f'vg_name={self.vgname} && origin!=""')
+        origins = sorted({x["origin"] for x in vols if x.get("origin")})
+        names: dict[str, str] = {}
+        if origins:
+            cond = " || ".join(f"lv_name={x}" for x in origins)
+            for ent in runparse_report(mode="lv", filter=f"vg_name={self.vgname} && ({cond})"):
+                names[ent["lv_name"]] = self.name_of(ent)
+        res = []
+        for vol in vols:
+            ent = self.vol2dict(vol)
+            if ent is not None and ent["parent"]:
+                res.append(dict(ent, parent=names.get(ent["parent"], ent["parent"])))
+        return sorted(res, key=lambda x: x["name"])
+
     def volume_list(self):
         """List all logical volumes in the volume group"""
         vols = self.getlist()
@@ -402,17 +486,21 @@ class LV(Base):
 
     def format_volume(self, filesystem: str, label: str | None):
         """Format the logical volume to make filesystem"""
-        if shutil.which(f"mkfs.{filesystem}") is None:
-            _log.error("command does not found: mkfs.%s", filesystem)
-            raise NotImplementedError("not supported")
-
-        volpath = self.volume_vol2path()
-        if filesystem in ("ext4", "xfs", "exfat", "btrfs", "ntfs", "nilfs2"):
-            lbl = ["-L", label or self.name]
-            runcmd([f"mkfs.{filesystem}", *lbl, volpath])
-        elif filesystem in ("vfat",):
-            lbl = ["-n", label or self.name]
-            runcmd([f"mkfs.{filesystem}", *lbl, volpath])
-        else:
-            _log.error("no such filesystem: %s", filesystem)
-            raise NotImplementedError("not supported")
+        cmd = mkfs_cmd(filesystem, label or self.name)
+        runcmd([*cmd, self.volume_vol2path()])
+
+
+def mkfs_cmd(filesystem: str, label: str | None = None) -> list[str]:
+    """mkfs command line without device"""
+    if shutil.which(f"mkfs.{filesystem}") is None:
+        _log.error("command does not found: mkfs.%s", filesystem)
+        raise NotImplementedError("not supported")
+
+    if filesystem in ("ext4", "xfs", "exfat", "btrfs", "ntfs", "nilfs2"):
+        lbl = ["-L", label] if label else []
+        return [f"mkfs.{filesystem}", *lbl]
+    elif filesystem in ("vfat",):
+        lbl = ["-n", label] if label else []
+        return [f"mkfs.{filesystem}", *lbl]
+    _log.error("no such filesystem: %s", filesystem)
+    raise NotImplementedError("not supported")
@@ -0,0 +1,303 @@
+import re
+from dataclasses import dataclass, field
+from typing import Any
+from .exceptions import InvalidArgument
+
+# LVM2 text metadata format (vgcfgbackup, /etc/lvm/backup):
+#   key = value, name { ... }, values are "string", integer, float or [list]
+_TOKEN = re.compile(
+    r"""
+    (?P<space>[ \t\r\f\v]+)
+    |(?P<newline>\n)
+    |(?P<comment>\#[^\n]*)
+    |(?P<string>"(?:[^"\\]|\\.)*")
+    |(?P<number>-?[0-9]+(?:\.[0-9]+)?(?![\w.+\-:@]))
+    |(?P<ident>[\w.+\-:@]+)
+    |(?P<op>[={}\[\],])
+    |(?P<error>.)
+    """,
+    re.VERBOSE | re.DOTALL,
+)
+_UNESCAPE = re.compile(r"\\(.)", re.DOTALL)
+
+
+def tokenize(text: str) -> list[tuple[str, Any, int]]:
+    """Split LVM metadata into (kind, value, line) tokens"""
+    res: list[tuple[str, Any, int]] = []
+    line = 1
+    for m in _TOKEN.finditer(text):
+        kind = m.lastgroup
+        if kind == "space" or kind == "comment":
+            continue
+        if kind == "newline":
+            line += 1
+            continue
+        value = m.group()
+        if kind == "string":
+            line += value.count("\n")
+            value = value[1:-1]
+            if "\\" in value:
+                value = _UNESCAPE.sub(r"\1", value)
+        elif kind == "number":
+            value = float(value) if "." in value else int(value)
+        elif kind == "error":
+            raise InvalidArgument(f"lvm metadata: line {line}: unexpected character {value!r}")
+        res.append((kind, value, line))  # type: ignore[arg-type]
+    return res
+
+
+class _Parser:
+    def __init__(self, tokens: list[tuple[str, Any, int]]):
+        self.tokens = tokens
+        self.pos = 0
+
+    def error(self, msg: str):
+        if self.pos < len(self.tokens):
+            return InvalidArgument(f"lvm metadata: line {self.tokens[self.pos][2]}: {msg}")
+        return InvalidArgument(f"lvm metadata: unexpected end: {msg}")
+
+    def section(self, toplevel: bool) -> dict:
+        res: dict = {}
+        tokens = self.tokens
+        while self.pos < len(tokens):
+            kind, key, _ = tokens[self.pos]
+            if kind == "op" and key == "}" and not toplevel:
+                self.pos += 1
+                return res
+            if kind not in ("ident", "number"):
+                raise self.error(f"unexpected token {key!r}")
+            self.pos += 1
+            if self.pos >= len(tokens):
+                raise self.error(f"expected '=' or '{{' after {key!r}")
+            op = tokens[self.pos][1] if tokens[self.pos][0] == "op" else None
+            self.pos += 1
+            if op == "=":
+                res[str(key)] = self.value()
+            elif op == "{":
+                res[str(key)] = self.section(False)
+            else:
+                self.pos -= 1
+                raise self.error(f"expected '=' or '{{' after {key!r}")
+        if not toplevel:
+            raise self.error("missing '}'")
+        return res
+
+    def value(self) -> Any:
+        if self.pos >= len(self.tokens):
+            raise self.error("missing value")
+        kind, value, _ = self.tokens[self.pos]
+        self.pos += 1
+        if kind == "string" or kind == "number":
+            return value
+        if value != "[":
+            self.pos -= 1
+            raise self.error(f"unexpected value {value!r}")
+        res = []
+        while True:
+            if self.pos >= len(self.tokens):
+                raise self.error("missing ']'")
+            if self.tokens[self.pos][:2] == ("op", "]"):
+                self.pos += 1
+                return res
+            kind, value, _ = self.tokens[self.pos]
+            if kind != "string" and kind != "number":
+                raise self.error(f"unexpected list item {value!r}")
+            res.append(value)
+            self.pos += 1
+            if self.pos < len(self.tokens) and self.tokens[self.pos][:2] == ("op", ","):
+                self.pos += 1
+
+
+def parse(text: str) -> dict:
+    """Parse LVM metadata into nested dict"""
+    return _Parser(tokenize(text)).section(True)
+
+
+@dataclass
+class Segment:
+    """Segment of logical volume"""
+
+    start_extent: int
+    extent_count: int
+    type: str
+    attrs: dict[str, Any] = field(default_factory=dict)
+
+
+@dataclass
+class LogicalVolume:
+    """Logical volume"""
+
+    name: str
+    id: str
+    status: list[str] = field(default_factory=list)
+    flags: list[str] = field(default_factory=list)
+    tags: list[str] = field(default_factory=list)
+    creation_time: int | None = None
+    creation_host: str | None = None
+    segments: list[Segment] = field(default_factory=list)
+
+    @property
+    def extent_count(self) -> int:
+        return sum(x.extent_count for x in self.segments)
+
+    @property
+    def visible(self) -> bool:
+        return "VISIBLE" in self.status
+
+    @property
+    def writable(self) -> bool:
+        return "WRITE" in self.status
+
+    @property
+    def thin(self) -> bool:
+        return any(x.type == "thin" for x in self.segments)
+
+    @property
+    def thin_pool(self) -> bool:
+        return any(x.type == "thin-pool" for x in self.segments)
+
+    @property
+    def origin(self) -> str | None:
+        for seg in self.segments:
+            if seg.type == "thin" and isinstance(seg.attrs.get("origin"), str):
+                return seg.attrs["origin"]
+        return None
+
+    def tag(self, prefix: str) -> str | None:
+        """Value of the first tag which starts with prefix"""
+        for tag in self.tags:
+            if tag.startswith(prefix):
+                return tag.removeprefix(prefix)
+        return None
+
+
+@dataclass
+class PhysicalVolume:
+    """Physical volume"""
+
+    name: str
+    id: str
+    device: str | None = None
+    dev_size: int = 0
+    pe_start: int = 0
+    pe_count: int = 0
+
+
+@dataclass
+class VolumeGroup:
+    """Volume group"""
+
+    name: str
+    id: str
+    seqno: int
+    extent_size: int
+    status: list[str] = field(default_factory=list)
+    flags: list[str] = field(default_factory=list)
+    physical_volumes: dict[str, PhysicalVolume] = field(default_factory=dict)
+    logical_volumes: dict[str, LogicalVolume] = field(default_factory=dict)
+
+    def lv_size(self, lv: LogicalVolume) -> int:
+        """Size of logical volume in bytes"""
+        return lv.extent_count * self.extent_size * 512
+
+
+@dataclass
+class Metadata:
+    """Content of vgcfgbackup file"""
+
+    version: int
+    description: str | None = None
+    creation_host: str | None = None
+    creation_time: int | None = None
+    volume_groups: dict[str, VolumeGroup] = field(default_factory=dict)
+
+
+def _get(d: dict, key: str, typ: type | tuple[type, ...], default: Any = None, where: str = "") -> Any:
+    value = d.get(key, default)
+    if value is default:
+        return value
+    if not isinstance(value, typ) or isinstance(value, bool):
+        raise InvalidArgument(f"lvm metadata: {where}{key}: invalid value {value!r}")
+    return value
+
+
+def _strlist(d: dict, key: str, where: str) -> list[str]:
+    value = _get(d, key, list, [], where)
+    if not all(isinstance(x, str) for x in value):
+        raise InvalidArgument(f"lvm metadata: {where}{key}: invalid value {value!r}")
+    return value
+
+
+def _section(d: dict, key: str, where: str) -> dict[str, dict]:
+    value = _get(d, key, dict, {}, where)
+    for k, v in value.items():
+        if not isinstance(v, dict):
+            raise InvalidArgument(f"lvm metadata: {where}{key}.{k}: not a section")
+    return value
+
+
+def _lv(name: str, d: dict, where: str) -> LogicalVolume:
+    where = f"{where}{name}."
+    segments = []
+    for i in range(_get(d, "segment_count", int, 0, where)):
+        segname = f"segment{i + 1}"
+        seg = _get(d, segname, dict, None, where)
+        if seg is None:
+            raise InvalidArgument(f"lvm metadata: {where}{segname}: missing")
+        segwhere = f"{where}{segname}."
+        segments.append(
+            Segment(
+                start_extent=_get(seg, "start_extent", int, 0, segwhere),
+                extent_count=_get(seg, "extent_count", int, 0, segwhere),
+                type=_get(seg, "type", str, "", segwhere),
+                attrs={k: v for k, v in seg.items() if k not in ("start_extent", "extent_count", "type")},
+            )
+        )
+    return LogicalVolume(
+        name=name,
+        id=_get(d, "id", str, "", where),
+        status=_strlist(d, "status", where),
+        flags=_strlist(d, "flags", where),
+        tags=_strlist(d, "tags", where),
+        creation_time=_get(d, "creation_time", int, None, where),
+        creation_host=_get(d, "creation_host", str, None, where),
+        segments=segments,
+    )
+
+
+def _vg(name: str, d: dict) -> VolumeGroup:
+    where = f"{name}."
+    pvs = {
+        k: PhysicalVolume(
+            name=k,
+            id=_get(v, "id", str, "", f"{where}{k}."),
+            device=_get(v, "device", str, None, f"{where}{k}."),
+            dev_size=_get(v, "dev_size", int, 0, f"{where}{k}."),
+            pe_start=_get(v, "pe_start", int, 0, f"{where}{k}."),
+            pe_count=_get(v, "pe_count", int, 0, f"{where}{k}."),
+        )
+        for k, v in _section(d, "physical_volumes", where).items()
+    }
+    lvs = {k: _lv(k, v, where) for k, v in _section(d, "logical_volumes", where).items()}
+    return VolumeGroup(
+        name=name,
+        id=_get(d, "id", str, "", where),
+        seqno=_get(d, "seqno", int, 0, where),
+        extent_size=_get(d, "extent_size", int, 0, where),
+        status=_strlist(d, "status", where),
+        flags=_strlist(d, "flags", where),
+        physical_volumes=pvs,
+        logical_volumes=lvs,
+    )
+
+
+def loads(text: str) -> Metadata:
+    """Parse vgcfgbackup output into typed structure"""
+    parsed = parse(text)
+    return Metadata(
+        version=_get(parsed, "version", int, 0),
+        description=_get(parsed, "description", str),
+        creation_host=_get(parsed, "creation_host", str),
+        creation_time=_get(parsed, "creation_time", int),
+        volume_groups={k: _vg(k, v) for k, v in parsed.items() if isinstance(v, dict)},
+    )
@@ -1,6 +1,5 @@
 import os
 import click
-import uvicorn
 from logging import getLogger
 from .cli_utils import verbose_option
 from .version import VERSION
@@ -38,9 +37,12 @@ def cli(ctx):
 @click.option("--log-config", type=click.Path(), help="uvicorn log config")
 @click.option("--cmd-timeout", type=float, envvar="VOLEXP_CMD_TIMEOUT", help="command execution timeout")
 @click.option("--check/--skip-check", default=True, help="pre-boot check")
-def server(hostport, log_config, check, **kwargs):
+@click.option("--warmup/--no-warmup", default=False, help="fill state store and backup index before listening")
+def server(hostport, log_config, check, warmup, **kwargs):
     """Run the volexport server."""
     import json
+    import uvicorn
+    from concurrent.futures import ThreadPoolExecutor
     from urllib.parse import urlparse
 
     for k, v in kwargs.items():
@@ -53,7 +55,6 @@ def server(hostport, log_config, check, **kwargs):
             vv = v
         os.environ[kk] = vv
 
-    from .api import api
     from .config import config
     from .config2 import config2
     from .lvm2 import VG
@@ -63,13 +64,26 @@ def server(hostport, log_config, check, **kwargs):
     if log_config is None:
         getLogger("uvicorn").setLevel("INFO")
 
-    # pre-boot check
-    if check:
-        if os.getuid() == 0 and config.BECOME_METHOD:
-            _log.info("you are already root. disable become_method")
-            config.BECOME_METHOD = ""
-        assert VG(config2.VG).get() is not None
-        assert Tgtd().sys_show() is not None
+    # pre-boot check, run concurrently with importing the app
+    with ThreadPoolExecutor(max_workers=2, thread_name_prefix="volexp-boot") as pool:
+        checks = []
+        if check:
+            if os.getuid() == 0 and config.BECOME_METHOD:
+                _log.info("you are already root. disable become_method")
+                config.BECOME_METHOD = ""
+            checks.append(pool.submit(VG(config2.VG).get))
+            checks.append(pool.submit(Tgtd().sys_show))
+        from .api import api
+
+        for res in checks:
+            assert res.result() is not None
+        if warmup:
+            from .statedb import reconcile_once
+            from .api_mgmt import load_backup_index
+
+            state = pool.submit(reconcile_once)
+            backups = pool.submit(load_backup_index)
+            _log.info("warmup: state=%s, backups=%s", state.result(), backups.result())
 
     # start server
     if "://" not in hostport:
@@ -117,19 +131,72 @@ def apispec(format):
 @click.option("--cert", type=click.File("r"), help="certificate .pem file for TLS")
 @click.option("--rootcert", type=click.File("r"), help="ca cert for TLS/mTLS")
 @click.option("--use-mtls/--no-mtls", default=False, show_default=True, help="use client auth")
-@click.option("--max-workers", type=int, help="# of workers", envvar="VOLEXP_MAX_WORKERS")
-def csiserver(hostport, endpoint, node_id, private_key, cert, rootcert, use_mtls, max_workers):
+@click.option("--max-workers", type=int, help="# of workers [default: pool-size]", envvar="VOLEXP_MAX_WORKERS")
+@click.option("--cache-ttl", type=float, help="seconds to reuse volume list/capacity", envvar="VOLEXP_CACHE_TTL")
+@click.option(
+    "--cache-max-age", type=float, help="max seconds to reuse if unchanged, 0 to disable", envvar="VOLEXP_CACHE_MAX_AGE"
+)
+@click.option("--aio/--no-aio", default=False, show_default=True, help="use asyncio server", envvar="VOLEXP_AIO")
+@click.option("--max-concurrent-rpcs", type=int, help="reject RPCs over this", envvar="VOLEXP_MAX_CONCURRENT_RPCS")
+@click.option(
+    "--pool-size", type=int, help="HTTP connections to volexport [default: max-workers]", envvar="VOLEXP_POOL_SIZE"
+)
+@click.option("--connect-timeout", type=float, default=5.0, show_default=True, help="HTTP connect timeout")
+@click.option("--http-timeout", type=float, default=300.0, show_default=True, help="HTTP read timeout")
+@click.option(
+    "--log-level-method",
+    multiple=True,
+    help="access log level of method, e.g. ListVolumes=DEBUG",
+    metavar="METHOD=LEVEL",
+)
+@click.option("--log-max-bytes", type=int, default=1024, show_default=True, help="log size only if larger message")
+@click.option(
+    "--log-sample", type=float, default=1.0, show_default=True, help="ratio of successful calls to log messages"
+)
+@click.option("--metrics-hostport", help="listen host:port for GET /metrics", envvar="VOLEXP_METRICS_HOSTPORT")
+def csiserver(
+    hostport,
+    endpoint,
+    node_id,
+    private_key,
+    cert,
+    rootcert,
+    use_mtls,
+    max_workers,
+    cache_ttl,
+    cache_max_age,
+    aio,
+    max_concurrent_rpcs,
+    pool_size,
+    connect_timeout,
+    http_timeout,
+    log_level_method,
+    log_max_bytes,
+    log_sample,
+    metrics_hostport,
+):
     """Run the CSI driver service"""
     from pathlib import Path
-    from volexpcsi.server import boot_server
+    from volexpcsi.server import boot_server, boot_metrics
 
     _log.info("starting server: %s", hostport)
     conf = dict(
         endpoint=endpoint,
         nodeid=node_id,
         max_workers=max_workers,
+        max_concurrent_rpcs=max_concurrent_rpcs,
         become_method="sudo",
+        cache_ttl=cache_ttl,
+        cache_max_age=cache_max_age,
+        pool_size=pool_size or max_workers,
+        http_timeout=(connect_timeout, http_timeout),
+        log_levels=dict(x.split("=", 1) for x in log_level_method),
+        log_max_bytes=log_max_bytes,
+        log_sample=log_sample,
     )
+    if metrics_hostport:
+        boot_metrics(metrics_hostport)
+    cred = None
     if private_key and cert:
         import grpc
 
@@ -143,9 +210,19 @@ def csiserver(hostport, endpoint, node_id, private_key, cert, rootcert, use_mtls
             root,
             require_client_auth=use_mtls,
         )
-        port, srv = boot_server(hostport=hostport, config=conf, cred=cred)
-    else:
-        port, srv = boot_server(hostport=hostport, config=conf)
+    if aio:
+        import asyncio
+        from volexpcsi.server import boot_aio_server
+
+        async def serve():
+            port, srv = await boot_aio_server(hostport=hostport, config=conf, cred=cred)
+            _log.info("server started(aio): port=%s", port)
+            return await srv.wait_for_termination()
+
+        exit = asyncio.run(serve())
+        _log.info("server finished: timeout=%s", exit)
+        return
+    port, srv = boot_server(hostport=hostport, config=conf, cred=cred)
     _log.info("server started: port=%s", port)
     exit = srv.wait_for_termination()
     _log.info("server finished: timeout=%s", exit)
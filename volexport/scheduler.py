@@ -0,0 +1,171 @@
+import datetime
+import threading
+import time
+from typing import Callable
+from logging import getLogger
+from .exceptions import InvalidArgument
+from .util import generation
+
+_log = getLogger(__name__)
+
+_ALIASES = {
+    "@hourly": "0 * * * *",
+    "@daily": "0 0 * * *",
+    "@midnight": "0 0 * * *",
+    "@weekly": "0 0 * * 0",
+    "@monthly": "0 0 1 * *",
+    "@yearly": "0 0 1 1 *",
+    "@annually": "0 0 1 1 *",
+}
+
+
+def _cronfield(spec: str, low: int, high: int) -> set[int]:
+    res: set[int] = set()
+    for item in spec.split(","):
+        rng, _, step = item.partition("/")
+        if rng == "*":
+            start, end = low, high
+        elif "-" in rng:
+            start, end = (int(x) for x in rng.split("-", 1))
+        else:
+            start = int(rng)
+            end = high if step else start
+        inc = int(step) if step else 1
+        if start < low or end > high or start > end or inc < 1:
+            raise ValueError(f"out of range: {item}")
+        res.update(range(start, end + 1, inc))
+    return res
+
+
+class CronSchedule:
+    """Cron-like schedule: minute hour day month weekday"""
+
+    def __init__(self, expr: str):
+        fields = _ALIASES.get(expr.strip(), expr).split()
+        if len(fields) != 5:
+            raise InvalidArgument(f"invalid schedule: {expr}")
+        try:
+            self.minute = _cronfield(fields[0], 0, 59)
+            self.hour = _cronfield(fields[1], 0, 23)
+            self.day = _cronfield(fields[2], 1, 31)
+            self.month = _cronfield(fields[3], 1, 12)
+            # 0 and 7 are sunday
+            self.weekday = {x % 7 for x in _cronfield(fields[4], 0, 7)}
+        except ValueError as e:
+            raise InvalidArgument(f"invalid schedule: {expr}: {e}")
+        self.any_day = fields[2] == "*"
+        self.any_weekday = fields[4] == "*"
+
+    def _match_day(self, t: datetime.datetime) -> bool:
+        day = t.day in self.day
+        weekday = (t.weekday() + 1) % 7 in self.weekday
+        if self.any_day or self.any_weekday:
+            return day and weekday
+        # both restricted: either matches
+        return day or weekday
+
+    def next(self, after: datetime.datetime) -> datetime.datetime:
+        """First matching time after the given time"""
+        t = after.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+        limit = t + datetime.timedelta(days=366 * 5)
+        while t < limit:
+            if t.month not in self.month:
+                t = (t.replace(day=1, hour=0, minute=0) + datetime.timedelta(days=32)).replace(day=1)
+            elif not self._match_day(t):
+                t = t.replace(hour=0, minute=0) + datetime.timedelta(days=1)
+            elif t.hour not in self.hour:
+                t = t.replace(minute=0) + datetime.timedelta(hours=1)
+            elif t.minute not in self.minute:
+                t += datetime.timedelta(minutes=1)
+            else:
+                return t
+        raise InvalidArgument("schedule never matches")
+
+
+class BackupScheduler:
+    """Create backups after mutations (debounced) and on schedule, then apply retention"""
+
+    def __init__(
+        self,
+        create: Callable[[], str],
+        prune: Callable[[], list[str]],
+        schedule: str | None = None,
+        debounce: float | None = None,
+        min_interval: float = 0.0,
+        poll: float = 1.0,
+    ):
+        self.create = create
+        self.prune = prune
+        self.schedule = CronSchedule(schedule) if schedule else None
+        self.debounce = debounce
+        self.min_interval = min_interval
+        self.poll = poll
+        self.last_generation: int | None = None
+        self.last_run: float | None = None
+        self.last_backup: str | None = None
+        self.last_error: str | None = None
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name="volexp-backup", daemon=True)
+        self._thread.start()
+        _log.info("backup scheduler started: schedule=%s, debounce=%s", self.schedule is not None, self.debounce)
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def pending(self, now: float) -> float | None:
+        """Monotonic time when backup after mutation is due, None if nothing changed"""
+        if self.debounce is None or generation.changed is None or generation.value == self.last_generation:
+            return None
+        due = generation.changed + self.debounce
+        if self.last_run is not None:
+            due = max(due, self.last_run + self.min_interval)
+        return due
+
+    def run_once(self) -> str | None:
+        """Create a backup if inventory changed, and delete old backups"""
+        gen = generation.value
+        name = None
+        try:
+            if gen == self.last_generation:
+                _log.info("no change since last backup: generation=%s", gen)
+            else:
+                name = self.create()
+                _log.info("scheduled backup created: name=%s, generation=%s", name, gen)
+                self.last_generation = gen
+                self.last_backup = name
+            removed = self.prune()
+            if removed:
+                _log.info("old backups deleted: %s", removed)
+            self.last_error = None
+        except Exception as e:
+            _log.warning("scheduled backup failed", exc_info=e)
+            self.last_error = f"{type(e).__qualname__}: {e}"
+        finally:
+            self.last_run = time.monotonic()
+        return name
+
+    def _loop(self):
+        cron_next = self.schedule.next(datetime.datetime.now()) if self.schedule else None
+        while not self._stop.is_set():
+            now = time.monotonic()
+            wait = self.poll
+            due = self.pending(now)
+            if due is not None:
+                wait = min(wait, due - now)
+            if cron_next is not None:
+                remaining = (cron_next - datetime.datetime.now()).total_seconds()
+                if remaining <= 0:
+                    cron_next = self.schedule.next(datetime.datetime.now())  # type: ignore[union-attr]
+                    wait = 0
+                wait = min(wait, remaining)
+            if wait <= 0:
+                self.run_once()
+                continue
+            self._stop.wait(wait)
@@ -0,0 +1,330 @@
+import json
+import datetime
+import threading
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Callable, Iterator
+from logging import getLogger
+from .config import config
+from .util import generation
+
+if TYPE_CHECKING:
+    import sqlite3
+
+_log = getLogger(__name__)
+
+SCHEMA_VERSION = 1
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS volumes (
+    name TEXT PRIMARY KEY,
+    lv_uuid TEXT,
+    lv_name TEXT NOT NULL,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    thin INTEGER NOT NULL,
+    parent TEXT,
+    created TEXT,
+    params TEXT,
+    updated TEXT NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS volumes_uuid ON volumes (lv_uuid);
+CREATE INDEX IF NOT EXISTS volumes_path ON volumes (path);
+CREATE TABLE IF NOT EXISTS exports (
+    targetname TEXT PRIMARY KEY,
+    tid INTEGER NOT NULL,
+    volume TEXT,
+    path TEXT,
+    acl TEXT NOT NULL,
+    updated TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS exports_volume ON exports (volume);
+CREATE TABLE IF NOT EXISTS users (
+    user TEXT PRIMARY KEY,
+    targetname TEXT NOT NULL REFERENCES exports (targetname) ON DELETE CASCADE
+);
+CREATE INDEX IF NOT EXISTS users_target ON users (targetname);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+def _now() -> str:
+    return datetime.datetime.now(tz=datetime.timezone.utc).isoformat()
+
+
+class Transaction:
+    """Write operations in a transaction"""
+
+    def __init__(self, conn: "sqlite3.Connection", vgname: str):
+        self.conn = conn
+        self.vgname = vgname
+
+    def put_volume(self, vol: dict, params: dict | None = None):
+        """Insert or update a volume from LV.vol2dict() output"""
+        old = self.conn.execute("SELECT params FROM volumes WHERE name=?", (vol["name"],)).fetchone()
+        if params is None and old is not None:
+            params_str = old[0]
+        else:
+            params_str = json.dumps(params) if params is not None else None
+        self.conn.execute("DELETE FROM volumes WHERE lv_uuid=? AND name<>?", (vol["lvm_id"], vol["name"]))
+        self.conn.execute(
+            "INSERT OR REPLACE INTO volumes"
+            " (name, lv_uuid, lv_name, path, size, thin, parent, created, params, updated)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                vol["name"],
+                vol["lvm_id"],
+                vol["lvm_name"],
+                f"/dev/{self.vgname}/{vol['lvm_name']}",
+                int(vol["size"]),
+                int(bool(vol["thin"])),
+                vol.get("parent") or None,
+                vol.get("created"),
+                params_str,
+                _now(),
+            ),
+        )
+
+    def delete_volume(self, name: str):
+        self.conn.execute("DELETE FROM volumes WHERE name=?", (name,))
+
+    def put_export(self, export: dict, volume: str | None, path: str | None):
+        """Insert or update an export from Tgtd.export_volume() or export_list() output"""
+        self.conn.execute(
+            "INSERT OR REPLACE INTO exports (targetname, tid, volume, path, acl, updated) VALUES (?, ?, ?, ?, ?, ?)",
+            (export["targetname"], int(export["tid"]), volume, path, json.dumps(export.get("acl") or []), _now()),
+        )
+        users = export.get("users") or ([export["user"]] if export.get("user") else [])
+        self.conn.execute("DELETE FROM users WHERE targetname=?", (export["targetname"],))
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO users (user, targetname) VALUES (?, ?)",
+            [(x, export["targetname"]) for x in users],
+        )
+
+    def delete_export(self, targetname: str):
+        self.conn.execute("DELETE FROM exports WHERE targetname=?", (targetname,))
+
+
+class Changes:
+    """Writes recorded along with a mutation, applied in a short transaction after it succeeded"""
+
+    def __init__(self):
+        self.ops: list[tuple[Callable, tuple]] = []
+
+    def put_volume(self, vol: dict, params: dict | None = None):
+        self.ops.append((Transaction.put_volume, (vol, params)))
+
+    def delete_volume(self, name: str):
+        self.ops.append((Transaction.delete_volume, (name,)))
+
+    def put_export(self, export: dict, volume: str | None, path: str | None):
+        self.ops.append((Transaction.put_export, (export, volume, path)))
+
+    def delete_export(self, targetname: str):
+        self.ops.append((Transaction.delete_export, (targetname,)))
+
+    def apply(self, tx: Transaction):
+        for fn, args in self.ops:
+            fn(tx, *args)
+
+
+class StateDB:
+    """SQLite (WAL) store of volume and export metadata, mirror of LVM and tgtd"""
+
+    def __init__(self, path: str, vgname: str, timeout: float = 30.0):
+        self.path = path
+        self.vgname = vgname
+        self.timeout = timeout
+        self._local = threading.local()
+        self.conn.executescript(SCHEMA)
+        with self.transaction() as tx:
+            tx.conn.execute(
+                "INSERT OR IGNORE INTO meta (key, value) VALUES ('schema_version', ?)", (str(SCHEMA_VERSION),)
+            )
+
+    @property
+    def conn(self) -> "sqlite3.Connection":
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            import sqlite3
+
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA foreign_keys=ON")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def transaction(self) -> Iterator[Transaction]:
+        """Write transaction, rollback on error"""
+        conn = self.conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield Transaction(conn, self.vgname)
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def volume(self, name: str) -> dict | None:
+        row = self.conn.execute("SELECT * FROM volumes WHERE name=?", (name,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def volume_by_path(self, path: str) -> str | None:
+        row = self.conn.execute("SELECT name FROM volumes WHERE path=?", (path,)).fetchone()
+        return row[0] if row is not None else None
+
+    def volume_names(self) -> list[str]:
+        return [x[0] for x in self.conn.execute("SELECT name FROM volumes ORDER BY name")]
+
+    def exports(self, volume: str | None = None) -> list[dict]:
+        if volume is None:
+            rows = self.conn.execute("SELECT * FROM exports ORDER BY tid").fetchall()
+        else:
+            rows = self.conn.execute("SELECT * FROM exports WHERE volume=? ORDER BY tid", (volume,)).fetchall()
+        res = []
+        for row in rows:
+            ent = dict(row)
+            ent["acl"] = json.loads(ent["acl"])
+            ent["users"] = [
+                x[0] for x in self.conn.execute("SELECT user FROM users WHERE targetname=?", (row["targetname"],))
+            ]
+            res.append(ent)
+        return res
+
+    def get_meta(self, key: str) -> str | None:
+        row = self.conn.execute("SELECT value FROM meta WHERE key=?", (key,)).fetchone()
+        return row[0] if row is not None else None
+
+    def reconcile(self, volumes: list[dict], exports: list[dict], gen: int | None = None) -> dict | None:
+        """Replace contents by actual volumes and exports, None if generation changed while listing"""
+        with self.transaction() as tx:
+            if gen is not None and generation.value != gen:
+                _log.info("skip reconcile: changed while listing, generation=%s -> %s", gen, generation.value)
+                return None
+            before = set(self.volume_names())
+            for vol in volumes:
+                tx.put_volume(vol)
+            names = {x["name"] for x in volumes}
+            for name in before - names:
+                tx.delete_volume(name)
+            before_exp = {x[0] for x in tx.conn.execute("SELECT targetname FROM exports")}
+            targets = set()
+            for exp in exports:
+                path = exp["volumes"][0] if exp.get("volumes") else None
+                volume = self.volume_by_path(path) if path else None
+                tx.put_export(exp, volume, path)
+                targets.add(exp["targetname"])
+            for targetname in before_exp - targets:
+                tx.delete_export(targetname)
+            tx.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('reconciled', ?)", (_now(),))
+        res = dict(
+            volumes=len(names),
+            volumes_added=len(names - before),
+            volumes_removed=len(before - names),
+            exports=len(targets),
+            exports_added=len(targets - before_exp),
+            exports_removed=len(before_exp - targets),
+        )
+        if any(v for k, v in res.items() if k.endswith(("_added", "_removed"))):
+            _log.info("state reconciled: %s", res)
+        return res
+
+
+_db: StateDB | None = None
+_db_lock = threading.Lock()
+
+
+def get() -> StateDB | None:
+    """State store from configuration, None if disabled"""
+    global _db
+    if not config.STATE_DB:
+        return None
+    from .config2 import config2
+
+    with _db_lock:
+        if _db is None or _db.path != config.STATE_DB or _db.vgname != config2.VG:
+            _db = StateDB(config.STATE_DB, config2.VG)
+        return _db
+
+
+@contextmanager
+def mutation() -> Iterator[Changes | None]:
+    """Changes along with LVM/tgtd mutation, discarded if the mutation failed. None if disabled
+
+    The write lock is not held while LVM/tgtd commands run, reconcile repairs a crash in between.
+    """
+    db = get()
+    if db is None:
+        yield None
+        return
+    changes = Changes()
+    yield changes
+    if changes.ops:
+        with db.transaction() as tx:
+            changes.apply(tx)
+
+
+def reconcile_once() -> dict | None:
+    """Reconcile state store with lvs and tgtadm"""
+    db = get()
+    if db is None:
+        return None
+    from .lvm2 import LV
+    from .tgtd import Tgtd
+
+    gen = generation.value
+    volumes = LV(db.vgname).volume_list()
+    exports = Tgtd().export_list()
+    return db.reconcile(volumes, exports, gen)
+
+
+class StateReconciler:
+    """Reconcile state store at startup and periodically"""
+
+    def __init__(self, poll: float):
+        self.poll = poll
+        self.last_result: dict | None = None
+        self.last_error: str | None = None
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name="volexp-statedb", daemon=True)
+        self._thread.start()
+        _log.info("state reconciler started: poll=%s", self.poll)
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def run_once(self) -> dict | None:
+        try:
+            res = reconcile_once()
+            if res is not None:
+                self.last_result = res
+            self.last_error = None
+            return res
+        except Exception as e:
+            _log.warning("reconcile failed", exc_info=e)
+            self.last_error = f"{type(e).__qualname__}: {e}"
+            return None
+
+    def _loop(self):
+        while not self._stop.is_set():
+            res = self.run_once()
+            # retry soon if skipped by concurrent changes
+            self._stop.wait(self.poll if res is not None else min(self.poll, 1.0))
+
+
+def state_reconciler() -> StateReconciler | None:
+    """Reconciler from configuration, None if disabled"""
+    if not config.STATE_DB or not config.STATE_RECONCILE_INTERVAL:
+        return None
+    return StateReconciler(config.STATE_RECONCILE_INTERVAL)
@@ -0,0 +1,119 @@
+import uuid
+import tempfile
+import threading
+from logging import getLogger
+from .config import config
+from .lvm2 import LV, runparse_report, mkfs_cmd
+from .util import runcmd
+from .exceptions import InvalidArgument
+
+_log = getLogger(__name__)
+# serialize making templates, so that each template is made once
+_lock = threading.Lock()
+# filesystems whose UUID and label can be changed offline
+filesystems = ("ext4", "xfs")
+
+
+def classtag(size: int, filesystem: str) -> str:
+    """LV tag of the golden template volume"""
+    return f"{LV.template_tag}.{size}.{filesystem}"
+
+
+def pick(size: int) -> int | None:
+    """Largest template size not exceeding the request"""
+    return max((x for x in config.TEMPLATE_SIZES if x <= size), default=None)
+
+
+def find(vgname: str, size: int, filesystem: str) -> str | None:
+    """LV name of the template, None if not made yet"""
+    res = runparse_report(mode="lv", filter=f"vg_name={vgname} && tags={classtag(size, filesystem)}")
+    if len(res) == 0:
+        return None
+    return res[0]["lv_name"]
+
+
+def _make(vgname: str, thinpool: str, size: int, filesystem: str) -> str:
+    name = str(uuid.uuid4())
+    runcmd(
+        [
+            "lvcreate",
+            "--thin",
+            "--virtualsize",
+            f"{size}b",
+            "--name",
+            name,
+            "--addtag",
+            LV.template_tag,
+            f"{vgname}/{thinpool}",
+        ]
+    )
+    try:
+        runcmd([*mkfs_cmd(filesystem), f"/dev/{vgname}/{name}"])
+        # usable from now on, never written again
+        runcmd(["lvchange", "--permission", "r", "--addtag", classtag(size, filesystem), f"{vgname}/{name}"])
+    except BaseException:
+        runcmd(["lvremove", f"{vgname}/{name}", "--yes"])
+        raise
+    _log.info("template created: %s, size=%s, filesystem=%s", name, size, filesystem)
+    return name
+
+
+def ensure(vgname: str, thinpool: str, size: int, filesystem: str) -> str:
+    """LV name of the template, make it if not exists"""
+    with _lock:
+        name = find(vgname, size, filesystem)
+        if name is None:
+            name = _make(vgname, thinpool, size, filesystem)
+        return name
+
+
+def reidentify_cmd(filesystem: str, label: str) -> list[str]:
+    """Command line to set new UUID and label, without device"""
+    if filesystem == "ext4":
+        return ["tune2fs", "-U", "random", "-L", label[:16]]
+    elif filesystem == "xfs":
+        return ["xfs_admin", "-U", "generate", "-L", label[:12]]
+    raise NotImplementedError("not supported")
+
+
+def grow(filesystem: str, device: str):
+    """Grow the filesystem to the size of the device"""
+    if filesystem == "ext4":
+        runcmd(["resize2fs", device])
+    elif filesystem == "xfs":
+        # xfs_growfs works on mounted filesystem only
+        with tempfile.TemporaryDirectory(prefix="volexp-") as mnt:
+            runcmd(["mount", "-t", "xfs", device, mnt])
+            try:
+                runcmd(["xfs_growfs", mnt])
+            finally:
+                runcmd(["umount", mnt])
+    else:
+        raise NotImplementedError("not supported")
+
+
+def create_volume(vgname: str, name: str, size: int, filesystem: str | None) -> dict | None:
+    """Create a formatted volume as a thin snapshot of the golden template"""
+    if not config.LVM_THINPOOL:
+        raise InvalidArgument("from_template requires thin pool")
+    if filesystem not in filesystems:
+        raise InvalidArgument(f"from_template does not support filesystem: {filesystem}")
+    base = pick(size)
+    if base is None:
+        raise InvalidArgument(f"no template for size: {size}")
+    lv = LV(vgname, name)
+    if lv.get() is not None:
+        raise InvalidArgument(f"volume already exists: {name}")
+    src = ensure(vgname, config.LVM_THINPOOL, base, filesystem)
+    lv.create_thinclone_of(src)
+    try:
+        device = lv.volume_vol2path()
+        # snapshots share UUID with the template, the label is the one NodePublishVolume mounts by
+        runcmd([*reidentify_cmd(filesystem, name), device])
+        if size > base:
+            lv.resize(size)
+            grow(filesystem, device)
+    except BaseException:
+        lv.delete()
+        raise
+    return lv.volume_read()
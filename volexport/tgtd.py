@@ -2,7 +2,6 @@ from urllib.parse import urlsplit
 from socket import AF_INET6, AF_INET
 import shlex
 import secrets
-import ifaddr
 import tempfile
 from pathlib import Path
 from logging import getLogger
@@ -210,12 +209,30 @@ class Tgtd:
         """List all sessions for a target"""
         return self.parse(self.tgtadm(lld=self.lld, mode="conn", op="show", tid=tid).stdout.splitlines())
 
+    def connected(self, tid: int) -> list[dict]:
+        """Connected initiators of a target by TID"""
+        res = []
+        for key, sess in self.list_session(tid).items():
+            if not key.startswith("Session") or not isinstance(sess, dict):
+                continue
+            conns = [v for k, v in sess.items() if k.startswith("Connection") and isinstance(v, dict)]
+            if conns:
+                res.append(
+                    dict(
+                        address=[x.get("IP Address") for x in conns],
+                        initiator=conns[0].get("Initiator", "").split(" ")[0],
+                    )
+                )
+        return res
+
     def disconnect_session(self, tid: int, sid: int, cid: int):
         """Disconnect a session by TID, SID, and CID"""
         return self.tgtadm(lld=self.lld, mode="conn", op="delete", tid=tid, sid=sid, cid=cid)
 
     def myaddress(self):
         """Get the addresses of the target"""
+        import ifaddr
+
         portal_addrs = [x.removesuffix(",1") for x in self.portal_list()]
         res = []
         ifaddrs = {AF_INET: [], AF_INET6: []}
@@ -314,6 +331,13 @@ class Tgtd:
             res.append(self._target2export(tgtid, tgtinfo))
         return res
 
+    def export_find(self, filename: str, acl: list[str]) -> dict | None:
+        """Find the export of only the volume with the same ACL"""
+        for exp in self.export_list():
+            if exp["volumes"] == [filename] and sorted(exp["acl"]) == sorted(acl):
+                return exp
+        return None
+
     def export_read(self, tid):
         """Read exports"""
         tgtid, tgtinfo = self._find_target(lambda t, tinfo: int(t.removeprefix("Target ")) == tid)
@@ -0,0 +1,134 @@
+import tempfile
+import threading
+from contextlib import contextmanager
+from typing import IO, Iterable, Iterator
+from logging import getLogger
+from .exceptions import InvalidArgument
+from .util import runcmd, popencmd
+
+_log = getLogger(__name__)
+# a thin pool has only one metadata snapshot at a time
+_locks: dict[str, threading.Lock] = {}
+_locks_lock = threading.Lock()
+
+# element: (begin attribute, length attribute or None if single block)
+_DELTA_TAGS: dict[str, tuple[str, str | None]] = {
+    "different": ("begin", "length"),
+    "left_only": ("begin", "length"),
+    "right_only": ("begin", "length"),
+}
+_DUMP_TAGS: dict[str, tuple[str, str | None]] = {
+    "range_mapping": ("origin_begin", "length"),
+    "single_mapping": ("origin_block", None),
+}
+
+
+def dm_name(vgname: str, lvname: str) -> str:
+    """Device mapper name of the logical volume"""
+    return f"{vgname.replace('-', '--')}-{lvname.replace('-', '--')}"
+
+
+def _pool_lock(name: str) -> threading.Lock:
+    with _locks_lock:
+        return _locks.setdefault(name, threading.Lock())
+
+
+@contextmanager
+def metadata_snap(vgname: str, pool: str):
+    """Reserve metadata snapshot of the thin pool, yields path of the metadata device"""
+    tpool = dm_name(vgname, pool) + "-tpool"
+    with _pool_lock(tpool):
+        runcmd(["dmsetup", "message", tpool, "0", "reserve_metadata_snap"])
+        try:
+            yield f"/dev/mapper/{dm_name(vgname, pool + '_tmeta')}"
+        finally:
+            runcmd(["dmsetup", "message", tpool, "0", "release_metadata_snap"])
+
+
+def parse_extents(fp, tags: dict[str, tuple[str, str | None]]) -> Iterator[tuple[int, int]]:
+    """Parse thin_delta/thin_dump XML incrementally, yield (offset, length) in bytes"""
+    import xml.etree.ElementTree as ET
+
+    block_size = None
+    stack = []
+    try:
+        for event, el in ET.iterparse(fp, events=("start", "end")):
+            if event == "start":
+                if el.tag == "superblock":
+                    block_size = int(el.attrib["data_block_size"]) * 512
+                stack.append(el)
+                continue
+            stack.pop()
+            if el.tag not in tags:
+                continue
+            if block_size is None:
+                raise InvalidArgument("no superblock")
+            begin, length = tags[el.tag]
+            yield int(el.attrib[begin]) * block_size, (int(el.attrib[length]) if length else 1) * block_size
+            # drop parsed elements
+            if stack:
+                stack[-1].remove(el)
+    except (ET.ParseError, KeyError, ValueError) as e:
+        raise InvalidArgument(f"invalid thin metadata: {type(e).__qualname__}: {e}")
+
+
+def merge_extents(extents: Iterable[tuple[int, int]]) -> Iterator[tuple[int, int]]:
+    """Merge adjacent extents"""
+    cur = None
+    for offset, length in extents:
+        if cur is not None and cur[0] + cur[1] == offset:
+            cur = (cur[0], cur[1] + length)
+            continue
+        if cur is not None:
+            yield cur
+        cur = (offset, length)
+    if cur is not None:
+        yield cur
+
+
+def _spool(cmd: list[str], vgname: str, pool: str) -> IO[bytes]:
+    """Run the tool on the metadata snapshot into a temporary file, rewound"""
+    spool = tempfile.TemporaryFile(prefix="volexp-thin-")
+    try:
+        # release metadata snapshot before streaming to the (maybe slow) client
+        with metadata_snap(vgname, pool) as tmeta:
+            with popencmd([*cmd, tmeta], stdout=spool.fileno()):
+                pass
+        spool.seek(0)
+        return spool
+    except BaseException:
+        spool.close()
+        raise
+
+
+def _iter_spool(spool: IO[bytes], first: tuple[int, int], rest: Iterator[tuple[int, int]]) -> Iterator[tuple[int, int]]:
+    with spool:
+        yield first
+        yield from rest
+
+
+def _stream(cmd: list[str], vgname: str, pool: str, tags: dict[str, tuple[str, str | None]]):
+    # tool errors and broken output raise here, before the caller starts a response
+    spool = _spool(cmd, vgname, pool)
+    try:
+        extents = merge_extents(parse_extents(spool, tags))
+        first = next(extents, None)
+    except BaseException:
+        spool.close()
+        raise
+    if first is None:
+        spool.close()
+        return iter(())
+    return _iter_spool(spool, first, extents)
+
+
+def delta(vgname: str, pool: str, snap1: int, snap2: int) -> Iterator[tuple[int, int]]:
+    """Changed extents between two thin volumes in the pool, the tool runs now and the output is parsed lazily"""
+    cmd = ["thin_delta", "--metadata-snap", "--snap1", str(snap1), "--snap2", str(snap2)]
+    return _stream(cmd, vgname, pool, _DELTA_TAGS)
+
+
+def allocated(vgname: str, pool: str, dev_id: int) -> Iterator[tuple[int, int]]:
+    """Allocated extents of the thin volume, the tool runs now and the output is parsed lazily"""
+    cmd = ["thin_dump", "--metadata-snap", "--dev-id", str(dev_id)]
+    return _stream(cmd, vgname, pool, _DUMP_TAGS)
@@ -1,27 +1,242 @@
+import os
 import subprocess
 import shlex
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
 from logging import getLogger
 from .config import config
+from .exceptions import Cancelled, Busy
 
 _log = getLogger(__name__)
 
+# absolute deadline of current request (time.monotonic() based)
+deadline: ContextVar[float | None] = ContextVar("deadline", default=None)
+# set when current request/job is cancelled
+cancel_event: ContextVar[threading.Event | None] = ContextVar("cancel_event", default=None)
+# False in API requests: they share the threadpool and are rejected instead of waiting for a command slot
+slot_wait: ContextVar[bool] = ContextVar("slot_wait", default=True)
+
+_MUTATING = {"lvm_write", "tgtd_write"}
+# vgcfgbackup writes the metadata to a file only
+_LVM_READ = {"lvs", "vgs", "pvs", "lvscan", "vgscan", "pvscan", "lvdisplay", "vgdisplay", "pvdisplay", "vgcfgbackup"}
+_LVM_PREFIX = ("lv", "vg", "pv")
+
+
+def cmdclass(cmd: list[str]) -> str:
+    """Classify a command: lvm_read, lvm_write, tgtd_read, tgtd_write, mkfs or other"""
+    if len(cmd) == 0:
+        return "other"
+    name = os.path.basename(cmd[0])
+    if name == "lvm" and len(cmd) > 1:
+        name = cmd[1]
+    if name in _LVM_READ:
+        return "lvm_read"
+    if name == "vgcfgrestore" and ("--list" in cmd or "-l" in cmd):
+        return "lvm_read"
+    if name.startswith(_LVM_PREFIX):
+        return "lvm_write"
+    if name == "tgtadm":
+        return "tgtd_read" if "show" in cmd else "tgtd_write"
+    if name == "tgt-admin":
+        return "tgtd_read" if "--dump" in cmd else "tgtd_write"
+    if name.startswith("mkfs."):
+        return "mkfs"
+    return "other"
+
+
+def cmd_timeout(cls: str) -> float:
+    """Timeout of the command class, limited by the deadline of current request"""
+    timeout = config.CMD_TIMEOUT_CLASS.get(cls, config.CMD_TIMEOUT)
+    limit = deadline.get()
+    if limit is not None:
+        remaining = limit - time.monotonic()
+        if remaining < config.CMD_MIN_TIME:
+            raise TimeoutError(f"deadline exceeded: remaining={remaining:.3f} sec")
+        timeout = min(timeout, remaining)
+    return timeout
+
+
+class Limiter:
+    """Bound running and waiting commands of a subsystem"""
+
+    def __init__(self, name: str, concurrency: int, queue: int):
+        self.name = name
+        self.concurrency = concurrency
+        self.queue = queue
+        self.running = 0
+        self.waiting = 0
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def slot(self, timeout: float, cancel: threading.Event | None = None, wait: bool = True):
+        """Hold a slot while running a command, raise Busy if queue is full or timed out, or at once if not wait"""
+        limit = time.monotonic() + timeout
+        with self._cond:
+            if self.running >= self.concurrency:
+                if not wait:
+                    raise Busy(f"too many running commands: {self.name}")
+                if self.waiting >= self.queue:
+                    raise Busy(f"too many pending commands: {self.name}")
+                self.waiting += 1
+                try:
+                    while self.running >= self.concurrency:
+                        if cancel is not None and cancel.is_set():
+                            raise Cancelled(f"cancelled while waiting: {self.name}")
+                        remaining = limit - time.monotonic()
+                        if remaining <= 0:
+                            raise Busy(f"timed out while waiting: {self.name}")
+                        self._cond.wait(min(remaining, 0.1 if cancel is not None else remaining))
+                finally:
+                    self.waiting -= 1
+            self.running += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.running -= 1
+                self._cond.notify()
+
+    def stats(self) -> dict:
+        return dict(concurrency=self.concurrency, queue=self.queue, running=self.running, waiting=self.waiting)
+
+
+class Generation:
+    """Counter of inventory changes, bumped by mutating commands"""
+
+    def __init__(self):
+        self.value = 0
+        self.changed: float | None = None  # time.monotonic() of last change
+        self._lock = threading.Lock()
+
+    def bump(self):
+        with self._lock:
+            self.value += 1
+            self.changed = time.monotonic()
+
+
+generation = Generation()
+_limiters: dict[str, Limiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def limiter(cls: str) -> Limiter | None:
+    """Limiter of the command class, None if unlimited"""
+    name = "tgtd" if cls.startswith("tgtd") else cls
+    if name not in config.CMD_CONCURRENCY:
+        return None
+    with _limiters_lock:
+        if name not in _limiters:
+            _limiters[name] = Limiter(name, config.CMD_CONCURRENCY[name], config.CMD_QUEUE.get(name, 0))
+        return _limiters[name]
+
+
+def _run_cancellable(cmd: list[str], timeout: float, cancel: threading.Event):
+    limit = time.monotonic() + timeout
+    with subprocess.Popen(
+        cmd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        encoding="utf-8",
+        stdin=subprocess.DEVNULL,
+        start_new_session=True,
+    ) as proc:
+        while True:
+            try:
+                stdout, stderr = proc.communicate(timeout=max(0.0, min(0.1, limit - time.monotonic())))
+                break
+            except subprocess.TimeoutExpired:
+                if not cancel.is_set() and time.monotonic() < limit:
+                    continue
+                proc.terminate()
+                try:
+                    stdout, stderr = proc.communicate(timeout=1.0)
+                except subprocess.TimeoutExpired:
+                    proc.kill()
+                    stdout, stderr = proc.communicate()
+                if cancel.is_set():
+                    _log.info("cancelled: %s", cmd)
+                    raise Cancelled(f"command cancelled: {cmd[0]}")
+                raise subprocess.TimeoutExpired(cmd, timeout, output=stdout, stderr=stderr)
+    return subprocess.CompletedProcess(cmd, proc.returncode, stdout, stderr)
+
 
 def runcmd(cmd: list[str], root: bool = True):
     """Run a command"""
     _log.info("run %s, root=%s", cmd, root)
+    cls = cmdclass(cmd)
+    lim = limiter(cls)
+    try:
+        if lim is None:
+            return _runcmd(cmd, root, cmd_timeout(cls))
+        with lim.slot(cmd_timeout(cls), cancel_event.get(), slot_wait.get()):
+            # time spent in queue is subtracted from the deadline
+            return _runcmd(cmd, root, cmd_timeout(cls))
+    finally:
+        if cls in _MUTATING:
+            # failed command may have changed something too
+            generation.bump()
+
+
+def _become(cmd: list[str], root: bool) -> list[str]:
     if root:
         if config.BECOME_METHOD == "su":
             cmd = ["su", "-c", shlex.join(cmd)]
         elif config.BECOME_METHOD.lower() not in ("none", "false"):
             cmd[0:0] = shlex.split(config.BECOME_METHOD)
-    res = subprocess.run(
-        cmd,
-        capture_output=True,
-        encoding="utf-8",
-        timeout=config.CMD_TIMEOUT,
-        stdin=subprocess.DEVNULL,
-        start_new_session=True,
-    )
+    return cmd
+
+
+def _runcmd(cmd: list[str], root: bool, timeout: float):
+    cmd = _become(cmd, root)
+    cancel = cancel_event.get()
+    if cancel is not None:
+        if cancel.is_set():
+            raise Cancelled(f"command cancelled: {cmd[0]}")
+        res = _run_cancellable(cmd, timeout, cancel)
+    else:
+        res = subprocess.run(
+            cmd,
+            capture_output=True,
+            encoding="utf-8",
+            timeout=timeout,
+            stdin=subprocess.DEVNULL,
+            start_new_session=True,
+        )
     _log.info("returncode=%s, stdout=%s, stderr=%s", res.returncode, repr(res.stdout), repr(res.stderr))
     res.check_returncode()
     return res
+
+
+@contextmanager
+def popencmd(cmd: list[str], root: bool = True, stdin: int | None = None, stdout: int | None = None):
+    """Run a command with streaming stdin/stdout, kill it if not finished"""
+    _log.info("popen %s, root=%s", cmd, root)
+    cmd = _become(cmd, root)
+    # stderr is not read while streaming, a pipe would block the command when full
+    with tempfile.TemporaryFile(prefix="volexp-stderr-") as errfp:
+        proc = subprocess.Popen(
+            cmd,
+            stdin=subprocess.DEVNULL if stdin is None else stdin,
+            stdout=subprocess.DEVNULL if stdout is None else stdout,
+            stderr=errfp,
+            start_new_session=True,
+        )
+        try:
+            yield proc
+        except BaseException:
+            proc.kill()
+            proc.wait()
+            raise
+        finally:
+            for fp in (proc.stdin, proc.stdout):
+                if fp is not None:
+                    fp.close()
+        proc.wait()
+        errfp.seek(0)
+        stderr = errfp.read().decode("utf-8", errors="replace")
+    _log.info("returncode=%s, stderr=%s", proc.returncode, repr(stderr))
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd, stderr=stderr)
@@ -0,0 +1,195 @@
+import time
+import uuid
+import threading
+from collections import defaultdict
+from subprocess import SubprocessError
+from logging import getLogger
+from .config import config, WarmPoolSpec
+from .lvm2 import LV, runparse_report, mkfs_cmd
+from .util import runcmd
+from .exceptions import InvalidArgument
+from .metrics import registry
+
+_log = getLogger(__name__)
+# serialize claim and trim, so that a spare is never claimed and removed at once
+_lock = threading.Lock()
+# refill soon after a claim
+wakeup = threading.Event()
+
+depth = registry.gauge("volexp_warm_pool_depth", "Number of spare volumes in warm pool", ["size", "filesystem"])
+claims = registry.counter("volexp_warm_pool_claims_total", "Volume creations by warm pool", ["result"])
+refills = registry.counter("volexp_warm_pool_refill_total", "Number of spare volume creations", ["result"])
+refill_seconds = registry.histogram(
+    "volexp_warm_pool_refill_seconds", "Time to create and format a spare volume", buckets=[1, 5, 10, 30, 60, 300, 600]
+)
+
+
+def _fsname(filesystem: str | None) -> str:
+    return filesystem or "raw"
+
+
+def classtag(spec: WarmPoolSpec) -> str:
+    """LV tag of spare volumes of the size class"""
+    return f"{LV.warm_tag}.{spec.size}.{_fsname(spec.filesystem)}"
+
+
+def _fits(spec: WarmPoolSpec, size: int) -> bool:
+    # raw spares shrink to the size, a filesystem does not
+    return spec.size >= size if spec.filesystem is None else spec.size == size
+
+
+def match(size: int, filesystem: str | None) -> WarmPoolSpec | None:
+    """Smallest size class serving the request"""
+    specs = [x for x in config.WARM_POOL if x.count > 0 and x.filesystem == filesystem and _fits(x, size)]
+    return min(specs, key=lambda x: x.size, default=None)
+
+
+def spares(vgname: str, tag: str = LV.warm_tag) -> list[dict]:
+    return runparse_report(mode="lv", filter=f"vg_name={vgname} && tags={tag}")
+
+
+def claim(vgname: str, name: str, size: int, filesystem: str | None) -> dict | None:
+    """Take a spare volume as the volume by retagging, None if no spare"""
+    if not config.WARM_POOL:
+        return None
+    spec = match(size, filesystem)
+    if spec is None:
+        claims.inc(result="miss")
+        return None
+    tag = classtag(spec)
+    lv = LV(vgname, name)
+    if lv.get() is not None:
+        raise InvalidArgument(f"volume already exists: {name}")
+    with _lock:
+        ents = spares(vgname, tag)
+        if not ents:
+            _log.info("no spare volume: size=%s, filesystem=%s", spec.size, spec.filesystem)
+            claims.inc(result="miss")
+            wakeup.set()
+            return None
+        ent = ents[0]
+        runcmd(
+            [
+                "lvchange",
+                "--deltag",
+                tag,
+                "--deltag",
+                LV.warm_tag,
+                "--addtag",
+                lv.tagname,
+                f"{vgname}/{ent['lv_name']}",
+            ]
+        )
+        depth.set(len(ents) - 1, size=str(spec.size), filesystem=_fsname(spec.filesystem))
+    _log.info("spare volume claimed: %s -> %s", ent["lv_name"], name)
+    if spec.size != size:
+        try:
+            lv.resize(size)
+        except BaseException:
+            lv.delete()
+            raise
+    claims.inc(result="hit")
+    wakeup.set()
+    return lv.volume_read()
+
+
+def _create_spare(vgname: str, spec: WarmPoolSpec):
+    name = str(uuid.uuid4())
+    if config.LVM_THINPOOL:
+        cmd = ["lvcreate", "--thin", "--virtualsize", f"{spec.size}b", "--name", name]
+        cmd.extend(["--addtag", LV.warm_tag, f"{vgname}/{config.LVM_THINPOOL}"])
+    else:
+        cmd = ["lvcreate", "--size", f"{spec.size}b", vgname, "--name", name, "--addtag", LV.warm_tag]
+    runcmd(cmd)
+    try:
+        if spec.filesystem:
+            runcmd([*mkfs_cmd(spec.filesystem), f"/dev/{vgname}/{name}"])
+        # claimable from now on
+        runcmd(["lvchange", "--addtag", classtag(spec), f"{vgname}/{name}"])
+    except BaseException:
+        runcmd(["lvremove", f"{vgname}/{name}", "--yes"])
+        raise
+
+
+class WarmPool:
+    """Keep spare volumes created and formatted, refill after claims"""
+
+    def __init__(self, vgname: str, poll: float):
+        self.vgname = vgname
+        self.poll = poll
+        self.last_error: str | None = None
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name="volexp-warmpool", daemon=True)
+        self._thread.start()
+        _log.info("warm pool started: poll=%s, spec=%s", self.poll, config.WARM_POOL)
+
+    def stop(self):
+        self._stop.set()
+        wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _trim(self, specs: dict[str, WarmPoolSpec]) -> dict[str, int]:
+        """Remove unclaimable or excess spares, returns number of spares per class tag"""
+        with _lock:
+            byclass: dict[str | None, list[dict]] = defaultdict(list)
+            for ent in spares(self.vgname):
+                tags = ent["lv_tags"].split(",")
+                byclass[next((x for x in tags if x.startswith(LV.warm_tag + ".")), None)].append(ent)
+            for tag, ents in byclass.items():
+                keep = specs[tag].count if tag in specs else 0
+                for ent in ents[keep:]:
+                    # half-made by crash (no class tag), removed class or decreased count
+                    _log.info("remove spare volume: %s, class=%s", ent["lv_name"], tag)
+                    runcmd(["lvremove", f"{self.vgname}/{ent['lv_name']}", "--yes"])
+            return {tag: min(len(byclass.get(tag, [])), spec.count) for tag, spec in specs.items()}
+
+    def run_once(self) -> int:
+        """Trim and refill spares, returns number of created"""
+        specs = {classtag(x): x for x in config.WARM_POOL}
+        counts = self._trim(specs)
+        created = 0
+        for tag, spec in specs.items():
+            labels = dict(size=str(spec.size), filesystem=_fsname(spec.filesystem))
+            depth.set(counts[tag], **labels)
+            for _ in range(spec.count - counts[tag]):
+                if self._stop.is_set():
+                    return created
+                start = time.perf_counter()
+                try:
+                    _create_spare(self.vgname, spec)
+                except (SubprocessError, OSError, NotImplementedError) as e:
+                    _log.warning("failed to create spare volume: %s", tag, exc_info=e)
+                    self.last_error = f"{type(e).__qualname__}: {e}"
+                    refills.inc(result="error")
+                    break
+                refill_seconds.observe(time.perf_counter() - start)
+                refills.inc(result="ok")
+                created += 1
+                counts[tag] += 1
+                depth.set(counts[tag], **labels)
+        return created
+
+    def _loop(self):
+        while not self._stop.is_set():
+            wakeup.clear()
+            try:
+                self.run_once()
+            except Exception as e:
+                _log.warning("warm pool check failed", exc_info=e)
+                self.last_error = f"{type(e).__qualname__}: {e}"
+            wakeup.wait(self.poll)
+
+
+def warm_pool() -> WarmPool | None:
+    """Warm pool from configuration, None if disabled"""
+    if not config.WARM_POOL:
+        return None
+    from .config2 import config2
+
+    return WarmPool(config2.VG, config.WARM_POOL_INTERVAL)